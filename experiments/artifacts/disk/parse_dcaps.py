@@ -9,11 +9,11 @@ import sys
 import os
 from collections import deque
 
-from lophi.capture import CaptureReader
+from lophi.capture import CaptureReaderMapped
 
 def parse_dcap(filename):
     
-    reader = CaptureReader(filename)
+    reader = CaptureReaderMapped(filename)
     
     start = None
     end = None
@@ -24,17 +24,19 @@ def parse_dcap(filename):
     window_time = deque([])
     window_sum = 0
     max_throughput = 0
-    for (ts,data) in reader:
+    # Only the headers are needed, so never touch the packet data
+    for (offset,ts,length) in reader.headers():
         
-        data_size += len(data)
+        length = int(length)
+        data_size += length
         
         # Keep track of timestamps
         if start is None:
             start = ts
         end = ts
             
-        window_sum += len(data)
-        window_data.append(len(data))
+        window_sum += length
+        window_data.append(length)
         window_time.append(ts)
         
         # Only compute with a certain number of samples
@@ -32,7 +32,8 @@ def main(options):
     # Initilize our experiment
     client = MemorySensorPhysical(options.target, 
                                       cache_timeout=0,
-                                      use_threading=True)
+                                      use_threading=(options.window_size == 0),
+                                      window_size=options.window_size)
     READ_SIZE = int(options.read_size)*85
     start_addr = options.startaddr   
         
@@ -89,6 +90,11 @@ if __name__ == "__main__":
                          default_read_size,
                     default=default_read_size, dest='read_size')
 
+    opts.add_option("-w", "--window_size", action='store', type="int",
+                    help="Number of read requests to keep in-flight. "
+                         "(Default: 0, send them all at once)",
+                    default=0, dest='window_size')
+
     opts.add_option("-o", "--output_file", action='store', type='string',
                     default="memory_speed.txt",
                     help="Name of output file for results.")
@@ -11,7 +11,6 @@ import multiprocessing
 import os
 import pprint
 import shutil
-import subprocess
 import tempfile
 import logging
 logger = logging.getLogger(__name__)
@@ -19,11 +18,15 @@ logger = logging.getLogger(__name__)
 
 # LO-PHI
 import lophi.globals as G
-from lophi.capture import CaptureReader
+from lophi.capture import CaptureReader, CaptureReaderMapped
+from lophi.capture.compression import is_compressed
+from lophi.capture.indexed import CaptureReaderIndexed, disk_packet_sectors
 from lophi.data import DiskSensorPacket
-from lophi_semanticgap.disk.sata import SATAInterpreter
+from lophi_semanticgap.disk.sata import SATAInterpreter, get_sector_range
 from lophi_semanticgap.disk.sata_reconstructor import SATAReconstructor
+from lophi_semanticgap.disk.sata_parallel import reconstruct_parallel
 from lophi_semanticgap.disk.filesystems import SemanticEngineDisk
+from lophi_semanticgap.disk.fs_cache import FilesystemCache
 # DB
 import lophi_automation.database.datastore as datastore
 
@@ -41,20 +44,31 @@ class DiskAnalysis(object):
     machines and compare the two
     """
 
-    def __init__(self, dcap_url, machine_type, disk_image_url, output_dir):
+    def __init__(self, dcap_url, machine_type, disk_image_url, output_dir,
+                 start_time=None, end_time=None, processes=None):
         """
         :param dcap_url: path to DCAP file
         :param machine_type: machine type
         :param disk_image_url: path to base disk image
+        :param start_time: only replay records captured after this time
+        :param end_time: only replay records captured before this time
+        :param processes: number of processes used to reassemble SATA frames
+        (default: one per CPU, 1 to reassemble serially)
         """
 
         self.dcap_url = dcap_url
         self.machine_type = machine_type
         self.disk_img = disk_image_url
 
+        # time window to replay (uses the dcap index)
+        self.start_time = start_time
+        self.end_time = end_time
+
         # working dir
         self.output_dir = output_dir
 
+        self.processes = processes
+
 
     def run(self):
         # replay SATA
@@ -67,45 +81,46 @@ class DiskAnalysis(object):
         return disk_dict
 
 
-    def replay(self):
+    def _disk_packets(self):
         """
-        Replays the raw log of SATA frames (captured as LOPHIPackets),
-        bridges the semantic gap and returns human-readable text form
+        Generator of the disk accesses in our dcap (as DiskSensorPackets), in
+        the order that they happened
         """
-
-        # copy our disk image to a temporary working image
-        self.working_disk_img = os.path.join(self.output_dir, "disk.img.tmp")
-        logger.debug("* Creating temporary working image from disk scan. (%s)" % self.working_disk_img)
-
-        # Delete, copy, chmod new file
-
-        try:
-            os.unlink(self.working_disk_img)
-        except OSError:
-            pass
-        
-        cmd = "cp --sparse=always %s %s" % (self.disk_img, self.working_disk_img)
-        subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
-        os.chmod(self.working_disk_img, 0755)
-        
-        # Set up our semantic bridge
-        logger.debug("* Parsing disk image %s into our semantic engine... (This may take a while)" % self.working_disk_img)
-        semantic_engine = SemanticEngineDisk(self.working_disk_img)
-
-        # Start processing our dcap
-        logger.debug("* Processing dcap file %s..." % self.dcap_url)
-        # SATA Interpreter
-        sata = SATAInterpreter()
         """
             @TODO Extract sector size from PyTSK
         """
-        sata_reconstructor = SATAReconstructor(sector_size=G.SENSOR_DISK.DEFAULT_SECTOR_SIZE)
+        sector_size = G.SENSOR_DISK.DEFAULT_SECTOR_SIZE
+
+        windowed = self.start_time is not None or self.end_time is not None
+
+        # Reassemble whole physical captures on all of our cores
+        if (self.machine_type == G.MACHINE_TYPES.PHYSICAL and
+                self.processes != 1 and
+                not windowed and
+                not is_compressed(self.dcap_url)):
+            for dsp in reconstruct_parallel(self.dcap_url,
+                                            sector_size=sector_size,
+                                            processes=self.processes):
+                yield dsp
+            return
 
-        # read from the cap file
-        reader = CaptureReader(self.dcap_url)
+        # SATA Interpreter
+        sata = SATAInterpreter()
+        sata_reconstructor = SATAReconstructor(sector_size=sector_size)
 
-        # output
-        output_log = []
+        # read from the cap file
+        if windowed:
+            if self.machine_type == G.MACHINE_TYPES.PHYSICAL:
+                sector_fn = get_sector_range
+            else:
+                sector_fn = disk_packet_sectors
+            reader = CaptureReaderIndexed(self.dcap_url, sector_fn).read_time(
+                                                            self.start_time,
+                                                            self.end_time)
+        elif is_compressed(self.dcap_url):
+            reader = CaptureReader(self.dcap_url)
+        else:
+            reader = CaptureReaderMapped(self.dcap_url)
 
         # Loop over all of the dcap contents
         for (timestamp, data) in reader:
@@ -127,27 +142,49 @@ class DiskAnalysis(object):
                 # logger.debug(DiskSensorPacket(data))
                 disk_sensor_pkts = [DiskSensorPacket(data)]
 
-            # Process all of our disk packets
             if disk_sensor_pkts:
                 for dsp in disk_sensor_pkts:
-                    # Skip empty packets
-                    if not dsp:
-                        continue
+                    yield dsp
+
 
-                    try:
-                        fs_operations = semantic_engine.get_access(dsp.sector,
-                                                                   dsp.num_sectors,
-                                                                   dsp.disk_operation,
-                                                                   dsp.data)
-                        if fs_operations == None:
-                            logger.error("Got an operation to sector %s that is outside our disk." % dsp.sector)
-                            continue
+    def replay(self):
+        """
+        Replays the raw log of SATA frames (captured as LOPHIPackets),
+        bridges the semantic gap and returns human-readable text form
+        """
+
+        # Writes are kept in a copy-on-write overlay (See Shadow_Img_Info), 
+        # so we can parse our disk scan directly
+        logger.debug("* Parsing disk image %s into our semantic engine... (This may take a while)" % self.disk_img)
+        semantic_engine = SemanticEngineDisk(self.disk_img,
+                                    cache=FilesystemCache(self.disk_img))
+
+        # Start processing our dcap
+        logger.debug("* Processing dcap file %s..." % self.dcap_url)
+
+        # output
+        output_log = []
+
+        # Process all of our disk packets
+        for dsp in self._disk_packets():
+            # Skip empty packets
+            if not dsp:
+                continue
+
+            try:
+                fs_operations = semantic_engine.get_access(dsp.sector,
+                                                           dsp.num_sectors,
+                                                           dsp.disk_operation,
+                                                           dsp.data)
+                if fs_operations == None:
+                    logger.error("Got an operation to sector %s that is outside our disk." % dsp.sector)
+                    continue
 
-                        for op in fs_operations:
-                            output_log.append(op)
+                for op in fs_operations:
+                    output_log.append(op)
 
-                    except:
-                        logging.exception("Encountered error while trying to bridge semantic gap for this disk access.")
+            except:
+                logging.exception("Encountered error while trying to bridge semantic gap for this disk access.")
 
         # return value
         fs_dict = {}
@@ -298,7 +335,11 @@ def main(args):
         args.disk_img):
 
         logger.info("Analyzing locally stored dcap file %s" % args.dcap_url)
-        fs_dict = DiskAnalysis(args.dcap_url, args.machine_type, args.disk_img).run()
+        fs_dict = DiskAnalysis(args.dcap_url, args.machine_type, args.disk_img,
+                               tempfile.mkdtemp(),
+                               start_time=args.start_time,
+                               end_time=args.end_time,
+                               processes=args.processes).run()
 
         pprint.pprint(fs_dict)
 
@@ -334,6 +375,13 @@ if __name__=="__main__":
                         help="Machine type for dcap file 1 : Phys -> 0; KVM -> 2")
     parser.add_argument("--diskimg", action='store', dest='disk_img',
                         help="Local copy of base disk image for analysis")
+    parser.add_argument("--start", action='store', type=float, dest='start_time',
+                        help="Only replay disk activity after this time (seconds since epoch)")
+    parser.add_argument("--end", action='store', type=float, dest='end_time',
+                        help="Only replay disk activity before this time (seconds since epoch)")
+    parser.add_argument("-p", "--processes", action='store', type=int,
+                        dest='processes', default=None,
+                        help="Number of processes used to reassemble SATA frames (Default: one per CPU)")
     parser.add_argument("-u", "--db_host", action='store', dest='db_host',
                         default="lophi-dev",
                         help="Database host")
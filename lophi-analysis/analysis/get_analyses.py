@@ -10,8 +10,6 @@
 # Native
 import argparse
 import os
-import shutil
-import tarfile
 import logging
 import sys
 
@@ -21,6 +19,8 @@ logger = logging.getLogger(__name__)
 import lophi.globals as G
 import lophi_automation.database.datastore as datastore
 from lophi_automation.database.mongodb_al import MongoDb
+from lophi_analysis.memory_dumps import unpack_memory_dump, \
+    rebuild_memory_dump
 
 
 
@@ -98,39 +98,13 @@ def main(args):
             screenshot2+'.png')
 
         # unpack memory snapshots
-        if tarfile.is_tarfile(clean_url):
-            logger.debug("Unpacking %s" % clean_url)
-            clean_path_out = os.path.join(outdir_path, "sut_memory_clean.mfd")
-            clean_tar = tarfile.open(clean_url)
-            clean_tar.extractall(outdir_path)
-            clean_tar.close()
-
-            # find stupid path
-            p = os.path.join(outdir_path, 'lophi', 'tmp')
-            p = os.path.join(p, os.listdir(p)[0])
-            p = os.path.join(p, os.listdir(p)[0])
-
-            logger.debug("Moving %s to %s" % (p, clean_path_out))
-            shutil.move(p, clean_path_out)
-            p = os.path.join(outdir_path, 'lophi')
-            shutil.rmtree(p)
-
-        if tarfile.is_tarfile(dirty_url):
-            logger.debug("Unpacking %s" % dirty_url)
-            dirty_path_out = os.path.join(outdir_path, "sut_memory_dirty.mfd")
-            dirty_tar = tarfile.open(dirty_url)
-            dirty_tar.extractall(outdir_path)
-            dirty_tar.close()
-
-            # find stupid path
-            p = os.path.join(outdir_path, 'lophi', 'tmp')
-            p = os.path.join(p, os.listdir(p)[0])
-            p = os.path.join(p, os.listdir(p)[0])
-
-            logger.debug("Moving %s to %s" % (p, dirty_path_out))
-            shutil.move(p, dirty_path_out)
-            p = os.path.join(outdir_path, 'lophi')
-            shutil.rmtree(p)
+        clean_path_out = os.path.join(outdir_path, "sut_memory_clean.mfd")
+        dirty_path_out = os.path.join(outdir_path, "sut_memory_dirty.mfd")
+        
+        unpack_memory_dump(clean_url, clean_path_out, outdir_path)
+
+        if unpack_memory_dump(dirty_url, dirty_path_out, outdir_path):
+            rebuild_memory_dump(dirty_path_out, clean_path_out)
 
 
 
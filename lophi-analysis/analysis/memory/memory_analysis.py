@@ -15,7 +15,6 @@ import multiprocessing
 import os
 import pprint
 import shutil
-import tarfile
 import tempfile
 import time
 import logging
@@ -27,6 +26,8 @@ import lophi_automation.database.utils as utils
 import lophi_automation.database.documents as documents
 import lophi_automation.database.datastore as datastore
 from lophi_semanticgap.memory.volatility_extensions import VolatilityWrapper
+from lophi_analysis.memory_dumps import unpack_memory_dump, \
+    rebuild_memory_dump
 
 # specifically for Win7
 PLUGINS_TO_USE = [
@@ -489,42 +490,19 @@ def memory_analyze_from_db(analysis_id, db_uri):
         logger.debug("Downloading dirty memory dump to %s" % dirty_url)
         files_datastore.download_file(dirty_memory_dump_id, dirty_url)
 
+        # unpack memory snapshots (compressed images are used as is)
         clean_path_out = os.path.join(outdir_path, "sut_memory_clean.mfd")
-        # unpack memory snapshots
-        if tarfile.is_tarfile(clean_url):
-            logger.debug("Unpacking %s" % clean_url)
-
-            clean_tar = tarfile.open(clean_url)
-            clean_tar.extractall(outdir_path)
-            clean_tar.close()
-
-            # find stupid path
-            p = os.path.join(outdir_path, 'lophi', 'tmp')
-            p = os.path.join(p, os.listdir(p)[0])
-            p = os.path.join(p, os.listdir(p)[0])
-
-            logger.debug("Moving %s to %s" % (p, clean_path_out))
-            shutil.move(p, clean_path_out)
-            p = os.path.join(outdir_path, 'lophi')
-            shutil.rmtree(p)
+        unpack_memory_dump(clean_url, clean_path_out, outdir_path)
 
+        # Differential dumps are rebuilt from the clean dump before Volatility
+        # ever sees them
         dirty_path_out = os.path.join(outdir_path, "sut_memory_dirty.mfd")
-        if tarfile.is_tarfile(dirty_url):
-            logger.debug("Unpacking %s" % dirty_url)
-
-            dirty_tar = tarfile.open(dirty_url)
-            dirty_tar.extractall(outdir_path)
-            dirty_tar.close()
-
-            # find stupid path
-            p = os.path.join(outdir_path, 'lophi', 'tmp')
-            p = os.path.join(p, os.listdir(p)[0])
-            p = os.path.join(p, os.listdir(p)[0])
-
-            logger.debug("Moving %s to %s" % (p, dirty_path_out))
-            shutil.move(p, dirty_path_out)
-            p = os.path.join(outdir_path, 'lophi')
-            shutil.rmtree(p)
+        if unpack_memory_dump(dirty_url, dirty_path_out, outdir_path) and \
+                not rebuild_memory_dump(dirty_path_out, clean_path_out):
+            logger.error("Could not rebuild dirty memory dump for %s" % 
+                         analysis_id)
+            shutil.rmtree(outdir_path)
+            return
 
         # run the analysis
         logger.info("Running memory analysis on %s" % analysis_id)
@@ -0,0 +1,80 @@
+"""
+    Unpack the memory dumps that an analysis stored in our database
+
+    (c) 2015 Massachusetts Institute of Technology
+"""
+# Native
+import os
+import shutil
+import tarfile
+import logging
+logger = logging.getLogger(__name__)
+
+# LO-PHI
+from lophi.capture.compressed_dump import is_compressed_dump
+from lophi.capture.memory_delta import MemorySnapshot, is_delta
+
+
+def unpack_memory_dump(url, path_out, outdir_path):
+    """
+        Unpack a downloaded memory dump
+
+        Compressed images (See lophi.capture.compressed_dump) can be read as
+        is (by Volatility and LO-PHI), anything else was stored tar-gzipped.
+
+        @param url: Filename of the downloaded dump
+        @param path_out: Filename to unpack the dump to
+        @param outdir_path: Directory to extract the archive in
+        @return: True/False
+    """
+    if is_compressed_dump(url):
+        logger.debug("Moving %s to %s" % (url, path_out))
+        shutil.move(url, path_out)
+        return True
+
+    if not tarfile.is_tarfile(url):
+        logger.error("Unknown memory dump format. (%s)" % url)
+        return False
+
+    logger.debug("Unpacking %s" % url)
+    tar = tarfile.open(url)
+    tar.extractall(outdir_path)
+    tar.close()
+
+    # find stupid path
+    p = os.path.join(outdir_path, 'lophi', 'tmp')
+    p = os.path.join(p, os.listdir(p)[0])
+    p = os.path.join(p, os.listdir(p)[0])
+
+    logger.debug("Moving %s to %s" % (p, path_out))
+    shutil.move(p, path_out)
+    p = os.path.join(outdir_path, 'lophi')
+    shutil.rmtree(p)
+    return True
+
+
+def rebuild_memory_dump(path, base_path):
+    """
+        Rebuild a full memory dump in place, if it is a differential dump
+        (See lophi.capture.memory_delta)
+
+        @param path: Filename of the unpacked dump
+        @param base_path: Filename of the full dump it was made against
+        @return: True/False
+    """
+    # Differential dumps only contain the pages that changed
+    if not is_delta(path):
+        return True
+
+    logger.debug("Rebuilding %s from %s" % (path, base_path))
+    delta_path = path + "d"
+    shutil.move(path, delta_path)
+    try:
+        snapshot = MemorySnapshot(base_path, delta_path)
+        snapshot.save(path)
+        snapshot.close()
+    except (IOError, ValueError), e:
+        logger.error("Could not rebuild %s. (%s)" % (path, e))
+        return False
+    os.remove(delta_path)
+    return True
@@ -17,6 +17,7 @@ logger = logging.getLogger(__name__)
 import lophi.globals as G
 from lophi.capture import CaptureWriter
 from lophi.capture.network import PcapWriter
+from lophi.capture.memory_delta import MemorySnapshot
 
 # LO-PHI Automation
 from lophi_automation.analysis_scripts import LophiAnalysis
@@ -51,6 +52,17 @@ class MalwareAnalysis(LophiAnalysis):
     # Time to wait for OS to stabilize after boot
     OS_BOOT_WAIT = 60
     
+    # Only store the pages that changed since the clean dump in later dumps
+    DIFFERENTIAL_DUMPS = False
+    
+    # Number of concurrent streams to dump full memory images with
+    MEMORY_DUMP_STREAMS = 4
+    
+    # Compress memory images as they are dumped (E.g. "zlib"), instead of 
+    # tar-gzipping them afterwards.  Requires the LO-PHI compressed address 
+    # space in Volatility.
+    MEMORY_DUMP_COMPRESSION = None
+    
     def compress_file(self, input_name, output_name):
         """
             Simple function to to compress a file
@@ -222,9 +234,13 @@ class MalwareAnalysis(LophiAnalysis):
             # Dump our memory
             print "* %s: Timestamp: %f"%(self.machine.config.name,time.time())
             print "* %s: Dumping memory (Clean)..."%self.machine.config.name
+            compression = self.MEMORY_DUMP_COMPRESSION
             memory_file_clean = os.path.join(tmp_dir,"sut_memory_clean.mfd")
             cleandump_start = time.time()
-            if not machine.memory_dump(memory_file_clean):
+            if not machine.memory_dump(memory_file_clean,
+                                       save_hashes=self.DIFFERENTIAL_DUMPS,
+                                       streams=self.MEMORY_DUMP_STREAMS,
+                                       compression=compression):
                 # Stop everything, and start over.
                 dcap_writer.stop()
                 disk_tap.stop()
@@ -239,14 +255,27 @@ class MalwareAnalysis(LophiAnalysis):
             memory_file_clean_gz = os.path.join(tmp_dir,
                                                 "sut_memory_clean.tar.gz")
             memory_file_clean_tmp = memory_file_clean+".tmp"
+            memory_file_base = memory_file_clean+".base"
             
-            shutil.copy(memory_file_clean, memory_file_clean_tmp)
+            if compression is not None:
+                # Already compressed, and never written over, so we can just 
+                # link to it
+                memory_file_clean_gz = memory_file_clean
+                memory_file_base = memory_file_clean
+                os.link(memory_file_clean, memory_file_clean_tmp)
+                memory_clean_compress = None
+            else:
+                shutil.copy(memory_file_clean, memory_file_clean_tmp)
                 
-            memory_clean_compress = multiprocessing.Process(
+                # Keep a pristine copy to rebuild our later dumps from
+                if self.DIFFERENTIAL_DUMPS:
+                    shutil.copy(memory_file_clean, memory_file_base)
+                    
+                memory_clean_compress = multiprocessing.Process(
                                                     target=self.compress_file, 
                                                     args=(memory_file_clean,
                                                           memory_file_clean_gz))
-            memory_clean_compress.start()
+                memory_clean_compress.start()
 
             timestamps.append((0, 0)) # Place holder for mem compression
 
@@ -307,7 +336,30 @@ class MalwareAnalysis(LophiAnalysis):
                 print "* %s: Dumping memory (Interim)..." % \
                       self.machine.config.name
                 interimdump_start = time.time()
-                if not machine.memory_dump(memory_file_clean_tmp):
+                
+                # Never write through the link to our clean dump
+                if compression is not None:
+                    os.remove(memory_file_clean_tmp)
+                    
+                if self.DIFFERENTIAL_DUMPS:
+                    memory_file_interim = os.path.join(tmp_dir,
+                                                "sut_memory_interim.mfdd")
+                    if not machine.memory_dump(memory_file_interim,
+                                               base=memory_file_clean):
+                        raise Exception("Bad memory read.")
+                    snapshot = MemorySnapshot(memory_file_base,
+                                              memory_file_interim)
+                    if compression is not None:
+                        snapshot.save(memory_file_clean_tmp, compression)
+                    else:
+                        # Our tmp file is still clean, just update what 
+                        # changed
+                        snapshot.apply(memory_file_clean_tmp)
+                    snapshot.close()
+                    os.remove(memory_file_interim)
+                elif not machine.memory_dump(memory_file_clean_tmp,
+                                        streams=self.MEMORY_DUMP_STREAMS,
+                                        compression=compression):
                     raise Exception("Bad memory read.")
                 interimdump_stop = time.time()
                 timestamps.append((interimdump_start,interimdump_stop))
@@ -387,8 +439,22 @@ class MalwareAnalysis(LophiAnalysis):
             print "* %s: Timestamp: %f"%(self.machine.config.name,time.time())
             print "* %s: Dumping memory..."%self.machine.config.name
             memory_file_dirty = os.path.join(tmp_dir,"sut_memory_dirty.mfd")
+            memory_file_dirty_delta = memory_file_dirty+"d"
             dirtydump_start = time.time()
-            if not machine.memory_dump(memory_file_dirty):
+            if self.DIFFERENTIAL_DUMPS:
+                dirtydump_ok = machine.memory_dump(memory_file_dirty_delta,
+                                                   base=memory_file_clean)
+                if dirtydump_ok:
+                    # Rebuild the full dump for our screenshot
+                    snapshot = MemorySnapshot(memory_file_base,
+                                              memory_file_dirty_delta)
+                    snapshot.save(memory_file_dirty, compression)
+                    snapshot.close()
+            else:
+                dirtydump_ok = machine.memory_dump(memory_file_dirty,
+                                        streams=self.MEMORY_DUMP_STREAMS,
+                                        compression=compression)
+            if not dirtydump_ok:
                 # Stop everything, and start over.
                 self.machine.control.mouse_wiggle(False)
                 dcap_writer.stop()
@@ -422,14 +488,24 @@ class MalwareAnalysis(LophiAnalysis):
             timestamps.append((screenshot2_start, screenshot2_stop))
 
             # Join our clean compression
-            memory_clean_compress.join()
-            memory_clean_compress.terminate()
+            if memory_clean_compress is not None:
+                memory_clean_compress.join()
+                memory_clean_compress.terminate()
              
             # Compress dirty file
             dirtycompress_start = time.time()
             memory_file_dirty_gz = os.path.join(tmp_dir,
                                                 "sut_memory_dirty.tar.gz")
-            self.compress_file(memory_file_dirty, memory_file_dirty_gz)
+            if self.DIFFERENTIAL_DUMPS:
+                # Only store the pages that changed, readers rebuild the rest
+                # from the clean dump
+                self.compress_file(memory_file_dirty_delta,
+                                   memory_file_dirty_gz)
+            elif compression is not None:
+                # Already compressed
+                memory_file_dirty_gz = memory_file_dirty
+            else:
+                self.compress_file(memory_file_dirty, memory_file_dirty_gz)
             dirtycompress_stop = time.time()
             timestamps.append((dirtycompress_start, dirtycompress_stop))
 
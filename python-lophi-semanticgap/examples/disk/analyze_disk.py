@@ -12,7 +12,6 @@ import sys
 import argparse
 import time
 import multiprocessing
-import subprocess
 import logging
 logger = logging.getLogger(__name__)
 
@@ -69,22 +68,15 @@ class Analyze(multiprocessing.Process):
             semantic output.
         """
 
-        # copy our disk image to a temporary working image
+        # Writes are kept in a copy-on-write overlay, our disk scan is never
+        # modified
         self.working_disk_img = os.path.join(self.output_dir, "disk.img.tmp")
-        print "* Creating temporary working image from disk scan. (%s)"%self.working_disk_img
-        
-        # Delete, copy, chmod new file
-        try:
-            os.unlink(self.working_disk_img)
-        except:
-            pass
-        cmd = "cp --sparse=always %s %s" % (self.disk_img, self.working_disk_img)
-        subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
-        os.chmod(self.working_disk_img, 0755)
+        print "* Keeping writes in a temporary overlay. (%s)"%self.working_disk_img
 
         # Set up our semantic bridge
-        print "* Parsing disk image %s into our semantic engine... (This may take a while)" % self.working_disk_img
-        semantic_engine = SemanticEngineDisk(self.working_disk_img)
+        print "* Parsing disk image %s into our semantic engine... (This may take a while)" % self.disk_img
+        semantic_engine = SemanticEngineDisk(self.disk_img,
+                                             overlay_url=self.working_disk_img)
   
         # Start processing our dcap
         print "* Processing dcap file %s..." % self.dcap_filename
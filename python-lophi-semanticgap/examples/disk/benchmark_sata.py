@@ -0,0 +1,140 @@
+#!/usr/bin/python
+"""
+    Benchmark for decoding and reconstructing the SATA frames in a recorded
+    dcap (i.e. the innermost loop of disk analysis)
+
+    (c) 2015 Massachusetts Institute of Technology
+"""
+
+# Native
+import sys
+import time
+import argparse
+import logging
+logger = logging.getLogger(__name__)
+
+# LOPHI
+import lophi.globals as G
+from lophi.capture import CaptureReader
+from lophi_semanticgap.disk.sata import SATAInterpreter
+from lophi_semanticgap.disk.sata_reconstructor import SATAReconstructor, \
+    PhysicalPacket
+
+
+def load_frames(filename, max_frames=None):
+    """
+        Read the frames of our capture into memory, so that we only time
+        decoding them
+
+        @param filename: Filename of the dcap
+        @param max_frames: Maximum number of frames to read (Default: All)
+        @return: List of raw SATA frames
+    """
+    frames = []
+    reader = CaptureReader(filename)
+    for (timestamp, data) in reader:
+        frames.append(data)
+        if max_frames is not None and len(frames) >= max_frames:
+            break
+    return frames
+
+
+def time_decode(frames, flip_data):
+    """
+        Decode every frame
+
+        @return: Seconds elapsed
+    """
+    sata = SATAInterpreter()
+
+    time_start = time.time()
+    for frame in frames:
+        sata.extract_sata_data(frame, flip_data)
+    return time.time() - time_start
+
+
+def time_reconstruct(frames, sector_size):
+    """
+        Decode every frame and feed it through a SATAReconstructor
+
+        @return: (Seconds elapsed, number of disk sensor packets)
+    """
+    sata = SATAInterpreter()
+    sata_reconstructor = SATAReconstructor(sector_size=sector_size)
+
+    disk_packets = 0
+    time_start = time.time()
+    for frame in frames:
+        extracted = sata.extract_sata_data(frame)
+        if extracted is None or extracted[1] is None:
+            continue
+
+        disk_sensor_pkts = sata_reconstructor.process_packet(
+                                    PhysicalPacket(extracted[0], extracted[1]))
+        if disk_sensor_pkts:
+            disk_packets += len(disk_sensor_pkts)
+
+    return (time.time() - time_start, disk_packets)
+
+
+def report(name, frame_count, elapsed):
+    """ Print the rate for one of our runs """
+    rate = frame_count / elapsed if elapsed > 0 else 0
+    print "%-28s %10d frames  %8.3f sec  %12.1f frames/sec" % (name,
+                                                               frame_count,
+                                                               elapsed,
+                                                               rate)
+
+
+def main(args):
+
+    logger.info("Loading frames from %s..." % args.dcap_file)
+    frames = load_frames(args.dcap_file, args.max_frames)
+    if len(frames) == 0:
+        logger.error("No frames found in %s." % args.dcap_file)
+        sys.exit(1)
+
+    for run in range(args.runs):
+        print "Run %d:" % (run + 1)
+        report("Decode (headers only)", len(frames),
+               time_decode(frames, False))
+        report("Decode", len(frames), time_decode(frames, True))
+
+        (elapsed, disk_packets) = time_reconstruct(frames, args.sector_size)
+        report("Decode + reconstruct", len(frames), elapsed)
+        print "%-28s %10d disk operations" % ("", disk_packets)
+
+
+if __name__ == "__main__":
+
+    # Get our machine types
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("dcap_file", action="store", type=str, default=None,
+                        help="Recorded physical SATA capture (dcap).")
+
+    parser.add_argument("-n", "--max_frames", action="store", type=int,
+                        default=None,
+                        help="Maximum number of frames to use. (Default: All)")
+
+    parser.add_argument("-r", "--runs", action="store", type=int, default=3,
+                        help="Number of times to repeat the benchmark. "
+                             "(Default: 3)")
+
+    parser.add_argument("-s", "--sector_size", action="store", type=int,
+                        default=G.SENSOR_DISK.DEFAULT_SECTOR_SIZE,
+                        help="Sector size of the disk. (Default: %d)" %
+                             G.SENSOR_DISK.DEFAULT_SECTOR_SIZE)
+
+    parser.add_argument("-d", "--debug", action="store_true", default=False,
+                        help="Enable DEBUG")
+
+    args = parser.parse_args()
+
+    # Get our log level
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    main(args)
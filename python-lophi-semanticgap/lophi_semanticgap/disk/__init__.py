@@ -57,9 +57,12 @@ class DiskEngine(multiprocessing.Process):
         
         
     def __del__(self):
-        """ Cleanup our temp file """
+        """ Cleanup our temp files """
         if self.working_disk_img is not None:
-            os.unlink(self.working_disk_img)
+            for filename in (self.working_disk_img,
+                             self.working_disk_img + ".overlay"):
+                if os.path.exists(filename):
+                    os.unlink(filename)
         
         
     def _check_disk_scan(self):
@@ -219,10 +222,12 @@ class DiskEngine(multiprocessing.Process):
         from lophi_semanticgap.disk.sata import SATAInterpreter
         from lophi_semanticgap.disk.sata_reconstructor import SATAReconstructor
         from lophi_semanticgap.disk.filesystem_reconstructor import SemanticEngineDisk
+        from lophi_semanticgap.disk.fs_cache import FilesystemCache, CACHE_SUFFIX
 
         logger.debug("DiskEngine Started.")
 
         # Scan in our starting point
+        live_image = False
         if self.machine.type == G.MACHINE_TYPES.PHYSICAL:
             if not self._check_disk_scan():
                 logger.error("Analysis cannot continue without a valid scan file.")
@@ -243,19 +248,30 @@ class DiskEngine(multiprocessing.Process):
                 disk_img = self.machine.config.disk_base
             else:
                 disk_img = image_name
+                live_image = True
                 
         # Setup our tmp file
         self.working_disk_img = os.path.join(G.DIR_ROOT,G.DIR_TMP,self.machine.config.name+"-disk.img.tmp")
         
-        # Create a backup
-        logger.debug("Copying %s to %s..."%(disk_img, self.working_disk_img))
-        cmd = "cp --sparse=always %s %s" % (disk_img, self.working_disk_img)
-        subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
-        os.chmod(self.working_disk_img, 0755)
+        # Writes are kept in a copy-on-write overlay, so the image only needs
+        # to be copied if the VM is still writing to it underneath us
+        base_disk_img = disk_img
+        if live_image:
+            logger.debug("Copying %s to %s..."%(disk_img, self.working_disk_img))
+            # Keep the timestamps so that an unchanged image keeps its key
+            cmd = "cp --sparse=always --preserve=timestamps %s %s" % (disk_img, self.working_disk_img)
+            subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
+            base_disk_img = self.working_disk_img
         
         # Set up our semantic bridge
-        logger.info("Parsing disk image %s into our semantic engine... (This may take a while)" % self.working_disk_img)
-        semantic_engine = SemanticEngineDisk(self.working_disk_img)
+        logger.info("Parsing disk image %s into our semantic engine... (This may take a while)" % base_disk_img)
+        # The cache is keyed on the image that we actually parse, but kept
+        # next to the original so that it outlives our working copy
+        cache = FilesystemCache(base_disk_img, 
+                                cache_url=disk_img+CACHE_SUFFIX)
+        semantic_engine = SemanticEngineDisk(base_disk_img,
+                                        cache=cache,
+                                        overlay_url=self.working_disk_img+".overlay")
 
         # SATA Interpreter
         sata = SATAInterpreter() 
@@ -306,6 +322,11 @@ class DiskEngine(multiprocessing.Process):
                 continue
 
             if self.machine.type == G.MACHINE_TYPES.PHYSICAL:
+                # Did the sensor lose any frames before this one?
+                gap = getattr(data, "gap", None)
+                if gap is not None:
+                    sata_reconstructor.handle_gap(gap.first, gap.count)
+                    
                 lophi_packet = type('AnonClass', (object,), { "sata_header": None, "sata_data": None })                    
                 (lophi_packet.sata_header, lophi_packet.sata_data) = sata.extract_sata_data(`data`)
                 
@@ -1,10 +1,16 @@
+import bisect
+import collections
 import logging
 import struct
 
 logger = logging.getLogger(__name__)
 from lophi_semanticgap.disk.filesystems.ntfs import *
+from lophi_semanticgap.disk.filesystems.ntfs import bulk
 # LOPHI
 import lophi.globals as G
+from lophi_semanticgap.disk.overlay import ImageOverlay
+from lophi_semanticgap.disk.fs_cache import engine_name
+from lophi_semanticgap.disk.run_index import RunIndex
 
 #### ADDING FORENSIC ANALYSIS CODE ####
 # 3rd Party
@@ -20,45 +26,100 @@ logger.addHandler(hdlr)
 logger.setLevel(logging.INFO)
 
 MFT_ENTRY_SIZE = 1024 # Bytes
+
+# Deepest directory nesting that we will follow parent references through
+# before declaring a record an orphan (protects us from corrupt parent loops)
+MAX_PATH_DEPTH = 256
+
+# Number of parsed MFT entries that each volume keeps around
+META_CACHE_SIZE = 4096
+
+
+class MftEntrySnapshot:
+    """
+        Everything that we use from a TSK file entry, read once so that we 
+        don't have to go back to TSK until its MFT record is written to
+    """
+    
+    # Fields of TSK_FS_META that we diff
+    META_FIELDS = ['size', 'uid', 'gid', 
+                   'mtime', 'mtime_nano', 'atime', 'atime_nano', 
+                   'ctime', 'ctime_nano', 'crtime', 'crtime_nano',
+                   'content_len', 'seq']
+    
+    def __init__(self, tsk_file, path=None):
+        """
+            @param tsk_file: PyTSK file object
+            @param path: Full path of the file, if we know it
+        """
+        meta = tsk_file.info.meta
+        self.flags = long(str(meta.flags))
+        self.meta = dict((field, getattr(meta, field)) 
+                         for field in self.META_FIELDS)
+        
+        self.name = None
+        if tsk_file.info.name:
+            self.name = tsk_file.info.name.name
+        self.path = path
+        
+        # (block address, length) of every data run
+        self.runs = []
+        for attribute in tsk_file:
+            for run in attribute:
+                # run.addr should be the LBA
+                # TSK seems to use run.addr == 0 for sparse runs too
+                # but this can mess up $Boot, whose addr is also 0, so we have to special case it
+                if run.addr != 0 or self.name == "$Boot":
+                    self.runs.append((run.addr, run.len))
+
+
 class Write_Img_Info(pytsk3.Img_Info):
     """
-    Creates an updateable Img_Info that pushes changes to disk.
+    Creates an updateable Img_Info.  Writes land in a copy-on-write 
+    ImageOverlay, the disk image itself is never modified.
     """
-    def __init__(self, url, sector_size):
+    def __init__(self, url, sector_size, overlay=None):
+        """
+            @param url: Path to the disk image
+            @param sector_size: Size of the sectors that we are written in
+            @param overlay: ImageOverlay shared with other volumes on the 
+            same disk (Default: create our own, in memory)
+        """
         self.URL = url
         self.SECTOR_SIZE = sector_size
         
         ## Open the image
-        self.fd = open(url, 'r+b')
-        if not self.fd:
-            raise IOError("Unable to open %s" % url)
+        self.own_overlay = overlay is None
+        if overlay is None:
+            overlay = ImageOverlay(url)
+        self.OVERLAY = overlay
 
         ## Call the base class with an empty URL
         pytsk3.Img_Info.__init__(self, '')
 
     def get_size(self):
         """ This function returns the size of the image """
-        return os.path.getsize(self.URL)
+        return self.OVERLAY.size
 
     def read(self, off, length):
         """
         This returns byte ranges from the image, using the image
         """
-        
-        self.fd.seek(off)
-        return self.fd.read(length)
+        return self.OVERLAY.read(off, length)
         
     def write(self, sector, sector_count, data):
         """ Writes data to the img """
-        
-        off = sector*self.SECTOR_SIZE
-        self.fd.seek(off)
-        self.fd.write(data)
-
+        self.OVERLAY.write(sector*self.SECTOR_SIZE, 
+                           data[:sector_count*self.SECTOR_SIZE])
 
     def close(self):
         """ This is called when we want to close the image """
-        self.fd.close()
+        if self.own_overlay:
+            self.OVERLAY.close()
+            
+    def dump_cache(self):
+        """ Returns every sector that has been written to """
+        return self.OVERLAY.sectors(self.SECTOR_SIZE)
 
 
 class SemanticEngineDisk:
@@ -68,10 +129,19 @@ class SemanticEngineDisk:
     """
 
     
-    def __init__(self,url):
+    def __init__(self, url, cache=None, overlay_url=None):
+        """
+            @param url: Path to the disk image to parse (never modified)
+            @param cache: FilesystemCache to load our parsed volumes from, or
+            store them in if it is stale (See lophi_semanticgap.disk.fs_cache)
+            @param overlay_url: Sparse file to keep the data written to the 
+            disk in (Default: keep it in memory)
+        """
         # parse out the different volumes
         logger.info("Initializing Semantic Engine")    
         self.url = url
+        # Everything written to any volume
+        self.overlay = ImageOverlay(url, overlay_url)
         self.img = pytsk3.Img_Info(url=self.url)
         self.VOL_INFO = pytsk3.Volume_Info(self.img)
 
@@ -91,16 +161,37 @@ class SemanticEngineDisk:
         print("Parition Count: %d" % self.VOL_INFO.info.part_count)
         print("--- Volume info ---")
         '''
+        # Reuse the volumes that we parsed on a previous run
+        states = None
+        if cache is not None:
+            states = cache.load(engine_name(self))
+        stale = states is None
+        
         # Add each volume
         for vol in self.VOL_INFO:
-            self.add_volume(vol)
+            state = None
+            if states is not None:
+                state = states.get(vol.start)
+            self.add_volume(vol, state)
+
+            # Did this volume have to be parsed again?
+            sem_eng_vol = self.vol_to_se[vol]
+            if sem_eng_vol is not None and not sem_eng_vol.from_cache and \
+                    sem_eng_vol.get_state() is not None:
+                stale = True
+
+        if cache is not None and stale:
+            cache.save(self.get_state(), engine_name(self))
 
                 
-    def add_volume(self, vol):
+    def add_volume(self, vol, state=None):
         """
             Add a new volume
             
             WARNING: These must be added in sequential order!
+            
+            @param vol: TSK volume
+            @param state: Parsed state of this volume from get_state()
         """
         #print("--- Partition ---")
         #print("Start: %d" % vol.start)
@@ -119,11 +210,28 @@ class SemanticEngineDisk:
         # right now, just handle NTFS separately
         if vol.desc == 'NTFS / exFAT (0x07)' or vol.desc == 'NTFS (0x07)':
             logger.info("Creating SEV_NTFS_Sparse class from: %s" % vol.desc)
-            self.vol_to_se[vol] = SEV_NTFS_Sparse(self.img, self.VOL_INFO, vol, self.url)
+            self.vol_to_se[vol] = SEV_NTFS_Sparse(self.img, self.VOL_INFO, vol, self.url, state,
+                                                  overlay=self.overlay)
         else:
             self.vol_to_se[vol] = None
     
     
+    def get_state(self):
+        """
+            Returns dictionary of vol.start -> parsed state of that volume, 
+            for every volume that can be cached
+        """
+        ret = {}
+        for vol in self.VOLUMES:
+            sem_eng_vol = self.vol_to_se[vol]
+            if sem_eng_vol is None:
+                continue
+            state = sem_eng_vol.get_state()
+            if state is not None:
+                ret[vol.start] = state
+        return ret
+    
+    
     ### TODO Go through this        
     def _get_volume(self, sector):
         """
@@ -194,7 +302,7 @@ class SemanticEngineVolumeSparse:
         Base class for representing a semantic volume
     """
     
-    def __init__(self, img, vol_info, volume, url):
+    def __init__(self, img, vol_info, volume, url, overlay=None):
         
         self.URL = url
         self.VOL_INFO = vol_info
@@ -203,14 +311,51 @@ class SemanticEngineVolumeSparse:
         self.VOLUME_OFFSET = volume.start # Stored in SECTORS!
         self.OFFSET_BYTES = self.SECTOR_SIZE * self.VOLUME.start
 
-        #self.IMG = Shadow_Img_Info(url=url,sector_size=self.SECTOR_SIZE)
-        self.IMG = Write_Img_Info(url=url, sector_size=self.SECTOR_SIZE)
+        self.IMG = Write_Img_Info(url=url, sector_size=self.SECTOR_SIZE,
+                                  overlay=overlay)
         
         self.error_log = []
+        
+        # Was our state restored from a snapshot? (See _restore_state)
+        self.from_cache = False
  
     def get_error_log(self):
         return self.error_log
  
+    def get_state(self):
+        """
+            Returns the parsed state of this volume so that it can be restored
+            with set_state() instead of being parsed again, or None if this 
+            volume can't be cached
+        """
+        return None
+
+    def _restore_state(self, state):
+        """
+            Restore our parsed state from a snapshot, unless it was made by
+            something else (E.g. another engine or an older version)
+            
+            @param state: Parsed state of this volume from get_state()
+            @return: True/False
+        """
+        # A fresh volume tells us which keys to expect
+        expected = self.get_state()
+        if not isinstance(state, dict) or expected is None or \
+                set(state) != set(expected):
+            logger.warning("Cached state of volume at %d doesn't match, "
+                           "parsing it again." % self.VOLUME_OFFSET)
+            return False
+
+        try:
+            self.set_state(state)
+        except (TypeError, ValueError, AttributeError), e:
+            logger.warning("Could not restore cached state of volume at %d, "
+                           "parsing it again. (%s)" % (self.VOLUME_OFFSET, e))
+            return False
+
+        self.from_cache = True
+        return True
+ 
     def get_access(self, sector, sector_count, direction, data, depth=0):
         print "get_access() should be overridden!"
     
@@ -233,11 +378,16 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
         Generic class for handling types of volumes/partitions supported by pyTSK (slow but should work)
     """
 
-    def __init__(self, img, vol_info, volume, url):
+    def __init__(self, img, vol_info, volume, url, state=None, overlay=None):
         """
             Intiialize our NTFS volume
+            
+            @param state: Parsed state of this volume from get_state(), 
+            instead of parsing the file system
+            @param overlay: ImageOverlay that writes to the disk are kept in
         """
-        SemanticEngineVolumeSparse.__init__(self, img, vol_info, volume, url)
+        SemanticEngineVolumeSparse.__init__(self, img, vol_info, volume, url,
+                                            overlay)
 
         # Try to open the file system
         try:
@@ -248,14 +398,25 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
             return None
 
         
-        # inode mappings
-        self.fs_sector_to_inode = {}
+        # Runs of sectors -> inode that owns them
+        self.fs_sector_index = RunIndex()
+        # Runs added or removed since we last indexed (See _index_runs)
+        self.pending_runs = []
         self.fs_inode_to_path = {}
-        #Contains the mappings for our resident attributes
-        self.fs_inode_to_sector_resident = {}
-        #Contains the sectors that make up the MFT entries (and consqeuently the resident attributes)
+        # Directory structure, so that renames only touch the affected subtree
+        self.fs_inode_to_parent = {}
+        self.fs_parent_to_inodes = {}
         
         self.mft_raw = None
+        # Parent and name of every record in mft_raw (If NumPy is installed)
+        self.mft_columns = None
+        # Parses records out of mft_raw for incremental path resolution
+        self.mft_session = None
+        # MFT extents (See _mft_run_map), rebuilt when record 0 changes
+        self.mft_run_map = None
+        # LRU of inode -> MftEntrySnapshot, entries are dropped whenever 
+        # their MFT record is written to
+        self.meta_cache = collections.OrderedDict()
 
         # Extract useful infor about the file system
         self.ROOT_INUM = self.FILE_SYSTEM.info.root_inum
@@ -287,18 +448,46 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
         '''
         ## Step 3: Open the directory node this will open the node based on path
         ## or inode as specified.
-        self._load_file_system()
+        if state is None or not self._restore_state(state):
+            self._load_file_system()
 
         ## Testing MFT Resident Attribute sector location to inode relationship
         ## Get MFT Sector Ranges
         
 
+    def get_state(self):
+        """
+            Returns our sector index, inode mappings and parsed MFT entries so
+            that they can be restored without parsing the file system again
+        """
+        if not hasattr(self, 'fs_sector_index'):
+            return None
+        
+        return {'fs_sector_index':self.fs_sector_index,
+                'fs_inode_to_path':self.fs_inode_to_path,
+                'fs_inode_to_parent':self.fs_inode_to_parent,
+                'meta_cache':self.meta_cache.items(),
+                'error_log':self.error_log}
+        
+    def set_state(self, state):
+        """
+            Restore our inode mappings from get_state()
+        """
+        self.fs_sector_index = state['fs_sector_index']
+        self.fs_inode_to_path = state['fs_inode_to_path']
+        self.fs_inode_to_parent = {}
+        self.fs_parent_to_inodes = {}
+        for (inode, parent) in state['fs_inode_to_parent'].items():
+            self._set_parent(inode, parent)
+        self.meta_cache = collections.OrderedDict(state['meta_cache'])
+        self.error_log = state['error_log']
+
     def _get_mft_sectors(self):
         mft_sectors = []
-        for key,value in self.fs_sector_to_inode.iteritems():
-            if(value == 0 ):
-                mft_sectors.append(key)
-        return _mft_sectors
+        for (start, end, inode) in self.fs_sector_index:
+            if inode == 0:
+                mft_sectors.extend(xrange(start, end))
+        return mft_sectors
 
     def _print_mft(self):
         """
@@ -306,7 +495,7 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
         """
         root_dir = self.FILE_SYSTEM.open_dir(inode=self.ROOT_INUM)
         self.fs_inode_to_path[self.ROOT_INUM] = "/"
-        self._parse_paths(root_dir,"/")
+        self._parse_paths(root_dir, "/", self.ROOT_INUM)
         
         last_inum = self.FILE_SYSTEM.info.last_inum
         for inode_num in xrange(0, last_inum+1):
@@ -330,6 +519,8 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
         
             print output
         
+        self._index_runs()
+        
     
     def _load_file_system(self):
         """
@@ -338,9 +529,15 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
         
         #a = time.time()
         # parse the paths so we get full paths
-        root_dir = self.FILE_SYSTEM.open_dir(inode=self.ROOT_INUM)
         self.fs_inode_to_path[self.ROOT_INUM] = "/"
-        self._parse_paths(root_dir,"/")
+        if bulk.numpy_installed:
+            # Straight from the parent references in the MFT
+            self._read_mft()
+            for inode in self.mft_columns.named_records():
+                self._resolve_path(int(inode))
+        else:
+            root_dir = self.FILE_SYSTEM.open_dir(inode=self.ROOT_INUM)
+            self._parse_paths(root_dir, "/", self.ROOT_INUM)
         
         #print "Total time to process path structure: %f s" % (time.time() - a)
         logger.info("Parsing MFT Entries")
@@ -348,12 +545,17 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
         last_inum = self.FILE_SYSTEM.info.last_inum
         for inode_num in xrange(0, last_inum+1):
             self._load_file_entry(inode_num)
+        self._index_runs()
             
 
 
-    def _parse_paths(self, directory, parent_path=""):
+    def _parse_paths(self, directory, parent_path="", parent_inode=None):
         """
         Parse the full paths of our file entries
+        
+        @param directory: TSK directory to walk
+        @param parent_path: Path of the directory
+        @param parent_inode: Inode of the directory
         """
         
         for f in directory:
@@ -367,90 +569,242 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
             if f.info.meta:
                 inode = f.info.meta.addr
                 self.fs_inode_to_path[inode] = abs_filename
+                if parent_inode is not None:
+                    self._set_parent(inode, parent_inode)
                     
             if f.info.name.type == pytsk3.TSK_FS_NAME_TYPE_DIR and f.info.meta:
-                self._parse_paths(f.as_directory(), parent_path=abs_filename)
+                self._parse_paths(f.as_directory(), 
+                                  parent_path=abs_filename,
+                                  parent_inode=f.info.meta.addr)
 
 
-    def _get_path(self, raw_mft, inode):
+    def _set_parent(self, inode, parent_inode):
         """
-        Tries to parse out the path for this file given the raw MFT record
-        using mft.parse_record
+            Record which directory an inode lives in
         """
-           
-        if raw_mft is None:
-            logger.debug("get_path: Got empty raw_mft, returning None")
-            return None
-        
-        raw_mft_record = raw_mft[inode*1024:(inode+1)*1024]
+        old_parent = self.fs_inode_to_parent.get(inode)
+        if old_parent == parent_inode:
+            return
         
-        if len(raw_mft_record) < 4:
-            logger.warn("Got empty mft record for inode #%d"%inode)
-            return None
-         
-        if(len(raw_mft_record) != 1024):
-            self.fs_inode_to_path[inode] = 'NoFNRecord'
-            return self.fs_inode_to_path[inode]
+        if old_parent is not None and old_parent in self.fs_parent_to_inodes:
+            self.fs_parent_to_inodes[old_parent].discard(inode)
             
-        record = mft.parse_record(raw_mft_record, mft.set_default_options())
-        
-        if record['fncnt'] == 1:
-            record['par_ref'] = record['fn',0]['par_ref']
-            record['name'] = record['fn',0]['name']
-        if record['fncnt'] > 1:
-            record['par_ref'] = record['fn',0]['par_ref']
-            for j in (0, record['fncnt']-1):
-                if (record['fn', j]['nspace'] == 0x1 or record['fn', j]['nspace'] == 0x3):
-                    record['name'] = record['fn', j]['name']
-            if (record.get('name') == None):
-                record['name'] = record['fn', record['fncnt']-1]['name']
-        
-        if 'name' not in record:
-            self.fs_inode_to_path[inode] = 'NoFNRecord' 
-            return self.fs_inode_to_path[inode]    
+        self.fs_inode_to_parent[inode] = parent_inode
+        if parent_inode not in self.fs_parent_to_inodes:
+            self.fs_parent_to_inodes[parent_inode] = set()
+        self.fs_parent_to_inodes[parent_inode].add(inode)
+
+
+    def _read_mft(self, inodes=None):
+        """
+            Read our shadow copy of the MFT, and parse the parent and name of
+            the records that changed in bulk
             
-        filename = record['name']
+            @param inodes: MFT record numbers that changed (Default: All of 
+            them)
+        """
+        mft_file = self.FILE_SYSTEM.open_meta(inode=0)
+        self.mft_raw = mft_file.read_random(0, mft_file.info.meta.size)
+        
+        if not bulk.numpy_installed:
+            return
+        if self.mft_columns is None:
+            self.mft_columns = bulk.MftColumns(self.mft_raw)
+        else:
+            self.mft_columns.update(self.mft_raw, inodes)
+
 
-        # now go up the chain of parent pointers, if needed
+    def _parse_mft_record(self, inode):
+        """
+            Parse a single record out of our shadow copy of the MFT
+            
+            @param inode: MFT record number
+            @return: (parent inode, name) or None if the record has no 
+            $FILE_NAME attribute
+        """
+        if self.mft_raw is None or \
+                len(self.mft_raw) < (inode+1)*MFT_ENTRY_SIZE:
+            return None
+        
+        # Only torn records, and records whose $FILE_NAME was moved to 
+        # another record by an $ATTRIBUTE_LIST need the full parser
+        columns = self.mft_columns
+        if columns is not None and inode < len(columns) and \
+                not columns.torn[inode] and \
+                (columns.parent_record[inode] >= 0 or 
+                 not columns.attribute_list[inode]):
+            return columns.file_name(inode)
+        
+        if self.mft_session is None:
+            self.mft_session = MftSession(self.mft_raw)
+        else:
+            self.mft_session.MFT_RAW = self.mft_raw
+            
         try:
-            if record['par_ref'] == 5: # 5 is "/", the root directory
-                self.fs_inode_to_path[inode] = os.path.join('/',filename) 
-                return self.fs_inode_to_path[inode]
+            record = self.mft_session.update_record(inode, gen_paths=False)
+        except (struct.error, IndexError, KeyError, ValueError), e:
+            # Corrupt (or half written) record
+            logger.error("Could not parse MFT record for inode %d (%s)" % 
+                         (inode, e))
+            return None
+        
+        # We only ever need these records once
+        self.mft_session.mft.clear()
+        
+        if 'name' not in record or 'par_ref' not in record:
+            return None
+        
+        return (record['par_ref'], record['name'])
+
+
+    def _resolve_path(self, inode, depth=0):
+        """
+            Return the path of an inode, only parsing the MFT records on the
+            way up to a directory whose path we already know
+            
+            @param inode: MFT record number
+            @return: Full path of the inode
+        """
+        if inode in self.fs_inode_to_path:
+            return self.fs_inode_to_path[inode]
         
-        except: # If there was an error getting the parent's sequence number, then there is no FN recor
+        parsed = self._parse_mft_record(inode)
+        if parsed is None:
             self.fs_inode_to_path[inode] = 'NoFNRecord'
             return self.fs_inode_to_path[inode]
-                
-        # Self referential parent sequence number. The filename becomes a NoFNRecord note
-        if (record['par_ref']) == inode:
-            print("Error, self-referential, while trying to determine path for inode %s" % inode)
+        
+        (parent_inode, filename) = parsed
+        
+        # Self referential parent sequence number (or a loop)
+        if parent_inode == inode or depth > MAX_PATH_DEPTH:
+            logger.error("Could not determine the path for inode %d, its "
+                         "parents are self-referential." % inode)
             self.fs_inode_to_path[inode] = 'ORPHAN/' + filename
             return self.fs_inode_to_path[inode]
         
-        # We're not at the top of the tree and we've not hit an error
-        parentpath = self._get_path(raw_mft, record['par_ref'])
-        self.fs_inode_to_path[inode] = os.path.join(parentpath, filename)
+        if parent_inode == self.ROOT_INUM:
+            parent_path = "/"
+        else:
+            parent_path = self._resolve_path(parent_inode, depth+1)
+            
+        self.fs_inode_to_path[inode] = os.path.join(parent_path, filename)
+        self._set_parent(inode, parent_inode)
         
         return self.fs_inode_to_path[inode]
 
-    
-    def _clean_file_entry(self, inode_num):
+
+    def _move_subtree(self, inode):
+        """
+            Fix the paths of everything under an inode whose path changed
+        """
+        stack = [inode]
+        while len(stack) > 0:
+            parent_inode = stack.pop()
+            parent_path = self.fs_inode_to_path[parent_inode]
+            
+            for child in self.fs_parent_to_inodes.get(parent_inode, ()):
+                if child == parent_inode or child not in self.fs_inode_to_path:
+                    continue
+                filename = os.path.basename(self.fs_inode_to_path[child])
+                self.fs_inode_to_path[child] = os.path.join(parent_path, 
+                                                            filename)
+                stack.append(child)
+
+
+    def _update_paths(self, inodes):
+        """
+            Update our paths for MFT records that were just created or 
+            changed, using our shadow copy of the MFT, instead of walking the 
+            entire directory tree again.  Renamed (or moved) directories only 
+            update the paths of their own subtree.
+            
+            @param inodes: MFT record numbers that were created or changed
+        """
+        
+        # Without a copy of the MFT, all we can do is walk the tree
+        if self.mft_raw is None:
+            root_dir = self.FILE_SYSTEM.open_dir(inode=self.ROOT_INUM)
+            self.fs_inode_to_path[self.ROOT_INUM] = "/"
+            self._parse_paths(root_dir, "/", self.ROOT_INUM)
+            return
+        
+        for inode in inodes:
+            if inode == self.ROOT_INUM:
+                continue
+            
+            parsed = self._parse_mft_record(inode)
+            if parsed is None:
+                # Deleted records keep their last known path
+                if inode not in self.fs_inode_to_path:
+                    self.fs_inode_to_path[inode] = 'NoFNRecord'
+                continue
+            
+            (parent_inode, filename) = parsed
+            old_path = self.fs_inode_to_path.get(inode)
+            
+            # Nothing about its name changed
+            if old_path is not None and \
+                    self.fs_inode_to_parent.get(inode) == parent_inode and \
+                    os.path.basename(old_path) == filename:
+                continue
+            
+            # Resolve it again
+            if old_path is not None:
+                del self.fs_inode_to_path[inode]
+            new_path = self._resolve_path(inode)
+            
+            if old_path is not None and new_path != old_path:
+                logger.debug("Inode %d moved from %s to %s" % (inode,
+                                                               old_path,
+                                                               new_path))
+                self._move_subtree(inode)
+
+
+    def _get_meta(self, inode_num):
+        """
+            Return the parsed metadata of a file entry, only opening it with
+            TSK if its MFT record has changed since we last looked
+            
+            @param inode_num: TSK inode number (aka MFT entry number)
+            @return: MftEntrySnapshot
+        """
+        snapshot = self.meta_cache.pop(inode_num, None)
+        if snapshot is None:
+            f = self.FILE_SYSTEM.open_meta(inode=inode_num)
+            snapshot = MftEntrySnapshot(f)
+            if len(self.meta_cache) >= META_CACHE_SIZE:
+                self.meta_cache.popitem(last=False)
+        self.meta_cache[inode_num] = snapshot
+        
+        # Our path changes without our record being written to (E.g. a 
+        # parent directory was renamed), so always hand out the current one
+        snapshot.path = self.fs_inode_to_path.get(inode_num)
+        return snapshot
+
+
+    def _invalidate_meta(self, inodes):
+        """
+            Forget the parsed metadata of file entries whose MFT records were
+            written to
+        """
+        for inode_num in inodes:
+            self.meta_cache.pop(inode_num, None)
+
+
+    def _clean_file_entry(self, inode_num, snapshot=None):
         """
         Cleans up block mappings for this file entry
         in preparation for reloading
-        """
-        # open up the file entry by inode number
-        f = self.FILE_SYSTEM.open_meta(inode=inode_num)
         
-        # skip deleted files
-#         if not self._is_file_allocated(f.info):
-#             print("Skip cleaning file inode %d" % inode_num)
-#             return
+        @param snapshot: MftEntrySnapshot of the entry before it changed 
+        (Default: its current metadata)
+        """
+        if snapshot is None:
+            snapshot = self._get_meta(inode_num)
         
         # remove block mappings
-        for attribute in f:
-            for run in attribute:
-                self._remove_run(inode_num, run.addr, run.len)
+        for (addr, length) in snapshot.runs:
+            self._remove_run(inode_num, addr, length)
         
         
     
@@ -458,55 +812,26 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
         """
         Reload and reprocess a file entry by inode_num
         """
-        # add the sectors inside the MFT for this inode too
-        sectors = self._mft_record_to_sectors(inode_num)
-        
         # open up the file entry by inode number
-        f = self.FILE_SYSTEM.open_meta(inode=inode_num)
-        
-        # skip deleted files
-#         if not self._is_file_allocated(f.info):
-#             print("Skip loading file inode %d" % inode_num)
-#             return
+        snapshot = self._get_meta(inode_num)
         
-        filename = 'None'
-        if inode_num in self.fs_inode_to_path:
-            filename = self.fs_inode_to_path[inode_num]
-        output = "%d  %s " % (inode_num, filename)
-        
-        for attribute in f:
-                #print("Attribute:")
-                #print("Name: %s" % attribute.info.name)
-                #print("ID: %d" % attribute.info.id)
-                #print("Size: %d" % attribute.info.size)
-                
-                for run in attribute:
-                    #print("Run:")
-                    #print("Offset: %d" % run.offset)
-                    #print("Address: %d" % run.addr)
-                    #print("Length: %d" % run.len)
-                    #print("Flags: %s" % run.flags)
-                    
-                    # run.addr should be the LBA
-                    # TSK seems to use run.addr == 0 for sparse runs too
-                    # but this can mess up $Boot, whose addr is also 0, so we have to special case it
-                    if run.addr != 0 or (f.info.name and f.info.name.name == "$Boot"):
-                        self._add_run(inode_num, run.addr, run.len)                            
-                        
-                        output += str([run.len, run.addr]) + " "
+        for (addr, length) in snapshot.runs:
+            self._add_run(inode_num, addr, length)
 
 
-    def _reload_file_entry(self, inode_num):
+    def _reload_file_entry(self, inode_num, snapshot=None):
         """
         Reload a file entry if by its inode if we know it has been updated
+        
+        @param snapshot: MftEntrySnapshot of the entry before it changed
         """
-        self._clean_file_entry(inode_num)
+        self._clean_file_entry(inode_num, snapshot)
         self._load_file_entry(inode_num)
 
 
     def _remove_run(self, inode_num, addr, length):
         """
-        Remove a data run
+        Remove a data run.  Runs are indexed in bulk by _index_runs().
         """
         # check for out of bounds
         if (length < 0 or length > self.BLOCK_COUNT) or \
@@ -514,16 +839,15 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
             self.error_log.append({'error_type':'datarun_out_of_bounds', 'MFT Record Number':inode_num, 'data_run':{'num_blocks':length, 'addr':addr}})
             return
         
-        # Add all of our sector mappings
-        for i in range(length):    
-            for sector in self._block_to_sectors(addr+i):
-                if sector in self.fs_sector_to_inode:
-                    del self.fs_sector_to_inode[sector]
+        self.pending_runs.append((self._block_to_sectors(addr)[0],
+                                  length*self.BLOCK_SIZE/self.SECTOR_SIZE,
+                                  None))
 
 
     def _add_run(self, inode_num, block_addr, length):
         """
-            Add a run and annotate all of the sectors that this file touches
+            Add a run of sectors that this file touches.  Runs are indexed in
+            bulk by _index_runs().
             
             @param inode_num: TSK inode number (aka MFT entry number) 
             @param block_addr: block offset on volume to this run
@@ -535,41 +859,58 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
             self.error_log.append({'error_type':'datarun_out_of_bounds', 'MFT Record Number':inode_num, 'data_run':{'num_blocks':length, 'block_addr':block_addr}})
             return
             
-        # 
-        for i in range(length):
-            for sector in self._block_to_sectors(block_addr+i):
+        self.pending_runs.append((self._block_to_sectors(block_addr)[0],
+                                  length*self.BLOCK_SIZE/self.SECTOR_SIZE,
+                                  inode_num))
+
+
+    def _index_runs(self):
+        """
+            Apply every run added or removed since we last indexed to our 
+            sector index, in the order that they were found
+        """
+        if len(self.pending_runs) == 0:
+            return
+        self.fs_sector_index.update(self.pending_runs, self._resolve_collision)
+        self.pending_runs = []
+
+
+    def _resolve_collision(self, inode2, inode_num, sector):
+        """
+            Decide which inode owns sectors that are claimed by two runs
             
-                # check for a collision
-                if sector in self.fs_sector_to_inode:
-                    # filter out special metafiles
-                    inode2 = self.fs_sector_to_inode[sector]
-                    
-                    f1_name = ""
-                    if inode_num in self.fs_inode_to_path:
-                        f1_name = self.fs_inode_to_path[inode_num]
+            @param inode2: Inode that already owns the sectors
+            @param inode_num: Inode of the new run
+            @param sector: first sector of the collision
+            @return: Inode that should own the sectors
+        """
+        # check that the inodes (MFT record number for NTFS) are not the same
+        if inode_num == inode2:
+            return inode_num
+        
+        f1_name = ""
+        if inode_num in self.fs_inode_to_path:
+            f1_name = self.fs_inode_to_path[inode_num]
 
-                    f2_name = ""
-                    if inode2 in self.fs_inode_to_path:
-                        f2_name = self.fs_inode_to_path[inode2]
-                    
-                    # check that the inodes (MFT record number for NTFS) are not the same
-                    if inode_num != inode2:
-                        
-                        # dealing with special case of $BadClus
-                        if f1_name != "" and f1_name[1] != '$' and f2_name != "" and f2_name[1] != '$':
-                        
-                            logger.error( "Datarun collision for MFT record no %d and MFT record no %d at block %d." % (inode_num, inode2, block_addr+i))
-                            #print "Datarun collision for MFT record no %d and MFT record no %d at block %d." % (inode_num, inode2, block_addr+i)
-                            
-                            self.error_log.append({'error_type':'datarun_collision', 
-                                               'filename1':f1_name, 
-                                               'inode1':inode_num, 
-                                               'filename2':f2_name,
-                                               'inode2':inode2, 
-                                               'block_addr':block_addr+i})
-                            continue
-                
-                self.fs_sector_to_inode[sector] = inode_num
+        f2_name = ""
+        if inode2 in self.fs_inode_to_path:
+            f2_name = self.fs_inode_to_path[inode2]
+        
+        # dealing with special case of $BadClus
+        if f1_name != "" and f1_name[1] != '$' and f2_name != "" and f2_name[1] != '$':
+            block_addr = self._sector_to_block(sector)
+            
+            logger.error( "Datarun collision for MFT record no %d and MFT record no %d at block %d." % (inode_num, inode2, block_addr))
+            
+            self.error_log.append({'error_type':'datarun_collision', 
+                               'filename1':f1_name, 
+                               'inode1':inode_num, 
+                               'filename2':f2_name,
+                               'inode2':inode2, 
+                               'block_addr':block_addr})
+            return inode2
+        
+        return inode_num
 
 
     def get_access(self, sector, sector_count, direction, data):
@@ -614,8 +955,7 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
             inodes = self._get_records_from_sectors(range(sector, sector+sector_count))
             for inode in inodes:
                 try:    
-                    f = self.FILE_SYSTEM.open_meta(inode=inode)
-                    updated_mft_entries[inode] = f
+                    updated_mft_entries[inode] = self._get_meta(inode)
                 except:
                     logger.error("Possible Corrupted MFT entry found at inode: %d" % inode)
                     #print "Possible corrupted MFT entry found at inode: %d" % inode
@@ -625,27 +965,26 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
             
             # apply changes only if this was an MFT Update
             if len(updated_mft_entries) > 0:
-                # Save old MFT
-                self.old_mft_raw = self.mft_raw
-                
                 # Update file system
                 self._update_file_system(sector, sector_count, data)
                 
+                # Every record we just wrote has to be parsed again
+                self._invalidate_meta(inodes)
+                
+                # The MFT's own data runs live in record 0
+                if 0 in updated_mft_entries:
+                    self.mft_run_map = None
+                
                 # Extract new MFT
-                mft_file = self.FILE_SYSTEM.open_meta(inode=0)
-                self.mft_raw = mft_file.read_random(0,mft_file.info.meta.size)
-
-
-            # determine if there are new MFT records to reload
-            if self.LAST_INUM < self.FILE_SYSTEM.info.last_inum:
-                # Reparse the whole directory structure
-                """
-                    @TODO Optimize this so that we only parse the new inode
-                    and extract the path using analyzeMFT code.
-                """
-                root_dir = self.FILE_SYSTEM.open_dir(inode=self.ROOT_INUM)
-                self.fs_inode_to_path[self.ROOT_INUM] = "/"
-                self._parse_paths(root_dir,"/")
+                self._read_mft(inodes)
+
+
+            # Resolve the paths of any new or changed MFT records
+            added_inodes = range(self.LAST_INUM+1, 
+                                 self.FILE_SYSTEM.info.last_inum+1)
+            self._invalidate_meta(added_inodes)
+            if len(updated_mft_entries) > 0 or len(added_inodes) > 0:
+                self._update_paths(updated_mft_entries.keys() + added_inodes)
                 
             # Add all of the new inode entries to be reported
             while self.LAST_INUM < self.FILE_SYSTEM.info.last_inum:
@@ -663,17 +1002,18 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
             
 #             # Update our internal data structures if necessary
             for record_no in updated_mft_entries:
+                old_f = updated_mft_entries[record_no]
+                
                  # reload all the MFT records that were touched
-                self._reload_file_entry(record_no)
+                self._reload_file_entry(record_no, old_f)
                          
                  # Deal with file creation/deletion
                  # compare old and new record flags
-                old_f = updated_mft_entries[record_no]
-                new_f = self.FILE_SYSTEM.open_meta(inode=record_no)    
                 if old_f is None:
-                    break
-                old_flags = long(str(old_f.info.meta.flags))
-                new_flags = long(str(new_f.info.meta.flags))
+                    continue
+                new_f = self._get_meta(record_no)
+                old_flags = old_f.flags
+                new_flags = new_f.flags
  
                  # check for creation
                 if (old_flags & pytsk3.TSK_FS_META_FLAG_ALLOC == 0) and (new_flags & pytsk3.TSK_FS_META_FLAG_ALLOC != 0):
@@ -704,13 +1044,16 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
                 else:
                     pass
 
+            self._index_runs()
+            
+            # Diffs of every MFT record that we wrote (See [MFT WRITE])
+            mft_diffs = None
             
             # Look at the writes again semantically and add them to our output structure            
             for i in xrange(sector_count):
                 # KNOWN WRITE
-                if sector+i in self.fs_sector_to_inode:
-                    
-                    inode = self.fs_sector_to_inode[sector+i]
+                inode = self.fs_sector_index.lookup(sector+i)
+                if inode is not None:
                     
                     filename = "unknown"
                     
@@ -721,10 +1064,10 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
                     if inode in self.fs_inode_to_path:                
                         filename = self.fs_inode_to_path[inode]
                     else:
-                        f = self.FILE_SYSTEM.open_meta(inode=inode)
+                        f = self._get_meta(inode)
                         #filename = "UNKNOWN_PREFIX "
-                        if f.info.name:
-                            filename = f.info.name.name
+                        if f.name:
+                            filename = f.name
                             
                         
                     if inode == 0:
@@ -735,12 +1078,15 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
                         
                         #print updated_mft_entries
                         
-                        for record_no in updated_mft_entries:
-                            # do the diff
-                            old_f = updated_mft_entries[record_no]
-                            new_f = self.FILE_SYSTEM.open_meta(inode=record_no)
-                            meta_diff = self._diff_metadata(old_f, new_f,record_no)
-                            semantic_data.append(meta_diff)
+                        # do the diffs (once for the entire write)
+                        if mft_diffs is None:
+                            mft_diffs = []
+                            for record_no in updated_mft_entries:
+                                old_f = updated_mft_entries[record_no]
+                                new_f = self._get_meta(record_no)
+                                meta_diff = self._diff_metadata(old_f, new_f,record_no)
+                                mft_diffs.append(meta_diff)
+                        semantic_data.extend(mft_diffs)
                         
                     elif sector+i == 1 or sector+i == 0:
                         op_type = "[MBR WRITE]"
@@ -751,9 +1097,8 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
                     
                     #Check if we are playing with a resident attribute
                     if inode == 0:
-                        if sector+i in self.fs_inode_to_sector_resident:
-                            if self.fs_inode_to_sector_resident[sector+i] in self.fs_inode_to_path:
-                                res_inode = self.fs_inode_to_sector_resident[sector+i]
+                        for res_inode in self._get_records_from_sectors([sector+i]):
+                            if res_inode in self.fs_inode_to_path:
                                 res_filename = self.fs_inode_to_path[res_inode]
                                 filename = filename + " entry for " + res_filename
                     filesystem_operations.append(self._fs_operation(sector+i, 
@@ -788,8 +1133,9 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
                 
                 
                 # Known Read
-                if sector+i in self.fs_sector_to_inode:
-                    inode = self.fs_sector_to_inode[sector+i]
+                sector_inode = self.fs_sector_index.lookup(sector+i)
+                if sector_inode is not None:
+                    inode = sector_inode
                     
                     if inode in self.fs_inode_to_path:
                         filename = self.fs_inode_to_path[inode]
@@ -798,9 +1144,8 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
                         op_type = "[MBR READ]"
                     elif inode == 0:
                         op_type = '[MFT READ]'
-                        if sector+i in self.fs_inode_to_sector_resident:
-                            if self.fs_inode_to_sector_resident[sector+i] in self.fs_inode_to_path:
-                                res_inode = self.fs_inode_to_sector_resident[sector+i]
+                        for res_inode in self._get_records_from_sectors([sector+i]):
+                            if res_inode in self.fs_inode_to_path:
                                 res_filename = self.fs_inode_to_path[res_inode]
                                 filename = filename + "entry for " + res_filename
                     else:
@@ -831,13 +1176,39 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
                 'semantic_data':semantic_data}
         
         
+    def _snapshot_metadata(self, snapshot, filename):
+        """
+            Returns the dict of meta data that we diff for a file entry
+            
+            @param snapshot: MftEntrySnapshot of the entry
+            @param filename: Full path of the entry
+        """
+        flags = snapshot.flags
+        semantic_data = {
+                            'filename':filename,
+                            'flags':flags,
+                            # Extract Flags
+                            'flag_alloc':flags & pytsk3.TSK_FS_META_FLAG_ALLOC,
+                            'flag_comp':(flags & pytsk3.TSK_FS_META_FLAG_COMP) >> 4,
+                            'flag_orphan':(flags & pytsk3.TSK_FS_META_FLAG_ORPHAN) >> 5,
+                            'flag_unalloc':(flags & pytsk3.TSK_FS_META_FLAG_UNALLOC) >> 1,
+                            'flag_unused':(flags & pytsk3.TSK_FS_META_FLAG_UNUSED) >> 3,
+                            'flag_used':(flags & pytsk3.TSK_FS_META_FLAG_USED) >> 2,
+                        }
+        # size, uid, gid, mtime, ... (See MftEntrySnapshot.META_FIELDS)
+        semantic_data.update(snapshot.meta)
+        
+        return semantic_data
+    
+    
     def _diff_metadata(self, old_file, new_file, inode):
         """
             This function will return an intelligent diff of the meta data
             associated with the given inode (MFT Record #)
             
-            @param old_file: PyTSK file object for the old entry
-            @param new_file: PyTSK file object for the new entry
+            @param old_file: MftEntrySnapshot of the entry before it was 
+            written (or None)
+            @param new_file: MftEntrySnapshot of the entry now
             @param inode: Inode or Record number of the files
             @return: Some dict with intelligent diffing. 
             
@@ -846,36 +1217,8 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
             They all evalutate 1 for some reason when the flags bitmask clearly 
             idicates they aren't
         """
-
-        # Get our flags
-        new_flags = long(str(new_file.info.meta.flags))
-        mft_filename = self._get_path(self.mft_raw, inode)
-            
-        semantic_data_new = {
-                                'filename':mft_filename,
-                                'flags':new_flags,
-                                # Extract Flags
-                                'flag_alloc':new_flags & pytsk3.TSK_FS_META_FLAG_ALLOC,
-                                'flag_comp':(new_flags & pytsk3.TSK_FS_META_FLAG_COMP) >> 4,
-                                'flag_orphan':(new_flags & pytsk3.TSK_FS_META_FLAG_ORPHAN) >> 5,
-                                'flag_unalloc':(new_flags & pytsk3.TSK_FS_META_FLAG_UNALLOC) >> 1,
-                                'flag_unused':(new_flags & pytsk3.TSK_FS_META_FLAG_UNUSED) >> 3,
-                                'flag_used':(new_flags & pytsk3.TSK_FS_META_FLAG_USED) >> 2,
-                                'size':new_file.info.meta.size,
-                                'uid':new_file.info.meta.uid,
-                                'gid':new_file.info.meta.gid,
-#                                 'hidden':new_file.info.meta.hidden,
-                                'mtime':new_file.info.meta.mtime,
-                                'mtime_nano':new_file.info.meta.mtime_nano,
-                                'atime':new_file.info.meta.atime,
-                                'atime_nano':new_file.info.meta.atime_nano,
-                                'ctime':new_file.info.meta.ctime,
-                                'ctime_nano':new_file.info.meta.ctime_nano,
-                                'crtime':new_file.info.meta.crtime,
-                                'crtime_nano':new_file.info.meta.crtime_nano,
-                                'content_len':new_file.info.meta.content_len,
-                                'seq':new_file.info.meta.seq,
-                         }
+        mft_filename = self.fs_inode_to_path.get(inode, new_file.path)
+        semantic_data_new = self._snapshot_metadata(new_file, mft_filename)
         
         semantic_data = {
                             'inode':inode,
@@ -885,33 +1228,8 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
                         }
         
         if old_file is not None:
-            old_flags = long(str(old_file.info.meta.flags))
-            old_mft_filename = self._get_path(self.old_mft_raw, inode)
-            semantic_data_old = {
-                                'filename':old_mft_filename,
-                                'flags':old_flags,
-                                # Extract flags
-                                'flag_alloc':(old_flags & pytsk3.TSK_FS_META_FLAG_ALLOC),
-                                'flag_comp':(old_flags & pytsk3.TSK_FS_META_FLAG_COMP) >> 4,
-                                'flag_orphan':(old_flags & pytsk3.TSK_FS_META_FLAG_ORPHAN) >> 5,
-                                'flag_unalloc':(old_flags & pytsk3.TSK_FS_META_FLAG_UNALLOC) >> 1,
-                                'flag_unused':(old_flags & pytsk3.TSK_FS_META_FLAG_UNUSED) >> 3,
-                                'flag_used':(old_flags & pytsk3.TSK_FS_META_FLAG_USED) >> 2,                                
-                                'size':old_file.info.meta.size,
-                                'uid':old_file.info.meta.uid,
-                                'gid':old_file.info.meta.gid,
-#                                 'hidden':old_file.info.meta.hidden,
-                                'mtime':old_file.info.meta.mtime,
-                                'mtime_nano':old_file.info.meta.mtime_nano,
-                                'atime':old_file.info.meta.atime,
-                                'atime_nano':old_file.info.meta.atime_nano,
-                                'ctime':old_file.info.meta.ctime,
-                                'ctime_nano':old_file.info.meta.ctime_nano,
-                                'crtime':old_file.info.meta.crtime,
-                                'crtime_nano':old_file.info.meta.crtime_nano,
-                                'content_len':old_file.info.meta.content_len,
-                                'seq':old_file.info.meta.seq
-                                }
+            semantic_data_old = self._snapshot_metadata(old_file, 
+                                                        old_file.path)
             
             for k in semantic_data_new:
                 if semantic_data_new[k] != semantic_data_old[k] and semantic_data_old[k] is not None:
@@ -985,45 +1303,25 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
             is not collected when using the get_access function, the filename is listed as 
             /$MFT
         """
-        
-            
-        mft_blocks = self._mft_dataruns()
+        (sector_starts, sector_ends, byte_starts, 
+         record_starts) = self._mft_run_map()
 
         # byte offset for this record from start of the mft
-        byte_offset_from_MFT_start = record_no * 1024    
-        # go through each data run looking for the sector that
-        # matches this byte offset
-                
-        bytes_left = byte_offset_from_MFT_start
-        for (num_blocks, lba) in mft_blocks:
-            
-            # check if the record is in this datarun
-            if bytes_left < num_blocks * self.BLOCK_SIZE:
-    
-                # record should be inside this block
-                block = lba + bytes_left/self.BLOCK_SIZE
-                 
-                sectors = self._block_to_sectors(block)
-                
-                # find offset into this block
-                byte_offset_into_block = bytes_left % self.BLOCK_SIZE
-                sector_offset = byte_offset_into_block/self.SECTOR_SIZE
-                
-                sector_start = sectors[0] + sector_offset
-                # 1.) Check if the sector resides in the MFT
-                # 2.) If it does, add a new dictionary entry with the inode
-                # 3.) That inode can later be mapped back to a file!
-                if(sector_start in self.fs_sector_to_inode and self.fs_sector_to_inode[sector_start] == 0):
-                    self.fs_inode_to_sector_resident[sector_start] = record_no
-                    self.fs_inode_to_sector_resident[sector_start + 1024 / self.SECTOR_SIZE] = record_no
-                return range(sector_start, sector_start+1024/self.SECTOR_SIZE)
-
-                
-            else:
-                bytes_left -= num_blocks * self.BLOCK_SIZE
+        byte_offset_from_MFT_start = record_no * MFT_ENTRY_SIZE
+        
+        # find the data run that holds this byte offset
+        run = bisect.bisect_right(byte_starts, byte_offset_from_MFT_start) - 1
+        if run < 0:
+            return []
+        
+        sector_offset = (byte_offset_from_MFT_start - byte_starts[run])/self.SECTOR_SIZE
+        sector_start = sector_starts[run] + sector_offset
         
         # we only get here if record_no is too high to actually be in the MFT    
-        return []
+        if sector_start >= sector_ends[run]:
+            return []
+        
+        return range(sector_start, sector_start+MFT_ENTRY_SIZE/self.SECTOR_SIZE)
     
     
     def _get_records_from_sectors(self,sectors):
@@ -1034,35 +1332,65 @@ class SEV_NTFS_Sparse(SemanticEngineVolumeSparse):
             @param sector: List of physical sectors
             @return List of MFT Record #s (AKA inode number in pytsk) or empty list 
         """
-        
-        inode_start = 0
+        (sector_starts, sector_ends, byte_starts, 
+         record_starts) = self._mft_run_map()
         
         inodes = []
-        # Loop over all of the MFT runs in order
+        seen = set()
+        for sector in sectors:
+            # Is the sector in one of our data runs?
+            run = bisect.bisect_right(sector_starts, sector) - 1
+            if run < 0 or sector >= sector_ends[run]:
+                continue
+            
+            # First inode num in this run + our offset
+            record_num = record_starts[run] + ((sector - sector_starts[run])*self.SECTOR_SIZE)/MFT_ENTRY_SIZE
+            
+            if record_num not in seen:
+                seen.add(record_num)
+                inodes.append(record_num)
+            
+        return inodes
+        
+    
+    def _mft_run_map(self):
+        """
+            Returns our table of MFT extents, only reopening the MFT when it 
+            has changed since we last built it
+            
+            @return (sector_starts, sector_ends, byte_starts, record_starts) 
+            with an entry for every MFT run, in the same order as 
+            _mft_dataruns().  byte_starts and record_starts are the offsets of
+            each run from the start of the MFT.
+        """
+        if self.mft_run_map is not None:
+            return self.mft_run_map
+        
+        sector_starts = []
+        sector_ends = []
+        byte_starts = []
+        record_starts = []
+        
+        byte_start = 0
+        record_start = 0
         for (num_blocks, block_addr) in self._mft_dataruns():
             
             # Get our actual start and ending sectors of this MFT run
             sector_start = self._block_to_sectors(block_addr)[0]
             sector_end = sector_start + (num_blocks*self.BLOCK_SIZE)/self.SECTOR_SIZE
             
+            sector_starts.append(sector_start)
+            sector_ends.append(sector_end)
+            byte_starts.append(byte_start)
+            record_starts.append(record_start)
             
-            for sector in sectors:
-                # Is the sector in this data run?
-                if sector >= sector_start and sector <= sector_end:
-                    # First inode num in this run + our offset
-                    record_num = inode_start + ((sector - sector_start)*self.SECTOR_SIZE)/MFT_ENTRY_SIZE
-            
-                    if record_num not in inodes:
-                        inodes.append(record_num)
-            
-            # Add all of the inodes that we just skipped
-            inode_start += ((sector_end - sector_start)*self.SECTOR_SIZE)/MFT_ENTRY_SIZE
-            
-        return inodes
-        
-        
-
+            byte_start += num_blocks*self.BLOCK_SIZE
+            record_start += ((sector_end - sector_start)*self.SECTOR_SIZE)/MFT_ENTRY_SIZE
         
+        self.mft_run_map = (sector_starts, sector_ends, byte_starts, 
+                            record_starts)
+        return self.mft_run_map
+    
     
     def _mft_dataruns(self):
         """
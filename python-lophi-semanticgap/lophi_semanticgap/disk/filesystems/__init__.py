@@ -16,6 +16,9 @@ sys.path.append(os.path.join(os.getcwd(), "../../"))
 # LO-PHI
 import lophi.globals as G
 from lophi_semanticgap.disk.filesystems.ntfs import MftSession, mft
+from lophi_semanticgap.disk.fs_cache import engine_name
+from lophi_semanticgap.disk.run_index import RunIndex
+from lophi_semanticgap.disk.overlay import ImageOverlay
 
 # logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -25,6 +28,9 @@ class Shadow_Img_Info(pytsk3.Img_Info):
     """
     Creates an updateable Img_Info that maintains a shadow copy in memory.
     No changes are made to the underlying disk image.
+    
+    Writes are kept as extents in an ImageOverlay, so reads of long runs are
+    a single copy out of the (memory-mapped) image or the overlay.
     """
     
     def __init__(self, url, sector_size):
@@ -32,80 +38,34 @@ class Shadow_Img_Info(pytsk3.Img_Info):
         self.SECTOR_SIZE = sector_size
         
         ## Open the image
-        self.fd = open(url, 'rb')
-        if not self.fd:
-            raise IOError("Unable to open %s" % url)
-
-        ## data cache in sectors
-        self.CACHE = {}
+        self.OVERLAY = ImageOverlay(url)
 
         ## Call the base class with an empty URL
         pytsk3.Img_Info.__init__(self, '')
 
     def get_size(self):
         """ This function returns the size of the image """
-        return os.path.getsize(self.URL)
+        return self.OVERLAY.size
 
     def read(self, off, length):
         """
         This returns byte ranges from the image, using the image
         Returns data from cache first
         """
-        
-        data = []
-        
-        # Read sector by sector
-        
-        while length > 0:
-            
-            # determine which sector
-            sector = off/self.SECTOR_SIZE
-            
-            # determine the offset --> should be 0 when we get sector aligned
-            offset_into_sector = off % self.SECTOR_SIZE
-            
-            # determine the length to read, at most one sector at a time
-            l = min(length, self.SECTOR_SIZE - offset_into_sector)
-            
-            # read the data
-            data.append(self._read_sector(sector, offset_into_sector, l))
-            
-            # update the length left and the offset
-            off += l
-            length -= l
-                    
-        return ''.join(data)
-
-
-    def _read_sector(self, sector, offset_into_sector, length):
-        """
-        Reads a single sector with offset into the sector and length
-        """
-                
-        # determine if the sector is in the CACHE
-        if sector in self.CACHE:
-#            print "Reading sector %d from CACHE" % sector
-            return self.CACHE[sector][offset_into_sector:offset_into_sector+length]
-        else:
-#            print "Reading sector %d from DISK" % sector
-            self.fd.seek(sector*self.SECTOR_SIZE + offset_into_sector)
-            return self.fd.read(length)
-        
+        return self.OVERLAY.read(off, length)
 
     def write(self, sector, sector_count, data):
         """ Writes data to the cache """
-        #print "Writing sectors %d to %d to CACHE" % (sector, sector+sector_count-1)
-        for i in xrange(sector_count):    
-            self.CACHE[sector+i] = data[i*self.SECTOR_SIZE:(i+1)*self.SECTOR_SIZE]
-
+        self.OVERLAY.write(sector*self.SECTOR_SIZE, 
+                           data[:sector_count*self.SECTOR_SIZE])
 
     def close(self):
         """ This is called when we want to close the image """
-        self.fd.close()
+        self.OVERLAY.close()
         
     def dump_cache(self):
         """ This is called when we want to dump the cache """
-        return self.CACHE
+        return self.OVERLAY.sectors(self.SECTOR_SIZE)
 
 
 class SemanticEngineDisk:
@@ -115,7 +75,12 @@ class SemanticEngineDisk:
     """
 
     
-    def __init__(self, url):
+    def __init__(self, url, cache=None):
+        """
+            @param url: Path to the disk image to parse
+            @param cache: FilesystemCache to load our parsed volumes from, or
+            store them in if it is stale (See lophi_semanticgap.disk.fs_cache)
+        """
         # parse out the different volumes
         
         self.url = url
@@ -137,17 +102,38 @@ class SemanticEngineDisk:
         logger.debug("Parition Count: %d" % self.VOL_INFO.info.part_count)
         logger.debug("--- Volume info ---")
 
+        # Reuse the volumes that we parsed on a previous run
+        states = None
+        if cache is not None:
+            states = cache.load(engine_name(self))
+        stale = states is None
+
         # Add each volume
         for vol in self.VOL_INFO:
             #print part.addr, part.desc, part.start, part.len
-            self.add_volume(vol)
+            state = None
+            if states is not None:
+                state = states.get(vol.start)
+            self.add_volume(vol, state)
+
+            # Did this volume have to be parsed again?
+            sem_eng_vol = self.vol_to_se[vol]
+            if sem_eng_vol is not None and not sem_eng_vol.from_cache and \
+                    sem_eng_vol.get_state() is not None:
+                stale = True
+
+        if cache is not None and stale:
+            cache.save(self.get_state(), engine_name(self))
 
                 
-    def add_volume(self, vol):
+    def add_volume(self, vol, state=None):
         """
             Add a new volume
             
             WARNING: These must be added in sequential order!
+            
+            @param vol: TSK volume
+            @param state: Parsed state of this volume from get_state()
         """
         logger.debug("--- Partition ---")
         logger.debug("Start: %d" % vol.start)
@@ -167,19 +153,35 @@ class SemanticEngineDisk:
         # deal with different types of volumes (i.e. partitions)
         # right now, just handle NTFS separately
         if vol.desc == 'NTFS (0x07)':
-            sev = SemanticEngineVolumePyTSK_NTFS(self.img, self.VOL_INFO, vol, self.url)
+            sev = SemanticEngineVolumePyTSK_NTFS(self.img, self.VOL_INFO, vol, self.url, state)
             if sev.NON_FILESYSTEM:
                 self.vol_to_se[vol] = None
             else:
                 self.vol_to_se[vol] = sev
         else:
-            sev = SemanticEngineVolumePyTSK(self.img, self.VOL_INFO, vol, self.url)
+            sev = SemanticEngineVolumePyTSK(self.img, self.VOL_INFO, vol, self.url, state)
             if sev.NON_FILESYSTEM:
                 self.vol_to_se[vol] = None
             else:
                 self.vol_to_se[vol] = sev
     
     
+    def get_state(self):
+        """
+            Returns dictionary of vol.start -> parsed state of that volume, 
+            for every volume that can be cached
+        """
+        ret = {}
+        for vol in self.VOLUMES:
+            sem_eng_vol = self.vol_to_se[vol]
+            if sem_eng_vol is None:
+                continue
+            state = sem_eng_vol.get_state()
+            if state is not None:
+                ret[vol.start] = state
+        return ret
+    
+    
     ### TODO Go through this        
     def _get_volume(self, sector):
         import bisect
@@ -271,10 +273,47 @@ class SemanticEngineVolume:
         self.NON_FILESYSTEM = False
         
         self.error_log = []
+        
+        # Was our state restored from a snapshot? (See _restore_state)
+        self.from_cache = False
  
     def get_error_log(self):
         return self.error_log
  
+    def get_state(self):
+        """
+            Returns the parsed state of this volume so that it can be restored
+            with set_state() instead of being parsed again, or None if this 
+            volume can't be cached
+        """
+        return None
+
+    def _restore_state(self, state):
+        """
+            Restore our parsed state from a snapshot, unless it was made by
+            something else (E.g. another engine or an older version)
+            
+            @param state: Parsed state of this volume from get_state()
+            @return: True/False
+        """
+        # A fresh volume tells us which keys to expect
+        expected = self.get_state()
+        if not isinstance(state, dict) or expected is None or \
+                set(state) != set(expected):
+            logger.warning("Cached state of volume at %d doesn't match, "
+                           "parsing it again." % self.VOLUME_OFFSET)
+            return False
+
+        try:
+            self.set_state(state)
+        except (TypeError, ValueError, AttributeError), e:
+            logger.warning("Could not restore cached state of volume at %d, "
+                           "parsing it again. (%s)" % (self.VOLUME_OFFSET, e))
+            return False
+
+        self.from_cache = True
+        return True
+ 
     def get_access(self, sector, sector_count, direction, data, depth=0):
         print "get_access() should be overridden!"
     
@@ -299,7 +338,11 @@ class SemanticEngineVolumePyTSK(SemanticEngineVolume):
 
     UPDATE_FILES = ['$MFT']
 
-    def __init__(self, img, vol_info, volume, url):
+    def __init__(self, img, vol_info, volume, url, state=None):
+        """
+            @param state: Parsed state of this volume from get_state(), 
+            instead of scanning the file system
+        """
 
         SemanticEngineVolume.__init__(self, img, vol_info, volume, url)
 
@@ -312,8 +355,13 @@ class SemanticEngineVolumePyTSK(SemanticEngineVolume):
             self.NON_FILESYSTEM = True
             return
 
-        self.fs_block_to_file = {}
-        self.fs_file_to_path = {}
+        # Runs of blocks -> path of the file that owns them
+        self.fs_block_index = RunIndex()
+        # Runs found during a scan that haven't been indexed yet
+        self.pending_runs = []
+        # Inode of every file that has one (to tell hard links apart from
+        # real collisions)
+        self.fs_path_to_inode = {}
         self.FILE_SYSTEM = file_system
 
         self.ROOT_INUM = file_system.info.root_inum
@@ -342,8 +390,30 @@ class SemanticEngineVolumePyTSK(SemanticEngineVolume):
 
         ## Step 3: Open the directory node this will open the node based on path
         ## or inode as specified.
-        directory = file_system.open_dir(inode=self.ROOT_INUM)
-        self._scan_file_system(directory)
+        if state is None or not self._restore_state(state):
+            directory = file_system.open_dir(inode=self.ROOT_INUM)
+            self._scan_file_system(directory)
+            self._index_runs()
+
+    def get_state(self):
+        """
+            Returns our block index so that it can be restored without 
+            scanning the file system again
+        """
+        if self.NON_FILESYSTEM:
+            return None
+        
+        return {'fs_block_index':self.fs_block_index,
+                'fs_path_to_inode':self.fs_path_to_inode,
+                'error_log':self.error_log}
+        
+    def set_state(self, state):
+        """
+            Restore our block index from get_state()
+        """
+        self.fs_block_index = state['fs_block_index']
+        self.fs_path_to_inode = state['fs_path_to_inode']
+        self.error_log = state['error_log']
         
 
     def _scan_file_system(self, directory, path=""):
@@ -396,7 +466,8 @@ class SemanticEngineVolumePyTSK(SemanticEngineVolume):
 
         logger.debug(f.info)
 
-        self.fs_file_to_path[f] = path
+        if f.info.meta:
+            self.fs_path_to_inode[path] = f.info.meta.addr
 
 
 #        output = path + " "
@@ -422,7 +493,7 @@ class SemanticEngineVolumePyTSK(SemanticEngineVolume):
                     # TSK seems to use run.addr == 0 for sparse runs too
                     # but this can mess up $Boot, whose addr is also 0, so we have to special case it
                     if run.addr != 0 or filename == "$Boot":
-                        self._add_run(f, run.addr, run.len)
+                        self._add_run(path, run.addr, run.len)
     #                print run.type
     
 #                    output += " [Len: %d, Offset: %d, Addr: %d]," % (run.len, run.offset, run.addr)
@@ -448,57 +519,64 @@ class SemanticEngineVolumePyTSK(SemanticEngineVolume):
 #            print "Where is this extra DATA?!?!?"
 #            sys.exit(0)
 
-    def _add_run(self, f, block_addr, length):
+    def _add_run(self, path, block_addr, length):
         """
-            Add a run and annotate all of the sectors that this file touches
+            Add a run of blocks that this file touches.  Runs are indexed in
+            bulk by _index_runs() once the scan is complete.
             
-            @param f: TSK File Object
+            @param path: Full path of the file
             @param block_addr: block offset on volume to this run
             @param length: length of run in blocks
         """
         
-        # if f has a meta attribute, then its "inode" (MFT record no for NTFS) should be f.info.meta.block_addr
+        # check for out of bounds
+        if (length < 0 or length > self.BLOCK_COUNT) or (block_addr < 0 or block_addr+length > self.BLOCK_COUNT):                
+            self.error_log.append({'error_type':'datarun_out_of_bounds', 'filename':os.path.basename(path), 'data_run':{'num_blocks':length, 'block_addr':block_addr}})
+            return
         
-        for i in range(length):
-            
-            # check for out of bounds
-            if (length < 0 or length > self.BLOCK_COUNT) or (block_addr < 0 or block_addr+length > self.BLOCK_COUNT):                
-                self.error_log.append({'error_type':'datarun_out_of_bounds', 'filename':f.info.name.name, 'data_run':{'num_blocks':length, 'block_addr':block_addr}})
-                continue
-            
-            
+        self.pending_runs.append((block_addr, length, path))
+        
+    def _index_runs(self):
+        """
+            Add all of the runs found by our last scan to our block index
+        """
+        logger.debug("Indexing %d runs." % len(self.pending_runs))
+        self.fs_block_index.update(self.pending_runs, self._resolve_collision)
+        self.pending_runs = []
+        
+    def _resolve_collision(self, path2, path, block_addr):
+        """
+            Decide which file owns blocks that are claimed by two runs
             
-            # check for a collision
-            if block_addr+i in self.fs_block_to_file:
-                # filter out special metafiles
-                f2 = self.fs_block_to_file[block_addr+i]
-                
-                if f.info.name.name[0] != '$' and f2.info.name.name[0] != '$':
-                
-                    # check that the inodes (MFT record number for NTFS) are not the same
-                    
-                    inode1 = ''
-                    if f.info.meta:
-                        inode1 = f.info.meta.addr
-                        
-                    inode2 = ''
-                    
-                    if f2.info.meta:
-                        inode2 = f2.info.meta.addr
-                    
-                    if inode1 != '' and inode2 != '' and inode1 != inode2:
-                    
-                        logger.error("Datarun collision for file %s and file %s at block %d." % (f.info.name.name, self.fs_block_to_file[block_addr+i].info.name.name, block_addr+i))
-                        
-                        self.error_log.append({'error_type':'datarun_collision', 
-                                           'filename1':f.info.name.name, 
-                                           'inode1':inode1, 
-                                           'filename2':self.fs_block_to_file[block_addr+i].info.name.name,
-                                           'inode2':inode2, 
-                                           'block_addr':block_addr+i})
-                        continue
+            @param path2: Path of the file that already owns the blocks
+            @param path: Path of the file of the new run
+            @param block_addr: first block of the collision
+            @return: Path of the file that should own the blocks
+        """
+        filename = os.path.basename(path)
+        filename2 = os.path.basename(path2)
+        
+        # filter out special metafiles
+        if filename[0] == '$' or filename2[0] == '$':
+            return path
+        
+        # check that the inodes (MFT record number for NTFS) are not the same
+        inode1 = self.fs_path_to_inode.get(path, '')
+        inode2 = self.fs_path_to_inode.get(path2, '')
+        
+        if inode1 != '' and inode2 != '' and inode1 != inode2:
+        
+            logger.error("Datarun collision for file %s and file %s at block %d." % (filename, filename2, block_addr))
             
-            self.fs_block_to_file[block_addr + i] = f
+            self.error_log.append({'error_type':'datarun_collision', 
+                               'filename1':filename, 
+                               'inode1':inode1, 
+                               'filename2':filename2,
+                               'inode2':inode2, 
+                               'block_addr':block_addr})
+            return path2
+        
+        return path
 
     def _sector_to_block(self, sector):
 
@@ -514,30 +592,29 @@ class SemanticEngineVolumePyTSK(SemanticEngineVolume):
 
     def lookup_block(self, block):
         """
-            Given a block on the filesystem, lookup the file
+            Given a block on the filesystem, lookup the path of its file
         """
 #        print "lookup: %d" % block
-        if block in self.fs_block_to_file:
-            f = self.fs_block_to_file[block]
-            return f
-        else:
-            return None
+        return self.fs_block_index.lookup(block)
 
 
-    def _update_file_system(self, sector, sector_count, data, file=None):
+    def _update_file_system(self, sector, sector_count, data, path=None):
 
         # Reload our filesystem to wipe away caches
         #url = "/home/ch23339/WinXPSP3.img"
 #        self.IMG = pytsk3.Img_Info(url)
 #        self.FILE_SYSTEM = pytsk3.FS_Info(self.IMG, self.OFFSET_BYTES, pytsk3.TSK_FS_TYPE_DETECT)
 
-        if file is not None:
-            path = self.fs_file_to_path[file]
+        if path is not None:
             new_file = self.FILE_SYSTEM.open(path)
 #            print file.__dict__
 #            print new_file.__dict__
         else:
+            # Rebuild our index from scratch
+            self.fs_block_index.clear()
+            self.fs_path_to_inode = {}
             self._scan_file_system(None)
+            self._index_runs()
 
     def get_access(self, sector, sector_count, direction, data, depth=0):
 
@@ -545,59 +622,47 @@ class SemanticEngineVolumePyTSK(SemanticEngineVolume):
         # See how many files were read
         files = []
         output_dict = {}
-        i = 0
-        first = True
 
-        # Check all of the sectors that were affected
-        while i < sector_count:
+        if sector_count < 1:
+            return output_dict
 
-            # Convert to block and check to see if there is a file there
-            fs_block = self._sector_to_block(sector + i)
-            f = self.lookup_block(fs_block)
+        # Find every run that intersects the blocks that were affected
+        first_block = self._sector_to_block(sector)
+        last_block = self._sector_to_block(sector + sector_count - 1)
+        for (start, end, filename) in self.fs_block_index.find(first_block,
+                                                               last_block + 1):
 
             # Only append each file once
-            if f not in files and f is not None:
-                files.append(f)
+            if filename not in files:
+                files.append(filename)
 
-            if f:
-                filename = self.fs_file_to_path[f]
-                if filename in output_dict:
-                    output_dict[filename]['blocks'].append(fs_block)
-                else:
-                    output_dict[filename] = {}
-                    output_dict[filename]['blocks'] = [fs_block]
-
-            # Increment into the next block
-            if first:
-                i += 1
-                while fs_block == self._sector_to_block(sector + i) and i < sector_count:
-                    i += 1
-                first = False
-            # If we are already on block boundaries just go straight to the next block
+            if filename in output_dict:
+                output_dict[filename]['blocks'].extend(xrange(start, end))
             else:
-                i += self.BLOCK_SIZE / self.SECTOR_SIZE
+                output_dict[filename] = {}
+                output_dict[filename]['blocks'] = range(start, end)
 
 #         if direction == G.SATA_OP.DIRECTION.WRITE and len(files) == 0 and depth == 0:
 #             self._update_file_system(sector, sector_count, data)
 #             return self.get_access(sector, sector_count, direction, data, depth=depth + 1)
 
         # Now put our results in a nice output format
-        for f in files:
+        for filename in files:
             if direction == G.SATA_OP.DIRECTION.READ:
-#                print "READ: ", self.fs_file_to_path[f]
+#                print "READ: ", filename
                 
-                output_dict[self.fs_file_to_path[f]]['op'] = 'READ'
-                output_dict[self.fs_file_to_path[f]]['data'] = data
+                output_dict[filename]['op'] = 'READ'
+                output_dict[filename]['data'] = data
                 
             else:
-#                print "WRITE: ", self.fs_file_to_path[f]
-                output_dict[self.fs_file_to_path[f]]['op'] = 'WRITE'
-                output_dict[self.fs_file_to_path[f]]['data'] = data
+#                print "WRITE: ", filename
+                output_dict[filename]['op'] = 'WRITE'
+                output_dict[filename]['data'] = data
 
 
                 # Do we need to update and try again?
-                if f.info.name.name in self.UPDATE_FILES and depth == 0:
-                    self._update_file_system(sector, sector_count, data, file=f)
+                if os.path.basename(filename) in self.UPDATE_FILES and depth == 0:
+                    self._update_file_system(sector, sector_count, data, path=filename)
                     return self.get_access(sector, sector_count, direction, data, depth=depth + 1)
 
 
@@ -611,7 +676,11 @@ class SemanticEngineVolumePyTSK_NTFS(SemanticEngineVolume):
         Generic class for handling types of volumes/partitions supported by pyTSK (slow but should work)
     """
 
-    def __init__(self, img, vol_info, volume, url):
+    def __init__(self, img, vol_info, volume, url, state=None):
+        """
+            @param state: Parsed state of this volume from get_state(), 
+            instead of parsing the file system
+        """
 
         SemanticEngineVolume.__init__(self, img, vol_info, volume, url)
 
@@ -625,13 +694,16 @@ class SemanticEngineVolumePyTSK_NTFS(SemanticEngineVolume):
             return
 
         
-        # inode mappings
-        self.fs_sector_to_inode = {}
+        # Runs of sectors -> inode that owns them
+        self.fs_sector_index = RunIndex()
         self.fs_inode_to_path = {}
         
-        # maps sector to MFT record number if the sector
-        # is inside the MFT
-        self.sector_to_mft_record_no = {}
+        # Runs of sectors inside the MFT -> MFT record number stored there
+        self.mft_sector_index = RunIndex()
+        
+        # Runs found since we last indexed (See _index_runs)
+        self.pending_runs = []
+        self.pending_mft_runs = []
 
         self.ROOT_INUM = self.FILE_SYSTEM.info.root_inum
         first_inum = self.FILE_SYSTEM.info.first_inum
@@ -650,7 +722,30 @@ class SemanticEngineVolumePyTSK_NTFS(SemanticEngineVolume):
 
         ## Step 3: Open the directory node this will open the node based on path
         ## or inode as specified.
-        self._load_file_system()
+        if state is None or not self._restore_state(state):
+            self._load_file_system()
+
+    def get_state(self):
+        """
+            Returns our inode mappings so that they can be restored without
+            parsing the file system again
+        """
+        if self.NON_FILESYSTEM:
+            return None
+        
+        return {'fs_sector_index':self.fs_sector_index,
+                'fs_inode_to_path':self.fs_inode_to_path,
+                'mft_sector_index':self.mft_sector_index,
+                'error_log':self.error_log}
+        
+    def set_state(self, state):
+        """
+            Restore our inode mappings from get_state()
+        """
+        self.fs_sector_index = state['fs_sector_index']
+        self.fs_inode_to_path = state['fs_inode_to_path']
+        self.mft_sector_index = state['mft_sector_index']
+        self.error_log = state['error_log']
 
     def _print_mft(self):
         root_dir = self.FILE_SYSTEM.open_dir(inode=self.ROOT_INUM)
@@ -679,6 +774,8 @@ class SemanticEngineVolumePyTSK_NTFS(SemanticEngineVolume):
         
             print output
         
+        self._index_runs()
+        
     
     def _load_file_system(self):
         """
@@ -697,6 +794,7 @@ class SemanticEngineVolumePyTSK_NTFS(SemanticEngineVolume):
         last_inum = self.FILE_SYSTEM.info.last_inum
         for inode_num in xrange(0, last_inum+1):
             self._load_file_entry(inode_num)
+        self._index_runs()
             
 
 
@@ -805,8 +903,8 @@ class SemanticEngineVolumePyTSK_NTFS(SemanticEngineVolume):
         """
         # add the sectors inside the MFT for this inode too
         sectors = self._mft_record_to_sectors(inode_num)
-        for s in sectors:
-            self.sector_to_mft_record_no[s] = inode_num
+        if len(sectors) > 0:
+            self.pending_mft_runs.append((sectors[0], len(sectors), inode_num))
         
         # open up the file entry by inode number
         f = self.FILE_SYSTEM.open_meta(inode=inode_num)
@@ -869,69 +967,84 @@ class SemanticEngineVolumePyTSK_NTFS(SemanticEngineVolume):
 
     def _remove_run(self, inode_num, addr, length):
         """
-        Remove a data run
+        Remove a data run.  Runs are indexed in bulk by _index_runs().
         """
+        # check for out of bounds
+        if (length < 0 or length > self.BLOCK_COUNT) or (addr < 0 or addr+length > self.BLOCK_COUNT):                
+            self.error_log.append({'error_type':'datarun_out_of_bounds', 'MFT Record Number':inode_num, 'data_run':{'num_blocks':length, 'addr':addr}})
+            return
         
-        for i in range(length):
-            # check for out of bounds
-            if (length < 0 or length > self.BLOCK_COUNT) or (addr < 0 or addr+length > self.BLOCK_COUNT):                
-                self.error_log.append({'error_type':'datarun_out_of_bounds', 'MFT Record Number':inode_num, 'data_run':{'num_blocks':length, 'addr':addr}})
-                continue
-            
-            for sector in self._block_to_sectors(addr+i):
-                if sector in self.fs_sector_to_inode:
-                    del self.fs_sector_to_inode[sector]
+        self.pending_runs.append((self._block_to_sectors(addr)[0],
+                                  length*self.BLOCK_SIZE/self.SECTOR_SIZE,
+                                  None))
 
     def _add_run(self, inode_num, block_addr, length):
         """
-            Add a run and annotate all of the sectors that this file touches
+            Add a run of sectors that this file touches.  Runs are indexed in
+            bulk by _index_runs().
             
             @param inode_num: TSK inode number (aka MFT entry number) 
             @param block_addr: block offset on volume to this run
             @param length: length of run in blocks
         """
-                
-        for i in range(length):
-            
-            # check for out of bounds
-            if (length < 0 or length > self.BLOCK_COUNT) or (block_addr < 0 or block_addr+length > self.BLOCK_COUNT):                
-                self.error_log.append({'error_type':'datarun_out_of_bounds', 'MFT Record Number':inode_num, 'data_run':{'num_blocks':length, 'block_addr':block_addr}})
-                continue
+        # check for out of bounds
+        if (length < 0 or length > self.BLOCK_COUNT) or (block_addr < 0 or block_addr+length > self.BLOCK_COUNT):                
+            self.error_log.append({'error_type':'datarun_out_of_bounds', 'MFT Record Number':inode_num, 'data_run':{'num_blocks':length, 'block_addr':block_addr}})
+            return
+        
+        self.pending_runs.append((self._block_to_sectors(block_addr)[0],
+                                  length*self.BLOCK_SIZE/self.SECTOR_SIZE,
+                                  inode_num))
+
+    def _index_runs(self):
+        """
+            Apply every run added or removed since we last indexed to our 
+            sector indexes, in the order that they were found
+        """
+        if len(self.pending_runs) > 0:
+            self.fs_sector_index.update(self.pending_runs, 
+                                        self._resolve_collision)
+            self.pending_runs = []
+        if len(self.pending_mft_runs) > 0:
+            self.mft_sector_index.update(self.pending_mft_runs)
+            self.pending_mft_runs = []
+
+    def _resolve_collision(self, inode2, inode_num, sector):
+        """
+            Decide which inode owns sectors that are claimed by two runs
             
+            @param inode2: Inode that already owns the sectors
+            @param inode_num: Inode of the new run
+            @param sector: first sector of the collision
+            @return: Inode that should own the sectors
+        """
+        # check that the inodes (MFT record number for NTFS) are not the same
+        if inode_num == inode2:
+            return inode_num
+        
+        f1_name = ""
+        if inode_num in self.fs_inode_to_path:
+            f1_name = self.fs_inode_to_path[inode_num]
+
+        f2_name = ""
+        if inode2 in self.fs_inode_to_path:
+            f2_name = self.fs_inode_to_path[inode2]
+        
+        # dealing with special case of $BadClus
+        if f1_name != "" and f1_name[1] != '$' and f2_name != "" and f2_name[1] != '$':
+            block_addr = self._sector_to_block(sector)
             
-            for sector in self._block_to_sectors(block_addr+i):
+            logger.error("Datarun collision for MFT record no %d and MFT record no %d at block %d." % (inode_num, inode2, block_addr))
             
-                # check for a collision
-                if sector in self.fs_sector_to_inode:
-                    # filter out special metafiles
-                    inode2 = self.fs_sector_to_inode[sector]
-                    
-                    f1_name = ""
-                    if inode_num in self.fs_inode_to_path:
-                        f1_name = self.fs_inode_to_path[inode_num]
-
-                    f2_name = ""
-                    if inode2 in self.fs_inode_to_path:
-                        f2_name = self.fs_inode_to_path[inode2]
-                    
-                    # check that the inodes (MFT record number for NTFS) are not the same
-                    if inode_num != inode2:
-                        
-                        # dealing with special case of $BadClus
-                        if f1_name != "" and f1_name[1] != '$' and f2_name != "" and f2_name[1] != '$':
-                        
-                            logger.error("Datarun collision for MFT record no %d and MFT record no %d at block %d." % (inode_num, inode2, block_addr+i))
-                            print "Datarun collision for MFT record no %d and MFT record no %d at block %d." % (inode_num, inode2, block_addr+i)
-                            
-                            self.error_log.append({'error_type':'datarun_collision', 
-                                               'filename1':f1_name, 
-                                               'inode1':inode_num, 
-                                               'filename2':f2_name,
-                                               'inode2':inode2, 
-                                               'block_addr':block_addr+i})
-                            continue
-                
-                self.fs_sector_to_inode[sector] = inode_num
+            self.error_log.append({'error_type':'datarun_collision', 
+                               'filename1':f1_name, 
+                               'inode1':inode_num, 
+                               'filename2':f2_name,
+                               'inode2':inode2, 
+                               'block_addr':block_addr})
+            return inode2
+        
+        return inode_num
 
 
     def get_access(self, sector, sector_count, direction, data):
@@ -975,9 +1088,8 @@ class SemanticEngineVolumePyTSK_NTFS(SemanticEngineVolume):
         
             for i in xrange(sector_count):
                 # determine which files we need to update
-                if sector+i in self.fs_sector_to_inode:
-                    
-                    inode = self.fs_sector_to_inode[sector+i]
+                inode = self.fs_sector_index.lookup(sector+i)
+                if inode is not None:
                     
                     mft_records_that_need_updating.add(inode)
                     if inode not in old_records:
@@ -985,9 +1097,9 @@ class SemanticEngineVolumePyTSK_NTFS(SemanticEngineVolume):
                         
                         # DO we need a copy of this?  There are pointers in this structure
                         old_records[inode] = f
-                if sector+i in self.sector_to_mft_record_no:
+                inode = self.mft_sector_index.lookup(sector+i)
+                if inode is not None:
                     # this sector is in the MFT itself
-                    inode = self.sector_to_mft_record_no[sector+i]
                     
                     #print "MFT was touched at sector %d, inode %d" % (sector+i, inode)
                     
@@ -1077,14 +1189,13 @@ class SemanticEngineVolumePyTSK_NTFS(SemanticEngineVolume):
                 else:
                     pass
 
-
+            self._index_runs()
             
             # Look at the writes again semantically and add them to our output structure            
             for i in xrange(sector_count):
                 # KNOWN WRITE
-                if sector+i in self.fs_sector_to_inode:
-                    
-                    inode = self.fs_sector_to_inode[sector+i]
+                inode = self.fs_sector_index.lookup(sector+i)
+                if inode is not None:
                     
                     filename = "unknown"
                     
@@ -1147,8 +1258,9 @@ class SemanticEngineVolumePyTSK_NTFS(SemanticEngineVolume):
                 
                 
                 # Known Read
-                if sector+i in self.fs_sector_to_inode:
-                    inode = self.fs_sector_to_inode[sector+i]
+                sector_inode = self.fs_sector_index.lookup(sector+i)
+                if sector_inode is not None:
+                    inode = sector_inode
                     
                     if inode in self.fs_inode_to_path:
                         filename = self.fs_inode_to_path[inode]
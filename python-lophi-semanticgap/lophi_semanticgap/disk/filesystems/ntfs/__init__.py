@@ -10,6 +10,9 @@ import logging
 # 3rd Party
 from analyzemft import mft
 
+# LO-PHI
+from lophi_semanticgap.disk.filesystems.ntfs import bulk
+
 
 SIAttributeSizeXP = 72
 SIAttributeSizeNT = 48
@@ -29,6 +32,9 @@ class MftSession:
         self.folders = {}
         self.debug = False
         self.mftsize = 0
+        
+        # Columnar view of every record (Only from process_mft_file)
+        self.columns = None
 
 
 
@@ -107,7 +113,14 @@ class MftSession:
             sys.exit()
 
      
-    def process_mft_file(self):
+    def process_mft_file(self, processes=1):
+        """
+            Parse every record in the MFT and build all of the filepaths
+            
+            @param processes: Number of processes to decode attributes with
+            (None: number of CPUs).  Only used when NumPy is installed, 
+            otherwise every record is parsed one at a time.
+        """
           
         #self.sizecheck()
                            
@@ -118,9 +131,17 @@ class MftSession:
 
         logger.debug("%d number of records" % num_records)
 
-        for i in range(num_records):          
-
-            self.update_record(i, raw_record=None)
+        if bulk.numpy_installed:
+            # Validate, apply fixups, and pull out the fixed fields all at once
+            self.columns = bulk.MftColumns(self.MFT_RAW)
+            
+            for (i, record) in bulk.decode_records(self.columns, 
+                                                   processes=processes):
+                self._add_record(i, record)
+        else:
+            for i in range(num_records):          
+    
+                self.update_record(i, raw_record=None, gen_paths=False)
             
 #             if self.options.progress:
 #                 if num_records % (self.mftsize/5) == 0 and num_records > 0:
@@ -184,9 +205,17 @@ class MftSession:
 
 
 
-    def update_record(self, record_no, raw_record = None):
+    def update_record(self, record_no, raw_record = None, gen_paths=True):
         """
             Update record when it changes (or to initialize)
+            
+            @param record_no: MFT record number
+            @param raw_record: New contents of the record (Default: reparse 
+            it from MFT_RAW)
+            @param gen_paths: Regenerate the paths of every record afterwards.
+            Callers that resolve paths themselves (or are parsing a lot of 
+            records at once) should skip this.
+            @return: The parsed record
         """
 
         # if new data is provided, use the new data as the raw record,
@@ -198,7 +227,25 @@ class MftSession:
         raw_record = self.MFT_RAW[record_no*1024:(record_no+1)*1024]            
 
   
-        record = mft.parse_record(raw_record, mft.set_default_options())
+        record = mft.parse_record(bulk.fixup_record(raw_record), 
+                                  mft.set_default_options())
+
+        self._add_record(record_no, record)
+
+        # Need to call gen_filepaths()
+        if gen_paths:
+            self.gen_filepaths()
+        
+        return record
+
+
+    def _add_record(self, record_no, record):
+        """
+            Add a parsed record to our MFT, along with any of its children
+            
+            @param record_no: MFT record number
+            @param record: Record parsed by analyzeMFT
+        """
 
         # Update the filepaths?
         if record['fncnt'] == 1:
@@ -220,12 +267,6 @@ class MftSession:
         # process children records, if any
         # children records are stored in other records or on disk (non-resident)
         self._process_children(record_no)
-    
-
-
-        # Need to call gen_filepaths()
-        self.gen_filepaths()
-        
 
 
         
@@ -257,7 +298,7 @@ class MftSession:
                         
                     # find the other record and look for the attribute we need
                     raw_other_record = self.MFT_RAW[attr_list_record['mft_record_no']*1024:(attr_list_record['mft_record_no']+1)*1024]
-                    other_record = mft.parse_record(raw_other_record, mft.set_default_options())
+                    other_record = mft.parse_record(bulk.fixup_record(raw_other_record), mft.set_default_options())
                     
                     self.mft[attr_list_record['mft_record_no']] = other_record
                                        
@@ -275,9 +316,16 @@ class MftSession:
 
 if __name__=="__main__":
     
+    # Usage: [mft.raw] [processes]
     url = "/media/disk2/mft.raw"
+    if len(sys.argv) > 1:
+        url = sys.argv[1]
+    processes = 1
+    if len(sys.argv) > 2:
+        processes = int(sys.argv[2])
+    
     f = open(url, 'rb')
     session = MftSession(f.read())
-    session.process_mft_file()
+    session.process_mft_file(processes=processes)
     session.print_runs()
     
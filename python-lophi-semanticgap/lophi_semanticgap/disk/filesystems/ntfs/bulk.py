@@ -0,0 +1,457 @@
+"""
+    Bulk parsing of an entire MFT
+
+    Every record in the MFT is the same size, so the whole MFT can be viewed
+    as a 2-D array of records (without copying it).  Signatures are
+    validated, fixups are checked, and the fields at fixed offsets, along with
+    the parent and name from the $FILE_NAME attributes, are pulled out of
+    every record at once into columnar arrays, instead of one record at a
+    time.  Only the records that change have to be parsed again.  Full
+    attribute decoding (analyzeMFT) can be spread across a pool of processes.
+
+    (c) 2015 Massachusetts Institute of Technology
+"""
+# Native
+import struct
+import collections
+import multiprocessing
+import logging
+logger = logging.getLogger(__name__)
+
+# 3rd Party
+from analyzemft import mft
+
+try:
+    import numpy
+    numpy_installed = True
+except ImportError:
+    numpy_installed = False
+
+MFT_RECORD_SIZE = 1024
+FIXUP_SECTOR_SIZE = 512
+
+SIGNATURE_FILE = 0x454c4946 # "FILE"
+SIGNATURE_BAAD = 0x44414142 # "BAAD"
+
+ATTR_ATTRIBUTE_LIST = 0x20
+ATTR_FILE_NAME = 0x30
+ATTR_END = 0xFFFFFFFF
+
+# MFT references are a 48-bit record number and a 16-bit sequence number
+MFT_REF_MASK = 0xFFFFFFFFFFFF
+
+# Give up on records that claim to have more attributes than this
+MAX_ATTRIBUTES = 64
+
+# Number of records handed to a process at a time
+DECODE_CHUNK_SIZE = 4096
+
+
+def fixup_record(raw_record, sector_size=FIXUP_SECTOR_SIZE):
+    """
+        Apply the fixups (update sequence array) of a single record
+
+        @param raw_record: Raw MFT record
+        @param sector_size: Size of the sectors that the fixups protect
+        @return: Record with its fixups applied (Unchanged if it has none, or
+        they don't match, i.e. the record was torn)
+    """
+    if len(raw_record) < 8 or raw_record[:4] != "FILE":
+        return raw_record
+
+    (usa_offset, usa_count) = struct.unpack_from("<HH", raw_record, 4)
+    sectors = len(raw_record) / sector_size
+    if usa_count != sectors + 1 or usa_offset + 2 * usa_count > sector_size:
+        return raw_record
+
+    usn = raw_record[usa_offset:usa_offset + 2]
+    record = bytearray(raw_record)
+    for i in xrange(1, usa_count):
+        end = i * sector_size - 2
+        if raw_record[end:end + 2] != usn:
+            logger.debug("Fixups do not match, record is torn.")
+            return raw_record
+        record[end:end + 2] = raw_record[usa_offset + 2 * i:
+                                         usa_offset + 2 * i + 2]
+    return str(record)
+
+
+class MftColumns:
+    """
+        Fields of every record in an MFT, as arrays indexed by record number
+
+        valid: Record has a FILE signature
+        baad: Record has a BAAD signature
+        torn: Fixups did not match (The record was only partially written)
+        fixed: Fixups were found (and are applied to everything we read)
+        flags: Record flags (0x1: In use, 0x2: Directory)
+        seq: Sequence number
+        link_count: Hard link count
+        base_record: Record number of the base record (0 for base records)
+        base_seq: Sequence number of the base record
+        parent_record: Parent of the first $FILE_NAME (-1 if there isn't one)
+        parent_seq: Sequence number of the parent
+        name_offset: Offset of the $FILE_NAME whose name we use (A Win32 name
+        if there is one, otherwise the last one), -1 if there isn't one
+        attribute_list: Record has an $ATTRIBUTE_LIST attribute
+    """
+
+    # (name, dtype, default)
+    COLUMNS = [('valid', bool, False),
+               ('baad', bool, False),
+               ('torn', bool, False),
+               ('fixed', bool, False),
+               ('flags', 'int64', 0),
+               ('seq', 'int64', 0),
+               ('link_count', 'int64', 0),
+               ('base_record', 'int64', 0),
+               ('base_seq', 'int64', 0),
+               ('parent_record', 'int64', -1),
+               ('parent_seq', 'int64', 0),
+               ('name_offset', 'int64', -1),
+               ('attribute_list', bool, False)]
+
+    def __init__(self, mft_raw, record_size=MFT_RECORD_SIZE):
+        """
+            Parse an entire MFT
+
+            @param mft_raw: Raw MFT (Any trailing partial record is ignored).
+            We keep a view of it, so it must not be modified in place.
+            @param record_size: Size of each record
+        """
+        if not numpy_installed:
+            raise ImportError("NumPy is required to parse the MFT in bulk.")
+
+        self.record_size = record_size
+        self.sectors = record_size / FIXUP_SECTOR_SIZE
+
+        self.count = 0
+        self.records = None
+        self.update(mft_raw)
+
+        logger.debug("Parsed %d MFT records in bulk. (%d valid, %d BAAD, "
+                     "%d torn)" % (self.count, self.valid.sum(),
+                                   self.baad.sum(), self.torn.sum()))
+
+    def __len__(self):
+        return self.count
+
+    def _resize(self, count):
+        """ Grow (or shrink) every column to count records """
+        for (name, dtype, default) in self.COLUMNS:
+            column = numpy.empty(count, dtype=dtype)
+            column.fill(default)
+            old = getattr(self, name, None)
+            if old is not None:
+                keep = min(count, len(old))
+                column[:keep] = old[:keep]
+            setattr(self, name, column)
+
+        # Original contents of the last two bytes of each sector
+        fixups = numpy.zeros((count, self.sectors, 2), dtype=numpy.uint8)
+        old = getattr(self, 'fixups', None)
+        if old is not None:
+            keep = min(count, len(old))
+            fixups[:keep] = old[:keep]
+        self.fixups = fixups
+
+        self.count = count
+
+    def update(self, mft_raw, record_nos=None):
+        """
+            Switch to a new copy of the MFT, and parse the records that changed
+
+            @param mft_raw: Raw MFT
+            @param record_nos: Records that changed (Default: All of them).
+            Records that weren't in the last copy are always parsed.
+        """
+        count = len(mft_raw) / self.record_size
+        old_count = self.count
+        if count != self.count:
+            self._resize(count)
+
+        self.records = numpy.frombuffer(mft_raw, dtype=numpy.uint8,
+                                        count=count * self.record_size)
+        self.records = self.records.reshape(count, self.record_size)
+
+        if record_nos is None:
+            rows = numpy.arange(count)
+        else:
+            rows = set(r for r in record_nos if 0 <= r < count)
+            rows.update(xrange(old_count, count))
+            rows = numpy.array(sorted(rows), dtype=numpy.int64)
+
+        if len(rows) > 0:
+            self._parse(rows)
+
+    def _byte(self, rows, offsets):
+        """
+            Return one byte from each of some records, with their fixups
+            applied
+
+            @param rows: Records to read from
+            @param offsets: Offset to read from (in every record, or in each)
+            @return: Array of bytes
+        """
+        offsets = offsets + numpy.zeros(len(rows), dtype=numpy.int64)
+        values = self.records[rows, offsets]
+
+        position = offsets % FIXUP_SECTOR_SIZE
+        tail = (position >= FIXUP_SECTOR_SIZE - 2) & self.fixed[rows]
+        if tail.any():
+            values[tail] = self.fixups[rows[tail],
+                                       offsets[tail] / FIXUP_SECTOR_SIZE,
+                                       position[tail] - FIXUP_SECTOR_SIZE + 2]
+        return values
+
+    def _gather(self, rows, offsets, size):
+        """
+            Return a little-endian unsigned field from each of some records
+
+            @param rows: Records to read from
+            @param offsets: Offset of the field (in every record, or in each),
+            which must leave room for the field
+            @param size: Size of the field in bytes
+            @return: Array of values
+        """
+        value = numpy.zeros(len(rows), dtype=numpy.uint64)
+        for i in xrange(size):
+            value |= self._byte(rows, offsets + i).astype(numpy.uint64) << \
+                     numpy.uint64(8 * i)
+        return value
+
+    def _parse(self, rows):
+        """ Parse some of our records """
+        signature = self._gather(rows, 0, 4)
+        self.valid[rows] = signature == SIGNATURE_FILE
+        self.baad[rows] = signature == SIGNATURE_BAAD
+
+        self.seq[rows] = self._gather(rows, 0x10, 2)
+        self.link_count[rows] = self._gather(rows, 0x12, 2)
+        self.flags[rows] = self._gather(rows, 0x16, 2)
+        base_ref = self._gather(rows, 0x20, 8)
+        self.base_record[rows] = base_ref & numpy.uint64(MFT_REF_MASK)
+        self.base_seq[rows] = base_ref >> numpy.uint64(48)
+
+        self._check_fixups(rows)
+        self._scan_attributes(rows)
+
+    def _check_fixups(self, rows):
+        """
+            Validate the fixups of some records, and keep the bytes that they
+            replace
+        """
+        self.torn[rows] = False
+        self.fixed[rows] = False
+
+        usa_offset = self._gather(rows, 4, 2).astype(numpy.int64)
+        usa_count = self._gather(rows, 6, 2).astype(numpy.int64)
+
+        ok = self.valid[rows] & (usa_count == self.sectors + 1) & \
+             (usa_offset + 2 * usa_count <= FIXUP_SECTOR_SIZE)
+        rows = rows[ok]
+        usa_offset = usa_offset[ok]
+        if len(rows) == 0:
+            return
+
+        # The last two bytes of every sector must match the sequence number
+        usn = self._gather(rows, usa_offset, 2)
+        matched = numpy.ones(len(rows), dtype=bool)
+        for i in xrange(1, self.sectors + 1):
+            matched &= self._gather(rows, i * FIXUP_SECTOR_SIZE - 2, 2) == usn
+        self.torn[rows[~matched]] = True
+
+        rows = rows[matched]
+        usa_offset = usa_offset[matched]
+        for i in xrange(self.sectors):
+            self.fixups[rows, i, 0] = self.records[rows, usa_offset + 2 * i + 2]
+            self.fixups[rows, i, 1] = self.records[rows, usa_offset + 2 * i + 3]
+        self.fixed[rows] = True
+
+    def _scan_attributes(self, rows):
+        """
+            Walk the attribute headers of some records in lock step, looking
+            for their $FILE_NAMEs and any $ATTRIBUTE_LIST
+        """
+        size = self.record_size
+
+        self.parent_record[rows] = -1
+        self.parent_seq[rows] = 0
+        self.name_offset[rows] = -1
+        self.attribute_list[rows] = False
+
+        # Parallel to rows
+        position = self._gather(rows, 0x14, 2).astype(numpy.int64)
+        active = self.valid[rows] & ~self.torn[rows]
+        win32 = numpy.zeros(len(rows), dtype=bool)
+
+        for _ in xrange(MAX_ATTRIBUTES):
+            # Every attribute header is at least 16 bytes
+            active &= position + 16 <= size
+            idx = numpy.nonzero(active)[0]
+            if len(idx) == 0:
+                break
+            current = rows[idx]
+            offsets = position[idx]
+
+            attr_type = self._gather(current, offsets, 4)
+            attr_length = self._gather(current, offsets + 4, 4).astype(
+                                                                numpy.int64)
+            done = (attr_type == ATTR_END) | (attr_length == 0) | \
+                   (offsets + attr_length > size)
+            attr_type[done] = ATTR_END
+
+            self.attribute_list[current[attr_type == ATTR_ATTRIBUTE_LIST]] = \
+                True
+
+            # Resident $FILE_NAMEs whose name header fits in the record
+            file_name = (attr_type == ATTR_FILE_NAME) & \
+                        (self._byte(current, offsets + 8) == 0)
+            if file_name.any():
+                fn_idx = idx[file_name]
+                fn_rows = current[file_name]
+                content = offsets[file_name] + self._gather(
+                                                fn_rows,
+                                                offsets[file_name] + 0x14,
+                                                2).astype(numpy.int64)
+                fits = content + 0x42 <= size
+                fn_idx = fn_idx[fits]
+                fn_rows = fn_rows[fits]
+                content = content[fits]
+
+                # Parent of the first one
+                first = self.parent_record[fn_rows] < 0
+                parent_ref = self._gather(fn_rows[first], content[first], 8)
+                self.parent_record[fn_rows[first]] = \
+                    parent_ref & numpy.uint64(MFT_REF_MASK)
+                self.parent_seq[fn_rows[first]] = \
+                    parent_ref >> numpy.uint64(48)
+
+                # Name of a Win32 one, otherwise the last one
+                namespace = self._byte(fn_rows, content + 0x41)
+                is_win32 = (namespace == 1) | (namespace == 3)
+                use = is_win32 | ~win32[fn_idx]
+                self.name_offset[fn_rows[use]] = content[use]
+                win32[fn_idx[is_win32]] = True
+
+            active[idx[done]] = False
+            position[idx] = offsets + attr_length
+
+    def in_use(self):
+        """
+            @return: Array of the record numbers that are valid and in use
+        """
+        return numpy.nonzero(self.valid & (self.flags & 0x1 != 0))[0]
+
+    def named_records(self):
+        """
+            @return: Array of the record numbers of base records that are in
+            use and have a $FILE_NAME
+        """
+        return numpy.nonzero(self.valid & (self.flags & 0x1 != 0) &
+                             (self.base_record == 0) &
+                             (self.parent_record >= 0))[0]
+
+    def raw_record(self, record_no):
+        """
+            @return: Raw record, with its fixups applied
+        """
+        record = bytearray(self.records[record_no].tostring())
+        if self.fixed[record_no]:
+            for i in xrange(self.sectors):
+                end = (i + 1) * FIXUP_SECTOR_SIZE
+                record[end - 2:end] = self.fixups[record_no, i].tostring()
+        return str(record)
+
+    def file_name(self, record_no):
+        """
+            Return the parent and name of a record
+
+            @param record_no: MFT record number
+            @return: (parent record number, name (UTF-8)), or None if the
+            record has no $FILE_NAME
+        """
+        if record_no >= self.count or self.parent_record[record_no] < 0:
+            return None
+
+        offset = self.name_offset[record_no]
+        record = self.raw_record(record_no)
+        length = ord(record[offset + 0x40])
+        name = record[offset + 0x42:offset + 0x42 + 2 * length]
+
+        return (int(self.parent_record[record_no]),
+                name.decode('utf-16-le', 'replace').encode('utf-8'))
+
+
+def _decode_chunk(chunk):
+    """
+        Decode the attributes of some records with analyzeMFT
+
+        @param chunk: List of (record number, raw record)
+        @return: List of (record number, parsed record)
+    """
+    options = mft.set_default_options()
+    return [(record_no, mft.parse_record(raw_record, options))
+            for (record_no, raw_record) in chunk]
+
+
+def decode_records(columns, record_nos=None, processes=1,
+                   chunk_size=DECODE_CHUNK_SIZE):
+    """
+        Decode the attributes of records with analyzeMFT, optionally using a
+        pool of processes
+
+        Only a few chunks are decoded ahead of the consumer so that a slow
+        consumer doesn't cause every record to pile up in memory.
+
+        @param columns: MftColumns of the MFT
+        @param record_nos: Records to decode (Default: All of them)
+        @param processes: Number of processes (None: number of CPUs)
+        @param chunk_size: Number of records handed to a process at a time
+        @return: Generator of (record number, parsed record), in the order
+        given
+    """
+    if record_nos is None:
+        record_nos = xrange(len(columns))
+
+    def chunks():
+        chunk = []
+        for record_no in record_nos:
+            chunk.append((record_no, columns.raw_record(record_no)))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    if processes == 1:
+        for chunk in chunks():
+            for decoded in _decode_chunk(chunk):
+                yield decoded
+        return
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = collections.deque()
+        remaining = chunks()
+        exhausted = False
+        while not exhausted or len(pending) > 0:
+
+            # Keep every process busy, and one chunk queued for each
+            while not exhausted and len(pending) < 2 * processes:
+                try:
+                    chunk = remaining.next()
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.append(pool.apply_async(_decode_chunk, (chunk,)))
+
+            if len(pending) > 0:
+                for decoded in pending.popleft().get():
+                    yield decoded
+    finally:
+        pool.terminate()
+        pool.join()
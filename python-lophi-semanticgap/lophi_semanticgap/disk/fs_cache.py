@@ -0,0 +1,192 @@
+"""
+    Persistent cache of the filesystem model that our semantic engines parse
+    from a disk image
+
+    Parsing every MFT entry and walking the whole directory tree of a large
+    image takes minutes, but the result only depends on the contents of the
+    image.  We store a snapshot of each volume's parsed state next to the base
+    image and reuse it as long as the image hasn't changed.
+
+    Every semantic engine parses volumes into its own kind of state, so each
+    one keeps a separate snapshot, named after the engine (See engine_name).
+
+    (c) 2015 Massachusetts Institute of Technology
+"""
+# Native
+import os
+import cPickle
+import hashlib
+import logging
+logger = logging.getLogger(__name__)
+
+CACHE_SUFFIX = ".fscache"
+CACHE_VERSION = 3
+
+HASH_CHUNK_SIZE = 1024 * 1024 # bytes
+
+
+def image_key(url, hash_contents=False):
+    """
+        Return a key that changes whenever a disk image changes
+
+        @param url: Path to the disk image
+        @param hash_contents: Hash the entire image instead of trusting its
+        size and modification time
+        @return: Key as a string, or None if the image can't be read
+    """
+    try:
+        if not hash_contents:
+            st = os.stat(url)
+            return "%d:%d" % (st.st_size, int(st.st_mtime * 1000000))
+
+        hasher = hashlib.sha1()
+        f = open(url, "rb")
+        while True:
+            data = f.read(HASH_CHUNK_SIZE)
+            if len(data) == 0:
+                break
+            hasher.update(data)
+        f.close()
+        return "sha1:" + hasher.hexdigest()
+    except (IOError, OSError):
+        logger.error("Could not read disk image. (%s)" % url)
+        return None
+
+
+def engine_name(engine):
+    """
+        Return the name that a semantic engine's snapshots are stored under
+        
+        @param engine: Semantic engine (E.g. SemanticEngineDisk instance)
+        @return: Name as a string, E.g. filesystem_reconstructor.SemanticEngineDisk
+    """
+    return "%s.%s" % (engine.__module__.split(".")[-1],
+                      engine.__class__.__name__)
+
+
+class FilesystemCache:
+    """
+        Snapshot of the parsed volumes of one disk image, stored as
+        <image>.<engine>.fscache
+    """
+
+    def __init__(self, image_url, hash_contents=False, cache_url=None):
+        """
+            Initialize our cache
+
+            @param image_url: Path to the (base) disk image that the snapshot
+            describes
+            @param hash_contents: Key the snapshot on a hash of the image's
+            contents instead of its size and modification time
+            @param cache_url: Where to store the snapshot (Default: next to the
+            image), the engine's name is added before its extension
+        """
+        self.image_url = image_url
+        self.hash_contents = hash_contents
+
+        if cache_url is None:
+            cache_url = image_url + CACHE_SUFFIX
+        self.filename = cache_url
+
+        self.key = None
+
+    def _get_key(self):
+        """ Compute the key of our image once """
+        if self.key is None:
+            self.key = image_key(self.image_url, self.hash_contents)
+        return self.key
+
+    def get_filename(self, engine):
+        """
+            Return the filename of an engine's snapshot
+
+            @param engine: Name of the engine (See engine_name)
+            @return: Filename
+        """
+        (root, ext) = os.path.splitext(self.filename)
+        return "%s.%s%s" % (root, engine, ext)
+
+    def load(self, engine):
+        """
+            Load the state of every volume from our snapshot
+
+            @param engine: Name of the engine that parsed them (See 
+            engine_name)
+            @return: Dict of volume start sector -> volume state, or None if
+            there is no usable snapshot for this image
+        """
+        filename = self.get_filename(engine)
+        if not os.path.exists(filename):
+            return None
+
+        key = self._get_key()
+        if key is None:
+            return None
+
+        try:
+            f = open(filename, "rb")
+            (version, cached_engine, cached_key) = cPickle.load(f)
+            if version != CACHE_VERSION or cached_engine != engine or \
+                    cached_key != key:
+                f.close()
+                logger.info("Filesystem cache is stale. (%s)" % filename)
+                return None
+
+            states = cPickle.load(f)
+            f.close()
+        except:
+            logger.error("Could not read filesystem cache. (%s)" % filename)
+            return None
+
+        if not isinstance(states, dict):
+            logger.error("Filesystem cache is corrupt. (%s)" % filename)
+            return None
+
+        logger.info("Loaded filesystem cache. (%s)" % filename)
+        return states
+
+    def save(self, states, engine):
+        """
+            Store the state of every volume
+
+            @param states: Dict of volume start sector -> volume state
+            @param engine: Name of the engine that parsed them (See 
+            engine_name)
+            @return: True/False
+        """
+        key = self._get_key()
+        if key is None:
+            return False
+
+        # Write to a temporary file so that readers never see a partial cache
+        filename = self.get_filename(engine)
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            f = open(tmp_filename, "wb")
+            cPickle.dump((CACHE_VERSION, engine, key), f,
+                         cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(states, f, cPickle.HIGHEST_PROTOCOL)
+            f.close()
+            os.rename(tmp_filename, filename)
+        except:
+            logger.warning("Could not write filesystem cache. (%s)" %
+                           filename)
+            try:
+                os.unlink(tmp_filename)
+            except OSError:
+                pass
+            return False
+
+        logger.info("Saved filesystem cache. (%s)" % filename)
+        return True
+
+    def invalidate(self, engine):
+        """
+            Remove an engine's snapshot
+
+            @param engine: Name of the engine (See engine_name)
+        """
+        try:
+            os.unlink(self.get_filename(engine))
+        except OSError:
+            pass
@@ -0,0 +1,295 @@
+"""
+    Copy-on-write overlay of a disk image
+
+    The image itself is memory-mapped read-only and never modified.  Writes
+    are kept as sorted, non-overlapping extents of bytes, backed either by a
+    bytearray arena in memory or by a sparse overlay file, so a large write is
+    a single extent instead of thousands of sectors, and a read of a long run
+    is a single slice of the image (or of the overlay) instead of one read per
+    sector.
+
+    (c) 2015 Massachusetts Institute of Technology
+"""
+# Native
+import os
+import mmap
+import bisect
+import logging
+logger = logging.getLogger(__name__)
+
+# Our arena is only compacted once it is at least this big (bytes), and more
+# than half of it is data that has since been overwritten
+ARENA_COMPACT_SIZE = 64 * 1024 * 1024
+
+
+class ImageOverlay:
+    """
+        Disk image with a copy-on-write overlay of everything written to it
+    """
+
+    def __init__(self, url, overlay_url=None):
+        """
+            Open our image
+
+            @param url: Path to the disk image (Only ever read)
+            @param overlay_url: Path to a sparse file to store written data in
+            (Default: keep it in memory).  The file is truncated when it is
+            opened and deleted when we are closed.
+        """
+        self.url = url
+        self.overlay_url = overlay_url
+
+        self.fd = open(url, 'rb')
+        self.base_size = os.fstat(self.fd.fileno()).st_size
+        self.size = self.base_size
+
+        self.base = None
+        if self.base_size > 0:
+            self.base = mmap.mmap(self.fd.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+
+        # Where written data goes
+        self.arena = None
+        self.overlay_fd = None
+        if overlay_url is None:
+            self.arena = bytearray()
+            self.compact_size = ARENA_COMPACT_SIZE
+        else:
+            self.overlay_fd = open(overlay_url, 'w+b')
+
+        # Parallel lists of written [start, end) byte ranges, sorted by start,
+        # and the offset of each one's data in our arena (or overlay file)
+        self.starts = []
+        self.ends = []
+        self.offsets = []
+
+    def __len__(self):
+        """ Return the number of extents that have been written """
+        return len(self.starts)
+
+    def extents(self):
+        """
+            Return every range that has been written
+
+            @return: List of (start, end) byte offsets
+        """
+        return zip(self.starts, self.ends)
+
+    def _read_base(self, start, end):
+        """ Read from the image, anything written past its end is zeros """
+        if start >= self.base_size:
+            return "\x00" * (end - start)
+        data = self.base[start:min(end, self.base_size)]
+        if end > self.base_size:
+            data += "\x00" * (end - self.base_size)
+        return data
+
+    def _read_overlay(self, position, length):
+        """ Read written data back out of our arena (or overlay file) """
+        if self.arena is not None:
+            return str(buffer(self.arena, position, length))
+        self.overlay_fd.seek(position)
+        return self.overlay_fd.read(length)
+
+    def _store(self, position, data):
+        """ Overwrite data in our arena (or overlay file) """
+        if self.arena is not None:
+            self.arena[position:position + len(data)] = data
+        else:
+            self.overlay_fd.seek(position)
+            self.overlay_fd.write(data)
+
+    def _append(self, start, data):
+        """
+            Store new data
+
+            @return: Offset of the data in our arena (or overlay file)
+        """
+        if self.arena is not None:
+            position = len(self.arena)
+            self.arena.extend(data)
+            return position
+
+        # The overlay file mirrors the image, so extents line up with it
+        self._store(start, data)
+        return start
+
+    def read(self, offset, length):
+        """
+            Read from the image, with everything written on top of it
+
+            @param offset: Byte offset into the image
+            @param length: Number of bytes to read
+            @return: Data (Short if the read goes past the end of the image)
+        """
+        end = min(offset + length, self.size)
+        if end <= offset or offset < 0:
+            return ""
+
+        # Extents that overlap [offset, end)
+        lo = bisect.bisect_right(self.ends, offset)
+        hi = bisect.bisect_left(self.starts, end)
+
+        # Nothing written here
+        if lo >= hi:
+            return self._read_base(offset, end)
+
+        data = []
+        position = offset
+        for idx in xrange(lo, hi):
+            start = max(self.starts[idx], offset)
+            stop = min(self.ends[idx], end)
+            if position < start:
+                data.append(self._read_base(position, start))
+            data.append(self._read_overlay(
+                                self.offsets[idx] + start - self.starts[idx],
+                                stop - start))
+            position = stop
+
+        if position < end:
+            data.append(self._read_base(position, end))
+
+        return "".join(data)
+
+    def write(self, offset, data):
+        """
+            Write on top of the image
+
+            @param offset: Byte offset into the image
+            @param data: Data to write
+        """
+        length = len(data)
+        if length == 0:
+            return
+        end = offset + length
+
+        # Rewriting part of a single extent (e.g. an MFT record) happens in
+        # place
+        idx = bisect.bisect_right(self.starts, offset) - 1
+        if idx >= 0 and end <= self.ends[idx]:
+            self._store(self.offsets[idx] + offset - self.starts[idx], data)
+            return
+
+        position = self._append(offset, data)
+        self._insert(offset, end, position)
+
+        self.size = max(self.size, end)
+
+        if self.arena is not None and len(self.arena) > self.compact_size:
+            self._compact()
+
+    def _compact(self):
+        """
+            Throw away data in our arena that has been overwritten, if there
+            is enough of it to be worth copying everything else
+        """
+        live = sum(end - start for (start, end) in self.extents())
+        if live * 2 < len(self.arena):
+            arena = bytearray()
+            starts = []
+            ends = []
+            offsets = []
+            for idx in xrange(len(self.starts)):
+                start = self.starts[idx]
+                end = self.ends[idx]
+                position = len(arena)
+                arena.extend(buffer(self.arena, self.offsets[idx],
+                                    end - start))
+
+                # Touching extents are contiguous now
+                if len(ends) > 0 and ends[-1] == start:
+                    ends[-1] = end
+                else:
+                    starts.append(start)
+                    ends.append(end)
+                    offsets.append(position)
+
+            logger.debug("Compacted overlay arena. (%d -> %d bytes)" %
+                         (len(self.arena), len(arena)))
+            self.arena = arena
+            self.starts = starts
+            self.ends = ends
+            self.offsets = offsets
+
+        self.compact_size = max(ARENA_COMPACT_SIZE, len(self.arena) * 2)
+
+    def _insert(self, start, end, position):
+        """
+            Add an extent, replacing whatever it overlaps and merging it with
+            its neighbors when their data is contiguous
+        """
+        starts = self.starts
+        ends = self.ends
+        offsets = self.offsets
+
+        # Extents that overlap [start, end)
+        lo = bisect.bisect_right(ends, start)
+        hi = bisect.bisect_left(starts, end)
+
+        new_starts = [start]
+        new_ends = [end]
+        new_offsets = [position]
+
+        if lo < hi:
+            # Keep whatever sticks out of either side
+            if starts[lo] < start:
+                new_starts.insert(0, starts[lo])
+                new_ends.insert(0, start)
+                new_offsets.insert(0, offsets[lo])
+            if ends[hi - 1] > end:
+                new_starts.append(end)
+                new_ends.append(ends[hi - 1])
+                new_offsets.append(offsets[hi - 1] + end - starts[hi - 1])
+
+        starts[lo:hi] = new_starts
+        ends[lo:hi] = new_ends
+        offsets[lo:hi] = new_offsets
+
+        # Merge around the extents we just inserted
+        idx = max(lo - 1, 0)
+        last = min(lo + len(new_starts), len(starts) - 1)
+        while idx < last:
+            if ends[idx] == starts[idx + 1] and \
+                    offsets[idx] + ends[idx] - starts[idx] == offsets[idx + 1]:
+                ends[idx] = ends[idx + 1]
+                del starts[idx + 1]
+                del ends[idx + 1]
+                del offsets[idx + 1]
+                last -= 1
+            else:
+                idx += 1
+
+    def sectors(self, sector_size):
+        """
+            Return the contents of every sector that has been written to
+
+            @param sector_size: Size of a sector in bytes
+            @return: Dictionary of sector -> data
+        """
+        rtn = {}
+        for (start, end) in self.extents():
+            for sector in xrange(start / sector_size,
+                                 (end - 1) / sector_size + 1):
+                if sector not in rtn:
+                    rtn[sector] = self.read(sector * sector_size, sector_size)
+        return rtn
+
+    def close(self):
+        """ Close our image, and throw away our overlay """
+        if self.base is not None:
+            self.base.close()
+            self.base = None
+        self.fd.close()
+
+        if self.overlay_fd is not None:
+            self.overlay_fd.close()
+            self.overlay_fd = None
+            try:
+                os.unlink(self.overlay_url)
+            except OSError:
+                pass
+
+        self.arena = bytearray() if self.arena is not None else None
+        self.starts = []
+        self.ends = []
+        self.offsets = []
@@ -0,0 +1,241 @@
+"""
+    Index of runs (extents) of blocks on a volume
+
+    Maps non-overlapping [START,END) ranges of blocks to a value (e.g. the file
+    that owns them) so that memory use and lookups scale with the number of
+    fragments instead of the number of blocks.
+
+    (c) 2015 Massachusetts Institute of Technology
+"""
+# Native
+import bisect
+import logging
+logger = logging.getLogger(__name__)
+
+# Updates that touch at most this many separate places in the index are 
+# spliced in, larger ones rebuild the index in a single pass
+MAX_SPLICES = 16
+
+
+class RunIndex:
+    """
+        Sorted, non-overlapping runs of blocks and the value that owns each
+    """
+
+    def __init__(self):
+        """
+            Initialize an empty index
+        """
+        # Parallel lists sorted by start
+        self.starts = []
+        self.ends = []
+        self.values = []
+
+    def __len__(self):
+        """ Return the number of runs in our index """
+        return len(self.starts)
+
+    def __iter__(self):
+        """ Iterate over (start, end, value) for every run """
+        return iter(zip(self.starts, self.ends, self.values))
+
+    def clear(self):
+        """ Remove every run """
+        self.starts = []
+        self.ends = []
+        self.values = []
+
+    def lookup(self, block):
+        """
+            Return the value that owns a block
+
+            @param block: Block address
+            @return: Value or None
+        """
+        idx = bisect.bisect_right(self.starts, block) - 1
+        if idx >= 0 and block < self.ends[idx]:
+            return self.values[idx]
+        return None
+
+    def find(self, start, end):
+        """
+            Find every run that intersects a range of blocks
+
+            @param start: First block
+            @param end: Last block (Exclusive)
+            @return: List of (start, end, value), clipped to [start,end)
+        """
+        idx = bisect.bisect_right(self.starts, start) - 1
+        if idx < 0 or self.ends[idx] <= start:
+            idx += 1
+
+        rtn = []
+        while idx < len(self.starts) and self.starts[idx] < end:
+            rtn.append((max(self.starts[idx], start),
+                        min(self.ends[idx], end),
+                        self.values[idx]))
+            idx += 1
+        return rtn
+
+    def update(self, runs, resolve=None):
+        """
+            Apply a batch of runs to the index
+
+            Runs are applied in order, so a later run replaces an earlier one
+            (or one already in the index) wherever they overlap.  A run with a
+            value of None removes those blocks from the index.
+
+            Only the runs already in the index that the batch touches are 
+            rebuilt, everything between them is kept as is.
+
+            @param runs: Iterable of (start, length, value)
+            @param resolve: Function (old value, new value, first block) ->
+            value to keep, called for every range where a run overlaps one
+            already applied.  (Default: keep the new value)
+        """
+        new_runs = []
+        order = 0
+        for (start, length, value) in runs:
+            if length > 0:
+                new_runs.append((start, start + length, order, value))
+            order += 1
+
+        if len(new_runs) == 0:
+            return
+        new_runs.sort()
+
+        # Group the new runs so that no two groups touch the same run in the
+        # index (or each other), each group is then rebuilt on its own.
+        # Groups with nothing in between are rebuilt together.
+        # Format: [first run in index, last run in index (Exclusive), 
+        #          end of the new runs, new runs]
+        groups = []
+        for run in new_runs:
+            (start, end, order, value) = run
+            # Include runs that we touch, so that they can be merged with ours
+            first = bisect.bisect_left(self.ends, start)
+            last = bisect.bisect_right(self.starts, end)
+            if len(groups) > 0 and (first <= groups[-1][1] or 
+                                    start <= groups[-1][2]):
+                group = groups[-1]
+                group[1] = max(group[1], last)
+                group[2] = max(group[2], end)
+                group[3].append(run)
+            else:
+                groups.append([first, last, end, [run]])
+
+        # A few small updates (E.g. a single MFT record), splice them in from
+        # the back so that the indices of earlier groups stay valid
+        if len(groups) <= MAX_SPLICES:
+            for (first, last, _, group_runs) in reversed(groups):
+                starts = []
+                ends = []
+                values = []
+                self._rebuild(first, last, group_runs, resolve, 
+                              starts, ends, values)
+                self.starts[first:last] = starts
+                self.ends[first:last] = ends
+                self.values[first:last] = values
+            return
+
+        starts = []
+        ends = []
+        values = []
+        copied = 0
+        for (first, last, _, group_runs) in groups:
+            # Keep everything before this group as is
+            starts.extend(self.starts[copied:first])
+            ends.extend(self.ends[copied:first])
+            values.extend(self.values[copied:first])
+            copied = last
+
+            self._rebuild(first, last, group_runs, resolve, 
+                          starts, ends, values)
+
+        starts.extend(self.starts[copied:])
+        ends.extend(self.ends[copied:])
+        values.extend(self.values[copied:])
+
+        self.starts = starts
+        self.ends = ends
+        self.values = values
+
+    def _rebuild(self, first, last, runs, resolve, starts, ends, values):
+        """
+            Apply new runs on top of a slice of our index, appending the runs 
+            that result to starts, ends and values
+
+            @param first: First run in our index to rebuild
+            @param last: Last run in our index to rebuild (Exclusive)
+            @param runs: List of (start, end, order, value) to apply
+            @param resolve: See update()
+        """
+        # Boundary events, runs already in the index are applied first
+        events = []
+        for idx in xrange(first, last):
+            order = idx - last
+            events.append((self.starts[idx], 1, order, self.values[idx]))
+            events.append((self.ends[idx], 0, order, self.values[idx]))
+        for (start, end, order, value) in runs:
+            events.append((start, 1, order, value))
+            events.append((end, 0, order, value))
+
+        # Sweep across every boundary.  Ends sort before starts at the same block, overlapping runs are 
+        # rare so the active set stays tiny.
+        events.sort(key=lambda e: (e[0], e[1]))
+
+        active = {}
+        idx = 0
+        while idx < len(events):
+            position = events[idx][0]
+            while idx < len(events) and events[idx][0] == position:
+                (_, is_start, order, value) = events[idx]
+                if is_start:
+                    active[order] = value
+                else:
+                    del active[order]
+                idx += 1
+
+            if len(active) == 0 or idx == len(events):
+                continue
+
+            # Apply the overlapping runs in order
+            orders = sorted(active)
+            value = active[orders[0]]
+            for order in orders[1:]:
+                if resolve is None or value is None or active[order] is None:
+                    value = active[order]
+                else:
+                    value = resolve(value, active[order], position)
+
+            if value is None:
+                continue
+
+            next_position = events[idx][0]
+
+            # Merge with the previous run if it is the same value
+            if len(ends) > 0 and ends[-1] == position and values[-1] is value:
+                ends[-1] = next_position
+            else:
+                starts.append(position)
+                ends.append(next_position)
+                values.append(value)
+
+    def add(self, start, length, value, resolve=None):
+        """
+            Add a single run (See update())
+
+            @param start: First block of the run
+            @param length: Length of the run in blocks
+            @param value: Value that owns the run
+        """
+        self.update([(start, length, value)], resolve)
+
+    def remove(self, start, length):
+        """
+            Remove a range of blocks from the index
+
+            @param start: First block
+            @param length: Number of blocks
+        """
+        self.update([(start, length, None)])
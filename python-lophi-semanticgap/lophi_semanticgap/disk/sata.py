@@ -41,59 +41,311 @@ class NCQCommandType:
     # TODO NCQQueueManagement abort subcommand
     
 
-class SATAInterpreter:
+# Register FIS - Host to Device (p. 384)
+REGISTER_HTD_HEADER = struct.Struct("!BBBB" + "BBH" + "BBH" + "BBH" + "I")
+
+# Size of the LO-PHI header (lophi.data.SATAFrame) that precedes every FIS in 
+# a capture
+SATA_FRAME_HEADER_SIZE = 4
 
-    def _extract_header(self, HEADER, packet):
-        """
-            Extract the SATA header and data
-            
-            @param HEADER: struct format for the SATA header
-            @param packet: bytestring of the packet data
-            @return: (header, data) where extracted is the struct unpack
-        """
-        # Calculate teh size of our header
-        header_len = struct.Struct(HEADER).size
 
-        # Store our header
-        extracted = struct.unpack(HEADER, packet[:header_len])
+def get_sector_range(frame):
+    """
+        Return the sectors referenced by a captured SATA frame.  Only Register
+        HTD FISes (i.e. commands) reference sectors.
+        
+        This is suitable as a sector_fn for lophi.capture.indexed
         
-        # Store the remainder as data
-        data = packet[header_len:]
+        @param frame: Raw SATAFrame (LO-PHI header + FIS) as stored in a dcap
+        @return: (lba, sector_count) or None
+    """
+    packet = frame[SATA_FRAME_HEADER_SIZE:]
+    if len(packet) < REGISTER_HTD_HEADER.size or \
+            ord(packet[3]) != FrameType.RegisterFIS_HtoD:
+        return None
+    
+    extracted = REGISTER_HTD_HEADER.unpack_from(packet)
+    
+    # No command is issued when the C bit is 0
+    if (extracted[2] & 0b10000000) == 0:
+        return None
 
-        return (extracted, data)
+    lba1 = extracted[5] << 8 * 2
+    lba1 |= extracted[6]
 
-    def extract_sata_data(self, packet):
-        """
-            Will extract our data data according to 
-            SerialATA_Revision_3_0_Gold.pdf
+    lba2 = extracted[8] << 8 * 2
+    lba2 |= extracted[9]
+
+    lba = (lba2 << 8 * 3) | lba1
+    
+    command = extracted[1]
+    if command == NCQCommandType.NCQQueueManagement:
+        return None
+    # NOTE: NCQ uses features field instead of count field for sector count
+    elif command in (NCQCommandType.ReadFPDMAQueued, 
+                     NCQCommandType.WriteFPDMAQueued):
+        sector_count = extracted[0] | extracted[7] << 8
+    else:
+        sector_count = extracted[12]
+        
+    return (lba, sector_count)
+    
+
+"""
+    Decoded FIS headers
+    
+    These used to be dictionaries, and still behave like them 
+    (header['lba'], 'tag' in header, header.get('count')), but every field is 
+    a slot, so decoding doesn't have to build a dictionary for every frame 
+    and the reconstructor can use plain attribute access (header.lba).
+"""
+
+class SATAHeader(object):
+    """
+        Fields common to every frame
+        
+        type: FIS type (See FrameType)
+        direction: Direction bit from our LO-PHI header
+        lophi_seqn: Sequence number from our LO-PHI header
+    """
+    __slots__ = ('type', 'direction', 'lophi_seqn')
+    
+    def __init__(self, fis_type, direction, lophi_seqn):
+        self.type = fis_type
+        self.direction = direction
+        self.lophi_seqn = lophi_seqn
+    
+    def keys(self):
+        """ Return the names of every field that is set """
+        return [name for cls in type(self).__mro__
+                for name in getattr(cls, '__slots__', ())
+                if hasattr(self, name)]
+    
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+    
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+    
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+        
+    def __contains__(self, key):
+        return hasattr(self, key)
+    
+    def __getstate__(self):
+        # Slotted classes can't be pickled without this (sata_parallel)
+        return dict((name, getattr(self, name)) for name in self.keys())
+    
+    def __setstate__(self, state):
+        for name in state:
+            setattr(self, name, state[name])
             
-            Relevant pages: 383-400ish?
-        """
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__,
+                           ", ".join("%s=%r" % (name, getattr(self, name))
+                                     for name in self.keys()))
 
-        # # The first word is our header to add semantic information
-        # lophi_sata_header = struct.unpack("!I",packet[0:4])[0]
-        #
-        # direction = lophi_sata_header & 1
-        # lophi_seqn = lophi_sata_header >> 16
-        #
-        # packet = packet[4:]
-
-        # First just extract enough to figure out our message type
-        SATA_HEADER_TMP = "!BBBB"
-        TMP_SIZE = struct.calcsize(SATA_HEADER_TMP)
-#        print packet
-        if len(packet) < TMP_SIZE:
-            logger.error("SATA packet too small to contain a header!")
-            return None
-#         tmp = G.flip_endianess(packet[0:TMP_SIZE])
-        header_tmp = struct.unpack(SATA_HEADER_TMP, packet[0:TMP_SIZE])
 
-#        print header_tmp
-        message_type = header_tmp[3]
+class RegisterHTDHeader(SATAHeader):
+    """ 27h    Register FIS - Host to Device (p. 384) """
+    __slots__ = ('features', 'command', 'C', 'pm_port', 'fis_type', 'device',
+                 'lba', 'control', 'icc', 'count', 'tag', 'reserved')
+
+
+class RegisterDTHHeader(SATAHeader):
+    """ 34h    Register FIS - Device to Host """
+    __slots__ = ('error', 'status', 'interrupt', 'pm_port', 'fis_type', 
+                 'device', 'lba', 'count', 'reserved0', 'reserved1', 
+                 'reserved2')
+
+
+class DMAActivateHeader(SATAHeader):
+    """ 39h    DMA Activate FIS - Device to Host """
+    __slots__ = ('pm_port', 'reserved')
+
+
+class DMASetupHeader(SATAHeader):
+    """ 41h    DMA Setup FIS - Bi-directional (p. 389) """
+    __slots__ = ('auto_activate', 'interrupt', 'direction_bit', 'pm_port', 
+                 'fis_type', 'dma_buf_identifier_low', 
+                 'dma_buf_identifier_high', 'dma_buf_offset', 
+                 'transfer_count', 'reserved0', 'reserved1')
+
+
+class DataHeader(SATAHeader):
+    """ 46h    Data FIS - Bi-directional """
+    __slots__ = ()
+
+
+class PIOSetupHeader(SATAHeader):
+    """ 5Fh    PIO Setup FIS - Device to Host (p. 395) """
+    __slots__ = ('error', 'status', 'direction_bit', 'pm_port', 'fis_type', 
+                 'device', 'lba', 'count', 'transfer_count')
+
+
+class SetDeviceBitsHeader(SATAHeader):
+    """ A1h    Set Device Bits FIS - Device to Host """
+    __slots__ = ('error', 'status_hi', 'status_lo', 'notification', 
+                 'interrupt', 'pm_port', 'proto')
+
 
-        extracted_header = {}
-        data = None
+"""
+    Decoders for every FIS type that we care about, each one takes the 
+    unpacked header and returns the appropriate SATAHeader
+"""
+
+def _decode_register_htd(extracted, direction, lophi_seqn):
+    header = RegisterHTDHeader(FrameType.RegisterFIS_HtoD, direction, 
+                               lophi_seqn)
+    
+    lba1 = extracted[5] << 8 * 2
+    lba1 |= extracted[6]
+
+    lba2 = extracted[8] << 8 * 2
+    lba2 |= extracted[9]
+    
+    #
+    # NOTE: NCQ uses features field instead of count field for sector count
+    #
+    header.features = extracted[0] | extracted[7] << 8
+    header.command = extracted[1]
+    header.C = (extracted[2] & 0b10000000) >> 7
+    header.pm_port = extracted[2] & 0b1111
+    header.fis_type = extracted[3]
+    header.device = extracted[4]
+    header.lba = (lba2 << 8 * 3) | lba1
+    header.control = extracted[10]
+    header.icc = extracted[11]
+    header.count = extracted[12]
+    header.tag = (extracted[12] >> 3) & 0b11111
+    header.reserved = extracted[13]
+    return header
+
+
+def _decode_register_dth(extracted, direction, lophi_seqn):
+    header = RegisterDTHHeader(FrameType.RegisterFIS_DtoH, direction, 
+                               lophi_seqn)
+    
+    lba1 = extracted[5] << 8 * 2
+    lba1 |= extracted[6]
+
+    lba2 = extracted[8] << 8 * 2
+    lba2 |= extracted[9]
+    
+    header.error = extracted[0]
+    header.status = extracted[1]
+    header.interrupt = (extracted[2] & 0b01000000) >> 6
+    header.pm_port = extracted[2] & 0b1111
+    header.fis_type = extracted[3]
+    header.device = extracted[4]
+    header.lba = (lba2 << 8 * 3) | lba1
+    header.count = extracted[11]
+    header.reserved0 = extracted[7]
+    header.reserved1 = extracted[10]
+    header.reserved2 = extracted[12]
+    return header
+
+
+def _decode_dma_activate(extracted, direction, lophi_seqn):
+    header = DMAActivateHeader(FrameType.DMAActivateFIS, direction, 
+                               lophi_seqn)
+    header.pm_port = extracted[1] & 0b1111
+    header.reserved = extracted[0]
+    return header
+
+
+def _decode_dma_setup(extracted, direction, lophi_seqn):
+    header = DMASetupHeader(FrameType.DMASetupFIS, direction, lophi_seqn)
+    header.auto_activate = (extracted[2] & 0b10000000) >> 7
+    header.interrupt = (extracted[2] & 0b1000000) >> 6
+    header.direction_bit = (extracted[2] & 0b100000) >> 5
+    header.pm_port = extracted[2] & 0b1111
+    header.fis_type = extracted[3]
+    header.dma_buf_identifier_low = extracted[4]
+    header.dma_buf_identifier_high = extracted[5]
+    header.dma_buf_offset = extracted[7]
+    header.transfer_count = extracted[8]
+    header.reserved0 = extracted[6]
+    header.reserved1 = extracted[9]
+    return header
+
+
+def _decode_data(extracted, direction, lophi_seqn):
+    return DataHeader(FrameType.DataFIS, direction, lophi_seqn)
+
+
+def _decode_pio_setup(extracted, direction, lophi_seqn):
+    header = PIOSetupHeader(FrameType.PIOSetupFIS, direction, lophi_seqn)
+    
+    lba1 = extracted[5] << 8 * 2
+    lba1 |= extracted[6]
+
+    lba2 = extracted[8] << 8 * 3
+    lba2 |= extracted[9]
+    
+    header.error = extracted[0]
+    header.status = extracted[1]
+    header.direction_bit = (extracted[2] & 0b10000) >> 4
+    header.pm_port = extracted[2] & 0b1111
+    header.fis_type = extracted[3]
+    header.device = extracted[4]
+    header.lba = (lba2 << 8 * 3) | lba1
+    header.count = extracted[12]
+    header.transfer_count = extracted[14]
+    return header
+
+
+def _decode_set_device_bits(extracted, direction, lophi_seqn):
+    header = SetDeviceBitsHeader(FrameType.SetDeviceBitsFIS, direction, 
+                                 lophi_seqn)
+    header.error = extracted[0]
+    header.status_hi = (extracted[1] & 0b01110000) >> 4
+    header.status_lo = extracted[1] & 0b111
+    header.notification = (extracted[2] & 0b10000000) >> 7
+    header.interrupt = (extracted[2] & 0b01000000) >> 6
+    header.pm_port = extracted[2] & 0b1111
+    header.proto = extracted[4]
+    return header
+
+
+# LO-PHI header (lophi.data.SATAFrame): seqn[31:16], direction[0]
+LOPHI_SATA_HEADER = struct.Struct("!I")
+
+# FIS type -> (header struct, decoder)
+FIS_DECODERS = {
+    FrameType.RegisterFIS_HtoD: (REGISTER_HTD_HEADER, _decode_register_htd),
+    FrameType.RegisterFIS_DtoH: (struct.Struct("!BBBB" + "BBH" + "BBH" + 
+                                               "HH" + "I"),
+                                 _decode_register_dth),
+    FrameType.DMAActivateFIS: (struct.Struct("!HBB"), _decode_dma_activate),
+    FrameType.DMASetupFIS: (struct.Struct("!BBBB" + "I" + "I" + "I" + "I" + 
+                                          "I" + "I"),
+                            _decode_dma_setup),
+    FrameType.DataFIS: (struct.Struct("!BBBB"), _decode_data),
+    FrameType.PIOSetupFIS: (struct.Struct("!BBBB" + "BBH" + "BBH" + "BBH" + 
+                                          "HH"),
+                            _decode_pio_setup),
+    FrameType.SetDeviceBitsFIS: (struct.Struct("!BBBB" + "I"), 
+                                 _decode_set_device_bits)
+    }
+
+# Every FIS starts with a DWORD, the type is in its last byte
+FIS_TYPE_OFFSET = SATA_FRAME_HEADER_SIZE + 3
+
+
+class SATAInterpreter:
+
+    def extract_sata_data(self, packet, flip_data=True):
         """
+            Will extract our data data according to 
+            SerialATA_Revision_3_0_Gold.pdf
+            
+            Relevant pages: 383-400ish?
+            
             27h    Register FIS - Host to Device
             34h    Register FIS - Device to Host
             39h    DMA Activate FIS - Device to Host
@@ -102,170 +354,47 @@ class SATAInterpreter:
             58h    BIST Activate FIS - Bi-directional
             5Fh    PIO Setup FIS - Device to Host
             A1h    Set Device Bits FIS - Device to Host
+            
+            @param packet: Raw SATAFrame (LO-PHI header + FIS)
+            @param flip_data: Fix the endianess of the data.  Callers that 
+            only need the length of the data can skip this (expensive) step.
+            @return: (SATAHeader, data), data is None for types that we don't 
+            know how to decode.  None if the packet is too small.
         """
-        # Now look for the packets that we care about
-
-        #
-        # 27h    Register FIS - Host to Device (p. 384)
-        #
-        if message_type == 0x27:
-            HEADER = "!BBBB" + "BBH" + "BBH" + "BBH" + "I"
-
-            extracted, data = self._extract_header(HEADER, packet)
-
-            lba1 = extracted[5] << 8 * 2
-            lba1 |= extracted[6]
-
-            lba2 = extracted[8] << 8 * 2
-            lba2 |= extracted[9]
+        if len(packet) <= FIS_TYPE_OFFSET:
+            logger.error("SATA packet too small to contain a header!")
+            return None
+        
+        # The first word is our header to add semantic information
+        lophi_sata_header = LOPHI_SATA_HEADER.unpack_from(packet)[0]
 
-            lba = (lba2 << 8 * 3) | lba1
-            
-            #
-            # NOTE: NCQ uses features field instead of count field for sector count
-            #
-            
-            extracted_header = {'type':message_type,
-                                'features':extracted[0] | extracted[7] << 8,
-                                'command':extracted[1],
-                                'C':(extracted[2] & 0b10000000) >> 7,
-                                'pm_port':extracted[2] & 0b1111,
-                                'fis_type':extracted[3],
-                                'device':extracted[4],
-                                'lba':lba,
-                                'control':extracted[10],
-                                'icc':extracted[11],
-                                'count':extracted[12],
-                                'tag': (extracted[12] >> 3) & 0b11111,
-                                'direction':direction,
-                                'reserved':extracted[13]
-                                }
-
-
-        #
-        # 34h    Register FIS - Device to Host
-        #
-        elif message_type == 0x34:
-            HEADER = "!BBBB" + "BBH" + "BBH" + "HH" + "I"
-            extracted, data = self._extract_header(HEADER, packet)
-
-            lba1 = extracted[5] << 8 * 2
-            lba1 |= extracted[6]
-
-            lba2 = extracted[8] << 8 * 2
-            lba2 |= extracted[9]
-
-            lba = (lba2 << 8 * 3) | lba1
-            extracted_header = {'type':message_type,
-                                'error':extracted[0] ,
-                                'status':extracted[1],
-                                'interrupt':(extracted[2] & 0b01000000) >> 6,
-                                'pm_port':extracted[2] & 0b1111,
-                                'fis_type':extracted[3],
-                                'device':extracted[4],
-                                'lba':lba,
-                                'count':extracted[11],
-                                'direction':direction,
-                                'reserved0':extracted[7],
-                                'reserved1':extracted[10],
-                                'reserved2':extracted[12]
-                                }
-
-
-        #
-        # 41h    DMA Setup FIS - Bi-directional (p. 389)
-        #
-        elif message_type == 0x41:
-            HEADER = "!BBBB" + "I" + "I" + "I" + "I" + "I" + "I"
-            extracted, data = self._extract_header(HEADER, packet)
-
-            extracted_header = {'type':message_type,
-                                'auto_activate':(extracted[2] & 0b10000000) >> 7,
-                                'interrupt':(extracted[2] & 0b1000000) >> 6,
-                                'direction_bit':(extracted[2] & 0b100000) >> 5,
-                                'direction':direction,
-                                'pm_port':extracted[2] & 0b1111,
-                                'fis_type':extracted[3],
-                                'dma_buf_identifier_low':extracted[4],
-                                'dma_buf_identifier_high':extracted[5],
-                                'dma_buf_offset':extracted[7],
-                                'transfer_count':extracted[8],
-                                'reserved0':extracted[6],
-                                'reserved1':extracted[9]
-                                }
-
-        #
-        # 5Fh    PIO Setup FIS - Device to Host (p. 395)
-        #
-        elif message_type == 0x5f:
-            HEADER = "!BBBB" + "BBH" + "BBH" + "BBH" + "HH"
-            extracted, data = self._extract_header(HEADER, packet)
-
-            lba1 = extracted[5] << 8 * 2
-            lba1 |= extracted[6]
-
-            lba2 = extracted[8] << 8 * 3
-            lba2 |= extracted[9]
-
-            lba = (lba2 << 8 * 3) | lba1
-
-            extracted_header = {'type':message_type,
-                                'error':extracted[0] ,
-                                'status':extracted[1],
-                                'direction_bit':(extracted[2] & 0b10000) >> 4,
-                                'direction':direction,
-                                'pm_port':extracted[2] & 0b1111,
-                                'fis_type':extracted[3],
-                                'device':extracted[4],
-                                'lba':lba,
-                                'count':extracted[12],
-                                'transfer_count':extracted[14]
-                                }
-
-
-        #
-        # 46h    Data FIS - Bi-directional
-        #
-        elif message_type == 0x46:
-            HEADER = "!BBBB"
-            extracted, data = self._extract_header(HEADER, packet)
-
-            extracted_header = {'type':message_type,
-                                'direction':direction}
-        elif message_type == 0x39:
-            HEADER = "!HBB"
-            extracted, data = self._extract_header(HEADER, packet)
-            
-            extracted_header = {'pm_port':extracted[1] & 0b1111,
-                                'type':message_type,
-                                'direction':direction,
-                                'reserved':extracted[0]}
-        elif message_type == 0xa1:
-            HEADER = "!BBBB" + "I"
-            extracted, data = self._extract_header(HEADER, packet)
-            
-            extracted_header = {'error':extracted[0],
-                                'status_hi':(extracted[1] & 0b01110000) >> 4,
-                                'status_lo':extracted[1] & 0b111,
-                                'notification':(extracted[2] & 0b10000000) >> 7,
-                                'interrupt':(extracted[2] & 0b01000000) >> 6,
-                                'pm_port':extracted[2] & 0b1111,
-                                'type':message_type,
-                                'direction':direction,
-                                'proto':extracted[4]}
-        else:
+        direction = lophi_sata_header & 1
+        lophi_seqn = lophi_sata_header >> 16
+        
+        message_type = ord(packet[FIS_TYPE_OFFSET])
+        
+        try:
+            (HEADER, decode) = FIS_DECODERS[message_type]
+        except KeyError:
             logger.warn("Got unknown SATA type. (%s)" % hex(message_type))
-
-        # Fix endianess in the data
-        if data is not None:
+            return (SATAHeader(message_type, direction, lophi_seqn), None)
+        
+        header_end = SATA_FRAME_HEADER_SIZE + HEADER.size
+        if len(packet) < header_end:
+            logger.error("SATA packet too small to contain a %s header!" %
+                         FrameType.type_lookup[message_type])
+            return None
+        
+        header = decode(HEADER.unpack_from(packet, SATA_FRAME_HEADER_SIZE),
+                        direction,
+                        lophi_seqn)
+        
+        # Store the remainder as data, fixing its endianess
+        data = packet[header_end:]
+        if flip_data:
             data = G.flip_endianess(data)
+        else:
+            # Keep the same (whole word) length that flipping would
+            data = data[:len(data) - len(data) % 4]
             
-        # Add our seqn number that we extracted
-#         if extracted_header is not None:
-        extracted_header['lophi_seqn'] = lophi_seqn
-            
-        # return our dicts 
-        return (extracted_header, data)
-
-
-
+        return (header, data)
@@ -0,0 +1,388 @@
+"""
+    Parallel reconstruction of captured SATA streams
+
+    Reassembling SATA frames is inherently serial, however whenever no
+    transactions are outstanding (see SATAReconstructor.is_idle) the
+    reconstructor holds no state that affects its future output.  We pre-scan
+    the capture for these idle points, only looking at the FIS types, tags
+    and data lengths of the frames (see IdleScanner), reconstruct each segment
+    between them on a process pool, and hand the resulting DiskSensorPackets
+    back in capture order.
+
+    (c) 2015 Massachusetts Institute of Technology
+"""
+# Native
+import collections
+import multiprocessing
+import logging
+logger = logging.getLogger(__name__)
+
+# LO-PHI
+import lophi.globals as G
+from lophi.capture import CaptureReaderMapped
+from lophi_semanticgap.disk.sata import SATAInterpreter, FrameType, \
+    NCQCommandType, FIS_DECODERS, FIS_TYPE_OFFSET, LOPHI_SATA_HEADER, \
+    SATA_FRAME_HEADER_SIZE
+from lophi_semanticgap.disk.sata_reconstructor import SATAReconstructor, \
+    PhysicalPacket
+
+# Minimum number of frames in a segment, smaller segments aren't worth
+# shipping to another process
+DEFAULT_SEGMENT_FRAMES = 100000
+
+
+def _physical_packets(reader, sata, flip_data=True, end=None):
+    """
+        Generator of the frames in a capture, ready for a SATAReconstructor
+
+        @param reader: CaptureReaderMapped positioned at the first frame
+        @param sata: SATAInterpreter
+        @param flip_data: Decode the frame data (See extract_sata_data)
+        @param end: File offset to stop at (Default: end of capture)
+    """
+    while end is None or reader.where < end:
+        try:
+            (timestamp, data) = reader.next()
+        except StopIteration:
+            return
+
+        extracted = sata.extract_sata_data(data, flip_data)
+        if extracted is None or extracted[0] is None or extracted[1] is None:
+            logger.warning("Skipping abnormal physical SATA capture packet "
+                           "-- either sata header and/or data is None.")
+            continue
+
+        yield PhysicalPacket(extracted[0], extracted[1])
+
+
+class IdleScanner:
+    """
+        Follows just enough of SATAReconstructor's state machine to know when
+        it would be idle (See SATAReconstructor.is_idle), using only the FIS
+        types, tags and lengths of the frames
+        
+        Nothing is aggregated and Data FIS headers (i.e. most frames) are 
+        never decoded, so this is much cheaper than running a reconstructor.
+        Any change to the transitions in SATAReconstructor must be mirrored 
+        here.
+    """
+    
+    DEVICE_IDLE = SATAReconstructor.DEVICE_IDLE
+    WAIT_FOR_DMA_DATA_DEVICE = SATAReconstructor.WAIT_FOR_DMA_DATA_DEVICE
+    WAIT_FOR_DMA_DATA_HOST = SATAReconstructor.WAIT_FOR_DMA_DATA_HOST
+    WAIT_FOR_NON_NCQ_DATA = SATAReconstructor.WAIT_FOR_NON_NCQ_DATA
+    
+    HOST_TO_DEVICE = SATAReconstructor.HOST_TO_DEVICE
+    DEVICE_TO_HOST = SATAReconstructor.DEVICE_TO_HOST
+
+    def __init__(self, sector_size):
+        self.sector_size = sector_size
+        
+        self.STATE = self.DEVICE_IDLE
+        self.last_seqn = None
+        
+        # Outstanding NCQ commands, tag -> [bytes expected, bytes received]
+        self.ncq_outstanding = {}
+        
+        # Stack of (tag, transfer count) for DMA setups, and the data received
+        # for the one on top
+        self.ncq_dma_stack = []
+        self.ncq_data_len = 0
+        
+        # Non-NCQ commands issued, and [bytes expected, bytes received]
+        self.regular_registers = 0
+        self.regular_transfer = None
+
+    def is_idle(self):
+        """ Would SATAReconstructor.is_idle() be True? """
+        return (self.STATE == self.DEVICE_IDLE and 
+                not self.ncq_dma_stack and 
+                not self.ncq_outstanding and
+                self.regular_registers == 0 and
+                self.regular_transfer is None)
+
+    def process_frame(self, packet):
+        """
+            Follow a single raw SATA frame
+            
+            @param packet: Raw SATAFrame (LO-PHI header + FIS)
+        """
+        # Frames that extract_sata_data can't decode are never reconstructed
+        if len(packet) <= FIS_TYPE_OFFSET:
+            return
+        fis_type = ord(packet[FIS_TYPE_OFFSET])
+        try:
+            (HEADER, decode) = FIS_DECODERS[fis_type]
+        except KeyError:
+            return
+        header_end = SATA_FRAME_HEADER_SIZE + HEADER.size
+        if len(packet) < header_end:
+            return
+        
+        lophi_sata_header = LOPHI_SATA_HEADER.unpack_from(packet)[0]
+        direction = lophi_sata_header & 1
+        seqn = lophi_sata_header >> 16
+        
+        # Dropped frames
+        if self.last_seqn is not None:
+            expected = (self.last_seqn + 1) % 65536
+            if seqn != expected:
+                self._gap()
+        self.last_seqn = seqn
+        
+        if fis_type == FrameType.DMAActivateFIS or \
+                fis_type == FrameType.BISTActivateFIS:
+            return
+        
+        # Data FIS, only their length matters (whole words, less the CRC)
+        if fis_type == FrameType.DataFIS:
+            length = len(packet) - header_end
+            length = max(length - length % 4 - 4, 0)
+            
+            if self.STATE == self.WAIT_FOR_DMA_DATA_DEVICE:
+                if direction == self.DEVICE_TO_HOST:
+                    self._ncq_data(length)
+                else:
+                    self._unexpected_dma(fis_type, None)
+            elif self.STATE == self.WAIT_FOR_DMA_DATA_HOST:
+                if direction == self.HOST_TO_DEVICE:
+                    self._ncq_data(length)
+                else:
+                    self._unexpected_dma(fis_type, None)
+            elif self.STATE == self.WAIT_FOR_NON_NCQ_DATA:
+                self._regular_data(length)
+            return
+        
+        header = decode(HEADER.unpack_from(packet, SATA_FRAME_HEADER_SIZE),
+                        direction, seqn)
+        
+        if fis_type == FrameType.SetDeviceBitsFIS:
+            if header.status_lo & 1 == 1 or \
+                    (header.interrupt == 1 and header.proto == 0xffffffff):
+                self._reset_ncq()
+        elif direction == self.HOST_TO_DEVICE and \
+                fis_type == FrameType.RegisterFIS_HtoD:
+            self._register_htd(header)
+        elif direction == self.DEVICE_TO_HOST and \
+                fis_type == FrameType.RegisterFIS_DtoH:
+            if header.status & 1 == 1:
+                self._reset_ncq()
+        elif fis_type == FrameType.PIOSetupFIS:
+            self.STATE = self.WAIT_FOR_NON_NCQ_DATA
+        elif self.STATE == self.DEVICE_IDLE:
+            if direction == self.DEVICE_TO_HOST and \
+                    fis_type == FrameType.DMASetupFIS:
+                self._dma_setup(header)
+        elif self.STATE in (self.WAIT_FOR_DMA_DATA_DEVICE, 
+                            self.WAIT_FOR_DMA_DATA_HOST):
+            self._unexpected_dma(fis_type, header)
+        elif self.STATE == self.WAIT_FOR_NON_NCQ_DATA:
+            self._unexpected(fis_type, header)
+
+    def _gap(self):
+        """ See SATAReconstructor.handle_gap """
+        if self.STATE in (self.WAIT_FOR_DMA_DATA_DEVICE, 
+                          self.WAIT_FOR_DMA_DATA_HOST):
+            if self.ncq_dma_stack:
+                (tag, transfer_count) = self.ncq_dma_stack.pop()
+                self.ncq_outstanding.pop(tag, None)
+        self.ncq_data_len = 0
+        
+        if self.STATE == self.WAIT_FOR_NON_NCQ_DATA:
+            self.regular_registers = 0
+            self.regular_transfer = None
+        
+        self.STATE = self.DEVICE_IDLE
+
+    def _reset_ncq(self):
+        """ See SATAReconstructor._reset_ncq """
+        self.ncq_outstanding = {}
+        self.ncq_dma_stack = []
+        self.ncq_data_len = 0
+
+    def _register_htd(self, header):
+        """ See SATAReconstructor.handle_register_HTD """
+        if header.C == 0:
+            return
+        
+        if header.command in (NCQCommandType.ReadFPDMAQueued, 
+                              NCQCommandType.WriteFPDMAQueued):
+            self.ncq_outstanding[header.tag] = [header.features * 
+                                                self.sector_size, 0]
+        elif header.command == NCQCommandType.NCQQueueManagement:
+            pass
+        else:
+            self.regular_registers += 1
+            self.regular_transfer = [header.count * self.sector_size, 0]
+            self.STATE = self.WAIT_FOR_NON_NCQ_DATA
+
+    def _dma_setup(self, header):
+        """ See SATAReconstructor.handle_dma_setup """
+        self.ncq_dma_stack.append((header.dma_buf_identifier_low, 
+                                   header.transfer_count))
+        if header.direction_bit == self.HOST_TO_DEVICE:
+            self.STATE = self.WAIT_FOR_DMA_DATA_HOST
+        else:
+            self.STATE = self.WAIT_FOR_DMA_DATA_DEVICE
+
+    def _ncq_data(self, length):
+        """ See SATAReconstructor.handle_ncq_data_packet """
+        if not self.ncq_dma_stack:
+            return
+        (tag, transfer_count) = self.ncq_dma_stack[-1]
+        if tag not in self.ncq_outstanding:
+            return
+        
+        self.ncq_data_len += length
+        if self.ncq_data_len >= transfer_count:
+            transfer = self.ncq_outstanding[tag]
+            transfer[1] += self.ncq_data_len
+            
+            self.ncq_data_len = 0
+            self.ncq_dma_stack.pop()
+            self.STATE = self.DEVICE_IDLE
+            
+            if transfer[1] >= transfer[0]:
+                del self.ncq_outstanding[tag]
+
+    def _regular_data(self, length):
+        """ See SATAReconstructor.handle_non_ncq_data_packet """
+        if self.regular_registers == 0 or self.regular_transfer is None:
+            return
+        
+        self.regular_transfer[1] += length
+        if self.regular_transfer[1] >= self.regular_transfer[0]:
+            self.regular_registers = 0
+            self.regular_transfer = None
+            self.STATE = self.DEVICE_IDLE
+
+    def _unexpected_dma(self, fis_type, header):
+        """ Wrong frame while waiting for DMA data """
+        self.ncq_data_len = 0
+        if self.ncq_dma_stack:
+            self.ncq_dma_stack.pop()
+        self._unexpected(fis_type, header)
+
+    def _unexpected(self, fis_type, header):
+        """ See SATAReconstructor._handle_unexpected_packet """
+        self.STATE = self.DEVICE_IDLE
+        if fis_type == FrameType.RegisterFIS_HtoD:
+            self._register_htd(header)
+        elif fis_type == FrameType.DMASetupFIS:
+            self._dma_setup(header)
+
+
+def find_segments(filename,
+                  sector_size=G.SENSOR_DISK.DEFAULT_SECTOR_SIZE,
+                  min_frames=DEFAULT_SEGMENT_FRAMES):
+    """
+        Split a SATA capture at reconstructor idle points
+
+        The pre-scan only follows the frame types, tags and lengths (See
+        IdleScanner), it doesn't reconstruct anything.
+
+        @param filename: Filename of the dcap
+        @param sector_size: Sector size of the disk
+        @param min_frames: Minimum number of frames in each segment
+        @return: List of (start, end) file offsets
+    """
+    reader = CaptureReaderMapped(filename)
+    scanner = IdleScanner(sector_size)
+
+    segments = []
+    start = 0
+    frames = 0
+    for (timestamp, data) in reader:
+        scanner.process_frame(data)
+        frames += 1
+
+        if frames >= min_frames and scanner.is_idle():
+            segments.append((start, reader.where))
+            start = reader.where
+            frames = 0
+
+    if reader.where > start:
+        segments.append((start, reader.where))
+
+    reader.close()
+
+    logger.debug("Split %s into %d segments."%(filename, len(segments)))
+    return segments
+
+
+def _reconstruct_segment(args):
+    """
+        Reconstruct all of the DiskSensorPackets in one segment of a capture
+
+        @param args: (filename, start, end, sector_size)
+        @return: List of DiskSensorPackets
+    """
+    (filename, start, end, sector_size) = args
+
+    reader = CaptureReaderMapped(filename)
+    reader.where = start
+
+    sata = SATAInterpreter()
+    reconstructor = SATAReconstructor(sector_size=sector_size)
+
+    rtn = []
+    for physical_packet in _physical_packets(reader, sata, end=end):
+        disk_sensor_pkts = reconstructor.process_packet(physical_packet)
+        if disk_sensor_pkts:
+            rtn.extend(disk_sensor_pkts)
+
+    reader.close()
+
+    if not reconstructor.is_idle():
+        logger.warning("Segment [%d,%d) of %s did not end idle."%(start, end,
+                                                                   filename))
+    return rtn
+
+
+def reconstruct_parallel(filename,
+                         sector_size=G.SENSOR_DISK.DEFAULT_SECTOR_SIZE,
+                         processes=None,
+                         min_frames=DEFAULT_SEGMENT_FRAMES):
+    """
+        Reconstruct a SATA capture using a pool of processes
+
+        Only a few segments are reconstructed ahead of the consumer so that
+        a slow consumer doesn't cause every result to pile up in memory.
+
+        @param filename: Filename of the dcap
+        @param sector_size: Sector size of the disk
+        @param processes: Number of processes (Default: number of CPUs)
+        @param min_frames: Minimum number of frames in each segment
+        @return: Generator of DiskSensorPackets, in capture order
+    """
+    segments = find_segments(filename, sector_size, min_frames)
+
+    # Not worth starting a pool
+    if len(segments) < 2 or processes == 1:
+        for (start, end) in segments:
+            for dsp in _reconstruct_segment((filename, start, end,
+                                             sector_size)):
+                yield dsp
+        return
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = collections.deque()
+        segments = collections.deque(segments)
+        while len(segments) > 0 or len(pending) > 0:
+
+            # Keep every process busy, and one segment queued for each
+            while len(segments) > 0 and len(pending) < 2 * processes:
+                (start, end) = segments.popleft()
+                pending.append(pool.apply_async(_reconstruct_segment,
+                                                ((filename, start, end,
+                                                  sector_size),)))
+
+            for dsp in pending.popleft().get():
+                yield dsp
+    finally:
+        pool.terminate()
+        pool.join()
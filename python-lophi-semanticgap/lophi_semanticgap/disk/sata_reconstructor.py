@@ -34,6 +34,12 @@ class SATAReconstructor:
     # how to tell by the Register HTD Frame
     WAIT_FOR_NON_NCQ_DATA = 4
 
+    STATE_NAMES = {DEVICE_IDLE: "STATE DEVICE IDLE",
+                   WAIT_FOR_REGISTER_ACK: "STATE WAIT For REGISTER ACK",
+                   WAIT_FOR_DMA_DATA_DEVICE: "STATE WAIT For DMA DATA from DEVICE",
+                   WAIT_FOR_DMA_DATA_HOST: "STATE WAIT For DMA DATA from HOST",
+                   WAIT_FOR_NON_NCQ_DATA: "STATE WAIT for NON NCQ DATA"}
+
     HOST_TO_DEVICE = 0
     DEVICE_TO_HOST = 1
 
@@ -93,6 +99,26 @@ class SATAReconstructor:
         self.total_frames = 0
 
 
+    def is_idle(self):
+        """
+            Are we between transactions?  i.e. no NCQ tags or DMA transfers
+            outstanding and no non-NCQ command waiting for data
+
+            A fresh reconstructor started on the next frame would produce the
+            same output as this one.
+        """
+        if self.STATE != self.DEVICE_IDLE:
+            return False
+        if self.ncq_dma_stack or self.regular_disk_sensor_packet is not None:
+            return False
+        if self.regular_register_stack:
+            return False
+        for register_packet in self.ncq_transactions_outstanding:
+            if register_packet is not None:
+                return False
+        return True
+
+
     def process_packet(self, physical_packet):
         """
             Takes an incoming LOPHI packet and calls the appropriate
@@ -117,47 +143,36 @@ class SATAReconstructor:
         sata_data = physical_packet.sata_data
 
         # Show what state we are in
-        if self.STATE == self.DEVICE_IDLE:
-            logger.debug("STATE DEVICE IDLE: Received %d: %s" % (sata_header['lophi_seqn'], FrameType.type_lookup[sata_header['type']]))
-            if sata_header['type'] == 0x46: # data
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s: Received %d: %s" % (self.STATE_NAMES.get(self.STATE, "UNKNOWN STATE"),
+                                                  sata_header.lophi_seqn,
+                                                  FrameType.type_lookup.get(sata_header.type)))
+            if sata_header.type == FrameType.DataFIS:
                 logger.debug("DATA packet data length is %d" % len(sata_data[:-4]))
-        elif self.STATE == self.WAIT_FOR_REGISTER_ACK:
-            logger.debug("STATE WAIT For REGISTER ACK: Received %d: %s" % (sata_header['lophi_seqn'], FrameType.type_lookup[sata_header['type']]))
-        elif self.STATE == self.WAIT_FOR_DMA_DATA_DEVICE:
-            logger.debug("STATE WAIT For DMA DATA from DEVICE: Received %d: %s" % (sata_header['lophi_seqn'], FrameType.type_lookup[sata_header['type']]))
-        elif self.STATE == self.WAIT_FOR_DMA_DATA_HOST:
-            logger.debug("STATE WAIT For DMA DATA from HOST: Received %d: %s" % (sata_header['lophi_seqn'], FrameType.type_lookup[sata_header['type']]))
-        elif self.STATE == self.WAIT_FOR_NON_NCQ_DATA:
-            logger.debug("STATE WAIT for NON NCQ DATA: Received %d: %s" % (sata_header['lophi_seqn'], FrameType.type_lookup[sata_header['type']]))
-        else:
-            logger.debug("UNKNOWN STATE: Received %d: %s" % (sata_header['lophi_seqn'], FrameType.type_lookup[sata_header['type']]))
-
-
 
         # check for dropped packet
-        if self.last_packet_seqno:
+        seqn = sata_header.lophi_seqn
+        if self.last_packet_seqno is not None:
 
-            if sata_header['lophi_seqn'] == (self.last_packet_seqno + 1) % 65536:
-                # no dropped packet (at least due to network)
-                self.last_packet_seqno = sata_header['lophi_seqn']
-            else:
-                # We have at least one missing packet
-                # Need to flush all state, etc.
-                logger.error("Encountered dropped packet.  Resetting state.")
-                self._reset_state()
+            expected = (self.last_packet_seqno + 1) % 65536
+            if seqn != expected:
+                # We have at least one missing packet (that nobody told us 
+                # about with handle_gap)
+                logger.error("Encountered dropped packet. (Expected: %d, "
+                             "Got: %d)" % (expected, seqn))
+                self.handle_gap(expected, (seqn - expected) % 65536)
 
-        else: # first packet we've seen
-            self.last_packet_seqno = sata_header['lophi_seqn']
+        self.last_packet_seqno = seqn
 
 
         # Ignore DMA Activate, BIST Activate frames for now
-        if sata_header['type'] == FrameType.DMAActivateFIS or sata_header['type'] == FrameType.BISTActivateFIS:
+        if sata_header.type == FrameType.DMAActivateFIS or sata_header.type == FrameType.BISTActivateFIS:
             return None
 
 
         # now process the next packet from the queue
 
-        source = "HOST" if sata_header['direction'] == self.HOST_TO_DEVICE else "DEVICE"
+        source = "HOST" if sata_header.direction == self.HOST_TO_DEVICE else "DEVICE"
 
         # States
         # IDLE - waiting for a new frame to setup a new transaction or DMA transfer, etc.
@@ -171,28 +186,28 @@ class SATAReconstructor:
         # This might indicate that the device ran into an error
         # and we have to reset state
 
-        if sata_header['type'] == FrameType.SetDeviceBitsFIS:
+        if sata_header.type == FrameType.SetDeviceBitsFIS:
             return self.handle_set_device_bits(physical_packet)
 
         # Check if it is a register HTD packet
         # From our observations, apparently these can come at any time
         # even between DMA setup packets and DMA data packets
-        if (sata_header['direction'] == self.HOST_TO_DEVICE and
-                    sata_header['type'] == FrameType.RegisterFIS_HtoD):
+        if (sata_header.direction == self.HOST_TO_DEVICE and
+                    sata_header.type == FrameType.RegisterFIS_HtoD):
 
             return self.handle_register_HTD(physical_packet)
 
         # Check if it is a register DTH packet
         # this function will ignore it unless it announces an error
-        if (sata_header['direction'] == self.DEVICE_TO_HOST and
-                    sata_header['type'] == FrameType.RegisterFIS_DtoH):
+        if (sata_header.direction == self.DEVICE_TO_HOST and
+                    sata_header.type == FrameType.RegisterFIS_DtoH):
 
             return self.handle_ncq_register_DTH(physical_packet)
 
         # PIO Setup Frames only come from the device
         # Currently we have no way of knowing when they will come ahead of time -- should
         # be indicated by the Register Frame, but that is unknown
-        elif sata_header['type'] == FrameType.PIOSetupFIS:
+        elif sata_header.type == FrameType.PIOSetupFIS:
             return self.handle_pio_setup(physical_packet)
 
         ## IDLE state
@@ -204,28 +219,28 @@ class SATAReconstructor:
             # or DMA setup packet from the host queue
 
             # Check if it is a register HTD packet
-            if (sata_header['direction'] == self.HOST_TO_DEVICE and
-                        sata_header['type'] == FrameType.RegisterFIS_HtoD):
+            if (sata_header.direction == self.HOST_TO_DEVICE and
+                        sata_header.type == FrameType.RegisterFIS_HtoD):
 
                 return self.handle_register_HTD(physical_packet)
 
             # Try ignoring DMA Setups from Host for now
             # Doesn't look like it gets used for NCQ?
 
-            elif (sata_header['direction'] == self.HOST_TO_DEVICE and
-                          sata_header['type'] == FrameType.DMASetupFIS):
+            elif (sata_header.direction == self.HOST_TO_DEVICE and
+                          sata_header.type == FrameType.DMASetupFIS):
                 logger.debug("IDLE State: Received DMA Setup from %s.  Ignoring." % source)
 
                 # Didn't get a Register or DMA setup frame in the host queue
                 # Check the device queue for DMA setup frame
-            elif (sata_header['direction'] == self.DEVICE_TO_HOST and
-                          sata_header['type'] == FrameType.DMASetupFIS):
+            elif (sata_header.direction == self.DEVICE_TO_HOST and
+                          sata_header.type == FrameType.DMASetupFIS):
 
                 return self.handle_dma_setup(physical_packet)
 
 
             else:
-                logger.error("IDLE State: Expected Register HTD or DMA Setup frame from Device but got type %s from %s." % (FrameType.type_lookup[physical_packet.sata_header['type']], source))
+                logger.error("IDLE State: Expected Register HTD or DMA Setup frame from Device but got type %s from %s." % (FrameType.type_lookup[physical_packet.sata_header.type], source))
                 return None
 
 
@@ -233,29 +248,29 @@ class SATAReconstructor:
             # We got a HTD register frame, so we need the DTH Register frame to acknowledge
             # the new transaction
 
-            if (sata_header['direction'] == self.DEVICE_TO_HOST and
-                        sata_header['type'] == FrameType.RegisterFIS_DtoH):
+            if (sata_header.direction == self.DEVICE_TO_HOST and
+                        sata_header.type == FrameType.RegisterFIS_DtoH):
 
                 return self.handle_ncq_register_DTH(physical_packet)
 
             else:
                 # Wrong type of frame
 
-                logger.error("WAITING FOR NCQ REGISTER ACK State: Expected Register DTH ACK but got type %s from %s." % (FrameType.type_lookup[physical_packet.sata_header['type']], source))
+                logger.error("WAITING FOR NCQ REGISTER ACK State: Expected Register DTH ACK but got type %s from %s." % (FrameType.type_lookup[physical_packet.sata_header.type], source))
                 return self._handle_unexpected_packet(physical_packet)
 
                 #return None
 
         elif self.STATE == self.WAIT_FOR_DMA_DATA_DEVICE:
 
-            if (sata_header['direction'] == self.DEVICE_TO_HOST and
-                        sata_header['type'] == FrameType.DataFIS):
+            if (sata_header.direction == self.DEVICE_TO_HOST and
+                        sata_header.type == FrameType.DataFIS):
 
                 return self.handle_ncq_data_packet(physical_packet)
 
             else: # wrong Frame Type
 
-                logger.error("WAITING FOR DMA DATA from Device State: Expected Data Frame from Device but got type %s from %s." % (FrameType.type_lookup[physical_packet.sata_header['type']], source))
+                logger.error("WAITING FOR DMA DATA from Device State: Expected Data Frame from Device but got type %s from %s." % (FrameType.type_lookup[physical_packet.sata_header.type], source))
 
                 # reset len
                 self.ncq_data_len = 0
@@ -272,13 +287,13 @@ class SATAReconstructor:
 
         elif self.STATE == self.WAIT_FOR_DMA_DATA_HOST:
 
-            if (sata_header['direction'] == self.HOST_TO_DEVICE and
-                        sata_header['type'] == FrameType.DataFIS):
+            if (sata_header.direction == self.HOST_TO_DEVICE and
+                        sata_header.type == FrameType.DataFIS):
 
                 return self.handle_ncq_data_packet(physical_packet)
 
             else:
-                logger.error("WAITING FOR DMA DATA from HOST State: Expected Data Frame from Host but got type %s from %s." % (FrameType.type_lookup[physical_packet.sata_header['type']], source))
+                logger.error("WAITING FOR DMA DATA from HOST State: Expected Data Frame from Host but got type %s from %s." % (FrameType.type_lookup[physical_packet.sata_header.type], source))
 
                 # reset len
                 self.ncq_data_len = 0
@@ -301,11 +316,11 @@ class SATAReconstructor:
             # TODO how do we tell which way that DATA frames should be going?
             # Does the Register HTD packet have this info?
 
-            if sata_header['type'] == FrameType.DataFIS:
+            if sata_header.type == FrameType.DataFIS:
                 return self.handle_non_ncq_data_packet(physical_packet)
 
             else:
-                logger.error("WAITING FOR NON NCQ DATA State: Expected Data Frame but got type %s from %s" % (FrameType.type_lookup[physical_packet.sata_header['type']], source))
+                logger.error("WAITING FOR NON NCQ DATA State: Expected Data Frame but got type %s from %s" % (FrameType.type_lookup[physical_packet.sata_header.type], source))
                 return self._handle_unexpected_packet(physical_packet)
 
 
@@ -329,7 +344,7 @@ class SATAReconstructor:
 
         logger.error("Trying to handle unexpected packet.")
 
-        frame_type = physical_packet.sata_header['type']
+        frame_type = physical_packet.sata_header.type
 
         # Check if it is a register packet HTD
         if frame_type == FrameType.RegisterFIS_HtoD:
@@ -352,6 +367,48 @@ class SATAReconstructor:
         return None
 
 
+    def handle_gap(self, first_seqn, count):
+        """
+            Some frames were lost (E.g. the network dropped them), resync 
+            without throwing away more than we have to.
+            
+            Only the transfer that was in progress can have lost frames that
+            we would notice, so we abort it and go back to DEVICE IDLE.  Other 
+            NCQ transactions that are still outstanding keep their state, since 
+            their DMA setup (and data) will come later.  If that was lost too, 
+            the unexpected frame handling will clean up after it.
+            
+            @param first_seqn: Sequence number of the first missing frame
+            @param count: Number of consecutive frames that are missing
+        """
+        logger.error("Lost %d SATA frames starting at %d.  Aborting the "
+                     "current transfer." % (count, first_seqn))
+
+        self.num_errors += 1
+
+        # The next frame we see is the one after the gap
+        self.last_packet_seqno = (first_seqn + count - 1) % 65536
+
+        # Drop the NCQ transaction whose DMA transfer was in progress, it can
+        # never be completed
+        if self.STATE in (self.WAIT_FOR_DMA_DATA_DEVICE, 
+                          self.WAIT_FOR_DMA_DATA_HOST):
+            if self.ncq_dma_stack:
+                dma_setup_packet = self.ncq_dma_stack.pop()
+                tag = dma_setup_packet.sata_header.dma_buf_identifier_low
+                self.ncq_transactions_outstanding[tag] = None
+                self.ncq_data_outstanding[tag] = None
+        self.ncq_data_packets = deque([])
+        self.ncq_data_len = 0
+
+        # Drop a non-NCQ transaction that was in progress
+        if self.STATE == self.WAIT_FOR_NON_NCQ_DATA:
+            self.regular_register_stack = []
+            self.regular_disk_sensor_packet = None
+
+        self.STATE = self.DEVICE_IDLE
+
+
     def _reset_state(self):
         """
             Resets state if we have a dropped packet or out of order, etc.
@@ -394,9 +451,9 @@ class SATAReconstructor:
 
 
         # Extract useful info
-        status_lo = physical_packet.sata_header['status_lo']
-        ACT = physical_packet.sata_header['proto']
-        interrupt = physical_packet.sata_header['interrupt']
+        status_lo = physical_packet.sata_header.status_lo
+        ACT = physical_packet.sata_header.proto
+        interrupt = physical_packet.sata_header.interrupt
 
         # Was there an error?
         if status_lo & 1 == 1:
@@ -488,21 +545,21 @@ class SATAReconstructor:
         # Check if C bit is set to 0 -- see 11.2 Dl1 Note 1 -- no FIS is sent
         # I think we can ignore if C bit is set to 0 and go back to IDLE state
         # software reset could still happen -- not sure which bit is the SRST bit in the control register?
-        if sata_header['C'] == 0:
+        if sata_header.C == 0:
             logger.debug("Got HTD Register Packet but C bit is set to 0.  Ignoring.")
             return None
 
         # check if this is an NCQ command
-        if sata_header['command'] == NCQCommandType.ReadFPDMAQueued or sata_header['command'] == NCQCommandType.WriteFPDMAQueued:
+        if sata_header.command == NCQCommandType.ReadFPDMAQueued or sata_header.command == NCQCommandType.WriteFPDMAQueued:
 
             cmd = "READ"
             direction = G.SATA_OP.DIRECTION.READ
-            if sata_header['command'] == NCQCommandType.WriteFPDMAQueued:
+            if sata_header.command == NCQCommandType.WriteFPDMAQueued:
                 cmd = "WRITE"
                 direction = G.SATA_OP.DIRECTION.WRITE
 
             # NCQ uses features field for sector count
-            logger.debug("Got HTD Register Packet for NCQ %s -- TAG %d expecting %d bytes." % (cmd, sata_header['tag'], sata_header['features']*self.sector_size))
+            logger.debug("Got HTD Register Packet for NCQ %s -- TAG %d expecting %d bytes." % (cmd, sata_header.tag, sata_header.features*self.sector_size))
 
             #            if len(self.ncq_register_stack) > 0:
             #                logger.error("Our NCQ register stack will be greater than 1, so we have at least one outstanding NCQ register packet with NO Register ACK.  Stack size is %d" % len(self.ncq_register_stack))
@@ -518,14 +575,14 @@ class SATAReconstructor:
             #            return None
 
             # check if the spot belonging to the associated TAG is empty
-            if (not self.ncq_transactions_outstanding[sata_header['tag']]):
+            if (not self.ncq_transactions_outstanding[sata_header.tag]):
                 # This TAG is not taken, so we just add
-                self.ncq_transactions_outstanding[sata_header['tag']] = register_packet
+                self.ncq_transactions_outstanding[sata_header.tag] = register_packet
 
             else:
-                logger.error("Received HTD NCQ Register Packet for TAG %d but it is already in use.  Using it anyway." % sata_header['tag'])
+                logger.error("Received HTD NCQ Register Packet for TAG %d but it is already in use.  Using it anyway." % sata_header.tag)
                 # still put it in there for now
-                self.ncq_transactions_outstanding[sata_header['tag']] = register_packet
+                self.ncq_transactions_outstanding[sata_header.tag] = register_packet
 
                 #don't need this if we accept the register packet anyway
                 #return None
@@ -533,10 +590,10 @@ class SATAReconstructor:
 
             # Associate this DTH Register packet
             # with the tag and prepare the disk sensor packet for aggregating data
-            lba = sata_header['lba']
+            lba = sata_header.lba
 
             # NOTE: NCQ uses features field instead of count for sector count
-            sector_count = sata_header['features']
+            sector_count = sata_header.features
 
 
             disk_sensor_packet = DiskSensorPacket()
@@ -546,7 +603,7 @@ class SATAReconstructor:
             disk_sensor_packet.size = sector_count*self.sector_size
             disk_sensor_packet.data = ""
 
-            self.ncq_data_outstanding[sata_header['tag']] = disk_sensor_packet
+            self.ncq_data_outstanding[sata_header.tag] = disk_sensor_packet
 
             # DO NOT set state to IDLE
             # Because now it looks like Register packets can come during other times
@@ -560,15 +617,15 @@ class SATAReconstructor:
 
 
         # NCQ Management stuff
-        elif sata_header['command'] == NCQCommandType.NCQQueueManagement:
+        elif sata_header.command == NCQCommandType.NCQQueueManagement:
             logger.debug("Got Register Packet for NCQ Queue Management.  Ignoring for now.")
             # Don't need to change state
             return None
 
         # NON NCQ Register Packet
         else:
-            logger.debug("Got Non-NCQ HTD Register Packet, expected %d bytes." % (sata_header['count']*self.sector_size))
-            logger.debug("Command field is %d" % sata_header['command'])
+            logger.debug("Got Non-NCQ HTD Register Packet, expected %d bytes." % (sata_header.count*self.sector_size))
+            logger.debug("Command field is %d" % sata_header.command)
 
             #            if len(self.ncq_register_stack) > 0:
             #                logger.error("Have more than 0 outstanding NCQ HTD Register Packets.  Non NCQ Register packets are not supposed to be sent while NCQ Register packets are still outstanding.  Size of stack is %d" % len(self.regular_register_stack))
@@ -582,9 +639,9 @@ class SATAReconstructor:
 
 
             # prepare the disk sensor packet for aggregating data
-            lba = sata_header['lba']
-            sector_count = sata_header['count']
-            direction = sata_header['direction']
+            lba = sata_header.lba
+            sector_count = sata_header.count
+            direction = sata_header.direction
 
             #             self.regular_disk_sensor_packet = DiskSensorPacket(lba,
             #                                          sector_count,
@@ -613,14 +670,14 @@ class SATAReconstructor:
 
         sata_header = register_packet.sata_header
 
-        frame_type = sata_header['type']
+        frame_type = sata_header.type
 
 
         logger.debug("Received DTH Register Packet.")
 
         # Check for an error
-        if register_packet.sata_header['status'] & 1 == 1:
-            logger.error("DTH Register Packet indicates ATA error code: %d.  All outstanding commands will be aborted after Host sends request to read the Queued Error Log." % register_packet.sata_header['error'])
+        if register_packet.sata_header.status & 1 == 1:
+            logger.error("DTH Register Packet indicates ATA error code: %d.  All outstanding commands will be aborted after Host sends request to read the Queued Error Log." % register_packet.sata_header.error)
 
             # TODO reset state?
             self._reset_ncq()
@@ -638,21 +695,21 @@ class SATAReconstructor:
     #            last_reg_packet = self.ncq_register_stack.pop()
     #
     #            # check that last register was a register HTD
-    #            if last_reg_packet.sata_header['type'] != FrameType.RegisterFIS_HtoD:
+    #            if last_reg_packet.sata_header.type != FrameType.RegisterFIS_HtoD:
     #                logger.error("Got a DTH Register Packet (ACK) but previous Register Packet was NOT a HTD.  Ignoring.")
     #                return None
     #
     #            last_sata_header = last_reg_packet.sata_header
 
     #             # check if the spot belonging to the associated TAG is empty
-    #             if (not self.ncq_transactions_outstanding[last_sata_header['tag']]):
+    #             if (not self.ncq_transactions_outstanding[last_sata_header.tag]):
     #                 # This TAG is not taken, so we just add
-    #                 self.ncq_transactions_outstanding[last_sata_header['tag']] = last_reg_packet
+    #                 self.ncq_transactions_outstanding[last_sata_header.tag] = last_reg_packet
 
     #             else:
-    #                 logger.error("Received DTH NCQ Register Packet for TAG %d but it is already in use." % last_sata_header['tag'])
+    #                 logger.error("Received DTH NCQ Register Packet for TAG %d but it is already in use." % last_sata_header.tag)
     #                 # still put it in there for now
-    #                 self.ncq_transactions_outstanding[last_sata_header['tag']] = last_reg_packet
+    #                 self.ncq_transactions_outstanding[last_sata_header.tag] = last_reg_packet
 
     #                 #TODO reset state?
 
@@ -661,11 +718,11 @@ class SATAReconstructor:
 
     #             # Associate this DTH Register packet
     #             # with the tag and prepare the disk sensor packet for aggregating data
-    #             lba = last_sata_header['lba']
+    #             lba = last_sata_header.lba
 
     #             # NOTE: NCQ uses features field instead of count for sector count
-    #             sector_count = last_sata_header['features']
-    #             direction = last_sata_header['direction']
+    #             sector_count = last_sata_header.features
+    #             direction = last_sata_header.direction
 
     # #             disk_sensor_packet = DiskSensorPacket(lba,
     # #                                          sector_count,
@@ -680,9 +737,9 @@ class SATAReconstructor:
     #             disk_sensor_packet.__setattr__('size', sector_count*self.sector_size)
     #             disk_sensor_packet.data = ""
 
-    #             self.ncq_data_outstanding[last_sata_header['tag']] = disk_sensor_packet
+    #             self.ncq_data_outstanding[last_sata_header.tag] = disk_sensor_packet
 
-    #             logger.debug("Associating DTH Register Packet (ACK) with TAG %d.  Expecting %d bytes." % (last_sata_header['tag'], sector_count*self.sector_size))
+    #             logger.debug("Associating DTH Register Packet (ACK) with TAG %d.  Expecting %d bytes." % (last_sata_header.tag, sector_count*self.sector_size))
 
     #             # set state to IDLE
 
@@ -737,7 +794,7 @@ class SATAReconstructor:
             Always returns None
         """
 
-        logger.debug("Received a PIO Setup Frame expecting %d bytes." % pio_setup_packet.sata_header['transfer_count'])
+        logger.debug("Received a PIO Setup Frame expecting %d bytes." % pio_setup_packet.sata_header.transfer_count)
 
         # change state to receive PIO data
         if self.STATE != self.WAIT_FOR_NON_NCQ_DATA:
@@ -761,8 +818,8 @@ class SATAReconstructor:
         if len(self.ncq_dma_stack) > 0:
             logger.debug("Received a DMA setup packet (for NCQ) but have outstanding DMA setup commands.  Stack size is %d" % len(self.ncq_dma_stack))
 
-        tag = dma_setup_packet.sata_header['dma_buf_identifier_low']
-        data_len = dma_setup_packet.sata_header['transfer_count']
+        tag = dma_setup_packet.sata_header.dma_buf_identifier_low
+        data_len = dma_setup_packet.sata_header.transfer_count
 
         logger.debug("Received a DMA setup packet (for NCQ) for TAG %d expecting %d bytes." % (tag, data_len))
 
@@ -772,13 +829,13 @@ class SATAReconstructor:
         # Now we are waiting for data
         # Depends on the direction_bit, NOT the LOPHI direction
         # Hypothesis is that NCQ only uses DMA Setups from the Device
-        if dma_setup_packet.sata_header['direction_bit'] == self.HOST_TO_DEVICE:
-            logger.debug("DMA setup packet was for a WRITE - direction_bit == %d" % dma_setup_packet.sata_header['direction_bit'])
+        if dma_setup_packet.sata_header.direction_bit == self.HOST_TO_DEVICE:
+            logger.debug("DMA setup packet was for a WRITE - direction_bit == %d" % dma_setup_packet.sata_header.direction_bit)
             # Host will send data to write
             self.STATE = self.WAIT_FOR_DMA_DATA_HOST
 
         else:
-            logger.debug("DMA setup packet was for a READ - direction_bit == %d" % dma_setup_packet.sata_header['direction_bit'])
+            logger.debug("DMA setup packet was for a READ - direction_bit == %d" % dma_setup_packet.sata_header.direction_bit)
             self.STATE = self.WAIT_FOR_DMA_DATA_DEVICE
 
         return None
@@ -798,7 +855,7 @@ class SATAReconstructor:
 
             dma_setup_packet = self.ncq_dma_stack[-1]
 
-            tag = dma_setup_packet.sata_header['dma_buf_identifier_low']
+            tag = dma_setup_packet.sata_header.dma_buf_identifier_low
 
             # Check the register packet
             register_packet = self.ncq_transactions_outstanding[tag]
@@ -808,28 +865,29 @@ class SATAReconstructor:
 
             # Data is the data just observed without the 4 byte checksum
             data = data_packet.sata_data[:-4]
-            direction = data_packet.sata_header['direction']
+            direction = data_packet.sata_header.direction
 
             # NOTE - with the state based design, I don't think we need to check direction anymore
 
             # check direction
             # TODO make sure it is direction_bit we care about
-            #             if direction == dma_setup_packet.sata_header['direction']:
-            #                 logger.error("Received NCQ DATA packet with direction %d but expected %d from DMA setup packet.  Ignoring." % (direction, dma_setup_packet.sata_header['direction']+1 % 0))
+            #             if direction == dma_setup_packet.sata_header.direction:
+            #                 logger.error("Received NCQ DATA packet with direction %d but expected %d from DMA setup packet.  Ignoring." % (direction, dma_setup_packet.sata_header.direction+1 % 0))
             #                 return
 
             # Add to our queue
             self.ncq_data_packets.append(data_packet)
 
-            logger.debug("Added DATA packet to our queue. (%d -> %d of %d)"%(self.ncq_data_len,
-                                                                             self.ncq_data_len + len(data),
-                                                                             dma_setup_packet.sata_header['transfer_count']))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Added DATA packet to our queue. (%d -> %d of %d)"%(self.ncq_data_len,
+                                                                                 self.ncq_data_len + len(data),
+                                                                                 dma_setup_packet.sata_header.transfer_count))
 
             # check if we got the amount of data indicated by the dma setup packet
             self.ncq_data_len += len(data)
 
-            if self.ncq_data_len >= dma_setup_packet.sata_header['transfer_count']:
-                if self.ncq_data_len == dma_setup_packet.sata_header['transfer_count']:
+            if self.ncq_data_len >= dma_setup_packet.sata_header.transfer_count:
+                if self.ncq_data_len == dma_setup_packet.sata_header.transfer_count:
                     logger.debug("Received exactly the amount of data we expected from DMA setup packet.")
                 else:
                     logger.error("Received more data than we expected from DMA setup packet.  Aggregating anyway.")
@@ -838,7 +896,7 @@ class SATAReconstructor:
                 disk_sensor_packet = self.ncq_data_outstanding[tag]
                 for d_packet in self.ncq_data_packets:
                     disk_sensor_packet.data += d_packet.sata_data[:-4]
-                #                    disk_sensor_packet.disk_operation = d_packet.sata_header['direction']
+                #                    disk_sensor_packet.disk_operation = d_packet.sata_header.direction
 
                 # put it back in the appropriate position in ncq_databuffer
                 self.ncq_data_outstanding[tag] = disk_sensor_packet
@@ -906,10 +964,11 @@ class SATAReconstructor:
         ret = None
 
         if len(self.regular_register_stack) > 0:
-            logger.debug("Received DATA packet (normal non-NCQ) (%d -> %d)" % (len(self.regular_disk_sensor_packet.data), len(self.regular_disk_sensor_packet.data) + len(data_packet.sata_data[:-4])))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Received DATA packet (normal non-NCQ) (%d -> %d)" % (len(self.regular_disk_sensor_packet.data), len(self.regular_disk_sensor_packet.data) + len(data_packet.sata_data[:-4])))
 
             self.regular_disk_sensor_packet.data += data_packet.sata_data[:-4]
-            #            self.regular_disk_sensor_packet.disk_operation = data_packet.sata_header['direction']
+            #            self.regular_disk_sensor_packet.disk_operation = data_packet.sata_header.direction
 
             # check if we got all the data we expected for the corresponding register packet
             # we need to do this b/c PIO data transfers don't use a Register ACK to indicate end of the transaction
@@ -922,12 +981,13 @@ class SATAReconstructor:
                 logger.debug("Flushing data for non NCQ disk sensor packet.")
 
                 # Set our direction based on the actual direction that the data came
-                self.regular_disk_sensor_packet.direction = data_packet.sata_header['direction']
+                self.regular_disk_sensor_packet.direction = data_packet.sata_header.direction
 
                 # Return our disk sensor packet
                 ret = [self.regular_disk_sensor_packet]
 
-                # Reset state
+                # Reset state, the command is complete
+                self.regular_register_stack = []
                 self.regular_disk_sensor_packet = None
                 self.STATE = self.DEVICE_IDLE
 
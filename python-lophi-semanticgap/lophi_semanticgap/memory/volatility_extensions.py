@@ -9,6 +9,8 @@ logger = logging.getLogger(__name__)
 LOPHI_TIMEOUT = 100
 LOPHI_RETRIES = 5
 
+PAGE_SIZE = 4096
+
 pil_installed = True
 try:
     from PIL import Image, ImageDraw
@@ -154,34 +156,92 @@ class VolatilityWrapper:
         if self.addr_space is None:
             self.addr_space = self.utils.load_as(self.volatility_config)
 
-        # Enable our cache
-        self.volatility_config.update('LOPHI_CACHE',True)
-                    
-        # Get our results for this module
-        command_obj = self.command_objs[plugin_name]
-#       data = command_obj.calculate()
-        data = command_obj.calculate(self.addr_space)
-
-        # Disable and wipe our cache
-        self.volatility_config.update('LOPHI_CACHE',False)
-                    
-        # Render out output into the format we want
-        output = self._render_data(plugin_name, self.addr_space, data)
-    
-        if output is not None:
-            # We have to append our output specific info for processing
-            output['MODULE'] = plugin_name
-            output['URI'] = self.uri
-            output['PROFILE'] = self.profile
-        else:
-            stringio = cStringIO.StringIO()
-            command_obj.render_text(stringio, data)
-            output = stringio.getvalue()
-            stringio.close()
+        # Enable our cache (Plugins are generators, so memory is read while 
+        # we render too)
+        self._set_cache(True)
+        try:
+            # Get our results for this module
+            command_obj = self.command_objs[plugin_name]
+#           data = command_obj.calculate()
+            data = command_obj.calculate(self.addr_space)
+
+            # Render out output into the format we want
+            output = self._render_data(plugin_name, self.addr_space, data)
+        
+            if output is not None:
+                # We have to append our output specific info for processing
+                output['MODULE'] = plugin_name
+                output['URI'] = self.uri
+                output['PROFILE'] = self.profile
+            else:
+                stringio = cStringIO.StringIO()
+                command_obj.render_text(stringio, data)
+                output = stringio.getvalue()
+                stringio.close()
+        finally:
+            # Disable and wipe our cache, memory will have changed by the 
+            # next run
+            self._set_cache(False)
 
         return output
     
     
+    def _lophi_space(self, addr_space):
+        """
+            Find the LO-PHI address space under an address space
+            
+            @param addr_space: Volatility address space
+            @return: LoPhiAddressSpace or None (E.g. for file://)
+        """
+        while addr_space is not None:
+            if hasattr(addr_space, "prefetch") and \
+                    hasattr(addr_space, "set_cache"):
+                return addr_space
+            addr_space = getattr(addr_space, "base", None)
+        return None
+    
+    
+    def _set_cache(self, status):
+        """
+            Enable/Disable the page cache of our LO-PHI address space
+        """
+        lophi_space = self._lophi_space(self.addr_space)
+        if lophi_space is not None:
+            lophi_space.set_cache(status)
+    
+    
+    def _prefetch(self, vm, reads):
+        """
+            Pull many regions of virtual memory into our LO-PHI cache with a 
+            single batched request, instead of one request for every field 
+            that a plugin reads
+            
+            The page tables are walked through the same cache, so each table 
+            is only read from the sensor once.
+            
+            @param vm: Virtual address space that the regions are in
+            @param reads: List of (address, length)
+        """
+        lophi_space = self._lophi_space(vm)
+        if lophi_space is None:
+            return
+        
+        # Already physical?
+        if lophi_space is vm:
+            lophi_space.prefetch(reads)
+            return
+        
+        physical_reads = []
+        for (addr, length) in reads:
+            page = addr - addr % PAGE_SIZE
+            while page < addr + length:
+                paddr = vm.vtop(page)
+                if paddr is not None:
+                    physical_reads.append((paddr, PAGE_SIZE))
+                page += PAGE_SIZE
+        lophi_space.prefetch(physical_reads)
+    
+    
     def _render_data(self,module_name, addr_space, data):
         """
             Given volatility plugin output, will attempt to render it into a 
@@ -279,6 +339,12 @@ class VolatilityWrapper:
         offsettype = "(V)"
         out_header = ['Offset'+offsettype,'Name', 'Pid', 'PPid', 'Thds', 'Hnds', 'Time']
         out_data = []
+        
+        # Walk the list first, then fetch every process with one request
+        data = list(data)
+        self._prefetch(addr_space, [(task.obj_offset, task.size())
+                                    for task in data])
+        
         for task in data:
             offset = task.obj_offset
             try:
@@ -418,6 +484,8 @@ class VolatilityWrapper:
             
             
             if vm.is_valid_address(table):
+                # Fetch the whole table at once
+                self._prefetch(vm, [(table, n * 4)])
                 for i in range(n):
                     syscall_addr = obj.Object('unsigned long', table + (i * 4), vm).v()
                     try:
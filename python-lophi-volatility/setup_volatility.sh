@@ -24,6 +24,7 @@ cd ../../..
 
 echo "Installing LO-PHI address space..."
 cp lophiaddressspace.py Volatility/volatility/plugins/addrspaces/
+cp lophicompressedaddressspace.py Volatility/volatility/plugins/addrspaces/
 
 echo "Patching volatilty to reuse the same address space..."
 ./replace_calculate.sh
@@ -9,6 +9,7 @@
 
 import sys
 import struct
+import collections
 import logging
 logger = logging.getLogger(__name__)
 
@@ -20,6 +21,9 @@ try:
 except:
     logger.error("python-lophi does not appear to be installed!")
 
+PAGE_SIZE = 4096
+MAX_CACHED_PAGES = 16384 # 64MB, oldest pages are dropped first
+
 class LoPhiAddressSpace(addrspace.BaseAddressSpace):
     """Address space for using LO-PHI memory sensor.
      Mediates requests for the contents of a physical address and length
@@ -52,7 +56,8 @@ class LoPhiAddressSpace(addrspace.BaseAddressSpace):
         self.fname = location
         self.name = location
         self.cache = False
-        self.cache_data = {}
+        # page -> data, in the order they were fetched
+        self.cache_data = collections.OrderedDict()
         self.address = 0
         
         
@@ -70,11 +75,57 @@ class LoPhiAddressSpace(addrspace.BaseAddressSpace):
         """
             Enable/Disable caching
             
+            While caching is enabled every read pulls in whole pages, so a 
+            page-table walk only goes to the sensor once per table, and 
+            prefetch() can pull in many pages with a single batched request.
+            
+            Memory is live, so the cache is wiped every time it is switched on
+            or off (E.g. around every plugin run, see VolatilityWrapper)
         """
         self.cache = status
+        self.cache_data.clear()
+
+    def _cache_pages(self, pages):
+        """
+            Ensure that pages are in our cache, fetching any that are missing
+            with one batched request
+            
+            @param pages: Iterable of page indexes (i.e. address / PAGE_SIZE)
+        """
+        missing = sorted(set(p for p in pages if p not in self.cache_data))
+        if len(missing) == 0:
+            return
+        
+        # Don't fetch more than we can hold
+        missing = missing[:MAX_CACHED_PAGES]
+        
+        datas = self.client.read_many([(page * PAGE_SIZE, PAGE_SIZE) 
+                                       for page in missing])
+        for (page, data) in zip(missing, datas):
+            if data is not None:
+                self.cache_data[page] = data
+        
+        while len(self.cache_data) > MAX_CACHED_PAGES:
+            self.cache_data.popitem(last=False)
+
+    def prefetch(self, reads):
+        """
+            Fetch many regions of memory with a single batched request (e.g. 
+            the entries of a list or the page tables of a walk)
+            
+            NOTE: Only has an effect while caching is enabled (See set_cache)
+            
+            @param reads: List of (address, length)
+        """
+        if not self.cache:
+            return
         
-        if status == False:
-            self.cache_data = {}
+        pages = []
+        for (addr, length) in reads:
+            if length > 0:
+                pages.extend(xrange(addr / PAGE_SIZE, 
+                                    (addr + length - 1) / PAGE_SIZE + 1))
+        self._cache_pages(pages)
 
     def read(self, addr, length):
         """
@@ -83,7 +134,35 @@ class LoPhiAddressSpace(addrspace.BaseAddressSpace):
             @param addr: Address to read from
             @param lengt: Length of data to read
         """
-        return self.client.read(addr,length)
+        if not self.cache or length < 1:
+            return self.client.read(addr,length)
+        
+        first = addr / PAGE_SIZE
+        last = (addr + length - 1) / PAGE_SIZE
+        self._cache_pages(xrange(first, last + 1))
+        
+        data = []
+        for page in xrange(first, last + 1):
+            if page not in self.cache_data:
+                # Let our sensor handle (and report) the failure
+                return self.client.read(addr, length)
+            data.append(self.cache_data[page])
+        
+        offset = addr - first * PAGE_SIZE
+        return "".join(data)[offset:offset + length]
+
+    def read_many(self, reads):
+        """
+            Read many regions of memory with a single batched request
+            
+            @param reads: List of (address, length)
+            @return: List of data, None for any read that failed
+        """
+        if self.cache:
+            self.prefetch(reads)
+            return [self.read(addr, length) for (addr, length) in reads]
+        
+        return self.client.read_many(reads)
 
     def write(self, addr, data):
         """
@@ -0,0 +1,94 @@
+"""
+    Address space for LO-PHI's block-compressed memory images, so that
+    compressed dumps can be analyzed without decompressing them to disk first.
+
+    Selected for file:// locations that start with a compressed image header,
+    everything else falls through to the regular file address space.
+
+@author:       Chad Spensky
+@contact:      chad.spensky@ll.mit.edu
+@organization: MIT Lincoln Laboratory
+"""
+
+import os
+import struct
+import urllib
+import logging
+logger = logging.getLogger(__name__)
+
+import volatility.addrspace as addrspace
+
+try:
+    from lophi.capture.compressed_dump import CompressedDump, \
+        is_compressed_dump
+except:
+    logger.error("python-lophi does not appear to be installed!")
+
+class LoPhiCompressedAddressSpace(addrspace.BaseAddressSpace):
+    """Address space for LO-PHI compressed memory images (file://)"""
+
+    # Just ahead of the FileAddressSpace
+    order = 99
+    def __init__(self, base, config, layered=False, **kwargs):
+        addrspace.BaseAddressSpace.__init__(self, base, config, **kwargs)
+        self.as_assert(base == None or layered, 'Must be first address space')
+        self.as_assert(config.LOCATION.startswith("file://"),
+                       'Location is not a file')
+
+        path = urllib.url2pathname(config.LOCATION[7:])
+        self.as_assert(os.path.exists(path),
+                       'Filename must be specified and exist')
+        self.as_assert(is_compressed_dump(path),
+                       'Not a LO-PHI compressed memory image')
+
+        self.name = os.path.abspath(path)
+        self.fname = self.name
+        self.image = CompressedDump(self.name)
+        self.fsize = len(self.image)
+        self.address = 0
+
+        self.config = config
+        self._exclusions = sorted([])
+
+    def read(self, addr, length):
+        """
+            Read data from our image
+
+            @param addr: Address to read from
+            @param length: Length of data to read
+        """
+        return self.image.read_at(addr, length)
+
+    def zread(self, addr, length):
+        data = self.read(addr, length)
+        if len(data) < length:
+            data += "\x00" * (length - len(data))
+        return data
+
+    def fread(self, length):
+        data = self.read(self.address, length)
+        self.address += len(data)
+        return data
+
+    def read_long(self, addr):
+        string = self.read(addr, 4)
+        (longval, ) = struct.unpack('=L', string)
+        return longval
+
+    def write(self, addr, data):
+        """ Compressed images are read-only """
+        return False
+
+    def get_available_addresses(self):
+        yield (0, self.fsize)
+
+    def is_valid_address(self, addr):
+        if addr == None:
+            return False
+        return 0 <= addr < self.fsize
+
+    def intervals(self, start, end):
+        return [(start, min(end, self.fsize))]
+
+    def close(self):
+        self.image.close()
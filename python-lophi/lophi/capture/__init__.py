@@ -8,10 +8,39 @@ import multiprocessing
 import logging
 import time
 import struct
+import os
+import mmap
+import array
+import Queue
 logger = logging.getLogger(__name__)
 
+numpy_installed = True
+try:
+    import numpy
+except ImportError:
+    numpy_installed = False
+
 # LO-PHI
 from lophi.data import DataStruct
+from lophi.capture.compression import BLOCK_MAGIC, CapBlockHeader, \
+    codec_available, compress_block, decompress_block
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024 # bytes
+DEFAULT_FLUSH_INTERVAL = 1.0 # seconds
+
+
+def segment_filename(filename, segment):
+    """
+        Return the filename of one of the files that a rotated capture is
+        split into
+        
+        @param filename: Filename of the capture
+        @param segment: Segment number (0 is the first file)
+        @return: filename, filename.1, filename.2, ...
+    """
+    if segment == 0:
+        return filename
+    return "%s.%d"%(filename, segment)
 
 class CapHeader(DataStruct):
     """
@@ -68,14 +97,73 @@ class CaptureHandler:
 class CaptureWriter(CaptureHandler, multiprocessing.Process):
     """
         Main class for writing captures to file
+        
+        Records are collected in memory and written out in large groups, 
+        either once buffer_size bytes are pending or flush_interval seconds 
+        have passed.  Groups can optionally be compressed as blocks (See 
+        lophi.capture.compression) and the capture can be rotated into 
+        multiple files (filename, filename.1, filename.2, ...), each of which 
+        is fsync'd when it is closed.
+        
+        NOTE: CaptureReader reads a rotated capture from start to finish, but 
+        CaptureReaderTail, CaptureReaderMapped and CaptureReaderIndexed (and 
+        the index itself) work on one file at a time.
     """
-    def __init__(self, filename, input_queue=None):
+    def __init__(self, filename, input_queue=None, index=False, 
+                 sector_fn=None,
+                 buffer_size=DEFAULT_BUFFER_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 compression=None,
+                 rotate_size=None):
         """
             Initialize our disk capture writer
+            
+            @param filename: Filename of capture file to write
+            @param input_queue: Queue that packets will be read from
+            @param index: Also write an index (see lophi.capture.indexed) so
+            that the capture can be randomly accessed by time or sector
+            @param sector_fn: Function that returns (sector, num_sectors) for a
+            raw packet, or None.  Used to index sector ranges.
+            @param buffer_size: Number of bytes to buffer before writing to 
+            disk (0 writes every packet immediately)
+            @param flush_interval: Maximum number of seconds that a packet will
+            stay buffered (None to only flush on size)
+            @param compression: Codec used to compress blocks of records, 
+            'zlib', 'lz4', 'zstd', or None
+            @param rotate_size: Start a new file once this many bytes of 
+            records have been written to the current one (None to never 
+            rotate)
         """
         
         self.filename = filename
         
+        if compression is not None and not codec_available(compression):
+            logger.error("Compression codec is not available, writing an "
+                         "uncompressed capture. (%s)"%compression)
+            compression = None
+            
+        # Index offsets refer to records, which are hidden inside of blocks
+        if compression is not None and index:
+            logger.warning("Compressed captures cannot be indexed.")
+            index = False
+        
+        self.index_enabled = index
+        self.index = None
+        self.sector_fn = sector_fn
+        
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.compression = compression
+        self.rotate_size = rotate_size
+        
+        # Records that have not been written to disk yet
+        self.pending = []
+        self.pending_size = 0
+        
+        # Number of files that we have opened, and bytes of records in ours
+        self.segment = 0
+        self.offset = 0
+        
         if input_queue is None:
             self.input_queue = multiprocessing.Queue()
         else:
@@ -92,6 +180,111 @@ class CaptureWriter(CaptureHandler, multiprocessing.Process):
         """
         self.input_queue.put(data)
         
+    def _open_segment(self):
+        """
+            Open the next file of our capture, along with its index
+            
+            @return: True/False
+        """
+        filename = segment_filename(self.filename, self.segment)
+            
+        try:
+            self.f = open(filename, "wb")
+        except:
+            logger.error("Could not open file for writing. (%s)"%filename)
+            return False
+        
+        self.segment += 1
+        self.offset = 0
+        
+        if self.index_enabled:
+            from lophi.capture.indexed import CaptureIndex
+            self.index = CaptureIndex(filename)
+            if not self.index.open():
+                self.index = None
+                
+        return True
+    
+    def _close_segment(self):
+        """
+            Flush everything that is buffered and close our current file
+        """
+        self.flush()
+        
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+            
+        try:
+            os.fsync(self.f.fileno())
+        except:
+            logger.error("Could not sync capture file to disk.")
+        
+        self.f.close()
+        self.f = None
+        
+    def flush(self):
+        """
+            Write all of our buffered records to disk
+        """
+        if self.pending_size == 0:
+            return
+        
+        data = "".join(self.pending)
+        if self.compression is not None:
+            data = compress_block(self.compression, data)
+            
+        logger.debug("Writing %d records to file. (%d bytes)"%(
+                                                        len(self.pending),
+                                                        len(data)))
+        self.write(data)
+        
+        self.pending = []
+        self.pending_size = 0
+        
+    def _add_packet(self, cap_header, packet):
+        """
+            Buffer a packet and index it
+            
+            @param cap_header: CapHeader to reuse for this record
+            @param packet: Raw string or object whose repr is the raw packet 
+        """
+        if not isinstance(packet, str):
+            packet = `packet`
+            
+        # Set our header values
+        cap_header.timestamp = time.time()
+        cap_header.length = len(packet)
+        
+        # Our index must never point past what is on disk, so write out the 
+        # block that this record is about to close
+        if self.index is not None and \
+                self.index.block_full(cap_header.timestamp):
+            self.flush()
+        
+        header_data = `cap_header`
+        self.pending.append(header_data)
+        self.pending.append(packet)
+        
+        length = len(header_data) + len(packet)
+        self.pending_size += length
+        
+        # Index this record
+        if self.index is not None:
+            sectors = None
+            if self.sector_fn is not None:
+                sectors = self.sector_fn(packet)
+            self.index.add_record(self.offset, length, cap_header.timestamp,
+                                  sectors)
+        self.offset += length
+        
+        if self.pending_size >= self.buffer_size:
+            self.flush()
+            
+        if self.rotate_size is not None and self.offset >= self.rotate_size:
+            self._close_segment()
+            self._open_segment()
+        
     def run(self):
         """
             Read from our queue and write to a file
@@ -99,35 +292,48 @@ class CaptureWriter(CaptureHandler, multiprocessing.Process):
         
         logger.debug("Starting Capture Writer...")
         # Ensure our file is open
-        if self.f is None and not self._open("w+"):
+        if self.f is None and not self._open_segment():
             return None
         
         # Declare our header
         cap_header = CapHeader()
         
+        # Wake up at least this often to flush our buffer and check for exit
+        timeout = self.flush_interval
+        if not timeout:
+            timeout = DEFAULT_FLUSH_INTERVAL
+        last_flush = time.time()
+        
         # Write forever
         while not self.EXIT.is_set():
             # Get our packet from the queue
             try:
-                packet = self.input_queue.get()
+                packet = self.input_queue.get(True, timeout)
+            except Queue.Empty:
+                packet = None
             except:
                 logger.debug("Input queue closed.")
                 break
             
-            logger.debug("Writing packet to file. (%d bytes)"%len(packet))
+            if packet is not None:
+                self._add_packet(cap_header, packet)
             
-            # Set our header values
-            cap_header.timestamp = time.time()
-            cap_header.length = len(packet)
-            
-            # Write the packet to our pcap file
-            self.write(`cap_header`)
-            if type(packet) == 'str':
-                self.write(packet)
-            else:
-                self.write(`packet`)
+            if self.pending_size == 0:
+                last_flush = time.time()
+            elif self.flush_interval and \
+                    time.time() - last_flush >= self.flush_interval:
+                self.flush()
+                last_flush = time.time()
                 
-        self.f.close()
+        # Write out anything that was queued before we were stopped
+        try:
+            while True:
+                self._add_packet(cap_header, self.input_queue.get_nowait())
+        except:
+            pass
+        
+        if self.f is not None:
+            self._close_segment()
         
     def stop(self):
         """ Kill our process nicely """
@@ -136,7 +342,10 @@ class CaptureWriter(CaptureHandler, multiprocessing.Process):
         try:
             self.input_queue.close()
             self.EXIT.set()
-            self.terminate()
+            # Give our process a chance to write out its buffer
+            self.join(self.flush_interval or DEFAULT_FLUSH_INTERVAL)
+            if self.is_alive():
+                self.terminate()
         except:
             pass
         
@@ -146,16 +355,124 @@ class CaptureReader(CaptureHandler):
         Main class for reading captures from file
     """
 
-    def __init__(self,filename):
+    def __init__(self, filename, follow_segments=True):
         """
             Initialize our reader
+            
+            @param filename: Filename of capture file to read
+            @param follow_segments: Keep reading the files that a rotated 
+            capture continues in (filename.1, filename.2, ...) once we reach
+            the end of one
         """
         self.filename = filename
         
+        # Which file of a rotated capture we are reading
+        self.follow_segments = follow_segments
+        self.segment = 0
+        
+        # Decompressed block that we are reading from (compressed captures)
+        self.compressed = False
+        self.block = ""
+        self.block_offset = 0
+        
     def __iter__(self):
         
         return self
     
+    def _open(self, perm="rb"):
+        """
+            Open our capture and check whether it is block compressed
+            
+            @param perm: open permissions
+        """
+        filename = segment_filename(self.filename, self.segment)
+        try:
+            self.f = open(filename, perm)
+        except:
+            logger.error("Could not open file with '%s' perms. (%s)"%(perm,
+                                                                filename))
+            return False
+        
+        self.compressed = (self.f.read(len(BLOCK_MAGIC)) == BLOCK_MAGIC)
+        self.f.seek(0)
+        
+        self.block = ""
+        self.block_offset = 0
+        return True
+    
+    def _has_next_segment(self):
+        """
+            Has the capture been rotated into another file after ours?
+            
+            @return: True/False
+        """
+        if not self.follow_segments:
+            return False
+        return os.path.exists(segment_filename(self.filename, 
+                                               self.segment + 1))
+    
+    def _next_segment(self):
+        """
+            Move on to the next file of a rotated capture
+            
+            @return: True if there is another file to read
+        """
+        if not self._has_next_segment():
+            return False
+        
+        self.f.close()
+        self.f = None
+        self.segment += 1
+        logger.debug("Reading the next file of our capture. (%s)"%
+                     segment_filename(self.filename, self.segment))
+        return self._open()
+    
+    def _next_block(self):
+        """
+            Read and decompress the next block of a compressed capture
+            
+            @return: True/False
+        """
+        where = self.f.tell()
+        
+        header_data = self.f.read(CapBlockHeader.STRUCT_SIZE)
+        if len(header_data) == CapBlockHeader.STRUCT_SIZE:
+            block_header = CapBlockHeader(header_data)
+            if block_header.magic != BLOCK_MAGIC:
+                logger.error("Corrupt block in compressed capture. (%s)"%
+                             self.filename)
+                return False
+            
+            data = self.f.read(block_header.length)
+            if len(data) == block_header.length:
+                self.block = decompress_block(block_header, data)
+                self.block_offset = 0
+                return True
+            
+        # The block hasn't been completely written yet
+        self.f.seek(where)
+        return False
+    
+    def read(self, size):
+        """
+            Read size bytes of records from our capture
+        """
+        if not self.compressed:
+            return self.f.read(size)
+        
+        rtn = []
+        while size > 0:
+            if self.block_offset >= len(self.block) and \
+                    not self._next_block():
+                break
+            
+            data = self.block[self.block_offset:self.block_offset + size]
+            self.block_offset += len(data)
+            size -= len(data)
+            rtn.append(data)
+            
+        return "".join(rtn)
+    
     def next(self):
         """
             Read from our queue and write to a file
@@ -171,6 +488,8 @@ class CaptureReader(CaptureHandler):
         # Read header from file
         logger.debug("Reading header. (%d bytes)"%len(cap_header))
         header_data = self.read(len(cap_header))
+        while len(header_data) == 0 and self._next_segment():
+            header_data = self.read(len(cap_header))
         if len(header_data) == 0:
             logger.debug("Hit end of file.")
             raise StopIteration
@@ -200,9 +519,21 @@ class CaptureReader(CaptureHandler):
             header_data = self.read(len(cap_header))
             
             if len(header_data) == 0:
-                logger.debug("No data left in file.")
-                time.sleep(1)
-                continue
+                # Clear the end of file so that we see anything written since
+                self.f.seek(self.f.tell())
+                
+                # Our writer finishes a file before it starts the next one, 
+                # so once there is a next one, whatever is left in ours is 
+                # the last of it
+                if self._has_next_segment():
+                    header_data = self.read(len(cap_header))
+                    if len(header_data) == 0:
+                        self._next_segment()
+                        continue
+                else:
+                    logger.debug("No data left in file.")
+                    time.sleep(1)
+                    continue
             
             cap_header._unpack(header_data)
             
@@ -285,4 +616,245 @@ class CaptureReaderTail(CaptureHandler):
             # update our current position where we are leaving off            
             self.where = self.f.tell()
     
-        return ret
\ No newline at end of file
+        return ret
+
+
+class CaptureReaderMapped(CaptureHandler):
+    """
+        Reader for offline replay of large captures.
+        
+        The capture is memory-mapped and records are returned as read-only 
+        buffer slices into the map, so no data is copied and no header objects
+        are created.  Records can be read one at a time, in batches, or by 
+        index once the offset table has been built.
+    """
+    
+    # Just the length field of CapHeader
+    HEADER_LENGTH = struct.Struct('>4xI')
+    HEADER = struct.Struct('>fI')
+    
+    def __init__(self,filename):
+        """
+            Initialize our reader
+        """
+        self.filename = filename
+        
+        self.mm = None
+        self.size = 0
+        
+        # File offset of every record, see build_offsets()
+        self.offsets = None
+        
+        # Where the next call to next() will read from
+        self.where = 0
+        
+    def __del__(self):
+        """ Unmap our file """
+        self.close()
+        
+    def close(self):
+        """ Unmap and close our file """
+        if self.mm is not None and not isinstance(self.mm, str):
+            self.mm.close()
+        self.mm = None
+        
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        
+    def _map(self):
+        """
+            Memory map our capture file
+            
+            @return: True/False
+        """
+        if self.mm is not None:
+            return True
+        
+        if self.f is None and not self._open("rb"):
+            return False
+        
+        self.size = os.fstat(self.f.fileno()).st_size
+        
+        # Empty files cannot be mapped
+        if self.size == 0:
+            self.mm = ""
+        else:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+            
+        if self.mm[:len(BLOCK_MAGIC)] == BLOCK_MAGIC:
+            logger.error("Compressed captures cannot be memory mapped, use "
+                         "CaptureReader instead. (%s)"%self.filename)
+            self.close()
+            return False
+            
+        return True
+        
+    def __iter__(self):
+        return self
+    
+    def __len__(self):
+        """ Return the number of records in the capture """
+        self.build_offsets()
+        return len(self.offsets)
+    
+    def __getitem__(self, index):
+        """ Return record number index as (timestamp, data) """
+        self.build_offsets()
+        return self._record(self.offsets[index])
+    
+    def _record(self, offset):
+        """
+            Return the record at a file offset
+            
+            @param offset: File offset of the record's CapHeader
+            @return: (timestamp, data) where data is a buffer into our map
+        """
+        (timestamp, length) = self.HEADER.unpack_from(self.mm, offset)
+        return (timestamp, buffer(self.mm, offset + self.HEADER.size, length))
+    
+    def _next_offset(self, offset):
+        """
+            Return the offset of the record after the one at offset
+            
+            @return: Offset of the next record, or None if the record at 
+            offset is missing or truncated
+        """
+        if offset + self.HEADER.size > self.size:
+            return None
+        
+        end = offset + self.HEADER.size + \
+              self.HEADER_LENGTH.unpack_from(self.mm, offset)[0]
+        if end > self.size:
+            logger.debug("Truncated record at end of file.")
+            return None
+        
+        return end
+            
+    def next(self):
+        """
+            Return the next (timestamp, data) from our capture
+        """
+        if not self._map():
+            raise StopIteration
+        
+        end = self._next_offset(self.where)
+        if end is None:
+            logger.debug("Hit end of file.")
+            raise StopIteration
+        
+        record = self._record(self.where)
+        self.where = end
+        return record
+    
+    def next_batch(self, count):
+        """
+            Return the next count records
+            
+            @param count: Maximum number of records to return
+            @return: List of (timestamp, data), empty at the end of the file
+        """
+        if not self._map():
+            return []
+        
+        records = []
+        while len(records) < count:
+            end = self._next_offset(self.where)
+            if end is None:
+                break
+            records.append(self._record(self.where))
+            self.where = end
+            
+        return records
+    
+    def batches(self, count):
+        """
+            Generator of lists of up to count records
+            
+            @param count: Number of records per batch
+        """
+        while True:
+            records = self.next_batch(count)
+            if len(records) == 0:
+                return
+            yield records
+        
+    def build_offsets(self):
+        """
+            Build a table of the file offset of every record in one pass over
+            the headers
+            
+            NOTE: Each offset depends on the length of the record before it,
+            so this walk is a serial Python loop.  Only the header decoding in
+            headers() is vectorized.
+            
+            @return: array of offsets
+        """
+        if self.offsets is not None:
+            return self.offsets
+        
+        self.offsets = array.array('L')
+        if not self._map():
+            return self.offsets
+        
+        # Only the length field is needed to find the next record
+        append = self.offsets.append
+        unpack_from = self.HEADER_LENGTH.unpack_from
+        header_size = self.HEADER.size
+        mm = self.mm
+        size = self.size
+        
+        offset = 0
+        while offset + header_size <= size:
+            end = offset + header_size + unpack_from(mm, offset)[0]
+            if end > size:
+                logger.debug("Truncated record at end of file.")
+                break
+            append(offset)
+            offset = end
+            
+        logger.debug("Found %d records in %s"%(len(self.offsets),
+                                                self.filename))
+        return self.offsets
+    
+    def headers(self):
+        """
+            Return the header of every record in the capture.
+            
+            With NumPy installed this is a structured array with 'offset', 
+            'timestamp', and 'length' fields, read straight out of the map by 
+            indexing a strided view of it with the offset table.  Otherwise it
+            is a list of (offset, timestamp, length) tuples.
+        """
+        offsets = self.build_offsets()
+        
+        if not numpy_installed:
+            return [(offset,) + self.HEADER.unpack_from(self.mm, offset)
+                    for offset in offsets]
+            
+        header_dtype = numpy.dtype([('timestamp','>f4'), ('length','>u4')])
+        
+        offset_array = numpy.frombuffer(offsets, 
+                                    dtype=numpy.dtype('u%d'%offsets.itemsize))
+        offset_array = offset_array.astype(numpy.intp)
+        
+        rtn = numpy.zeros(len(offsets), dtype=[('offset','u8'),
+                                               ('timestamp','f8'),
+                                               ('length','u8')])
+        if len(offsets) == 0:
+            return rtn
+        
+        # Records are not a fixed size, so view the map as a header starting
+        # at every byte (no copy) and pick out the ones in our offset table
+        mapped_headers = numpy.ndarray(
+                            shape=(self.size - header_dtype.itemsize + 1,),
+                            dtype=header_dtype,
+                            buffer=self.mm,
+                            strides=(1,))
+        raw_headers = mapped_headers[offset_array]
+        
+        rtn['offset'] = offset_array
+        rtn['timestamp'] = raw_headers['timestamp']
+        rtn['length'] = raw_headers['length']
+        return rtn
+
@@ -0,0 +1,316 @@
+"""
+    Seekable, block-compressed memory images
+
+    Memory is split into fixed-size blocks that are compressed independently,
+    followed by an index of where every block landed, so any offset can be
+    read by decompressing a single block.  Blocks that are entirely zero are
+    not stored at all.
+
+    The container is written as the dump streams in, so the uncompressed
+    image never has to touch the disk, and can be read directly by Volatility
+    (See lophicompressedaddressspace.py in python-lophi-volatility).
+
+    (c) 2015 Massachusetts Institute of Technology
+"""
+# Native
+import os
+import Queue
+import threading
+import collections
+import logging
+logger = logging.getLogger(__name__)
+
+# LO-PHI
+from lophi.data import DataStruct
+from lophi.capture.compression import CODEC_ZLIB, CODEC_IDS, \
+    codec_available, compress, decompress
+
+DUMP_MAGIC = "LPMC"
+DUMP_VERSION = 1
+
+DEFAULT_BLOCK_SIZE = 256 * 1024
+
+# Number of decompressed blocks that readers keep around
+DEFAULT_CACHED_BLOCKS = 16
+
+# Number of blocks waiting to be compressed before write() blocks
+WRITE_QUEUE_SIZE = 16
+
+
+class CompressedDumpHeader(DataStruct):
+    """
+        Header at the start of every compressed memory image
+
+        magic: Always DUMP_MAGIC
+        version: Version of the format
+        codec: Id of the codec used for every block (See CODEC_IDS)
+        block_size: Size of each block once decompressed
+        total_size: Size of the memory image
+        index_offset: File offset of our block index (0 until it's written)
+    """
+    STRUCT = [('magic','>4s'),
+              ('version','>I'),
+              ('codec','>I'),
+              ('block_size','>I'),
+              ('total_size','>Q'),
+              ('index_offset','>Q')]
+
+
+class CompressedDumpEntry(DataStruct):
+    """
+        Index entry for every block
+
+        offset: File offset of the compressed block
+        length: Length of the compressed block (0 if the block is all zeros)
+    """
+    STRUCT = [('offset','>Q'),
+              ('length','>I')]
+
+
+def is_compressed_dump(filename):
+    """
+        Is this file a compressed memory image?
+
+        @param filename: Filename of the image
+        @return: True/False
+    """
+    try:
+        f = open(filename, "rb")
+        magic = f.read(len(DUMP_MAGIC))
+        f.close()
+    except:
+        return False
+    return magic == DUMP_MAGIC
+
+
+class CompressedDumpWriter:
+    """
+        File-like object that compresses a memory image as it is written
+
+        Blocks are compressed on a separate thread (our codecs release the GIL)
+        so that compression overlaps with reading memory from the sensor.
+    """
+
+    def __init__(self, filename, total_size, codec=CODEC_ZLIB,
+                 block_size=DEFAULT_BLOCK_SIZE):
+        """
+            Initialize our writer
+
+            @param filename: Filename of the compressed image
+            @param total_size: Size of the memory image
+            @param codec: CODEC_ZLIB, CODEC_LZ4, or CODEC_ZSTD
+            @param block_size: Size of each block once decompressed
+        """
+        if not codec_available(codec):
+            raise ValueError("Compression codec is not available. (%s)" %
+                             codec)
+
+        self.filename = filename
+        self.codec = codec
+        self.block_size = block_size
+
+        self.header = CompressedDumpHeader()
+        self.header.magic = DUMP_MAGIC
+        self.header.version = DUMP_VERSION
+        self.header.codec = CODEC_IDS[codec]
+        self.header.block_size = block_size
+        self.header.total_size = total_size
+        self.header.index_offset = 0
+
+        self.f = open(filename, "wb")
+        self.f.write(`self.header`)
+
+        self.entries = []
+        self.partial = []
+        self.partial_size = 0
+        self.zeros = "\x00" * block_size
+
+        # Compress on another thread
+        self.error = None
+        self.queue = Queue.Queue(WRITE_QUEUE_SIZE)
+        self.thread = threading.Thread(target=self._compress_blocks)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _compress_blocks(self):
+        """ Compress and write every block that is queued, in order """
+        while True:
+            block = self.queue.get()
+            if block is None:
+                return
+            try:
+                entry = CompressedDumpEntry()
+                entry.offset = self.f.tell()
+                entry.length = 0
+                if block != self.zeros[:len(block)]:
+                    compressed = compress(self.codec, block)
+                    self.f.write(compressed)
+                    entry.length = len(compressed)
+                self.entries.append(entry)
+            except Exception, e:
+                logger.error("Could not write compressed block. (%s)" % e)
+                self.error = e
+
+    def write(self, data):
+        """
+            Append memory to our image
+
+            @param data: Memory contents (String or buffer)
+        """
+        if self.error is not None:
+            raise IOError("Compressed dump failed. (%s)" % self.error)
+
+        data = str(data)
+        offset = 0
+        while offset < len(data):
+            needed = self.block_size - self.partial_size
+            piece = data[offset:offset + needed]
+            self.partial.append(piece)
+            self.partial_size += len(piece)
+            offset += len(piece)
+
+            if self.partial_size == self.block_size:
+                self.queue.put("".join(self.partial))
+                self.partial = []
+                self.partial_size = 0
+
+    def close(self):
+        """ Flush our last block and write our index """
+        if self.partial_size > 0:
+            self.queue.put("".join(self.partial))
+            self.partial = []
+            self.partial_size = 0
+
+        self.queue.put(None)
+        self.thread.join()
+
+        # Write our index and point our header at it
+        self.header.index_offset = self.f.tell()
+        self.f.write("".join(`entry` for entry in self.entries))
+        self.f.seek(0)
+        self.f.write(`self.header`)
+        self.f.close()
+
+        if self.error is not None:
+            raise IOError("Compressed dump failed. (%s)" % self.error)
+
+
+class CompressedDump:
+    """
+        Random-access reader for compressed memory images, with a file-like
+        interface (read, seek, tell)
+    """
+
+    def __init__(self, filename, cached_blocks=DEFAULT_CACHED_BLOCKS):
+        """
+            Open a compressed image
+
+            @param filename: Filename of the image
+            @param cached_blocks: Number of decompressed blocks to keep
+        """
+        self.filename = filename
+        self.f = open(filename, "rb")
+
+        self.header = CompressedDumpHeader(
+                                self.f.read(CompressedDumpHeader.STRUCT_SIZE))
+        if self.header.magic != DUMP_MAGIC or \
+                self.header.version > DUMP_VERSION:
+            raise ValueError("Not a compressed memory image. (%s)" % filename)
+        if self.header.index_offset == 0:
+            raise ValueError("Compressed memory image was never finished. "
+                             "(%s)" % filename)
+
+        self.block_size = self.header.block_size
+        self.total_size = self.header.total_size
+
+        self.f.seek(self.header.index_offset)
+        self.entries = CompressedDumpEntry.unpack_many(self.f.read())
+
+        # LRU of block index -> data
+        self.cache = collections.OrderedDict()
+        self.cached_blocks = cached_blocks
+
+        self.position = 0
+
+    def __len__(self):
+        """ Return the size of the memory image """
+        return self.total_size
+
+    def _read_block(self, block):
+        """ Return the decompressed contents of a block """
+        data = self.cache.pop(block, None)
+        if data is None:
+            entry = self.entries[block]
+            raw_length = min(self.block_size,
+                             self.total_size - block * self.block_size)
+            if entry.length == 0:
+                data = "\x00" * raw_length
+            else:
+                self.f.seek(entry.offset)
+                data = decompress(self.header.codec,
+                                  self.f.read(entry.length),
+                                  raw_length)
+            if len(self.cache) >= self.cached_blocks:
+                self.cache.popitem(last=False)
+        self.cache[block] = data
+        return data
+
+    def read_at(self, offset, length):
+        """
+            Read from the memory image
+
+            @param offset: Offset into the image
+            @param length: Number of bytes to read
+            @return: Data (Short if the read goes past the end of the image)
+        """
+        length = min(length, self.total_size - offset)
+        if length <= 0 or offset < 0:
+            return ""
+
+        first = offset / self.block_size
+        last = (offset + length - 1) / self.block_size
+
+        start = offset - first * self.block_size
+        if first == last:
+            return self._read_block(first)[start:start + length]
+
+        data = "".join(self._read_block(block)
+                       for block in xrange(first, last + 1))
+        return data[start:start + length]
+
+    def read(self, length=None):
+        """ Read from our current position """
+        if length is None:
+            length = self.total_size - self.position
+        data = self.read_at(self.position, length)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """ Move our current position """
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.total_size
+        self.position = offset
+
+    def tell(self):
+        """ Return our current position """
+        return self.position
+
+    def close(self):
+        """ Close our image """
+        self.f.close()
+        self.cache.clear()
+
+
+def open_dump(filename):
+    """
+        Open a memory image for reading, compressed or not
+
+        @param filename: Filename of the image
+        @return: File-like object
+    """
+    if is_compressed_dump(filename):
+        return CompressedDump(filename)
+    return open(filename, "rb")
@@ -0,0 +1,161 @@
+"""
+    Block compression for capture files
+
+    A compressed capture is a sequence of blocks, each one a CapBlockHeader
+    followed by the compressed bytes of a run of ordinary capture records
+    (CapHeader + data).  Decompressing every block in order yields exactly
+    the uncompressed capture.
+
+    zlib is always available, lz4 and zstd are used if their modules are
+    installed.
+
+    (c) 2015 Massachusetts Institute of Technology
+"""
+# Native
+import zlib
+import logging
+logger = logging.getLogger(__name__)
+
+lz4_installed = True
+try:
+    import lz4.block
+except ImportError:
+    lz4_installed = False
+
+zstd_installed = True
+try:
+    import zstandard
+except ImportError:
+    zstd_installed = False
+
+# LO-PHI
+from lophi.data import DataStruct
+
+BLOCK_MAGIC = "LPCZ"
+
+CODEC_ZLIB = "zlib"
+CODEC_LZ4 = "lz4"
+CODEC_ZSTD = "zstd"
+
+# Codec ids stored in our block headers
+CODEC_IDS = {CODEC_ZLIB: 1,
+             CODEC_LZ4: 2,
+             CODEC_ZSTD: 3}
+CODEC_NAMES = dict((v, k) for (k, v) in CODEC_IDS.items())
+
+
+class CapBlockHeader(DataStruct):
+    """
+        Header in front of every compressed block of records
+
+        magic: Always BLOCK_MAGIC
+        codec: Id of the codec used to compress the block (See CODEC_IDS)
+        length: Length of the compressed block
+        raw_length: Length of the block once decompressed
+    """
+    STRUCT = [('magic','>4s'),
+              ('codec','>I'),
+              ('length','>I'),
+              ('raw_length','>I')]
+
+
+def codec_available(codec):
+    """
+        Can we compress and decompress with this codec?
+
+        @param codec: CODEC_ZLIB, CODEC_LZ4, or CODEC_ZSTD
+        @return: True/False
+    """
+    if codec == CODEC_ZLIB:
+        return True
+    elif codec == CODEC_LZ4:
+        return lz4_installed
+    elif codec == CODEC_ZSTD:
+        return zstd_installed
+    return False
+
+
+def compress(codec, data):
+    """
+        Compress data with one of our codecs
+
+        @param codec: CODEC_ZLIB, CODEC_LZ4, or CODEC_ZSTD
+        @param data: Raw data
+        @return: Compressed data
+    """
+    if codec == CODEC_ZLIB:
+        return zlib.compress(str(data), 1)
+    elif codec == CODEC_LZ4:
+        return lz4.block.compress(str(data), store_size=False)
+    elif codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=1).compress(str(data))
+    else:
+        raise ValueError("Unknown capture compression codec. (%s)"%codec)
+
+
+def decompress(codec_id, data, raw_length):
+    """
+        Decompress data compressed by compress()
+
+        @param codec_id: Id of the codec (See CODEC_IDS)
+        @param data: Compressed data
+        @param raw_length: Length of the data once decompressed
+        @return: Raw data
+    """
+    codec = CODEC_NAMES.get(codec_id)
+    if codec is None or not codec_available(codec):
+        raise ValueError("Data uses an unavailable codec. (%d)"%codec_id)
+
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    elif codec == CODEC_LZ4:
+        return lz4.block.decompress(data, uncompressed_size=raw_length)
+    else:
+        return zstandard.ZstdDecompressor().decompress(data,
+                                                max_output_size=raw_length)
+
+
+def compress_block(codec, data):
+    """
+        Compress a block of capture records
+
+        @param codec: CODEC_ZLIB, CODEC_LZ4, or CODEC_ZSTD
+        @param data: Raw capture records
+        @return: CapBlockHeader and compressed data as a string
+    """
+    compressed = compress(codec, data)
+
+    header = CapBlockHeader()
+    header.magic = BLOCK_MAGIC
+    header.codec = CODEC_IDS[codec]
+    header.length = len(compressed)
+    header.raw_length = len(data)
+
+    return `header` + compressed
+
+
+def decompress_block(header, data):
+    """
+        Decompress a block of capture records
+
+        @param header: CapBlockHeader for this block
+        @param data: Compressed data
+        @return: Raw capture records
+    """
+    return decompress(header.codec, data, header.raw_length)
+
+
+def is_compressed(filename):
+    """
+        Is this capture file block compressed?
+
+        @param filename: Filename of the capture
+        @return: True/False
+    """
+    try:
+        f = open(filename, "rb")
+        magic = f.read(len(BLOCK_MAGIC))
+        f.close()
+    except:
+        return False
+    return magic == BLOCK_MAGIC
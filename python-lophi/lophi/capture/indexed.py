@@ -0,0 +1,501 @@
+"""
+    Sidecar index for capture files, allowing random access by time or sector
+
+    The capture file itself keeps the same record format (CapHeader + data) so
+    that every existing CaptureReader can still read it.  Records are grouped
+    into blocks, and for every block we store one entry in <capture>.idx
+    containing its file offset, record count, time span, and the range of
+    sectors touched by its records.
+
+    (c) 2015 Massachusetts Institute of Technology
+"""
+# Native
+import os
+import bisect
+import struct
+import logging
+logger = logging.getLogger(__name__)
+
+# LO-PHI
+from lophi.data import DataStruct
+from lophi.capture import CapHeader, CaptureReader
+from lophi.capture.compression import is_compressed
+
+INDEX_MAGIC = "LPCI"
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".idx"
+
+# A block is closed when it reaches either of these limits
+DEFAULT_BLOCK_RECORDS = 4096
+DEFAULT_BLOCK_TIME = 1.0 # seconds
+
+# Sector range stored for blocks without any sector information
+NO_SECTOR_START = 0xffffffffffffffff
+NO_SECTOR_END = 0
+
+DISK_PACKET_HEADER = struct.Struct("QI")
+
+
+class CapIndexHeader(DataStruct):
+    """
+        Header at the start of every capture index
+
+        magic: Always INDEX_MAGIC
+        version: Version of the index format
+        block_records: Maximum number of records in each block
+        block_time: Maximum time spanned by each block (seconds)
+    """
+    STRUCT = [('magic','>4s'),
+              ('version','>I'),
+              ('block_records','>I'),
+              ('block_time','>d')]
+
+
+class CapIndexEntry(DataStruct):
+    """
+        One entry per block of records in the capture file
+
+        offset: File offset of the first record in the block
+        length: Number of bytes used by the block's records
+        records: Number of records in the block
+        ts_start/ts_end: Time of the first and last record in the block
+        sector_start/sector_end: Range of sectors touched, [START,END)
+    """
+    STRUCT = [('offset','>Q'),
+              ('length','>Q'),
+              ('records','>I'),
+              ('ts_start','>d'),
+              ('ts_end','>d'),
+              ('sector_start','>Q'),
+              ('sector_end','>Q')]
+
+
+def disk_packet_sectors(data):
+    """
+        Return the sectors touched by a captured DiskSensorPacket
+
+        @param data: Raw record from a (virtual) disk capture
+        @return: (sector, num_sectors) or None
+    """
+    if len(data) < DISK_PACKET_HEADER.size:
+        return None
+    return DISK_PACKET_HEADER.unpack_from(data)
+
+
+class CaptureIndex:
+    """
+        Reads, writes, and queries the index that sits next to a capture file
+    """
+
+    def __init__(self, filename,
+                 block_records=DEFAULT_BLOCK_RECORDS,
+                 block_time=DEFAULT_BLOCK_TIME):
+        """
+            Initialize our index
+
+            @param filename: Filename of the capture (not the index)
+            @param block_records: Maximum number of records per block
+            @param block_time: Maximum number of seconds spanned by a block
+        """
+        self.filename = filename + INDEX_SUFFIX
+        self.block_records = block_records
+        self.block_time = block_time
+
+        self.entries = []
+        self.ts_ends = []
+
+        # Entries sorted by sector_start, built on demand (See find_sectors)
+        self.sector_table = None
+
+        # File handle and block that is currently being written
+        self.f = None
+        self.current = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def exists(self):
+        """ Does an index exist on disk for this capture? """
+        return os.path.exists(self.filename)
+
+    def load(self):
+        """
+            Load our index from disk
+
+            @return: True/False
+        """
+        try:
+            f = open(self.filename, "rb")
+            raw = f.read()
+            f.close()
+        except:
+            logger.error("Could not read capture index. (%s)"%self.filename)
+            return False
+
+        header_size = CapIndexHeader.STRUCT_SIZE
+        if len(raw) < header_size:
+            logger.error("Capture index is truncated. (%s)"%self.filename)
+            return False
+
+        header = CapIndexHeader(raw[:header_size])
+        if header.magic != INDEX_MAGIC:
+            logger.error("Not a capture index. (%s)"%self.filename)
+            return False
+        if header.version > INDEX_VERSION:
+            logger.error("Unsupported capture index version. (%d)"%
+                         header.version)
+            return False
+
+        self.block_records = header.block_records
+        self.block_time = header.block_time
+
+        # Any partial entry at the end is from a writer that died mid-write
+        self.entries = CapIndexEntry.unpack_many(raw, header_size)
+        self.ts_ends = [e.ts_end for e in self.entries]
+        self.sector_table = None
+
+        logger.debug("Loaded %d index entries. (%s)"%(len(self.entries),
+                                                      self.filename))
+        return True
+
+    def open(self):
+        """
+            Create our index on disk, entries are appended as blocks close
+
+            @return: True/False
+        """
+        try:
+            self.f = open(self.filename, "wb")
+        except:
+            logger.error("Could not create capture index. (%s)"%self.filename)
+            return False
+
+        header = CapIndexHeader()
+        header.magic = INDEX_MAGIC
+        header.version = INDEX_VERSION
+        header.block_records = self.block_records
+        header.block_time = self.block_time
+        self.f.write(`header`)
+        self.f.flush()
+
+        self.entries = []
+        self.ts_ends = []
+        self.sector_table = None
+        self.current = None
+        return True
+
+    def block_full(self, timestamp):
+        """
+            Will a record captured at this time close the current block?
+
+            @param timestamp: Time that the next record was captured
+            @return: True/False
+        """
+        entry = self.current
+        return entry is not None and (entry.records >= self.block_records or
+                                timestamp - entry.ts_start >= self.block_time)
+
+    def add_record(self, offset, length, timestamp, sectors=None):
+        """
+            Add a record to the current block
+
+            @param offset: File offset of the record's CapHeader
+            @param length: Size of the record (CapHeader and data)
+            @param timestamp: Time that the record was captured
+            @param sectors: (sector, num_sectors) touched by this record, or
+            None if the record does not reference any sectors
+        """
+        entry = self.current
+
+        # Do we need to start a new block?
+        if self.block_full(timestamp):
+            self.flush_block()
+            entry = None
+
+        if entry is None:
+            entry = CapIndexEntry()
+            entry.offset = offset
+            entry.length = 0
+            entry.records = 0
+            entry.ts_start = timestamp
+            entry.sector_start = NO_SECTOR_START
+            entry.sector_end = NO_SECTOR_END
+            self.current = entry
+
+        entry.records += 1
+        entry.length += length
+        entry.ts_end = timestamp
+
+        if sectors is not None:
+            (sector, num_sectors) = sectors
+            if sector < entry.sector_start:
+                entry.sector_start = sector
+            if sector + num_sectors > entry.sector_end:
+                entry.sector_end = sector + num_sectors
+
+    def flush_block(self):
+        """
+            Close the current block and append it to our index
+        """
+        if self.current is None:
+            return
+
+        self.entries.append(self.current)
+        self.ts_ends.append(self.current.ts_end)
+        self.sector_table = None
+
+        if self.f is not None:
+            self.f.write(`self.current`)
+            self.f.flush()
+
+        self.current = None
+
+    def close(self):
+        """ Flush any partial block and close our file """
+        self.flush_block()
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def find_time(self, start=None, end=None):
+        """
+            Find all of the blocks with records in a time window
+
+            NOTE: Assumes that timestamps never decrease within the capture
+
+            @param start: Start of the window (Default: beginning of capture)
+            @param end: End of the window (Default: end of capture)
+            @return: List of CapIndexEntry
+        """
+        idx = 0
+        if start is not None:
+            idx = bisect.bisect_left(self.ts_ends, start)
+
+        rtn = []
+        for entry in self.entries[idx:]:
+            if end is not None and entry.ts_start > end:
+                break
+            rtn.append(entry)
+        return rtn
+
+    def _sector_table(self):
+        """
+            Return our entries sorted by their first sector
+
+            @return: (entries, sector_starts, max_ends) where max_ends[i] is
+            the largest sector_end of entries[:i+1]
+        """
+        if self.sector_table is None:
+            entries = sorted((e for e in self.entries
+                              if e.sector_start < e.sector_end),
+                             key=lambda e: e.sector_start)
+            max_ends = []
+            max_end = NO_SECTOR_END
+            for e in entries:
+                max_end = max(max_end, e.sector_end)
+                max_ends.append(max_end)
+            self.sector_table = (entries, [e.sector_start for e in entries],
+                                 max_ends)
+        return self.sector_table
+
+    def find_sectors(self, start, end):
+        """
+            Find all of the blocks with records that touch a sector range
+
+            @param start: First sector
+            @param end: Last sector (Exclusive)
+            @return: List of CapIndexEntry, in file order
+        """
+        (entries, sector_starts, max_ends) = self._sector_table()
+
+        # Nothing before first can reach start, nothing from last on begins
+        # before end
+        first = bisect.bisect_right(max_ends, start)
+        last = bisect.bisect_left(sector_starts, end)
+
+        rtn = [e for e in entries[first:last] if e.sector_end > start]
+        rtn.sort(key=lambda e: e.offset)
+        return rtn
+
+    @staticmethod
+    def build(filename, sector_fn=None,
+              block_records=DEFAULT_BLOCK_RECORDS,
+              block_time=DEFAULT_BLOCK_TIME):
+        """
+            Build an index for an existing capture file with one linear pass
+
+            NOTE: Captures only store 32-bit float timestamps, so the block
+            times for indexes built after the fact are only as precise as the
+            capture.
+
+            @param filename: Filename of the capture
+            @param sector_fn: Function that returns (sector, num_sectors) for
+            a raw record, or None
+            @return: CaptureIndex
+        """
+        # Offsets inside of compressed blocks can't be seeked to
+        if is_compressed(filename):
+            logger.error("Compressed captures cannot be indexed. (%s)"%
+                         filename)
+            return None
+
+        index = CaptureIndex(filename, block_records, block_time)
+        if not index.open():
+            return None
+
+        # Every file of a rotated capture has its own index
+        reader = CaptureReader(filename, follow_segments=False)
+        offset = 0
+        for (timestamp, data) in reader:
+            sectors = None
+            if sector_fn is not None:
+                sectors = sector_fn(data)
+            length = CapHeader.STRUCT_SIZE + len(data)
+            index.add_record(offset, length, timestamp, sectors)
+            offset += length
+
+        index.close()
+        return index
+
+
+class CaptureReaderIndexed(CaptureReader):
+    """
+        Capture reader that uses our index to jump straight to the records in a
+        time window or sector range instead of scanning the entire capture
+    """
+
+    def __init__(self, filename, sector_fn=None):
+        """
+            Initialize our reader, building the index if it doesn't exist yet
+
+            @param filename: Filename of the capture
+            @param sector_fn: Function that returns (sector, num_sectors) for a
+            raw record, or None.  Used to build a missing index and to filter
+            records within a block.
+        """
+        CaptureReader.__init__(self, filename, follow_segments=False)
+
+        self.sector_fn = sector_fn
+
+        self.index = CaptureIndex(filename)
+        if not self.index.exists() or not self.index.load():
+            logger.info("Indexing capture file. (%s)"%filename)
+            self.index = CaptureIndex.build(filename, sector_fn)
+            if self.index is None:
+                logger.warning("Reading capture without an index. (%s)"%
+                               filename)
+
+    def _read_records(self, offset, count=None):
+        """
+            Read records starting at a file offset
+
+            @param offset: File offset of the first record's CapHeader
+            @param count: Number of records to read (Default: until EOF)
+            @return: Generator of (timestamp, data)
+        """
+        self.f.seek(offset)
+        read = 0
+        while count is None or read < count:
+            header_data = self.read(CapHeader.STRUCT_SIZE)
+            if len(header_data) < CapHeader.STRUCT_SIZE:
+                if count is not None:
+                    logger.error("Capture ended before its index. (%s)"%
+                                 self.filename)
+                return
+            cap_header = CapHeader(header_data)
+            packet_data = self.read(cap_header.length)
+            if len(packet_data) < cap_header.length:
+                return
+            yield (cap_header.timestamp, packet_data)
+            read += 1
+
+    def _read_blocks(self, entries, include_tail=False):
+        """
+            Read every record in the given blocks
+
+            @param entries: List of CapIndexEntry
+            @param include_tail: Also read any records written after the last
+            indexed block (E.g. the writer was killed before it could flush)
+            @return: Generator of (timestamp, data)
+        """
+        # Ensure our file is open
+        if self.f is None and not self._open("rb"):
+            return
+
+        for entry in entries:
+            for record in self._read_records(entry.offset, entry.records):
+                yield record
+
+        if include_tail:
+            tail = 0
+            if len(self.index) > 0:
+                last = self.index.entries[-1]
+                tail = last.offset + last.length
+            for record in self._read_records(tail):
+                yield record
+
+    def _read_filtered(self, start=None, end=None):
+        """
+            Scan the entire capture for the records in a time window (used
+            when the capture couldn't be indexed)
+
+            @param start: Start of the window (Default: beginning of capture)
+            @param end: End of the window (Default: end of capture)
+            @return: Generator of (timestamp, data)
+        """
+        for (timestamp, data) in CaptureReader(self.filename, 
+                                               follow_segments=False):
+            if start is not None and timestamp < start:
+                continue
+            if end is not None and timestamp > end:
+                continue
+            yield (timestamp, data)
+
+    def read_time(self, start=None, end=None):
+        """
+            Return all of the records captured in a time window
+
+            NOTE: Results have block granularity, some records just outside of
+            the window may be returned. (See DEFAULT_BLOCK_TIME)
+
+            @param start: Start of the window (Default: beginning of capture)
+            @param end: End of the window (Default: end of capture)
+            @return: Generator of (timestamp, data)
+        """
+        # Without an index we have to scan the entire capture
+        if self.index is None:
+            return self._read_filtered(start, end)
+
+        # Anything after our last block is newer than everything indexed
+        include_tail = (end is None or len(self.index) == 0 or
+                        end >= self.index.ts_ends[-1])
+        return self._read_blocks(self.index.find_time(start, end),
+                                 include_tail)
+
+    def read_sectors(self, start, end):
+        """
+            Return all of the records that touch a range of sectors
+
+            NOTE: Records that don't reference any sectors (E.g. SATA data
+            frames) are kept so that multi-record transfers stay intact
+
+            @param start: First sector
+            @param end: Last sector (Exclusive)
+            @return: Generator of (timestamp, data)
+        """
+        if self.index is None:
+            records = CaptureReader(self.filename, follow_segments=False)
+        else:
+            records = self._read_blocks(self.index.find_sectors(start, end),
+                                        True)
+
+        for (timestamp, data) in records:
+            if self.sector_fn is not None:
+                sectors = self.sector_fn(data)
+                if sectors is not None and (sectors[0] >= end or
+                                            sectors[0]+sectors[1] <= start):
+                    continue
+            yield (timestamp, data)
@@ -0,0 +1,467 @@
+"""
+    Differential memory dumps
+
+    A full dump can store a table with a hash of every page next to it
+    (<dump>.hashes).  Later dumps of the same machine are compared against
+    that table and only the pages that changed are stored, in a delta file.
+    Any snapshot can then be rebuilt from the base dump and its delta.
+
+    NOTE: Every page is still read from the sensor to hash it, only what is
+    written, compressed, and uploaded shrinks.
+
+    (c) 2015 Massachusetts Institute of Technology
+"""
+# Native
+import os
+import shutil
+import hashlib
+import logging
+logger = logging.getLogger(__name__)
+
+# LO-PHI
+from lophi.data import DataStruct
+from lophi.capture.compressed_dump import CompressedDump, \
+    CompressedDumpWriter, open_dump, DEFAULT_BLOCK_SIZE
+
+PAGE_SIZE = 4096
+
+HASH_MAGIC = "LPMH"
+DELTA_MAGIC = "LPMD"
+DELTA_VERSION = 1
+HASH_SUFFIX = ".hashes"
+
+# md5 is only used to detect changes, and is the fastest hash we have
+DIGEST_SIZE = 16
+
+
+class MemHashHeader(DataStruct):
+    """
+        Header at the start of every page hash table
+
+        magic: Always HASH_MAGIC
+        version: Version of the format
+        page_size: Number of bytes hashed for each digest
+        total_size: Size of the dump that was hashed
+    """
+    STRUCT = [('magic','>4s'),
+              ('version','>I'),
+              ('page_size','>I'),
+              ('total_size','>Q')]
+
+
+class MemDeltaHeader(DataStruct):
+    """
+        Header at the start of every delta
+
+        magic: Always DELTA_MAGIC
+        version: Version of the format
+        page_size: Size of the pages stored in this delta
+        total_size: Size of the snapshot
+        base: Fingerprint of the page hash table of our base dump
+    """
+    STRUCT = [('magic','>4s'),
+              ('version','>I'),
+              ('page_size','>I'),
+              ('total_size','>Q'),
+              ('base','>20s')]
+
+
+class MemDeltaPage(DataStruct):
+    """
+        Header in front of every page stored in a delta
+
+        page: Page index in the snapshot
+        length: Length of the data (Only the last page may be short)
+    """
+    STRUCT = [('page','>Q'),
+              ('length','>I')]
+
+
+class PageHashTable:
+    """
+        Digest of every page of a memory dump
+    """
+
+    def __init__(self, page_size=PAGE_SIZE):
+        """
+            Initialize an empty table
+
+            @param page_size: Number of bytes hashed for each digest
+        """
+        self.page_size = page_size
+        self.total_size = 0
+
+        # Concatenated digests, and any digests that haven't been joined yet
+        self.digests = ""
+        self.pending = []
+
+    def __len__(self):
+        """ Return the number of pages in our table """
+        return (len(self.digests) + DIGEST_SIZE * len(self.pending)) / \
+            DIGEST_SIZE
+
+    def add(self, data):
+        """
+            Append the digest of the next page
+
+            @param data: Contents of the page
+            @return: Digest of the page
+        """
+        digest = hashlib.md5(data).digest()
+        self.pending.append(digest)
+        self.total_size += len(data)
+        return digest
+
+    def get(self, page):
+        """
+            Return the digest of a page
+
+            @param page: Page index
+            @return: Digest, or None if the page isn't in our table
+        """
+        if len(self.pending) > 0:
+            self.digests += "".join(self.pending)
+            self.pending = []
+
+        offset = page * DIGEST_SIZE
+        if offset >= len(self.digests):
+            return None
+        return self.digests[offset:offset + DIGEST_SIZE]
+
+    def fingerprint(self):
+        """
+            Return a fingerprint of the entire table, stored in every delta
+            that is made against it
+        """
+        self.get(0)
+        return hashlib.sha1(self.digests).digest()
+
+    def save(self, filename):
+        """
+            Write our table to disk
+
+            @param filename: Filename of the table
+            @return: True/False
+        """
+        header = MemHashHeader()
+        header.magic = HASH_MAGIC
+        header.version = DELTA_VERSION
+        header.page_size = self.page_size
+        header.total_size = self.total_size
+
+        self.get(0)
+        try:
+            f = open(filename, "wb")
+            f.write(`header`)
+            f.write(self.digests)
+            f.close()
+        except:
+            logger.error("Could not write page hashes. (%s)" % filename)
+            return False
+        return True
+
+    @staticmethod
+    def from_dump(filename, page_size=PAGE_SIZE):
+        """
+            Hash every page of a full dump that is already on disk
+
+            @param filename: Filename of the dump
+            @param page_size: Number of bytes hashed for each digest
+            @return: PageHashTable or None
+        """
+        table = PageHashTable(page_size)
+        try:
+            f = open_dump(filename)
+            while True:
+                data = f.read(page_size)
+                if len(data) == 0:
+                    break
+                table.add(data)
+            f.close()
+        except:
+            logger.error("Could not hash memory dump. (%s)" % filename)
+            return None
+        return table
+
+    @staticmethod
+    def load(filename):
+        """
+            Read a table from disk
+
+            @param filename: Filename of the table
+            @return: PageHashTable or None
+        """
+        try:
+            f = open(filename, "rb")
+            raw = f.read()
+            f.close()
+        except:
+            logger.error("Could not read page hashes. (%s)" % filename)
+            return None
+
+        if len(raw) < MemHashHeader.STRUCT_SIZE:
+            logger.error("Page hashes are truncated. (%s)" % filename)
+            return None
+
+        header = MemHashHeader(raw[:MemHashHeader.STRUCT_SIZE])
+        if header.magic != HASH_MAGIC or header.version > DELTA_VERSION:
+            logger.error("Not a page hash table. (%s)" % filename)
+            return None
+
+        table = PageHashTable(header.page_size)
+        table.total_size = header.total_size
+        table.digests = raw[MemHashHeader.STRUCT_SIZE:]
+        return table
+
+
+class MemoryDumpWriter:
+    """
+        Writes a memory dump, and optionally its page hash table, from chunks
+        of any size.  Given the page hashes of a base dump, only pages that
+        differ from it are written, as a delta.
+    """
+
+    def __init__(self, filename, total_size, save_hashes=False,
+                 base_hashes=None, compression=None):
+        """
+            Initialize our writer
+
+            @param filename: Filename of the dump (or delta)
+            @param total_size: Total size of the dump
+            @param save_hashes: Also write <filename>.hashes
+            @param base_hashes: PageHashTable of the base dump to write a delta
+            against (Default: write a full dump)
+            @param compression: Codec to write a full dump as a compressed 
+            image with (See compressed_dump)
+        """
+        self.filename = filename
+        self.total_size = total_size
+        self.base_hashes = base_hashes
+
+        self.page_size = PAGE_SIZE
+        if base_hashes is not None:
+            self.page_size = base_hashes.page_size
+
+        self.hashes = None
+        if save_hashes or base_hashes is not None:
+            self.hashes = PageHashTable(self.page_size)
+        self.save_hashes = save_hashes
+
+        # Data that doesn't make up a full page yet
+        self.partial = ""
+        self.page = 0
+        self.pages_written = 0
+
+        if compression is not None and base_hashes is None:
+            self.f = CompressedDumpWriter(filename, total_size, compression)
+        else:
+            self.f = open(filename, "wb")
+
+        if base_hashes is not None:
+            header = MemDeltaHeader()
+            header.magic = DELTA_MAGIC
+            header.version = DELTA_VERSION
+            header.page_size = self.page_size
+            header.total_size = total_size
+            header.base = base_hashes.fingerprint()
+            self.f.write(`header`)
+
+    def _add_page(self, data):
+        """ Hash, and possibly store, the next page """
+        digest = None
+        if self.hashes is not None:
+            digest = self.hashes.add(data)
+
+        if self.base_hashes is not None:
+            if digest != self.base_hashes.get(self.page):
+                page_header = MemDeltaPage()
+                page_header.page = self.page
+                page_header.length = len(data)
+                self.f.write(`page_header`)
+                self.f.write(data)
+                self.pages_written += 1
+
+        self.page += 1
+
+    def write(self, data):
+        """
+            Write the next chunk of our dump
+
+            @param data: Memory contents (String or buffer)
+        """
+        # Full dumps are written as is
+        if self.base_hashes is None:
+            self.f.write(data)
+            if self.hashes is None:
+                return
+
+        data = self.partial + str(data)
+        offset = 0
+        while len(data) - offset >= self.page_size:
+            self._add_page(data[offset:offset + self.page_size])
+            offset += self.page_size
+        self.partial = data[offset:]
+
+    def close(self):
+        """
+            Flush any partial page and close our dump
+
+            @return: True/False
+        """
+        if len(self.partial) > 0:
+            self._add_page(self.partial)
+            self.partial = ""
+
+        try:
+            self.f.close()
+        except IOError, e:
+            logger.error("Could not write memory dump. (%s)" % e)
+            return False
+
+        if self.base_hashes is not None:
+            logger.debug("Wrote %d of %d pages to delta. (%s)" % (
+                                                            self.pages_written,
+                                                            self.page,
+                                                            self.filename))
+
+        if self.save_hashes:
+            return self.hashes.save(self.filename + HASH_SUFFIX)
+        return True
+
+
+def is_delta(filename):
+    """
+        Is this file a memory delta (as opposed to a full dump)?
+
+        @param filename: Filename of the dump
+        @return: True/False
+    """
+    try:
+        f = open(filename, "rb")
+        magic = f.read(len(DELTA_MAGIC))
+        f.close()
+    except:
+        return False
+    return magic == DELTA_MAGIC
+
+
+class MemorySnapshot:
+    """
+        A snapshot rebuilt from a full base dump and a delta
+    """
+
+    def __init__(self, base_filename, delta_filename):
+        """
+            Initialize our snapshot
+
+            @param base_filename: Filename of the full base dump
+            @param delta_filename: Filename of the delta
+        """
+        self.base_filename = base_filename
+        self.delta_filename = delta_filename
+
+        self.base = open_dump(base_filename)
+        self.delta = open(delta_filename, "rb")
+
+        header = MemDeltaHeader(self.delta.read(MemDeltaHeader.STRUCT_SIZE))
+        if header.magic != DELTA_MAGIC or header.version > DELTA_VERSION:
+            raise ValueError("Not a memory delta. (%s)" % delta_filename)
+
+        self.page_size = header.page_size
+        self.total_size = header.total_size
+
+        # Ensure that this delta belongs to this dump
+        base_hashes = PageHashTable.load(base_filename + HASH_SUFFIX)
+        if base_hashes is not None and \
+                base_hashes.fingerprint() != header.base:
+            logger.warning("Delta was not made against this dump. (%s, %s)" %
+                           (delta_filename, base_filename))
+
+        # page -> (offset in delta, length)
+        self.pages = {}
+        while True:
+            raw = self.delta.read(MemDeltaPage.STRUCT_SIZE)
+            if len(raw) < MemDeltaPage.STRUCT_SIZE:
+                break
+            page_header = MemDeltaPage(raw)
+            self.pages[page_header.page] = (self.delta.tell(),
+                                            page_header.length)
+            self.delta.seek(page_header.length, os.SEEK_CUR)
+
+    def __len__(self):
+        """ Return the size of our snapshot """
+        return self.total_size
+
+    def _read_page(self, page):
+        """ Return the contents of a page in our snapshot """
+        if page in self.pages:
+            (offset, length) = self.pages[page]
+            self.delta.seek(offset)
+            return self.delta.read(length)
+
+        self.base.seek(page * self.page_size)
+        return self.base.read(self.page_size)
+
+    def read(self, offset, length):
+        """
+            Read from our snapshot
+
+            @param offset: Offset into the snapshot
+            @param length: Number of bytes to read
+            @return: Data
+        """
+        length = min(length, self.total_size - offset)
+        if length <= 0:
+            return ""
+
+        first = offset / self.page_size
+        last = (offset + length - 1) / self.page_size
+
+        data = "".join(self._read_page(page)
+                       for page in xrange(first, last + 1))
+        start = offset - first * self.page_size
+        return data[start:start + length]
+
+    def apply(self, filename):
+        """
+            Write our changed pages over a copy of our base dump
+
+            @param filename: Filename of the copy, which is updated in place
+        """
+        f = open(filename, "r+b")
+        for page in sorted(self.pages):
+            f.seek(page * self.page_size)
+            f.write(self._read_page(page))
+        f.truncate(self.total_size)
+        f.close()
+
+    def save(self, filename, compression=None):
+        """
+            Rebuild our full snapshot
+
+            @param filename: Filename to write the snapshot to
+            @param compression: Codec to write a compressed image with (See
+            compressed_dump)
+        """
+        # Copy raw dumps and patch them in place
+        if compression is None and not isinstance(self.base, CompressedDump):
+            shutil.copyfile(self.base_filename, filename)
+            self.apply(filename)
+            return
+
+        if compression is None:
+            f = open(filename, "wb")
+        else:
+            f = CompressedDumpWriter(filename, self.total_size, compression)
+
+        chunk_pages = DEFAULT_BLOCK_SIZE / self.page_size
+        pages = (self.total_size + self.page_size - 1) / self.page_size
+        for first in xrange(0, pages, chunk_pages):
+            f.write(self.read(first * self.page_size, 
+                              chunk_pages * self.page_size))
+        f.close()
+
+    def close(self):
+        """ Close our files """
+        self.base.close()
+        self.delta.close()
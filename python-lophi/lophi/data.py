@@ -9,7 +9,103 @@ logger = logging.getLogger(__name__)
 
 import globals as G
 
-class DataStruct:
+# Struct byte order/size/alignment prefixes
+BYTE_ORDERS = "@=<>!"
+
+
+class DataStructCompiler(type):
+    """
+        Metaclass that compiles STRUCT once, when each DataStruct subclass is 
+        created, instead of every time a struct is instantiated.
+        
+        Every field becomes a slot and the whole header is (ideally) handled by 
+        a single precompiled struct.Struct.
+    """
+    def __new__(mcs, name, bases, attrs):
+        STRUCT = attrs.get('STRUCT')
+        
+        if '__slots__' not in attrs:
+            # Slots we already inherit
+            inherited = set()
+            for base in bases:
+                for klass in base.__mro__:
+                    inherited.update(klass.__dict__.get('__slots__', ()))
+                    
+            slots = []
+            if STRUCT is not None:
+                for (key, fmt) in STRUCT:
+                    if key in inherited or key in slots:
+                        continue
+                    # Class variables would shadow our slots (E.g. name)
+                    attrs.pop(key, None)
+                    slots.append(key)
+            attrs['__slots__'] = tuple(slots)
+            
+        cls = type.__new__(mcs, name, bases, attrs)
+        cls._compile()
+        return cls
+    
+    
+    def _compile(cls):
+        """
+            Precompute everything we need to pack and unpack STRUCT
+        """
+        cls._FIELDS = ()
+        cls._FIELD_SET = frozenset()
+        cls._STRUCT = None
+        cls._FIELD_STRUCTS = ()
+        cls._SETTERS = ()
+        cls._SIMPLE = False
+        cls.STRUCT_SIZE = 0
+        
+        if cls.STRUCT is None:
+            return
+        
+        fields = []
+        field_structs = []
+        offset = 0
+        for (key, fmt) in cls.STRUCT:
+            field_struct = struct.Struct(fmt)
+            
+            # How many values does this field pack? (E.g. '2H' or '7xQ')
+            defaults = field_struct.unpack("\x00"*field_struct.size)
+            
+            fields.append(key)
+            field_structs.append((key, field_struct, offset, len(defaults), 
+                                  defaults))
+            offset += field_struct.size
+            
+        cls._FIELDS = tuple(fields)
+        cls._FIELD_SET = frozenset(fields)
+        cls._FIELD_STRUCTS = tuple(field_structs)
+        cls.STRUCT_SIZE = offset
+        
+        # Does every field hold exactly one value?
+        cls._SIMPLE = all(f[3] == 1 for f in field_structs)
+        
+        # Slot descriptors, used to bypass our __setattr__ when unpacking
+        cls._SETTERS = tuple(getattr(cls, key).__set__ for key in fields)
+        
+        # Try to fold every field into one format string.  This only works if
+        # every field uses the same byte order and no alignment padding gets 
+        # introduced between them.
+        orders = set()
+        body = ""
+        for (key, fmt) in cls.STRUCT:
+            if len(fmt) > 0 and fmt[0] in BYTE_ORDERS:
+                orders.add(fmt[0])
+                body += fmt[1:]
+            else:
+                orders.add("@")
+                body += fmt
+        
+        if len(orders) == 1:
+            combined = struct.Struct(orders.pop() + body)
+            if combined.size == cls.STRUCT_SIZE:
+                cls._STRUCT = combined
+            
+
+class DataStruct(object):
     """
         This is an abstract class used to define structures in memory in an easy
         way.
@@ -23,7 +119,17 @@ class DataStruct:
         class Test(DataStruct):
             STRUCT = [('byte1','B'), 
                       ('byte2','B')]
+                      
+        STRUCT is compiled when the class is defined (see DataStructCompiler),
+        every field is stored in a slot, and the raw buffer is only repacked 
+        when it is actually needed.
     """
+    __metaclass__ = DataStructCompiler
+    
+    # __dict__ is kept so that callers can still hang extra values off of a 
+    # struct, it is only allocated if they do.
+    __slots__ = ('struct_name', 'data', '_raw', '__dict__')
+    
     STRUCT = None
 
     def __init__(self, data=None, name=None):
@@ -49,47 +155,50 @@ class DataStruct:
         
         self.data = None
         
-        # Check to see if we have any violations that will overwrite existing variables
-        for n in self.STRUCT:
-            if n in self.__dict__.keys():
-                logger.error("%s cannot be used a variable name."%n)
-                return
-        
         # Initialize all of our variables
-        self.STRUCT_SIZE = 0
-        for (key,fmt) in self.STRUCT:
-            self.__dict__[key] = None
-            
-            # Set our structure size
-            self.STRUCT_SIZE += struct.calcsize(fmt)
+        for setter in self._SETTERS:
+            setter(self, None)
         
         # Was data provided to parse?
         if data is not None:
             self._unpack(data)
         else:
-            self.struct_raw_data = "\x00"*self.STRUCT_SIZE
+            self._raw = "\x00"*self.STRUCT_SIZE
 
     def __setattr__(self,key,value):
         """
-            Set our attributes, if its an attribute of the struct, update our
-            buffer representation
+            Set our attributes, if its an attribute of the struct, our buffer 
+            representation will need to be repacked
         """
-        tmp = None
-        if key in self.__dict__:
-            tmp = self.__dict__[key]
+        object.__setattr__(self, key, value)
+        
+        if key in self._FIELD_SET:
+            object.__setattr__(self, '_raw', None)
             
-        # Update our new value
-        self.__dict__[key] = value
-        
-        # If its one of the keys in our struct, update our raw buffer
-        # Todo put the pack function here inline
-        success = True
-        for (key2,fmt) in self.STRUCT:
-            if key == key2:
-                success = (success and self._pack())
-                
-        if not success:
-            self.__dict__[key] = tmp
+    def __getstate__(self):
+        """ Pickle ourselves as our raw bytes """
+        return (self.struct_name, self.struct_raw_data, self.data,
+                getattr(self, '__dict__', None))
+    
+    def __setstate__(self, state):
+        """ Restore ourselves from our raw bytes """
+        (struct_name, raw_data, data, extra) = state
+        self._unpack(raw_data)
+        self.struct_name = struct_name
+        self.data = data
+        if extra:
+            self.__dict__.update(extra)
+            
+    def _get_raw_data(self):
+        """ Return our packed header, repacking only if a field changed """
+        if self._raw is None:
+            self._pack()
+        return self._raw
+    
+    def _set_raw_data(self, raw_data):
+        object.__setattr__(self, '_raw', raw_data)
+        
+    struct_raw_data = property(_get_raw_data, _set_raw_data)
         
     def __getitem__(self,index):
         """
@@ -97,8 +206,9 @@ class DataStruct:
             
             @param index: Index into raw data buffer to return 
         """
-        if self.struct_raw_data is not None and index > len(self.struct_raw_data):
-            return self.struct_raw_data[index]
+        raw_data = self.struct_raw_data
+        if raw_data is not None and index < len(raw_data):
+            return raw_data[index]
         
     def __iter__(self):
         """
@@ -124,16 +234,12 @@ class DataStruct:
             logger.debug("Tried to compare a buffer of different size.")
             return False
         
-        offset = 0
-        for (key,fmt) in self.STRUCT:
-            value = self.__dict__[key]
-            size = struct.calcsize(fmt)
-            
-            if value is not None:
-                if self.struct_raw_data[offset:size] != comp[offset:size]:
+        raw_data = self.struct_raw_data
+        for (key, field_struct, offset, count, defaults) in self._FIELD_STRUCTS:
+            if getattr(self, key) is not None:
+                end = offset + field_struct.size
+                if raw_data[offset:end] != comp[offset:end]:
                     return False
-                
-            offset += size
         
         return True
     
@@ -151,8 +257,8 @@ class DataStruct:
             Print output in human readable format
         """
         o = "[%s]\n"%self.struct_name
-        for (key,fmt) in self.STRUCT:
-            o += "  %s: %s\n"%(key,self.__dict__[key])
+        for key in self._FIELDS:
+            o += "  %s: %s\n"%(key,getattr(self, key))
             
         if self.data is not None:
             o += "  Data: [%d bytes]\n"%len(self.data)
@@ -160,6 +266,28 @@ class DataStruct:
         # Trim trailing \n
         return o[:-1]
     
+    def _set_values(self, values):
+        """
+            Store a flat tuple of unpacked values into our fields
+            
+            @param values: Values as returned by our compiled struct
+        """
+        if self._SIMPLE:
+            # Common case, every field is a single value
+            for setter, v in zip(self._SETTERS, values):
+                setter(self, v)
+            return
+        
+        idx = 0
+        for setter, (key, field_struct, offset, count, defaults) in zip(
+                                                        self._SETTERS,
+                                                        self._FIELD_STRUCTS):
+            if count == 1:
+                setter(self, values[idx])
+            else:
+                setter(self, values[idx:idx+count])
+            idx += count
+    
     def _unpack(self,data):
         """
             Unpack the raw data into semantic meaning
@@ -178,55 +306,89 @@ class DataStruct:
         elif len(data) > self.STRUCT_SIZE:
             self.data = data[self.STRUCT_SIZE:]
             
-        self.struct_raw_data = data[:self.STRUCT_SIZE]
+        raw_data = data[:self.STRUCT_SIZE]
     
         # Set our values, these will be of the form MemoryStruct.name
-        offset = 0
-        for (key,fmt) in self.STRUCT:
-
-            v = struct.unpack_from(fmt, self.struct_raw_data, offset)
-            if len(v) == 1:
-                self.__dict__[key] = v[0]
-            else:
-                self.__dict__[key] = v
+        if self._STRUCT is not None:
+            self._set_values(self._STRUCT.unpack(raw_data))
+        else:
+            values = ()
+            for (key, field_struct, offset, count, defaults) in self._FIELD_STRUCTS:
+                values += field_struct.unpack_from(raw_data, offset)
+            self._set_values(values)
             
-            offset += struct.calcsize(fmt)
+        object.__setattr__(self, '_raw', raw_data)
         
     def _pack(self):
         """
             Pack our struct back into raw data
         """
+        values = []
         
-        self.struct_raw_data = ""
-        
-        for (key,fmt) in self.STRUCT:
+        for (key, field_struct, offset, count, defaults) in self._FIELD_STRUCTS:
                         
-            value = self.__dict__[key]
-            size = struct.calcsize(fmt)
+            value = getattr(self, key)
             
             if type(value) is list or type(value) is tuple:
-                if len(value) != size:
-                    logger.error("%s was too small, cannot store in this struct. (%d vs %d)"%(key,))
+                if len(value) != count:
+                    logger.error("%s has the wrong number of values, cannot store in this struct. (%d vs %d)"%(key,
+                                                                        len(value),
+                                                                        count))
                     return False
-                self.struct_raw_data += struct.pack(fmt, *value)
+                values.extend(value)
                     
             elif value is not None:
-                self.struct_raw_data += struct.pack(fmt, value)
+                values.append(value)
             else:
-                self.struct_raw_data += "\x00"*size
+                values.extend(defaults)
+        
+        if self._STRUCT is not None:
+            raw_data = self._STRUCT.pack(*values)
+        else:
+            raw_data = ""
+            idx = 0
+            for (key, field_struct, offset, count, defaults) in self._FIELD_STRUCTS:
+                raw_data += field_struct.pack(*values[idx:idx+count])
+                idx += count
+                
+        object.__setattr__(self, '_raw', raw_data)
         
         return True
     
+    @classmethod
+    def unpack_many(cls, buf, offset=0, count=None):
+        """
+            Unpack a contiguous array of these structs (without trailing data)
+            
+            @param buf: Buffer containing back-to-back structs
+            @param offset: Offset into buf of the first struct
+            @param count: Number of structs to unpack (Default: as many as fit)
+            @return: List of struct objects
+        """
+        if count is None:
+            count = (len(buf) - offset) / cls.STRUCT_SIZE
+            
+        struct_name = cls.__name__
+        size = cls.STRUCT_SIZE
+        
+        rtn = []
+        for idx in xrange(count):
+            start = offset + idx*size
+            raw_data = buf[start:start+size]
+            
+            obj = cls.__new__(cls)
+            object.__setattr__(obj, 'struct_name', struct_name)
+            object.__setattr__(obj, 'data', None)
+            obj._unpack(raw_data)
+            rtn.append(obj)
+            
+        return rtn
+    
     def keys(self):
         """
             Return the keys into our structures
         """
-        # Loop through our defined list and add the keys
-        key_list = []
-        for (k, v) in self.STRUCT:
-            key_list.append(k)
-            
-        return key_list
+        return list(self._FIELDS)
 
     def values(self):
         """
@@ -234,9 +396,10 @@ class DataStruct:
         """
         # Loop through our defined list and append the values
         value_list = []
-        for (k, v) in self.STRUCT:
-            if k in self.__dict__ and self.__dict__[k] is not None:
-                value_list.append(self.__dict__[k])
+        for k in self._FIELDS:
+            v = getattr(self, k)
+            if v is not None:
+                value_list.append(v)
             else:
                 value_list.append("")
             
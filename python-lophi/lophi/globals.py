@@ -5,6 +5,7 @@
     (c) 2015 Massachusetts Institute of Technology
 """
 import os
+import array
 import logging
 logger = logging.getLogger(__name__)
 
@@ -708,18 +709,25 @@ def read_socket_data(sock):
     return data
 
 
+# Array typecode of an unsigned 32-bit word on this platform
+WORD_TYPECODE = 'I' if array.array('I').itemsize == 4 else 'L'
+
 def flip_endianess(data):
+    """
+        Reverse the byte order of every 32-bit word in our data, any trailing
+        partial word is dropped
+
+        @param data: String (or buffer) of data to flip
+        @return: Flipped string
+    """
+    if isinstance(data, memoryview):
+        data = data.tobytes()
 
-    # Flip endianess!
-    data2 = ""
-    for i in range(len(data) / 4):
-        tmp = data[i * 4:i * 4 + 4]
-        data2 += tmp[3]
-        data2 += tmp[2]
-        data2 += tmp[1]
-        data2 += tmp[0]
+    words = array.array(WORD_TYPECODE)
+    words.fromstring(data[:len(data) - len(data) % 4])
+    words.byteswap()
 
-    return data2
+    return words.tostring()
 
 
 
@@ -265,6 +265,27 @@ class Machine:
             return None
 
 
+    def memory_read_into(self, addr, buf):
+        """
+            Read physical memory directly into a writable buffer
+            
+            @param addr: Address to start reading from
+            @param buf: bytearray or memoryview to fill with len(buf) bytes
+            @return: Number of bytes read, or None on error
+        """
+        # Check for sensor
+        if not self._has_sensor("memory"):
+            return None
+        
+        try:
+            return self.memory.read_into(addr, buf)
+        except:
+            logger.error("Memory read failed. (Addr: 0x%x, Len: %d)"%(addr,
+                                                                      len(buf)))
+            G.print_traceback()
+            return None
+
+
     def memory_write(self, addr, data):
         """
             Write physical memory
@@ -284,40 +305,114 @@ class Machine:
         """
         raise NotImplementedError("ERROR: Unimplemented function.")
     
-    def memory_dump(self,filename):
+    def memory_dump(self,filename,save_hashes=False,base=None,streams=1,
+                    compression=None):
         """
             Dump the memory of the machine to the given filename
-           
-           WARNING: The current implementation reads the entire image into 
-           memory first.
+            
+            Memory is read in chunks and each chunk is written out before the
+            next is read, so the image is never held in memory.
                
             @param filename: Filename to dump a memory image to
-        """
+            @param save_hashes: Also save a hash of every page, so that later
+            dumps can be made against this one (See memory_delta)
+            @param base: Filename of a dump saved with save_hashes, only the 
+            pages that differ from it are written
+            @param streams: Number of concurrent streams to read memory with
+            (See lophi.sensors.memory.dump)
+            @param compression: Compress the dump as it streams in, into an 
+            image that Volatility can read directly (E.g. "zlib", see 
+            lophi.capture.compressed_dump)
+        """
+        from lophi.capture.memory_delta import MemoryDumpWriter, \
+            PageHashTable, HASH_SUFFIX
+        
+        total_size = self.memory_get_size()
+        
+        # Deltas and compressed images have to be written in order
+        if streams > 1 and (base is not None or compression is not None):
+            logger.warning("Differential and compressed dumps can only use a "
+                           "single stream.")
+            streams = 1
+        
+        if streams > 1:
+            if not self._has_sensor("memory"):
+                return False
+            
+            from lophi.sensors.memory.dump import dump_parallel
+            if not dump_parallel(self.memory, filename, total_size, streams):
+                return False
+            
+            if save_hashes:
+                hashes = PageHashTable.from_dump(filename)
+                if hashes is None:
+                    return False
+                return hashes.save(filename+HASH_SUFFIX)
+            return True
+        
+        base_hashes = None
+        if base is not None:
+            base_hashes = PageHashTable.load(base+HASH_SUFFIX)
+            if base_hashes is None:
+                logger.error("No page hashes for base dump %s"%base)
+                return False
+        
         try:
-            f = open(filename,"w+")
+            f = MemoryDumpWriter(filename, total_size, 
+                                 save_hashes=save_hashes, 
+                                 base_hashes=base_hashes,
+                                 compression=compression)
         except:
             logger.error("Could not create %s"%filename)
             return False
         
-        total_size = self.memory_get_size()
-        
         offset = 0
-        from lophi.sensors.memory import CACHE_CHUNK
+        from lophi.sensors.memory import CACHE_CHUNK, MAPPED_CHUNK
         rtn = True
         
+        # Can we write straight from a mapping of the machine's memory?
+        chunk_size = CACHE_CHUNK
+        mapped = (self._has_sensor("memory") and 
+                  self.memory.read_view(min(MAPPED_CHUNK,total_size)-1, 1) 
+                  is not None)
+        if mapped:
+            chunk_size = MAPPED_CHUNK
+        
+        # Reuse a single buffer for the entire dump
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        
         while offset < total_size:
-            memory = self.memory_read(offset, min(CACHE_CHUNK,total_size-offset))
+            read_len = min(chunk_size,total_size-offset)
+            
+            if mapped:
+                data = self.memory.read_view(offset, read_len)
+                if data is not None:
+                    f.write(data)
+                    offset += chunk_size
+                    continue
             
-            if memory is None:
+            nbytes = self.memory_read_into(offset, view[:read_len])
+            
+            if nbytes is None:
                 logger.error("Memory dump failed!")
                 rtn = False
                 break
             
-            f.write(memory)
+            # Keep our offsets intact if the sensor came up short
+            if nbytes < read_len:
+                logger.error("Short memory read at 0x%x (%d of %d bytes)"%(
+                                                                offset,
+                                                                nbytes,
+                                                                read_len))
+                view[nbytes:read_len] = "\x00"*(read_len-nbytes)
+            
+            f.write(buffer(buf, 0, read_len))
             
-            offset += CACHE_CHUNK
+            offset += chunk_size
             
-        f.close()
+        if not f.close():
+            rtn = False
         
         return rtn
 
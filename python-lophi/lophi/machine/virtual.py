@@ -257,7 +257,10 @@ class VirtualMachine(Machine):
         else:
             self.add_sensor(DiskSensorVirtual(self.config.disk))
         self.add_sensor(CPUSensorVirtual(config.vm_name))
-        self.add_sensor(MemorySensorVirtual(config.vm_name))
+        ram_path = None
+        if "ram_path" in kargs:
+            ram_path = kargs['ram_path']
+        self.add_sensor(MemorySensorVirtual(config.vm_name, ram_path=ram_path))
         
         net_iface = self.network_get_interface()
         if net_iface is not None:
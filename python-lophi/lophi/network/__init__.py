@@ -46,6 +46,9 @@ def int2ip(buffer):
 class PacketReaderUDP(multiprocessing.Process):
     """
         This class will listen on a UDP socket and read all 
+        
+        NOTE: Every packet is pickled through output_queue, use 
+        lophi.network.ring.PacketReaderRing for high packet rates.
     """
     def __init__(self,socket,output_queue,packet_type=None,
                  bind_ip=None,
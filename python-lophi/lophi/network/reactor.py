@@ -0,0 +1,750 @@
+"""
+    Non-blocking, event driven, sensor I/O
+
+    A Reactor multiplexes the sockets of any number of sensors in a single
+    thread, using select().  Sensors talk through transports, which hand back
+    a Request for everything that is sent.  Requests are matched to their
+    replies by a key (E.g. the transaction number of a memory read), and are
+    re-sent according to their RetryPolicy if no reply shows up in time.
+
+    The blocking sensor APIs simply start their requests and run the reactor
+    until those requests are done, while a controller that wants to drive many
+    sensors at once can share one reactor between all of them.
+
+    (c) 2015 Massachusetts Institute of Technology
+"""
+# Native
+import time
+import heapq
+import errno
+import socket
+import select
+import collections
+import logging
+logger = logging.getLogger(__name__)
+
+# LO-PHI
+import lophi.globals as G
+
+# Maximum number of datagrams to read per wakeup, so that one busy socket
+# can't starve everybody else
+MAX_READS_PER_EVENT = 64
+
+# Size of the chunks that stream transports read at once
+STREAM_RECV_SIZE = 64 * 1024
+
+# Errors that just mean "try again later" on a non-blocking socket
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class RetryPolicy:
+    """
+        How long to wait for a reply and how many times to re-send a request
+    """
+
+    def __init__(self, timeout=1, retries=5):
+        """
+            @param timeout: Seconds to wait for each reply (None waits forever)
+            @param retries: Number of times to re-send a request before
+            giving up with socket.timeout
+        """
+        self.timeout = timeout
+        self.retries = retries
+
+    def __repr__(self):
+        return "RetryPolicy(timeout=%s, retries=%s)" % (self.timeout,
+                                                        self.retries)
+
+
+DEFAULT_POLICY = RetryPolicy()
+
+
+class Request:
+    """
+        The eventual result of something that was sent to a sensor
+    """
+
+    def __init__(self, key=None, data=None, policy=DEFAULT_POLICY,
+                 on_reply=None, build=None):
+        """
+            @param key: Value used to match replies to this request
+            @param data: Raw data that is (re-)sent for this request
+            @param policy: RetryPolicy for this request
+            @param on_reply: Function called with the reply (a buffer that is
+            only valid for the duration of the call), returns the result of
+            the request or None if the reply was bad and the request should be
+            re-sent.  (Default: copy the reply into a string)
+            @param build: Function that returns (key, data) when the request
+            is first sent, for protocols that assign keys on the wire (E.g.
+            wrapping transaction numbers)
+        """
+        self.key = key
+        self.data = data
+        self.policy = policy
+        self.on_reply = on_reply
+        self.build = build
+
+        self.attempts = 0
+        self.timer = None
+
+        self._done = False
+        self._result = None
+        self.exception = None
+        self._callbacks = []
+
+    def done(self):
+        """ Has this request completed (successfully or not)? """
+        return self._done
+
+    def result(self):
+        """
+            Return the result of this request, raising its exception if it
+            failed
+        """
+        if not self._done:
+            raise RuntimeError("Request is still pending.")
+        if self.exception is not None:
+            raise self.exception
+        return self._result
+
+    def add_done_callback(self, callback):
+        """
+            Call a function with this request once it completes
+
+            @param callback: Function that takes this request
+        """
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def _finish(self):
+        """ Mark ourselves as done and let everyone know """
+        self._done = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        callbacks = self._callbacks
+        self._callbacks = []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except:
+                logger.exception("Request callback failed.")
+
+    def set_result(self, result):
+        """ Complete this request successfully """
+        if self._done:
+            return
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        """ Complete this request with an error """
+        if self._done:
+            return
+        self.exception = exception
+        self._finish()
+
+
+def gather(requests):
+    """
+        Combine many requests into one
+
+        @param requests: List of Requests
+        @return: Request whose result is the list of results, or the first
+        exception that any of them raised
+    """
+    combined = Request()
+    remaining = [len(requests)]
+
+    if len(requests) == 0:
+        combined.set_result([])
+        return combined
+
+    def request_done(request):
+        if request.exception is not None:
+            combined.set_exception(request.exception)
+            return
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            combined.set_result([r._result for r in requests])
+
+    for request in requests:
+        request.add_done_callback(request_done)
+
+    return combined
+
+
+class Timer:
+    """ Function scheduled on a reactor """
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """ Never call this timer """
+        self.cancelled = True
+
+    def __cmp__(self, other):
+        return cmp(self.deadline, other.deadline)
+
+
+class Reactor:
+    """
+        select() loop that drives every transport registered with it
+    """
+
+    def __init__(self):
+        """ Initialize our reactor """
+        # fileno -> transport
+        self.transports = {}
+
+        # Heap of Timers
+        self.timers = []
+
+        self.running = False
+
+    def register(self, transport):
+        """ Start watching a transport's socket """
+        self.transports[transport.fileno()] = transport
+
+    def unregister(self, transport):
+        """ Stop watching a transport's socket """
+        for (fileno, registered) in self.transports.items():
+            if registered is transport:
+                del self.transports[fileno]
+
+    def call_later(self, delay, callback, *args):
+        """
+            Call a function after a delay
+
+            @param delay: Seconds to wait
+            @param callback: Function to call
+            @return: Timer, which can be cancelled
+        """
+        timer = Timer(time.time() + delay, callback, args)
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def _run_timers(self):
+        """ Call every timer that is due """
+        now = time.time()
+        while len(self.timers) > 0 and self.timers[0].deadline <= now:
+            timer = heapq.heappop(self.timers)
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except:
+                logger.exception("Timer callback failed.")
+
+    def has_work(self):
+        """
+            Is anything registered that could still wake us up?
+
+            @return: True if we have a transport or pending timer
+        """
+        # Drop cancelled timers so that they don't wake us up
+        while len(self.timers) > 0 and self.timers[0].cancelled:
+            heapq.heappop(self.timers)
+
+        return len(self.transports) > 0 or len(self.timers) > 0
+
+    def run_once(self, timeout=None):
+        """
+            Wait for (at most) one round of events and handle them
+
+            @param timeout: Maximum number of seconds to wait (None waits until
+            something happens)
+        """
+        self.has_work()
+
+        if len(self.timers) > 0:
+            delay = max(0, self.timers[0].deadline - time.time())
+            if timeout is None or delay < timeout:
+                timeout = delay
+
+        readers = self.transports.keys()
+        writers = [fileno for (fileno, transport) in self.transports.items()
+                   if transport.wants_write()]
+
+        if len(readers) == 0 and len(writers) == 0:
+            if timeout is not None:
+                time.sleep(timeout)
+        else:
+            try:
+                (readable, writable, failed) = select.select(readers, writers,
+                                                             [], timeout)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                (readable, writable) = ([], [])
+
+            for fileno in readable:
+                transport = self.transports.get(fileno)
+                if transport is not None:
+                    transport.handle_read()
+
+            for fileno in writable:
+                transport = self.transports.get(fileno)
+                if transport is not None:
+                    transport.handle_write()
+
+        self._run_timers()
+
+    def run_until_complete(self, requests, timeout=None):
+        """
+            Run our loop until every request is done
+
+            @param requests: Request or list of Requests
+            @param timeout: Maximum number of seconds to run for
+            @return: True if everything completed, False if we timed out
+            @raise RuntimeError: If a request is still pending but nothing is
+            registered that could ever complete it
+        """
+        if isinstance(requests, Request):
+            requests = [requests]
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        for request in requests:
+            while not request.done():
+                wait = None
+                if deadline is not None:
+                    wait = deadline - time.time()
+                    if wait <= 0:
+                        return False
+                if not self.has_work():
+                    raise RuntimeError("Request is pending, but no transports"
+                                       " or timers are left to complete it.")
+                self.run_once(wait)
+
+        return True
+
+    def run_forever(self):
+        """
+            Run our loop until stop() is called, or nothing is left for it to
+            wait on
+        """
+        self.running = True
+        while self.running:
+            if not self.has_work():
+                logger.debug("Nothing left to run, stopping.")
+                break
+            self.run_once()
+        self.running = False
+
+    def stop(self):
+        """ Stop run_forever() """
+        self.running = False
+
+
+class Transport:
+    """
+        Abstract class for a socket driven by a Reactor, with requests that
+        are re-sent according to their RetryPolicy
+    """
+
+    def __init__(self, reactor):
+        """ Initialize our transport """
+        if self.__class__ == Transport:
+            raise Exception("Transport initialized directly!")
+
+        self.reactor = reactor
+        self.sock = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def wants_write(self):
+        """ Do we have data waiting to go out? """
+        return False
+
+    def handle_read(self):
+        raise NotImplementedError("ERROR: Unimplemented function.")
+
+    def handle_write(self):
+        pass
+
+    def _send_request(self, request):
+        raise NotImplementedError("ERROR: Unimplemented function.")
+
+    def _arm(self, request):
+        """ (Re-)send a request and start its timer """
+        request.attempts += 1
+        self._send_request(request)
+
+        timeout = request.policy.timeout
+        if timeout is not None and timeout > 0:
+            request.timer = self.reactor.call_later(timeout,
+                                                    self._expired,
+                                                    request)
+
+    def _expired(self, request):
+        """ No reply showed up in time """
+        request.timer = None
+        if request.done():
+            return
+        logger.debug("Request timed out. (Key: %s, Attempt: %d/%d)" % (
+                                                    request.key,
+                                                    request.attempts,
+                                                    request.policy.retries))
+        self._retry(request)
+
+    def _retry(self, request):
+        """ Re-send a request, or give up if it is out of retries """
+        if request.timer is not None:
+            request.timer.cancel()
+            request.timer = None
+
+        if request.attempts > request.policy.retries:
+            self._abandon(request)
+            request.set_exception(socket.timeout("Sensor timed out. (%s)" %
+                                                 request.key))
+            return
+
+        self._arm(request)
+
+    def _abandon(self, request):
+        """ Forget about a request that we are giving up on """
+        pass
+
+    def _complete(self, request, reply):
+        """
+            Hand a reply to its request
+
+            @return: True if the request is done, False if it was re-sent
+        """
+        if request.on_reply is None:
+            request.set_result(str(reply))
+            return True
+
+        try:
+            result = request.on_reply(reply)
+        except Exception, e:
+            request.set_exception(e)
+            return True
+
+        if result is None:
+            self._retry(request)
+            return False
+
+        request.set_result(result)
+        return True
+
+
+class DatagramTransport(Transport):
+    """
+        UDP transport, with replies matched to requests by a key in the reply
+    """
+
+    def __init__(self, reactor, sock, key_func, on_datagram=None,
+                 window_size=0, remote=None):
+        """
+            Initialize our transport
+
+            @param reactor: Reactor that drives this transport
+            @param sock: UDP socket (connected, unless remote is given)
+            @param key_func: Function that takes a datagram and returns the key
+            of the request that it answers (None if it isn't a reply)
+            @param on_datagram: Function called with (datagram, address) for
+            anything that isn't a reply to one of our requests
+            @param window_size: Maximum number of requests in-flight at once
+            (0 for no limit)
+            @param remote: Address to send to, for unconnected sockets
+        """
+        Transport.__init__(self, reactor)
+
+        self.sock = sock
+        self.sock.setblocking(0)
+        self.key_func = key_func
+        self.on_datagram = on_datagram
+        self.window_size = window_size
+        self.remote = remote
+
+        # key -> Request
+        self.in_flight = {}
+        # Requests waiting for room in our window
+        self.backlog = collections.deque()
+
+        # Every datagram is received into this buffer
+        self._rx_buffer = bytearray(G.MAX_PACKET_SIZE)
+        self._rx_view = memoryview(self._rx_buffer)
+
+        self.reactor.register(self)
+
+    def send(self, data):
+        """ Send a datagram that doesn't expect a reply """
+        if self.remote is not None:
+            self.sock.sendto(data, self.remote)
+        else:
+            self.sock.send(data)
+
+    def request(self, key, data, policy=DEFAULT_POLICY, on_reply=None,
+                build=None):
+        """
+            Send a request
+
+            @param key: Key that replies to this request will carry
+            @param data: Raw datagram to send
+            @param policy: RetryPolicy for this request
+            @param on_reply: See Request
+            @param build: See Request (key and data are ignored if given)
+            @return: Request
+        """
+        request = Request(key, data, policy, on_reply, build)
+        if self.window_size > 0 and len(self.in_flight) >= self.window_size:
+            self.backlog.append(request)
+        else:
+            self._start(request)
+        return request
+
+    def _start(self, request):
+        """ Put a request in-flight """
+        if request.build is not None:
+            (request.key, request.data) = request.build()
+        self.in_flight[request.key] = request
+        self._arm(request)
+
+    def _fill_window(self):
+        """ Start waiting requests as room opens up in our window """
+        while len(self.backlog) > 0 and (self.window_size <= 0 or
+                                         len(self.in_flight) < self.window_size):
+            self._start(self.backlog.popleft())
+
+    def _send_request(self, request):
+        try:
+            self.send(request.data)
+        except socket.error, e:
+            # Treat it like a lost packet, our timer will re-send it
+            logger.error("Could not send request. (%s)" % e)
+
+    def _abandon(self, request):
+        self.in_flight.pop(request.key, None)
+        self._fill_window()
+
+    def handle_read(self):
+        """ Read every datagram that is waiting and dispatch it """
+        for i in xrange(MAX_READS_PER_EVENT):
+            try:
+                (nbytes, address) = self.sock.recvfrom_into(self._rx_buffer)
+            except socket.error, e:
+                if e.args[0] in WOULD_BLOCK:
+                    break
+                logger.error("Could not receive data from socket. (%s)" % e)
+                break
+
+            datagram = self._rx_view[:nbytes]
+            key = self.key_func(datagram)
+            request = self.in_flight.get(key)
+
+            if request is None:
+                if self.on_datagram is not None:
+                    self.on_datagram(datagram, address)
+                else:
+                    # Most likely a late reply to a request that was re-sent
+                    logger.debug("Ignoring datagram. (Key: %s)" % (key,))
+                continue
+
+            if self._complete(request, datagram):
+                del self.in_flight[key]
+
+        self._fill_window()
+
+    def close(self):
+        """ Stop watching our socket and fail anything outstanding """
+        self.reactor.unregister(self)
+        pending = self.in_flight.values() + list(self.backlog)
+        self.in_flight = {}
+        self.backlog.clear()
+        for request in pending:
+            request.set_exception(socket.error("Transport closed."))
+
+
+class StreamTransport(Transport):
+    """
+        TCP (or UNIX) transport, replies are answered in the order that their
+        requests were sent
+    """
+
+    def __init__(self, reactor, address, family=socket.AF_INET,
+                 framer=None, connect_timeout=10):
+        """
+            Initialize our transport
+
+            @param reactor: Reactor that drives this transport
+            @param address: Address to connect to
+            @param family: Socket family
+            @param framer: Function that takes the bytes received so far and
+            returns (message, bytes consumed), or None if there is no complete
+            message yet.  (Default: every chunk received is a message)
+            @param connect_timeout: Seconds to wait for a connection
+        """
+        Transport.__init__(self, reactor)
+
+        self.address = address
+        self.family = family
+        self.framer = framer
+        self.connect_timeout = connect_timeout
+
+        # Requests that have been sent, oldest first
+        self.waiting = collections.deque()
+        self.sequence = 0
+
+        self.tx_buffer = bytearray()
+        self.rx_buffer = bytearray()
+
+    def connect(self):
+        """
+            Connect our socket (blocking, so that errors are reported to the
+            caller)
+
+            @return: True/False
+        """
+        if self.sock is not None:
+            return True
+
+        try:
+            sock = socket.socket(self.family, socket.SOCK_STREAM)
+            sock.settimeout(self.connect_timeout)
+            sock.connect(self.address)
+            sock.setblocking(0)
+        except socket.error, e:
+            logger.error("Could not connect to %s. (%s)" % (str(self.address),
+                                                           e))
+            return False
+
+        self.sock = sock
+        self.reactor.register(self)
+        return True
+
+    def disconnect(self):
+        """ Close our socket, outstanding requests are re-sent on reconnect """
+        if self.sock is None:
+            return
+        self.reactor.unregister(self)
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        self.sock = None
+        self.tx_buffer = bytearray()
+        self.rx_buffer = bytearray()
+
+    def send(self, data):
+        """ Queue data that doesn't expect a reply """
+        self.tx_buffer.extend(data)
+        self.handle_write()
+
+    def request(self, data, policy=DEFAULT_POLICY, on_reply=None):
+        """
+            Send a request
+
+            @param data: Raw data to send
+            @param policy: RetryPolicy for this request
+            @param on_reply: See Request
+            @return: Request
+        """
+        self.sequence += 1
+        request = Request(self.sequence, data, policy, on_reply)
+        self.waiting.append(request)
+        self._arm(request)
+        return request
+
+    def _send_request(self, request):
+        if self.sock is None and not self.connect():
+            return
+        self.send(request.data)
+
+    def _retry(self, request):
+        """
+            Replies can't be matched once we've lost track of one, so start
+            over with a new connection and re-send everything outstanding
+        """
+        self.disconnect()
+        for waiting in list(self.waiting):
+            # Only the request that failed counts this against its retries
+            if waiting is not request:
+                waiting.attempts -= 1
+            Transport._retry(self, waiting)
+
+    def _abandon(self, request):
+        try:
+            self.waiting.remove(request)
+        except ValueError:
+            pass
+
+    def wants_write(self):
+        return len(self.tx_buffer) > 0
+
+    def handle_write(self):
+        """ Send as much of our queued data as the socket will take """
+        while self.sock is not None and len(self.tx_buffer) > 0:
+            try:
+                sent = self.sock.send(self.tx_buffer)
+            except socket.error, e:
+                if e.args[0] in WOULD_BLOCK:
+                    return
+                logger.error("Could not send data. (%s)" % e)
+                self._lost_connection()
+                return
+            del self.tx_buffer[:sent]
+
+    def _lost_connection(self):
+        """ Our socket died, re-send whatever is outstanding """
+        if len(self.waiting) > 0:
+            self._retry(self.waiting[0])
+        else:
+            self.disconnect()
+
+    def handle_read(self):
+        """ Read whatever is waiting and hand out any complete replies """
+        try:
+            data = self.sock.recv(STREAM_RECV_SIZE)
+        except socket.error, e:
+            if e.args[0] in WOULD_BLOCK:
+                return
+            logger.error("Could not receive data. (%s)" % e)
+            data = ""
+
+        if len(data) == 0:
+            logger.debug("Connection closed by %s." % str(self.address))
+            self._lost_connection()
+            return
+
+        self.rx_buffer.extend(data)
+
+        while self.sock is not None and len(self.rx_buffer) > 0:
+            if self.framer is None:
+                (message, consumed) = (self.rx_buffer, len(self.rx_buffer))
+            else:
+                framed = self.framer(self.rx_buffer)
+                if framed is None:
+                    break
+                (message, consumed) = framed
+            message = str(message)
+            del self.rx_buffer[:consumed]
+
+            if len(self.waiting) == 0:
+                logger.debug("Ignoring unsolicited data. (%d bytes)" %
+                             len(message))
+                continue
+
+            request = self.waiting[0]
+            if self._complete(request, message) and \
+                    len(self.waiting) > 0 and self.waiting[0] is request:
+                self.waiting.popleft()
+
+    def close(self):
+        """ Disconnect and fail anything outstanding """
+        self.disconnect()
+        pending = list(self.waiting)
+        self.waiting.clear()
+        for request in pending:
+            request.set_exception(socket.error("Transport closed."))
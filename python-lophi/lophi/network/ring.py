@@ -0,0 +1,340 @@
+"""
+    Shared-memory ring buffer of received packets
+
+    A PacketReaderRing process receives datagrams straight into the fixed-size
+    slots of a PacketRing, which lives in memory shared with its parent.  The
+    parent consumes packets out of the same slots, so nothing is pickled or
+    pushed through a pipe per packet.
+
+    There is exactly one producer (the reader process) and one consumer, the
+    producer only ever moves the head and the consumer only ever moves the
+    tail, so neither side needs a lock.  The producer also writes a byte to a
+    pipe after every batch, which the consumer waits on when the ring is
+    empty.
+
+    NOTE: Without a lock, this relies on x86's memory ordering: aligned 64-bit
+    counter stores are atomic, and stores are seen by the other process in
+    the order they were made, so a slot is always filled before the head that
+    publishes it (and released before the tail that frees it).  Weakly
+    ordered CPUs (E.g. ARM) would need memory barriers around the counters.
+
+    (c) 2015 Massachusetts Institute of Technology
+"""
+# Native
+import os
+import time
+import errno
+import fcntl
+import socket
+import select
+import struct
+import ctypes
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import logging
+logger = logging.getLogger(__name__)
+
+# LO-PHI
+import lophi.globals as G
+
+DEFAULT_SLOTS = 4096
+DEFAULT_SLOT_SIZE = 9216 # Jumbo frame
+
+# Maximum number of packets received before the head is published
+BATCH_SIZE = 64
+
+# Indices into our shared counters
+HEAD = 0
+TAIL = 1
+RECEIVED = 2
+DROPPED = 3
+TRUNCATED = 4
+COUNTERS = 5
+
+
+class PacketRing:
+    """
+        Single-producer, single-consumer ring of packets in shared memory
+    """
+
+    def __init__(self, slots=DEFAULT_SLOTS, slot_size=DEFAULT_SLOT_SIZE):
+        """
+            Allocate our ring (must happen before the reader is started)
+
+            @param slots: Number of packets the ring can hold
+            @param slot_size: Largest packet that we can store, anything larger
+            is truncated (and counted)
+        """
+        self.slots = slots
+        self.slot_size = slot_size
+
+        # Every slot has one spare byte, so that we can tell a packet that
+        # fills its slot exactly from one that was truncated
+        self.slot_stride = slot_size + 1
+
+        self.buffer = RawArray(ctypes.c_char, slots * self.slot_stride)
+        self.lengths = RawArray(ctypes.c_uint32, slots)
+        self.addresses = RawArray(ctypes.c_uint32, slots)
+        self.ports = RawArray(ctypes.c_uint16, slots)
+        self.counters = RawArray(ctypes.c_uint64, COUNTERS)
+
+        self.view = memoryview(self.buffer)
+
+        # Written by the producer after every batch
+        (self.notify_read, self.notify_write) = os.pipe()
+        for fd in (self.notify_read, self.notify_write):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def __len__(self):
+        """ Return the number of packets waiting to be consumed """
+        return int(self.counters[HEAD] - self.counters[TAIL])
+
+    def stats(self):
+        """
+            Return our counters
+
+            @return: Dictionary of received, dropped (ring was full),
+            truncated (larger than a slot), and pending packets
+        """
+        return {'received': int(self.counters[RECEIVED]),
+                'dropped': int(self.counters[DROPPED]),
+                'truncated': int(self.counters[TRUNCATED]),
+                'pending': len(self)}
+
+    """
+        Producer
+    """
+
+    def _slot_view(self, sequence):
+        """ Return the memoryview of the slot for a sequence number """
+        offset = (sequence % self.slots) * self.slot_stride
+        return self.view[offset:offset + self.slot_stride]
+
+    def fill(self, sock, scratch):
+        """
+            Receive every packet waiting on a socket, without blocking
+
+            @param sock: Socket to receive from
+            @param scratch: Buffer that packets are received into (and thrown
+            away) when our ring is full
+            @return: Number of packets received
+        """
+        counters = self.counters
+        head = counters[HEAD]
+        received = 0
+
+        while received < BATCH_SIZE:
+            full = head - counters[TAIL] >= self.slots
+            try:
+                if full:
+                    (nbytes, address) = sock.recvfrom_into(
+                                                        scratch, 0,
+                                                        socket.MSG_DONTWAIT)
+                else:
+                    (nbytes, address) = sock.recvfrom_into(
+                                                        self._slot_view(head),
+                                                        0,
+                                                        socket.MSG_DONTWAIT)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                 errno.EINTR):
+                    break
+                raise
+
+            received += 1
+            counters[RECEIVED] += 1
+            if full:
+                counters[DROPPED] += 1
+                continue
+
+            if nbytes > self.slot_size:
+                counters[TRUNCATED] += 1
+                nbytes = self.slot_size
+
+            slot = head % self.slots
+            self.lengths[slot] = nbytes
+            self.addresses[slot] = struct.unpack("!I",
+                                        socket.inet_aton(address[0]))[0]
+            self.ports[slot] = address[1]
+            head += 1
+
+        # Publish the whole batch at once (after its slots are written, see 
+        # the note on memory ordering above)
+        if head != counters[HEAD]:
+            counters[HEAD] = head
+            try:
+                os.write(self.notify_write, "\x00")
+            except OSError:
+                # Pipe is full, the consumer already has plenty of wake ups
+                pass
+
+        return received
+
+    """
+        Consumer
+    """
+
+    def _wait(self, timeout):
+        """
+            Wait for the ring to have something in it
+
+            @param timeout: Seconds to wait (None waits forever)
+            @return: True if there is a packet waiting
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while self.counters[HEAD] == self.counters[TAIL]:
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    return False
+            try:
+                select.select([self.notify_read], [], [], wait)
+                os.read(self.notify_read, 4096)
+            except (OSError, select.error):
+                pass
+
+        return True
+
+    def _address(self, slot):
+        """ Return the (ip, port) that the packet in a slot came from """
+        return (socket.inet_ntoa(struct.pack("!I", self.addresses[slot])),
+                self.ports[slot])
+
+    def peek(self, timeout=None):
+        """
+            Return the next packet without copying it out of the ring
+
+            NOTE: The packet is only valid until release() is called
+
+            @param timeout: Seconds to wait for a packet (None waits forever)
+            @return: (memoryview of the packet, (ip, port)), or None if we
+            timed out
+        """
+        if not self._wait(timeout):
+            return None
+
+        tail = self.counters[TAIL]
+        slot = tail % self.slots
+        offset = slot * self.slot_stride
+        return (self.view[offset:offset + self.lengths[slot]],
+                self._address(slot))
+
+    def release(self):
+        """ Hand the slot of the packet returned by peek() back """
+        self.counters[TAIL] += 1
+
+    def get(self, timeout=None):
+        """
+            Return the next packet
+
+            @param timeout: Seconds to wait for a packet (None waits forever)
+            @return: (data, (ip, port)), or None if we timed out
+        """
+        packet = self.peek(timeout)
+        if packet is None:
+            return None
+        (view, address) = packet
+        data = view.tobytes()
+        self.release()
+        return (data, address)
+
+    def get_into(self, buf, timeout=None):
+        """
+            Copy the next packet into a buffer
+
+            @param buf: Writable buffer, packets larger than it are truncated
+            @param timeout: Seconds to wait for a packet (None waits forever)
+            @return: (number of bytes, (ip, port)), or None if we timed out
+        """
+        packet = self.peek(timeout)
+        if packet is None:
+            return None
+        (view, address) = packet
+        nbytes = min(len(view), len(buf))
+        buf[:nbytes] = view[:nbytes]
+        self.release()
+        return (nbytes, address)
+
+    def close(self):
+        """ Close our notification pipe """
+        for fd in (self.notify_read, self.notify_write):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class PacketReaderRing(multiprocessing.Process):
+    """
+        Process that receives every packet on a UDP socket into a PacketRing
+    """
+
+    def __init__(self, sock, ring, bind_ip=None, bind_port=None):
+        """
+            Initialize our reader with either an already open socket or an
+            IP/port
+
+            @param sock: Socket used for listening
+            @param ring: PacketRing to fill
+            @param bind_ip: [Optional] IP to bind to if no socket given
+            @param bind_port: [Optional] Port to bind to if no socket given
+        """
+        self.SOCK = sock
+        self.ring = ring
+        self.bind_ip = bind_ip
+        self.bind_port = bind_port
+
+        multiprocessing.Process.__init__(self)
+        self.daemon = True
+
+    def _connect(self):
+        """ Bind to our socket """
+        logger.debug("Binding packet reader. (%s:%s)" % (self.bind_ip,
+                                                         self.bind_port))
+        self.SOCK = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.SOCK.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.SOCK.bind((self.bind_ip, self.bind_port))
+
+        # Make our buffer much larger to help prevent packet loss
+        self.SOCK.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                             G.UDP_RECV_BUFFER_SIZE)
+
+    def run(self):
+        """ Receive packets until we are killed """
+        if self.SOCK is None:
+            self._connect()
+
+        scratch = bytearray(G.MAX_PACKET_SIZE)
+
+        while True:
+            try:
+                select.select([self.SOCK], [], [])
+                self.ring.fill(self.SOCK, scratch)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                logger.error("Could not wait on socket. (%s)" % e)
+                break
+            except socket.error, e:
+                logger.error("Could not receive data from socket. (%s)" % e)
+                break
+
+    def stop(self):
+        """ Kill our process nicely """
+        logger.debug("Killing packet reader process...")
+        stats = self.ring.stats()
+        if stats['dropped'] > 0 or stats['truncated'] > 0:
+            logger.warning("Packet reader dropped %d and truncated %d of %d "
+                           "packets." % (stats['dropped'],
+                                         stats['truncated'],
+                                         stats['received']))
+        try:
+            self.terminate()
+            self.join(1)
+        except:
+            pass
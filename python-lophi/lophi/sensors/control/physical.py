@@ -5,13 +5,13 @@
 """
 
 # Native
-import socket
 import logging
 logger = logging.getLogger(__name__)
 import time
 
 import lophi.globals as G
 from lophi.sensors.control import ControlSensor
+from lophi.network.reactor import Reactor, StreamTransport, RetryPolicy
 from lophi.actuation.keypressgenerator import KeypressGeneratorPhysical
 
 class ControlSensorPhysical(ControlSensor):
@@ -19,13 +19,24 @@ class ControlSensorPhysical(ControlSensor):
     SOCK_TIMEOUT = 60
     RETRIES = 3
     
-    def __init__(self, sensor_ip, sensor_port=G.SENSOR_CONTROL.DEFAULT_PORT,name=None):
+    def __init__(self, sensor_ip, sensor_port=G.SENSOR_CONTROL.DEFAULT_PORT,name=None,
+                 reactor=None):
         """
             Initialize our control sensor (e.g arduino)
+            
+            @param reactor: Reactor to drive our connection with, so that many
+            sensors can share one event loop (See command_async).  (Default: a
+            private reactor)
         """
         self.sensor_ip = sensor_ip
         self.sensor_port = sensor_port
-        self._sock = None
+        
+        if reactor is None:
+            reactor = Reactor()
+        self.reactor = reactor
+        self._transport = StreamTransport(self.reactor,
+                                          (sensor_ip, sensor_port),
+                                          connect_timeout=self.SOCK_TIMEOUT)
         
         if name is not None:
             self.name = name
@@ -48,86 +59,67 @@ class ControlSensorPhysical(ControlSensor):
         """
             Connect to the arduino server
         """
-        if self._sock is None:
+        if self._transport.sock is None:
             logger.debug("Connecting to control sensor. (%s:%d)"%(self.sensor_ip,
                                                                   self.sensor_port))
-            try:
-                self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self._sock.connect((self.sensor_ip, self.sensor_port))
-                # Set timeout
-                self._sock.settimeout(self.SOCK_TIMEOUT)
-                return True
-            except:
+            if not self._transport.connect():
                 logger.error("Could not connect to control sensor at %s:%s"%
                               (self.sensor_ip,self.sensor_port))
                 
                 return False
-        else:
-            return True
+            
+        return True
 
     def _disconnect(self):
         """
             Disconnect from the arduino server
         """
-        try:
-            # Send end of transmission
-            self._sock.sendall(G.SENSOR_CONTROL.END_TRANSMISSION)
-        except:
-            pass
-        
-        try:
-            # Close socket
-            self._sock.close()
-        except:
-            pass
+        if self._transport.sock is not None:
+            try:
+                # Send end of transmission
+                self._transport.sock.setblocking(1)
+                self._transport.sock.sendall(G.SENSOR_CONTROL.END_TRANSMISSION)
+            except:
+                pass
         
-        self._sock = None
+        self._transport.close()
         
-    def _read_response(self):
+    def command_async(self,msg):
         """
-            Read response from the arduino
+            Send a message to the arduino with end flag, without waiting for 
+            its response
+            
+            Responses are matched to commands in the order that they were sent,
+            if one times out (SOCK_TIMEOUT) we reconnect and re-send everything
+            outstanding, up to RETRIES times.
+            
+            @param msg: Command to send
+            @return: Request whose result is the raw response
         """
-        try:
-            data = self._sock.recv(1024)
-        except:
-            return None
-        
-        if len(data) == 0: 
-            return None
-        else:
-            return data
+        return self._transport.request(msg + G.SENSOR_CONTROL.END_MSG,
+                                       policy=RetryPolicy(self.SOCK_TIMEOUT,
+                                                          self.RETRIES - 1))
         
     def _send_comand(self,msg):
         """
             Send a message to the arduino with end flag
         """
-        for attempt in range(self.RETRIES):
-            if not self._connect():
-                return False
-            
-            try:
-                self._sock.sendall(msg)
-                self._sock.sendall(G.SENSOR_CONTROL.END_MSG)
-
-                response = self._read_response()
-
-                if response is None:
-                    logger.warn("Couldn't send command to the control "
-                                "sensor (%d/%d)."%(attempt+1,self.RETRIES))
-                    self._disconnect()
-                    continue
-
-                elif response == G.SENSOR_CONTROL.RESPONSE_DONE:
-                    return True
-                else:
-                    return response
-            except:
-                logger.warn("Couldn't send command to the control sensor ("
-                            "%d/%d)."%(attempt+1, self.RETRIES))
-                self._disconnect()
-                pass
+        if not self._connect():
+            return False
+        
+        request = self.command_async(msg)
+        self.reactor.run_until_complete(request)
         
-        return False
+        if request.exception is not None:
+            logger.warn("Couldn't send command to the control sensor. (%s)"%
+                        request.exception)
+            return False
+        
+        response = request.result()
+        if response == G.SENSOR_CONTROL.RESPONSE_DONE:
+            return True
+        else:
+            return response
         
     def sensor_reset(self):
         """
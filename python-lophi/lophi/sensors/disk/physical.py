@@ -8,9 +8,8 @@ import socket
 import struct
 import logging
 logger = logging.getLogger(__name__)
-import heapq
-import multiprocessing
 import math
+import collections
 
 
 # LO-PHI
@@ -18,7 +17,8 @@ import lophi.globals as G
 from lophi.sensors.disk import DiskSensor
 from lophi.data import SATAFrame
 from lophi.data import LOPHIPacket
-from lophi.network import PacketReaderUDP
+from lophi.network.ring import PacketRing, PacketReaderRing
+from lophi.sensors.disk.reorder import ReorderWindow, SequenceGap
 from lophi.data import SATAFrame
 import lophi.network as NET
 
@@ -26,7 +26,7 @@ import lophi.network as NET
 UDP_RECV_BUFFER_SIZE = 0x7fffffff
                        
 READ_TIMEOUT = 60
-MAX_HEAP_SIZE = 20
+REORDER_WINDOW = 32
 
 
 class DiskSensorPhysical(DiskSensor):
@@ -58,17 +58,16 @@ class DiskSensorPhysical(DiskSensor):
         self.connected = False
         self.sata_enabled = False
         
-        # Initialize a heap to re-order SATA frames that arrive out of order
-        self.sata_heap = []
-        self.last_lophi_seqn = None
-        self.last_lophi_packet = None
+        # Re-order SATA frames that arrive out of order
+        self.sata_window = ReorderWindow(REORDER_WINDOW)
+        self.sata_ready = collections.deque()
                 
         if name is not None:
             self.name = name
         
         # Are we reading a separate process?
         self.use_threading = use_threading
-        self.read_queue = None
+        self.packet_ring = None
         self.packet_reader = None
         
         self.SOCK = None
@@ -120,13 +119,18 @@ class DiskSensorPhysical(DiskSensor):
                 
                 if self.use_threading:
                     logger.debug("Starting listener thread.")
-                    # Start a process that will handle all of our reads
-                    self.read_queue = multiprocessing.Queue()
-                    self.packet_reader = PacketReaderUDP(self.SOCK,self.read_queue)
+                    # Start a process that will receive all of our packets 
+                    # into a shared ring buffer
+                    self.packet_ring = PacketRing()
+                    self.packet_reader = PacketReaderRing(self.SOCK,
+                                                          self.packet_ring)
                     self.packet_reader.start()
             
                 self.connected = True
                 
+                # This is a new stream of SATA frames
+                self._reset_sata_window()
+                
                 return True
                 
             except:
@@ -152,6 +156,9 @@ class DiskSensorPhysical(DiskSensor):
         
         self.connected = False
         
+        # Anything left in our window will never be completed
+        self._reset_sata_window()
+        
         # Close our socket
         if self.SOCK is not None:
             logger.debug("Closing socket.")
@@ -172,10 +179,11 @@ class DiskSensorPhysical(DiskSensor):
                 G.print_traceback()
                 pass
             
-        # Close our threaded process for reading?
-        if self.read_queue is not None:
-            logger.debug("Closing queue.")
-            self.read_queue.close()  
+        # Close the ring that our reader filled
+        if self.packet_ring is not None:
+            logger.debug("Closing packet ring.")
+            self.packet_ring.close()
+            self.packet_ring = None
 
         
         
@@ -222,9 +230,9 @@ class DiskSensorPhysical(DiskSensor):
         if not self._connect():
             return False
             
-        # Read UDP data from thread or off the wire
-        if self.read_queue is not None:
-            recv_data, recv_addr = self.read_queue.get()
+        # Read UDP data from our reader or off the wire
+        if self.packet_ring is not None:
+            recv_data, recv_addr = self.packet_ring.get()
         else:
             recv_data, recv_addr = self.SOCK.recvfrom(size)
 
@@ -232,73 +240,64 @@ class DiskSensorPhysical(DiskSensor):
         return recv_data, recv_addr
 
 
+    def _reset_sata_window(self):
+        """ Forget any SATA frames that we were re-ordering """
+        self.sata_window.reset()
+        self.sata_ready.clear()
+
+
     def _get_sata_packet(self):
         """
             This segment of code makes sure that we read our SATA packets in 
             order in case they are re-ordered by the network.
             
-            @return: LOPHI SATA packet guaranteed to be in the order sent by sensor.
-            @todo: Handle packet loss
+            If any frames were lost, the next frame returned has a SequenceGap
+            attached as its "gap" attribute.  (See SATAReconstructor.handle_gap)
+            
+            @return: SATAFrame guaranteed to be in the order sent by sensor.
         """
         # Make sure SATA extraction is enabled
         if not self.sata_enabled:
             self.sata_enable_all()
         
-        lophi_packet = None
-        
+        gap = None
         while 1:
-            # Are we dealing with the heap?
-            if len(self.sata_heap) > 0:
-                logger.debug("pulling from heap")
-                
-                heap_next_seqn = self.sata_heap[0][0]
-                if heap_next_seqn == (self.last_lophi_seqn+1)%65536 or len(self.sata_heap) > MAX_HEAP_SIZE:
-                    
-                    if len(self.sata_heap) > MAX_HEAP_SIZE:
-                        self.DROPPED_PACKETS += 1
-                        logger.warning("Sensor dropped packets. (Data may be unreliable)")
-                    lophi_seqn, lophi_packet = heapq.heappop(self.sata_heap)
-                    # hack to make sure we don't put it back on the heap
-                    self.last_lophi_seqn = lophi_seqn
-                    self.last_lophi_packet = lophi_packet
-                    
-                    # Return our packet
-                    return lophi_packet
-                
-                else:
-                    lophi_packet = self.get_lophi_packet()
-            else:
-                # Get the next packet from the wire
-                lophi_packet = self.get_lophi_packet()
-            
-            # Check the packet from the wire and see if it has the seqn we expected
-            if lophi_packet.op_code == G.SENSOR_DISK.OP.SATA_FRAME:
-                
-                # Extract our SATA data
-                sata_frame = SATAFrame(lophi_packet.data)
-                
-                # Get our sequence number
-                lophi_seqn = sata_frame.seqn_num
+            # Hand out anything that is already in order
+            while len(self.sata_ready) > 0:
+                sata_frame = self.sata_ready.popleft()
                 
-                # Take care of our ordering
-                if self.last_lophi_seqn is not None:
-                    # If this is an out of order packet, push to heap
-                    if lophi_seqn != (self.last_lophi_seqn+1)%65536:
-                        heapq.heappush(self.sata_heap,(lophi_seqn,lophi_packet))
-                        logger.debug("Got out of order packet. (Expected: %d, Got: %d)"%(
-                                                (self.last_lophi_seqn+1)%65536,
-                                                lophi_seqn))
-                        continue
+                if isinstance(sata_frame, SequenceGap):
+                    self.DROPPED_PACKETS += sata_frame.count
+                    logger.warning("Sensor dropped %d packets. (Data may be "
+                                   "unreliable)"%sata_frame.count)
+                    if gap is None:
+                        gap = sata_frame
+                    else:
+                        gap = SequenceGap(gap.first, 
+                                          gap.count + sata_frame.count)
+                    continue
                 
-                # Save our last seqn
-                self.last_lophi_seqn = lophi_seqn
-                self.last_lophi_packet = lophi_packet
-                
-                # Return our packet
+                if gap is not None:
+                    sata_frame.gap = gap
                 return sata_frame
-                
-            else:
+            
+            # Get the next packet from the wire
+            lophi_packet = self.get_lophi_packet()
+            
+            if lophi_packet.op_code != G.SENSOR_DISK.OP.SATA_FRAME:
                 continue
+                
+            # Extract our SATA data
+            sata_frame = SATAFrame(lophi_packet.data)
+            
+            late = self.sata_window.late
+            self.sata_ready.extend(self.sata_window.push(sata_frame.seqn_num,
+                                                         sata_frame))
+            
+            # Late frames were dropped too
+            if self.sata_window.late > late:
+                self.DROPPED_PACKETS += self.sata_window.late - late
+    
     
     def is_up(self):
         """
@@ -402,6 +401,9 @@ class DiskSensorPhysical(DiskSensor):
                            G.SENSOR_DISK.ADDR.SATA_CTRL,
                            "\x00\x00\x00\x03")
         self.sata_enabled = True
+        
+        # The sensor starts a new sequence of SATA frames
+        self._reset_sata_window()
 
     def sata_disable(self):
         """
@@ -0,0 +1,259 @@
+"""
+    Reorder window for sequence-numbered sensor streams (E.g. SATA frames)
+
+    Packets are held in a fixed-size ring, indexed by sequence number, until
+    everything before them has arrived.  When a packet falls further ahead
+    than the window can hold, whatever is still missing is given up on and
+    reported as a SequenceGap, so consumers know exactly what was lost.
+
+    A long run of packets that are all behind us means that the sensor
+    restarted its sequence numbers (or jumped backwards), so we start a new
+    sequence at the packet that ended the run instead of waiting for the
+    counter to wrap back around.
+
+    (c) 2015 Massachusetts Institute of Technology
+"""
+# Native
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = 32
+DEFAULT_MAX_LATE = 20 # Late packets in a row before we resync
+SEQN_MODULUS = 65536 # 16-bit sequence numbers
+
+
+class SequenceGap:
+    """
+        Packets that never arrived
+
+        first: Sequence number of the first missing packet
+        count: Number of consecutive packets that are missing
+    """
+
+    def __init__(self, first, count):
+        self.first = first
+        self.count = count
+
+    def __repr__(self):
+        return "SequenceGap(first=%d, count=%d)" % (self.first, self.count)
+
+
+class ReorderWindow:
+    """
+        Puts packets back into sequence number order, with wraparound
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, modulus=SEQN_MODULUS,
+                 max_late=DEFAULT_MAX_LATE):
+        """
+            Initialize our window
+
+            @param window: Number of packets that can be held while waiting
+            for a missing one (Must divide modulus, so that slots line up 
+            across wraparound)
+            @param modulus: Sequence numbers wrap at this value
+            @param max_late: Number of late packets in a row that makes us 
+            give up on our sequence and start a new one
+        """
+        if window >= modulus / 2 or modulus % window != 0:
+            raise ValueError("Reorder window must divide the sequence number "
+                             "space and be less than half of it.")
+        if max_late < 1:
+            raise ValueError("Reorder window must allow at least one late "
+                             "packet before resyncing.")
+
+        self.window = window
+        self.modulus = modulus
+        self.max_late = max_late
+
+        # seqn % window -> (seqn, packet)
+        self.slots = [None] * window
+        self.held = 0
+
+        # Next sequence number to release, None until we see our first packet
+        self.expected = None
+
+        # Late packets in a row, and the sequence number of the first one
+        self.late_run = 0
+        self.late_first = None
+
+        # Statistics
+        self.released = 0
+        self.lost = 0
+        self.reordered = 0
+        self.late = 0
+        self.resyncs = 0
+
+    def __len__(self):
+        """ Return the number of packets being held """
+        return self.held
+
+    def stats(self):
+        """
+            Return our statistics
+
+            @return: Dictionary of released, lost, reordered, and late packets
+        """
+        return {'released': self.released,
+                'lost': self.lost,
+                'reordered': self.reordered,
+                'late': self.late + self.late_run,
+                'resyncs': self.resyncs,
+                'held': self.held}
+
+    def _release(self, output):
+        """ Release every packet that is next in line """
+        slots = self.slots
+        while self.held > 0:
+            idx = self.expected % self.window
+            entry = slots[idx]
+            if entry is None or entry[0] != self.expected:
+                return
+            slots[idx] = None
+            self.held -= 1
+            output.append(entry[1])
+            self.released += 1
+            self.expected = (self.expected + 1) % self.modulus
+
+    def _gap(self, first, count, output):
+        """ Report missing packets, merging with a gap we just reported """
+        self.lost += count
+        if len(output) > 0 and isinstance(output[-1], SequenceGap):
+            last = output[-1]
+            if (last.first + last.count) % self.modulus == first:
+                last.count += count
+                return
+        output.append(SequenceGap(first, count))
+
+    def _skip(self, count, output):
+        """
+            Give up on the next count sequence numbers, releasing anything that
+            we were holding along the way
+        """
+        gap_first = None
+        gap_count = 0
+        for i in xrange(count):
+            if self.held == 0:
+                # Nothing left to release, the rest of it is one gap
+                if gap_first is None:
+                    gap_first = self.expected
+                gap_count += count - i
+                self.expected = (self.expected + count - i) % self.modulus
+                break
+
+            idx = self.expected % self.window
+            entry = self.slots[idx]
+            if entry is not None and entry[0] == self.expected:
+                if gap_count > 0:
+                    self._gap(gap_first, gap_count, output)
+                    gap_first = None
+                    gap_count = 0
+                self.slots[idx] = None
+                self.held -= 1
+                output.append(entry[1])
+                self.released += 1
+            else:
+                if gap_first is None:
+                    gap_first = self.expected
+                gap_count += 1
+            self.expected = (self.expected + 1) % self.modulus
+
+        if gap_count > 0:
+            self._gap(gap_first, gap_count, output)
+
+    def push(self, seqn, packet):
+        """
+            Add a packet to our window
+
+            @param seqn: Sequence number of the packet
+            @param packet: Packet to hold
+            @return: List of packets (and SequenceGaps) that are now in order
+        """
+        output = []
+
+        if self.expected is None:
+            self.expected = seqn
+
+        distance = (seqn - self.expected) % self.modulus
+
+        # Behind us, either a duplicate or too late to be useful
+        if distance >= self.modulus / 2:
+            if self.late_run == 0:
+                self.late_first = seqn
+            self.late_run += 1
+            if self.late_run < self.max_late:
+                logger.debug("Dropping late packet. (Expected: %d, Got: %d)" %
+                             (self.expected, seqn))
+                return output
+
+            # Nothing but late packets, our sequence numbers restarted
+            self._resync(seqn, output)
+            distance = 0
+        elif self.late_run > 0:
+            # Those were just stragglers
+            self.late += self.late_run
+            self.late_run = 0
+
+        # Too far ahead, give up on whatever we are missing to make room
+        if distance >= self.window:
+            self._skip(distance - self.window + 1, output)
+
+        if seqn != self.expected:
+            self.reordered += 1
+
+        idx = seqn % self.window
+        if self.slots[idx] is not None:
+            # Same sequence number twice
+            self.late += 1
+            return output
+
+        self.slots[idx] = (seqn, packet)
+        self.held += 1
+        self._release(output)
+        return output
+
+    def _resync(self, seqn, output):
+        """
+            Start a new sequence at seqn
+            
+            Everything that we were holding is released, and the late packets 
+            that we dropped on the way here are reported as a gap just before
+            seqn, since they belong to the new sequence.
+        """
+        logger.warning("Sequence numbers restarted, resyncing. (Expected: %d, "
+                       "Got: %d)" % (self.expected, seqn))
+        output.extend(self.flush())
+
+        if self.late_run > 1:
+            self._gap(self.late_first, self.late_run - 1, output)
+        self.late_run = 0
+
+        self.expected = seqn
+        self.resyncs += 1
+
+    def flush(self):
+        """
+            Release everything we are holding, giving up on anything missing
+
+            @return: List of packets (and SequenceGaps)
+        """
+        output = []
+        if self.held == 0:
+            return output
+
+        # Find the last sequence number that we are holding
+        furthest = 0
+        for entry in self.slots:
+            if entry is not None:
+                furthest = max(furthest,
+                               (entry[0] - self.expected) % self.modulus)
+        self._skip(furthest + 1, output)
+        return output
+
+    def reset(self):
+        """ Forget everything, the next packet starts a new sequence """
+        self.slots = [None] * self.window
+        self.held = 0
+        self.expected = None
+        self.late_run = 0
+        self.late_first = None
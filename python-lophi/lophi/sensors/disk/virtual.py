@@ -22,6 +22,7 @@ VM_PORT = 31337
 SOCKET_RETRY = 15 # Seconds
 
 VM_HEADER_STRING = 'QIII';
+HEADER_SIZE = len(DiskSensorPacket())
 
 VERBOSE = False
 
@@ -97,6 +98,25 @@ class DiskSensorVirtual(DiskSensor):
         
         logger.debug("Read %d bytes."%len(recv_data))
         return recv_data
+    
+    
+    def _read_raw_packet_into(self,view):
+        """
+            Fill a buffer with data from our socket
+            
+            @param view: memoryview to fill with len(view) bytes
+            @return: Number of bytes read (< len(view) if the socket closed)
+        """
+        recvd = 0
+        while recvd < len(view):
+            tmp = self.SOCK.recv_into(view[recvd:])
+            if tmp == 0:
+                logger.warn("Introspection server disconnected.")
+                break
+            recvd += tmp
+        
+        logger.debug("Read %d bytes."%recvd)
+        return recvd
         
         
     def get_disk_packet(self):
@@ -107,33 +127,25 @@ class DiskSensorVirtual(DiskSensor):
         if self.SOCK is None:
             self._connect()
         
-        access_packet = DiskSensorPacket()
+        header = bytearray(HEADER_SIZE)
 
         # Try forever to get a packet
         while 1:
             # Receive our header
-            header = self._read_raw_packet(len(access_packet))
+            recvd = self._read_raw_packet_into(memoryview(header))
 
             # Did our socket get closed?
-            if len(header) < len(access_packet):
+            if recvd < HEADER_SIZE:
                 logger.warn("Introspection server disconnected.")
                 # reconnect and try again
                 self._connect()
                 continue
             
-            access_packet = DiskSensorPacket(header)
+            access_packet = DiskSensorPacket(str(header))
 
             # Read for as long as the header tells us to to get the content
-            data = ""
-            recvd = 0
-            while len(data) < access_packet.size:
-                logger.debug("Read data.")
-                tmp = self.SOCK.recv(access_packet.size - recvd);
-                data += tmp
-                recvd = len(data)
-                if len(tmp) == 0:
-                    logger.warn("Introspection server disconnected.")
-                    break
+            data = bytearray(access_packet.size)
+            recvd = self._read_raw_packet_into(memoryview(data))
 
             # Did our socket get closed?
             if recvd < access_packet.size:
@@ -145,7 +157,7 @@ class DiskSensorVirtual(DiskSensor):
             logger.debug("Read %d bytes of data."%len(data))
             
             # Return our data
-            access_packet.data = data
+            access_packet.data = str(data)
             
             return access_packet
 
@@ -5,14 +5,33 @@
 """
 # Native
 import time
+import bisect
 import logging
 
 logger = logging.getLogger(__name__)
 
 # LO-PHI
 from lophi.sensors import Sensor
+from lophi.sensors.memory.cache import MemoryCache, PAGE_SIZE, DEFAULT_MAX_BYTES
 
 CACHE_CHUNK = 7680  # 7680 is the max
+MAPPED_CHUNK = 1024 * 1024  # Read size for sensors with read_view()
+MAX_COALESCED_READ = 16 * 1024 * 1024  # Largest run of uncached pages per read
+MAX_PENDING_READ = 64 * 1024 * 1024  # Most uncached memory fetched at once
+
+# Used to fill bad memory regions without building new strings
+ZEROS = "\x00" * (64 * 1024)
+
+
+def _zero_fill(view):
+    """ Fill a writable memoryview with zeros """
+    length = len(view)
+    offset = 0
+    while offset < length:
+        nbytes = min(len(ZEROS), length - offset)
+        view[offset:offset + nbytes] = buffer(ZEROS, 0, nbytes)
+        offset += nbytes
+
 
 class MemorySensor(Sensor):
     """"
@@ -24,6 +43,10 @@ class MemorySensor(Sensor):
     # Format: [START,END)
     BAD_MEM_REGIONS = []
 
+    # Cache settings, subclasses set CACHE_TIMEOUT before initializing us
+    CACHE_TIMEOUT = 0
+    CACHE_MAX_BYTES = DEFAULT_MAX_BYTES
+
     def __init__(self):
         """ Initialize our class """
 
@@ -31,172 +54,413 @@ class MemorySensor(Sensor):
         if self.__class__ == MemorySensor:
             raise ("Interface initialized directly!")
 
+        self.cache = MemoryCache(self.CACHE_TIMEOUT, self.CACHE_MAX_BYTES)
+
         Sensor.__init__(self)
 
+    def set_cache_timeout(self, start, end, timeout):
+        """
+            Override how long pages are cached for a region of memory (E.g.
+            kernel structures that rarely change)
+            
+            @param start: Starting physical memory address
+            @param end: Ending physical memory address (Exclusive)
+            @param timeout: How long to keep data in the cache (seconds)
+        """
+        self.cache.set_region_timeout(start, end, timeout)
+
+    def get_cache_stats(self):
+        """
+            Return our cache statistics
+            
+            @return: Dictionary of hits, misses, evictions, and bytes cached
+        """
+        return self.cache.stats()
+
+    def _read_from_sensor_into(self, address, buf):
+        """
+            Read memory from the sensor directly into a writable buffer
+
+            @param address: Starting physical memory address
+            @param buf: bytearray or memoryview to fill with len(buf) bytes
+            @return: Number of bytes read, or None on error
+        """
+        raise NotImplementedError("ERROR: Unimplemented function.")
+
     def _read_from_sensor(self, address, length):
         """ Read memory from the sensor directly """
-        raise NotImplementedError("ERROR: Unimplemented function.")
+        buf = bytearray(length)
+        nbytes = self._read_from_sensor_into(address, buf)
+        if nbytes is None:
+            return None
+        return str(buf[:nbytes])
 
-    def _read_cached(self, address, length):
+    def _read_many_from_sensor_into(self, requests):
         """
-            Read memory from the sensor, caching values if enabled.
+            Read many regions of memory from the sensor directly into writable
+            buffers
+            
+            Sensors that can have several requests in flight at once should
+            override this, by default we simply read them one at a time.
+
+            @param requests: List of (address, buf) where buf is a bytearray or
+            memoryview to fill with len(buf) bytes
+            @return: List with the number of bytes read into each buffer, or 
+            None for any read that failed
+        """
+        return [self._read_from_sensor_into(address, buf)
+                for (address, buf) in requests]
+
+    def _hole_map(self):
+        """
+            Return our bad memory regions as sorted, merged lists of starts and
+            ends, so that they can be searched with bisect
+            
+            The map is rebuilt whenever BAD_MEM_REGIONS is replaced.
+            
+            @return: (starts, ends)
+        """
+        regions = self.BAD_MEM_REGIONS
+        if getattr(self, "_holes_source", None) is regions and \
+                self._holes_count == len(regions):
+            return self._holes
+
+        starts = []
+        ends = []
+        for (start, end) in sorted(regions):
+            if len(ends) > 0 and start <= ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+
+        self._holes_source = regions
+        self._holes_count = len(regions)
+        self._holes = (starts, ends)
+        return self._holes
+
+    def _plan_read(self, address, length):
+        """
+            Split a read around our bad memory regions
             
             @param address: Starting physical memory address
             @param length: Length of memory to read
-            @return: RAW data string from memory 
+            @return: List of [START,END) regions that are safe to read
+        """
+        (starts, ends) = self._hole_map()
+        end = address + length
+
+        segments = []
+        position = address
+        hole = bisect.bisect_right(ends, address)
+        while hole < len(starts) and starts[hole] < end:
+            if starts[hole] > position:
+                segments.append((position, starts[hole]))
+            position = max(position, ends[hole])
+            hole += 1
+
+        if position < end:
+            segments.append((position, end))
+        return segments
+
+    def _in_bad_region(self, address, length):
+        """
+            Does a read overlap any of our bad memory regions?
             
-            @todo: CLEAN UP THE CACHE!
+            @param address: Starting physical memory address
+            @param length: Length of memory to read
+            @return: True/False
         """
+        (starts, ends) = self._hole_map()
+        hole = bisect.bisect_right(ends, address)
+        return hole < len(starts) and starts[hole] < address + length
 
+    def _read_many_cached_into(self, requests):
+        """
+            Read many regions of memory into buffers, caching values if 
+            enabled.
+            
+            Every page that misses our cache is fetched from the sensor with a 
+            single batch of requests.
+            
+            @param requests: List of (address, view) where view is a memoryview
+            to fill with len(view) bytes of memory
+            @return: List of True/False, for whether each buffer was filled
+        """
         # Is the cache disabled?
         if self.CACHE_TIMEOUT <= 0:
-            rtn = self._read_from_sensor(address, length)
-            if rtn is None:
-                return ""
-            else:
-                return rtn
+            nbytes = self._read_many_from_sensor_into(requests)
+            return [n == len(view) 
+                    for (n, (address, view)) in zip(nbytes, requests)]
 
-        # Temp variable for cached data
-        datas = ""
+        rtn = [True] * len(requests)
         NOW = time.time()
 
-        # Loop over each chunk in the cache
-        while (length > 0):
-
-            cacheindex = address / CACHE_CHUNK
-            chunkstart = cacheindex * CACHE_CHUNK
-            cacheoffset = address - chunkstart
-            inchunk = CACHE_CHUNK - cacheoffset
+        # page -> List of (request index, offset in page, view to fill)
+        missing = {}
+        for (idx, (address, view)) in enumerate(requests):
+            length = len(view)
+            filled = 0
+            while filled < length:
 
-            # See if we have a cached version, and if its expired
-            if cacheindex not in self.cache or self.cache_timeouts[
-                cacheindex] <= NOW - self.CACHE_TIMEOUT:
+                page = address / PAGE_SIZE
+                pageoffset = address - page * PAGE_SIZE
+                inpage = min(PAGE_SIZE - pageoffset, length - filled)
+                dest = view[filled:filled + inpage]
 
-                # Read the memory from our sensor
-                entry = self._read_from_sensor(chunkstart, CACHE_CHUNK)
+                entry = self.cache.get(page, NOW)
                 if entry is None:
-                    logger.error("Problem reading from sensor!")
-                    return datas
+                    missing.setdefault(page, []).append((idx, pageoffset, dest))
+                else:
+                    dest[:] = memoryview(entry)[pageoffset:pageoffset + inpage]
+
+                address += inpage
+                filled += inpage
+
+        if len(missing) == 0:
+            return rtn
+
+        # Merge adjacent missing pages into runs, so that each run is a single
+        # sensor read
+        max_pages = MAX_COALESCED_READ / PAGE_SIZE
+        runs = []
+        for page in sorted(missing):
+            if len(runs) > 0 and runs[-1][0] + runs[-1][1] == page and \
+                    runs[-1][1] < max_pages:
+                runs[-1][1] += 1
+            else:
+                runs.append([page, 1])
+
+        # Read the runs from our sensor in batches of at most 
+        # MAX_PENDING_READ bytes, which all share one scratch buffer
+        total = sum(count for (page, count) in runs) * PAGE_SIZE
+        scratch = memoryview(bytearray(min(total, MAX_PENDING_READ)))
+        batch = []
+        batch_size = 0
+        for (page, count) in runs:
+            if batch_size + count * PAGE_SIZE > len(scratch):
+                self._fill_missing_runs(batch, scratch, missing, rtn, NOW)
+                batch = []
+                batch_size = 0
+            batch.append((page, count, batch_size))
+            batch_size += count * PAGE_SIZE
+        self._fill_missing_runs(batch, scratch, missing, rtn, NOW)
+
+        return rtn
+
+    def _fill_missing_runs(self, runs, scratch, missing, rtn, now):
+        """
+            Read one batch of runs of uncached pages from our sensor, cache 
+            them, and copy them into the views that requested them
+            
+            @param runs: List of (first page, page count, offset in scratch)
+            @param scratch: memoryview to read the runs into
+            @param missing: page -> List of (request index, offset in page, 
+            view to fill)
+            @param rtn: List of True/False for each request, set to False for
+            every request that we couldn't fill
+            @param now: Time to cache the pages at
+        """
+        if len(runs) == 0:
+            return
+
+        nbytes = self._read_many_from_sensor_into(
+                        [(first * PAGE_SIZE,
+                          scratch[offset:offset + count * PAGE_SIZE])
+                         for (first, count, offset) in runs])
+
+        for ((first, count, offset), n) in zip(runs, nbytes):
+            if n != count * PAGE_SIZE:
+                logger.error("Problem reading from sensor! (Pages: 0x%x-0x%x)"
+                             % (first, first + count))
+                for page in xrange(first, first + count):
+                    for (idx, pageoffset, dest) in missing[page]:
+                        rtn[idx] = False
+                continue
+
+            for page in xrange(first, first + count):
+                page_offset = offset + (page - first) * PAGE_SIZE
+                entry = bytearray(scratch[page_offset:page_offset + PAGE_SIZE])
 
                 # Cache this entry
-                self.cache[cacheindex] = entry
-                # Save the time that we got this entry
-                self.cache_timeouts[cacheindex] = NOW
+                self.cache.put(page, entry, now)
 
-            # Only append what was requested
-            if length > CACHE_CHUNK - cacheoffset:
-                datas += self.cache[cacheindex][cacheoffset:]
+                for (idx, pageoffset, dest) in missing[page]:
+                    dest[:] = memoryview(entry)[pageoffset:
+                                                pageoffset + len(dest)]
+
+    def _read_cached_into(self, address, view):
+        """
+            Read memory from the sensor into a buffer, caching values if
+            enabled.
+            
+            Memory is cached in page-aligned chunks, see MemoryCache.
+            
+            @param address: Starting physical memory address
+            @param view: memoryview to fill with len(view) bytes of memory
+            @return: Number of bytes read
+        """
+        length = len(view)
+
+        # Is the cache disabled?
+        if self.CACHE_TIMEOUT <= 0:
+            rtn = self._read_from_sensor_into(address, view)
+            if rtn is None:
+                return 0
             else:
-                datas += self.cache[cacheindex][
-                         cacheoffset:cacheoffset + length]
+                return rtn
 
-            address += inchunk
-            length -= inchunk
+        # Uncached pages are coalesced into as few sensor reads as possible
+        if self._read_many_cached_into([(address, view)])[0]:
+            return length
+        return 0
 
-        return datas
+    def _read_cached(self, address, length):
+        """
+            Read memory from the sensor, caching values if enabled.
+            
+            @param address: Starting physical memory address
+            @param length: Length of memory to read
+            @return: RAW data string from memory 
+        """
+        buf = bytearray(length)
+        nbytes = self._read_cached_into(address, memoryview(buf))
+        return str(buf[:nbytes])
 
-    def read(self, address, length):
+    def read_into(self, address, buf):
         """
-            Read memory from our sensor
+            Read memory from our sensor directly into a writable buffer
             
             NOTE: This will use our temporal cache if it's set and handle any 
             memory holes
             
+            This avoids building any intermediate strings, so large reads 
+            (e.g. memory dumps) can reuse one buffer and write it straight out.
+            
             @param address: Starting physical memory address
-            @param length: Length of memory to read
-            @return: RAW data string from memory 
+            @param buf: bytearray or memoryview to fill with len(buf) bytes
+            @return: Number of bytes read, or None on error 
         """
+        view = memoryview(buf)
+        length = len(view)
 
         logger.debug("Got read (0x%x,%d)" % (address, length))
 
         if length < 1:
             logger.error("Read length must be >= 1")
 
-        READS = []
-
         # Given a read like below, we'll want to read the - sections and fill in
         # zeros for the * sections where
         #
         # S--------b1s***b1e-----b2s***b2e------E
         #
         # S - address, E - address+length, bX(s/e) - bad region start/end
-        #
-        # NOTE: BAD_MEM_REGIONS is assumed to be sorted!
-        # There are also faster ways to do this, but this is already likely a
-        # rare case to have many bad regions
-        last_bad = None
-        for bad in self.BAD_MEM_REGIONS:
-
-            # Does the entire requested region fall in a bad sector?
-            if bad[0] <= address and bad[1] >= address + length:
-                logger.debug(
-                    "Entire region is in bad memory %s, returning 0s" % str(
-                        bad))
-                return "\x00" * length
-
-            # Does this region start within our read?
-            if bad[0] >= address and bad[0] < address + length:
-
-                logger.debug("Region starts in bad memory. %s" % str(bad))
-                # We'll need to do one read from the start of the previous bad
-                # region to the beginning of this bad region
-                if last_bad is None and address != bad[0]:
-                    READS.append((address, bad[0]))
-                elif last_bad is not None:
-                    READS.append((last_bad[1], bad[0]))
-
-                last_bad = bad
-
-            # Does this read request start in a bad region?
-            elif bad[1] > address and bad[1] < address + length:
-                last_bad = bad
-
-            # Are we oustide of the region that we are worried about?
-            elif bad[0] > address + length:
-                continue
+        segments = self._plan_read(address, length)
+        if segments == [(address, address + length)]:
+            return self._read_cached_into(address, view)
 
-        # Are we doing multiple reads?
-        if len(READS) > 0 or last_bad is not None:
-            # Do we need a final read to pick up the left over case?
-            # i.e. b2e------E
-            if last_bad[1] < address + length:
-                READS.append((last_bad[1], address + length))
+        logger.debug("Issuing the following reads: %s" % segments)
 
-            # variable to store our data
-            data = ""
+        # Fill the bad sections with zeros and read the rest in place, all of
+        # the good sections are handed to the sensor together
+        position = address
+        requests = []
+        for (start, end) in segments:
+            _zero_fill(view[position - address:start - address])
+            requests.append((start, view[start - address:end - address]))
+            position = end
+        _zero_fill(view[position - address:])
 
-            # Do we need to prepend zeros?
-            if READS[0][0] > address:
-                data += "\x00" * (READS[0][0] - address)
+        if len(requests) > 0 and \
+                not all(self._read_many_cached_into(requests)):
+            logger.error("Got no data back from sensor.  (Timeout)")
+            return None
 
-            logger.debug("Issuing the following reads: %s" % READS)
+        return length
 
-            last_read = None
-            for read in READS:
-                # Append any zeros for the bad sections
-                # ..--b1s***b1e--..
-                # bs1 = last_read[1], bs1e = read[0]
-                if last_read is not None:
-                    data += "\x00" * (read[0] - last_read[1])
+    def read(self, address, length):
+        """
+            Read memory from our sensor
+            
+            NOTE: This will use our temporal cache if it's set and handle any 
+            memory holes
+            
+            @param address: Starting physical memory address
+            @param length: Length of memory to read
+            @return: RAW data string from memory 
+        """
+        buf = bytearray(length)
 
-                read_data = self._read_cached(read[0], read[1] - read[0])
+        nbytes = self.read_into(address, buf)
+        if nbytes is None:
+            return None
+        elif nbytes < length:
+            return str(buf[:nbytes])
+        else:
+            return str(buf)
 
-                if read_data is None or len(read_data) == 0:
-                    logger.error("Got no data back from sensor.  (Timeout)")
-                    return None
+    def new_connection(self):
+        """
+            Open another, independent, connection to the same sensor so that
+            memory can be read over several streams at once
+            
+            @return: New MemorySensor, or None if the sensor doesn't support
+            multiple connections
+        """
+        return None
 
-                data += read_data
+    def read_view(self, address, length):
+        """
+            Return memory without copying it, for sensors that can map the
+            target's memory directly
+            
+            @param address: Starting physical memory address
+            @param length: Length of memory to read
+            @return: Read-only buffer, or None if the region can't be mapped
+        """
+        return None
 
-                last_read = read
+    def read_many(self, reads):
+        """
+            Read many regions of memory at once
+            
+            All of the reads are gathered into one buffer and any that aren't 
+            cached are handed to the sensor together, so that sensors that 
+            support it can pipeline them instead of paying a round trip for 
+            each one.
+            
+            NOTE: Reads that overlap a bad memory region are handled one at a
+            time by read()
+            
+            @param reads: List of (address, length)
+            @return: List of RAW data strings, None for any read that failed
+        """
+        rtn = [None] * len(reads)
+
+        buf = bytearray(sum(length for (address, length) in reads))
+        view = memoryview(buf)
+
+        # (index, offset in buf, length) of every read we can batch
+        batched = []
+        requests = []
+        offset = 0
+        for (idx, (address, length)) in enumerate(reads):
+            if length < 1 or self._in_bad_region(address, length):
+                rtn[idx] = self.read(address, length)
+            else:
+                batched.append((idx, offset, length))
+                requests.append((address, view[offset:offset + length]))
+            offset += length
 
-            # Do we need to append zero's to the end to hit our length?
-            if len(data) < length:
-                data += "\x00" * (length - len(data))
+        if len(requests) == 0:
+            return rtn
 
-            return data
+        filled = self._read_many_cached_into(requests)
+        for ((idx, offset, length), ok) in zip(batched, filled):
+            if ok:
+                rtn[idx] = str(buf[offset:offset + length])
 
-        else:
-            return self._read_cached(address, length)
+        return rtn
 
     def write(self, address, data):
         """ Write memory """
@@ -0,0 +1,169 @@
+"""
+    Bounded, page-granular cache used by our memory sensors
+
+    (c) 2015 Massachusetts Institute of Technology
+"""
+# Native
+import time
+import bisect
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 4096
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024  # 64MB
+
+
+class MemoryCache:
+    """
+        Least-recently-used cache of 4KB physical memory pages.
+
+        The cache is bounded by a byte budget, once it is exceeded the least
+        recently used pages are evicted.  Every page expires after a timeout,
+        which can be overridden for specific physical memory regions (e.g.
+        keep page tables around longer than user pages).
+    """
+
+    def __init__(self, timeout, max_bytes=DEFAULT_MAX_BYTES):
+        """
+            Initialize our cache
+
+            @param timeout: Default number of seconds that a page is valid
+            @param max_bytes: Maximum number of bytes of memory to keep cached
+        """
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+
+        # page index -> (data, time cached), ordered oldest to newest use
+        self.pages = collections.OrderedDict()
+
+        # Sorted, non-overlapping list of [START,END) regions and timeouts
+        self.region_starts = []
+        self.regions = []
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        """ Return the number of bytes currently cached """
+        return len(self.pages) * PAGE_SIZE
+
+    def __contains__(self, page):
+        """ Is the given page index cached? (Ignores expiry) """
+        return page in self.pages
+
+    def set_region_timeout(self, start, end, timeout):
+        """
+            Override the page timeout for a physical memory region
+
+            @param start: Starting physical address of region
+            @param end: End physical address of region (Exclusive)
+            @param timeout: Number of seconds that pages in this region are
+            valid for
+        """
+        # Drop any regions that this one overlaps
+        self.regions = [r for r in self.regions
+                        if r[1] <= start or r[0] >= end]
+        self.regions.append((start, end, timeout))
+        self.regions.sort()
+        self.region_starts = [r[0] for r in self.regions]
+
+    def get_timeout(self, address):
+        """
+            Return the cache timeout for the given physical address
+
+            @param address: Physical memory address
+            @return: Timeout in seconds
+        """
+        idx = bisect.bisect_right(self.region_starts, address) - 1
+        if idx >= 0 and address < self.regions[idx][1]:
+            return self.regions[idx][2]
+        return self.timeout
+
+    def get(self, page, now=None):
+        """
+            Return the cached contents of a page
+
+            @param page: Page index (i.e. address / PAGE_SIZE)
+            @param now: Time to check expiry against (Default: time.time())
+            @return: Page data, or None if it is not cached or has expired
+        """
+        entry = self.pages.get(page)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        if now is None:
+            now = time.time()
+
+        (data, cached_time) = entry
+        if cached_time <= now - self.get_timeout(page * PAGE_SIZE):
+            del self.pages[page]
+            self.misses += 1
+            return None
+
+        # Mark this as our most recently used page
+        del self.pages[page]
+        self.pages[page] = entry
+
+        self.hits += 1
+        return data
+
+    def put(self, page, data, now=None):
+        """
+            Cache the contents of a page, evicting old pages if needed
+
+            @param page: Page index (i.e. address / PAGE_SIZE)
+            @param data: PAGE_SIZE bytes of memory
+            @param now: Time that the data was read (Default: time.time())
+        """
+        if now is None:
+            now = time.time()
+
+        if page in self.pages:
+            del self.pages[page]
+        self.pages[page] = (data, now)
+
+        while len(self.pages) * PAGE_SIZE > self.max_bytes:
+            self.pages.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, address, length):
+        """
+            Drop every page that overlaps a dirty region of memory
+
+            @param address: Starting physical address of dirty region
+            @param length: Length of dirty region in bytes
+        """
+        if length < 1:
+            return
+
+        first = address / PAGE_SIZE
+        last = (address + length - 1) / PAGE_SIZE
+
+        # Don't walk a huge range that is mostly uncached
+        if last - first + 1 > len(self.pages):
+            for page in self.pages.keys():
+                if first <= page <= last:
+                    del self.pages[page]
+        else:
+            for page in xrange(first, last + 1):
+                self.pages.pop(page, None)
+
+    def clear(self):
+        """ Empty the entire cache """
+        self.pages.clear()
+
+    def stats(self):
+        """
+            Return our cache statistics
+
+            @return: Dictionary of hits, misses, evictions, and bytes cached
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bytes': len(self)}
@@ -0,0 +1,187 @@
+"""
+    Parallel memory dumps
+
+    Physical memory is split into ranges that are read concurrently, each
+    stream through its own sensor connection, and written straight to their
+    offset in a preallocated sparse file.  Bad memory regions (and pages that
+    read back as zeros) are left as holes instead of being written.
+
+    (c) 2015 Massachusetts Institute of Technology
+"""
+# Native
+import os
+import time
+import Queue
+import threading
+import multiprocessing
+import logging
+logger = logging.getLogger(__name__)
+
+# LO-PHI
+from lophi.sensors.memory import CACHE_CHUNK, MAPPED_CHUNK
+
+# Size of the ranges that are handed out to each stream
+RANGE_SIZE = 16 * 1024 * 1024
+
+# How often to report our progress (seconds)
+PROGRESS_INTERVAL = 5
+
+
+def _dump_ranges(sensor, filename, ranges, progress_queue, chunk_size):
+    """
+        Read ranges of memory from a sensor and write them to our dump
+
+        Every stream has its own sensor connection and file descriptor, so
+        they never share a file offset.  (Python 2 has no os.pwrite)
+
+        @param sensor: MemorySensor with its own connection
+        @param filename: Filename of the (preallocated) dump
+        @param ranges: multiprocessing.Queue of (start, end), None when empty
+        @param progress_queue: Queue to report (bytes done, error) on
+        @param chunk_size: Number of bytes to read at a time
+    """
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    zeros = bytearray(chunk_size)
+
+    fd = os.open(filename, os.O_WRONLY)
+    try:
+        while True:
+            next_range = ranges.get()
+            if next_range is None:
+                break
+
+            (range_start, range_end) = next_range
+            for (start, end) in sensor._plan_read(range_start,
+                                                  range_end - range_start):
+                offset = start
+                while offset < end:
+                    read_len = min(chunk_size, end - offset)
+
+                    data = sensor.read_view(offset, read_len)
+                    if data is None:
+                        nbytes = sensor.read_into(offset, view[:read_len])
+                        if nbytes is None:
+                            logger.error("Memory dump failed at 0x%x!" %
+                                         offset)
+                            progress_queue.put((0, True))
+                            return
+                        data = buffer(buf, 0, read_len)
+
+                    # Leave zeros as holes in our sparse file
+                    if data != buffer(zeros, 0, read_len):
+                        os.lseek(fd, offset, os.SEEK_SET)
+                        os.write(fd, data)
+
+                    offset += read_len
+
+            progress_queue.put((range_end - range_start, False))
+    finally:
+        os.close(fd)
+
+
+def dump_parallel(sensor, filename, total_size, streams=4, progress=None):
+    """
+        Dump memory using several concurrent streams
+
+        NOTE: Each stream runs in its own process with a new connection from
+        sensor.new_connection(), sensors that can't open more connections are
+        dumped with a single stream (in a thread, using the sensor as is).
+
+        @param sensor: MemorySensor to dump
+        @param filename: Filename to dump a memory image to
+        @param total_size: Size of memory
+        @param streams: Number of concurrent streams
+        @param progress: Function (bytes done, total bytes, bytes/sec) called
+        periodically (Default: log our progress)
+        @return: True/False
+    """
+    # Open a connection for each stream
+    sensors = []
+    for stream in range(streams):
+        connection = sensor.new_connection()
+        if connection is None:
+            break
+        sensors.append(connection)
+
+    shared = False
+    if len(sensors) == 0:
+        logger.debug("Sensor does not support multiple connections, "
+                     "using a single stream.")
+        sensors = [sensor]
+        shared = True
+
+    # Can we write straight from a mapping of memory?
+    chunk_size = CACHE_CHUNK
+    if sensor.read_view(min(MAPPED_CHUNK, total_size) - 1, 1) is not None:
+        chunk_size = MAPPED_CHUNK
+
+    # Preallocate a sparse file
+    try:
+        f = open(filename, "wb")
+        f.truncate(total_size)
+        f.close()
+    except:
+        logger.error("Could not create %s" % filename)
+        return False
+
+    # Hand out our ranges
+    ranges = multiprocessing.Queue()
+    for start in xrange(0, total_size, RANGE_SIZE):
+        ranges.put((start, min(start + RANGE_SIZE, total_size)))
+    for stream in sensors:
+        ranges.put(None)
+
+    progress_queue = multiprocessing.Queue()
+    workers = []
+    for stream_sensor in sensors:
+        args = (stream_sensor, filename, ranges, progress_queue, chunk_size)
+        if shared:
+            worker = threading.Thread(target=_dump_ranges, args=args)
+            worker.daemon = True
+        else:
+            worker = multiprocessing.Process(target=_dump_ranges, args=args)
+        worker.start()
+        workers.append(worker)
+
+    logger.info("Dumping %d bytes of memory with %d streams. (%s)" % (
+                                                                total_size,
+                                                                len(workers),
+                                                                filename))
+
+    # Wait for every range to be dumped
+    rtn = True
+    done = 0
+    start_time = last_report = time.time()
+    while done < total_size:
+        try:
+            (nbytes, error) = progress_queue.get(True, PROGRESS_INTERVAL)
+            if error:
+                rtn = False
+                break
+            done += nbytes
+        except Queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                logger.error("Memory dump streams exited early!")
+                rtn = False
+                break
+
+        now = time.time()
+        if now - last_report >= PROGRESS_INTERVAL or done >= total_size:
+            rate = done / max(now - start_time, 0.001)
+            if progress is not None:
+                progress(done, total_size, rate)
+            else:
+                logger.info("Dumped %d/%d bytes (%.1f%%, %.1f MB/s)" % (
+                                                done,
+                                                total_size,
+                                                100.0 * done / total_size,
+                                                rate / (1024 * 1024)))
+            last_report = now
+
+    for worker in workers:
+        if not rtn and not shared:
+            worker.terminate()
+        worker.join(PROGRESS_INTERVAL)
+
+    return rtn
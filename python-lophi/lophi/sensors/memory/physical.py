@@ -5,6 +5,7 @@
 """
 # Native
 import socket
+import struct
 import time
 import logging
 logger = logging.getLogger(__name__)
@@ -14,14 +15,50 @@ import multiprocessing
 # LO-PHI
 import lophi.globals as G
 from lophi.sensors.memory import MemorySensor
+from lophi.sensors.memory.cache import DEFAULT_MAX_BYTES
 from lophi.data import MemoryRapidPacket
-from lophi.network import PacketReaderUDP
+from lophi.network.ring import PacketRing, PacketReaderRing
+from lophi.network.reactor import Reactor, DatagramTransport, RetryPolicy, \
+    Request, gather
 
 network_lock = multiprocessing.Lock()
 
 
 MAX_THREAD_READ = 7680*10 # Unimplemented... but should it be?
 READ_CHUNK = 7680
+TRANSACTION_MASK = 0x0000ffff
+RAPID_HEADER_SIZE = len(MemoryRapidPacket())
+
+# Header of every reply (See MemoryRapidPacket)
+RAPID_REPLY_HEAD = struct.Struct("!IIIIIII")
+
+
+def rapid_reply_key(datagram):
+    """
+        Return the key of a read reply from our sensor
+        
+        Transaction numbers wrap, so a late reply to an old request can carry
+        the same number as one that is in-flight.  Keying on the address and
+        length as well means that such a reply is never mistaken for the 
+        answer to a different read.
+        
+        @param datagram: Raw packet from the sensor
+        @return: (transaction number, address, length), or None if this isn't
+        a read reply
+    """
+    if len(datagram) < RAPID_HEADER_SIZE:
+        return None
+    
+    (magic, address_high, operation, address_low, length, flags, 
+     transaction_no) = RAPID_REPLY_HEAD.unpack_from(datagram)
+    if magic != G.SENSOR_MEMORY.MAGIC_LOPHI:
+        logger.error("Magic number mismatch. (%x)"%magic)
+        return None
+    if operation != G.SENSOR_MEMORY.COMMAND.READ + 0x2: # RAPID reply is 0x2
+        logger.error("not a read?! {0}".format(operation))
+        return None
+    
+    return (transaction_no, (address_high << 32) | address_low, length)
 
 class MemorySensorPhysical(MemorySensor):
     """
@@ -33,18 +70,28 @@ class MemorySensorPhysical(MemorySensor):
     def __init__(self, sensor_ip=G.SENSOR_MEMORY.DEFAULT_IP, 
                 sensor_port=G.SENSOR_MEMORY.DEFAULT_PORT,  
                  cache_timeout=0, 
+                 cache_size=DEFAULT_MAX_BYTES,
                  name=None,
                  use_threading=False,
                  timeout=1,
-                 retries=5):
+                 retries=5,
+                 window_size=0,
+                 reactor=None):
         """
             Initialize our memory sensor.  Just saving values at this point.
     
             @param cache_timeout: How long to keep data in the cache (seconds)
+            @param cache_size: Maximum number of bytes to keep in the cache
             @param name: Human name of the sensor
             @param use_threading: This will spawn a new process to read replys 
-            from the sensor.  Enables much faster reads, but will eventually 
-            blow the UDP stack in the FPGA. 
+            from the sensor into a shared ring buffer.  Enables much faster 
+            reads, but will eventually blow the UDP stack in the FPGA. 
+            @param window_size: Number of READ_CHUNK requests that may be 
+            in-flight at once.  Replies are reassembled out-of-order and only 
+            the chunks that time out are re-requested.  (0 disables windowing) 
+            @param reactor: Reactor to drive windowed reads with, so that many
+            sensors can share one event loop (See read_async).  (Default: a
+            private reactor)
         """
         # Sensor info
         self.sensor_ip = sensor_ip
@@ -59,17 +106,31 @@ class MemorySensorPhysical(MemorySensor):
         
         # Are we reading a separate process?
         self.use_threading = use_threading
-        self.read_queue = None
+        self.packet_ring = None
+        
+        # Sliding window of outstanding read requests
+        self.window_size = window_size
+        if self.window_size > 0 and self.use_threading:
+            logger.warning("Windowed reads use the socket directly, "
+                           "disabling use_threading.")
+            self.use_threading = False
         self.packet_reader = None
         
+        # Windowed reads are event driven
+        self.reactor = reactor
+        self._transport = None
+        
         # Cache
-        self.cache = {}
-        self.cache_timeouts = {}
         self.CACHE_TIMEOUT = cache_timeout # seconds
+        self.CACHE_MAX_BYTES = cache_size
         
         # Keep track of our transaction
         self.transaction_no = 1
         
+        # Every reply is received into this buffer before being copied out
+        self._rx_buffer = bytearray(G.MAX_PACKET_SIZE)
+        self._rx_view = memoryview(self._rx_buffer)
+        
         if name is not None:
             self.name = name
             
@@ -111,8 +172,8 @@ class MemorySensorPhysical(MemorySensor):
                 if self.use_threading:
                     logger.debug("Starting listener thread.")
                     # Start a process that will handle all of our reads
-                    self.read_queue = multiprocessing.Queue()
-                    self.packet_reader = PacketReaderUDP(s,self.read_queue)
+                    self.packet_ring = PacketRing()
+                    self.packet_reader = PacketReaderRing(s,self.packet_ring)
                     self.packet_reader.start()
                 elif self.TIMEOUT is not None and self.TIMEOUT > 0 :
                     s.settimeout(self.TIMEOUT)
@@ -139,31 +200,33 @@ class MemorySensorPhysical(MemorySensor):
         """
             Disconnect our socket.
         """
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+            
         if self._sock is not None:
             self._sock.close()
             self._sock = None
             
-        if self.read_queue is not None:
-            self.read_queue.close()
-            self.read_queue = None
-            
         if self.packet_reader is not None:
-            self.packet_reader.terminate()
+            self.packet_reader.stop()
             self.packet_reader = None
+            
+        if self.packet_ring is not None:
+            self.packet_ring.close()
+            self.packet_ring = None
     
     
-    def _send_command(self,command,address,length, data=None):
+    def _build_command(self,command,address,length, data=None):
         """
-            Send a command to to the card
+            Build a command for the card, using the next transaction number
             
             @param command: LO-PHI command to send
             @param address: Address on the SUT (Not address on the FPGA)
             @param length: Length for the command (Not the length of the packet)
             @param data: Any data to append to the packet 
+            @return: (transaction number, raw packet)
         """
-        
-        logger.debug("Sending command (0x%x, 0x%x, %d)"%(command,address,length))
-   
         # Build our payload
         packet = MemoryRapidPacket()
         
@@ -188,20 +251,45 @@ class MemorySensorPhysical(MemorySensor):
         packet.transaction_no = self.transaction_no
         
         # Increment our transcation number
-        self.transaction_no = (self.transaction_no+1)%0x0000ffff
+        self.transaction_no = (self.transaction_no+1)%TRANSACTION_MASK
+        
+        return (packet.transaction_no, `packet`)
+    
+    
+    def _send_command(self,command,address,length, data=None):
+        """
+            Send a command to to the card
+            
+            @param command: LO-PHI command to send
+            @param address: Address on the SUT (Not address on the FPGA)
+            @param length: Length for the command (Not the length of the packet)
+            @param data: Any data to append to the packet 
+        """
+        
+        logger.debug("Sending command (0x%x, 0x%x, %d)"%(command,address,length))
+        
+        (transaction_no, packet) = self._build_command(command, address, 
+                                                       length, data)
                 
         # Keep trying to reconnect
         while not self._connect():
             time.sleep(1)
         
         # Send payload to our sensor
-        sent = self._sock.send(`packet`)
+        sent = self._sock.send(packet)
         if sent != len(packet):
             logger.error("Only sent {0} out of {1}".format(sent, len(packet)))
             dead = True
             
     
     
+    def _ring_timeout(self):
+        """ How long to wait on our packet ring (None waits forever) """
+        if self.TIMEOUT is None or self.TIMEOUT <= 0:
+            return None
+        return self.TIMEOUT
+    
+    
     def _read_raw_packet(self,size=G.MAX_PACKET_SIZE):
         """ 
             Read and return raw data from our socket
@@ -218,8 +306,11 @@ class MemorySensorPhysical(MemorySensor):
             time.sleep(1)
             
         # Read UDP data off the wire
-        if self.read_queue is not None:
-            recv_data, recv_addr = self.read_queue.get()
+        if self.packet_ring is not None:
+            packet = self.packet_ring.get(self._ring_timeout())
+            if packet is None:
+                raise socket.timeout
+            recv_data, recv_addr = packet
         else:
             recv_data, recv_addr = self._sock.recvfrom(size)
             
@@ -227,22 +318,72 @@ class MemorySensorPhysical(MemorySensor):
         logger.debug("Read %d bytes."%len(recv_data))
         return recv_data, recv_addr
     
+    
+    def _read_raw_packet_into(self,buf):
+        """ 
+            Read raw data from our socket directly into a writable buffer
+            
+            @param buf: bytearray (or memoryview) to receive the packet into
+            @return: Number of bytes received 
+        """
+        
+        # If we already timed out, assume the sensor is dead
+        if self.TIMED_OUT:
+            raise socket.timeout
         
-    def _get_read_response(self,length,read_multiple=False):
+        # Keep trying to reconnect
+        while not self._connect():
+            time.sleep(1)
+            
+        # Read UDP data off the wire
+        if self.packet_ring is not None:
+            packet = self.packet_ring.get_into(buf, self._ring_timeout())
+            if packet is None:
+                raise socket.timeout
+            nbytes, recv_addr = packet
+        else:
+            nbytes, recv_addr = self._sock.recvfrom_into(buf)
+
+        logger.debug("Read %d bytes."%nbytes)
+        return nbytes
+    
+    
+    def _get_rapid_packet_into(self):
+        """
+            Read the next memory sensor packet into our receive buffer.
+            
+            @return: (RAPID header, memoryview of the packet's data) 
         """
+        nbytes = self._read_raw_packet_into(self._rx_buffer)
+        
+        rapid_packet = MemoryRapidPacket(
+                                str(self._rx_buffer[:RAPID_HEADER_SIZE]))
+        
+        return rapid_packet, self._rx_view[RAPID_HEADER_SIZE:nbytes]
         
+        
+    def _get_read_response_into(self,view,read_multiple=False):
+        """
+            Read the replies to our outstanding read requests directly into a 
+            buffer.
+            
+            @param view: memoryview to fill with the data that was read
+            @param read_multiple: Replies start at transaction 0 instead of the
+            last transaction that was sent
+            @return: True on success, None on error 
         """
-        data = ""
+        length = len(view)
+        received = 0
         if read_multiple:
             transaction_no = 0
         else:
-            transaction_no = (self.transaction_no -1)%0x0000ffff
+            transaction_no = (self.transaction_no -1)%TRANSACTION_MASK
             
         
-        while(len(data) < length):
+        while(received < length):
             
             # Read a LO-PHI packet
-            rapid_packet = self.get_rapid_packet()
+            rapid_packet, data = self._get_rapid_packet_into()
             
             if rapid_packet.MAGIC_LOPHI != G.SENSOR_MEMORY.MAGIC_LOPHI:
                 logger.error("Magic number mismatch. (%x)"%(rapid_packet.MAGIC_LOPHI))
@@ -260,165 +401,318 @@ class MemorySensorPhysical(MemorySensor):
                 logger.error(rapid_packet)
                 continue
             
-            if(rapid_packet.data is None or len(rapid_packet.data) != rapid_packet.length):
+            if(len(data) != rapid_packet.length):
                 logger.error("DATA LENGTHS DON'T MATCH! (Expected: %d, Got: %d bytes)"%(rapid_packet.length,
-                                                                                        len(rapid_packet.data)))
+                                                                                        len(data)))
             
-            # Append our data
-            data += rapid_packet.data
+            # Copy our data into place, truncating anything past what we wanted
+            nbytes = min(len(data), length - received)
+            view[received:received+nbytes] = data[:nbytes]
+            received += nbytes
             
             # look for next transaction
-            transaction_no = (transaction_no+1)%0x0000ffff
+            transaction_no = (transaction_no+1)%TRANSACTION_MASK
 
-        # Just in case we read more than we wanted, truncate off the end bytes
-        return (data[:length])
+        return True
         
-        return None
+        
+    def _get_transport(self):
+        """
+            Return the event-driven transport used for windowed reads, 
+            connecting if needed
+        """
+        if self._transport is None:
+            # Keep trying to reconnect
+            while not self._connect():
+                time.sleep(1)
+                
+            if self.reactor is None:
+                self.reactor = Reactor()
+                
+            self._transport = DatagramTransport(self.reactor,
+                                                self._sock,
+                                                rapid_reply_key,
+                                                window_size=self.window_size)
+        return self._transport
+    
+    
+    def _request_read(self,address,view):
+        """
+            Start an asynchronous read of at most READ_CHUNK bytes
+            
+            @param address: Word-aligned physical address to read
+            @param view: Word-aligned memoryview to fill with memory
+            @return: Request, whose result is True once view is filled
+        """
+        transport = self._get_transport()
+        req_len = len(view)
+        
+        def build():
+            # Never reuse a transaction number that is still in-flight
+            in_flight = set(key[0] for key in transport.in_flight)
+            while self.transaction_no in in_flight:
+                self.transaction_no = (self.transaction_no+1)%TRANSACTION_MASK
+            (transaction_no, data) = self._build_command(
+                                                G.SENSOR_MEMORY.COMMAND.READ,
+                                                address,
+                                                req_len)
+            return ((transaction_no, address, req_len), data)
+            
+        def on_reply(datagram):
+            data = datagram[RAPID_HEADER_SIZE:]
+            if len(data) < req_len:
+                logger.error("DATA LENGTHS DON'T MATCH! (Expected: %d, Got: %d bytes)"%(
+                                            req_len,
+                                            len(data)))
+                return None
+            view[:] = data[:req_len]
+            return True
+        
+        timeout = self.TIMEOUT
+        if timeout is not None and timeout <= 0:
+            timeout = None
+            
+        return transport.request(None, None,
+                                 policy=RetryPolicy(timeout, self.RETRIES),
+                                 on_reply=on_reply,
+                                 build=build)
         
         
-    def _read_from_sensor(self,address,length):
+    def read_async(self,address,length):
         """
-            This is the lowest level read command and the only read command that
-             will acctually perform a memory read from the sensor.
+            Start reading memory without waiting for it
+            
+            Every READ_CHUNK of the read is a separate request, up to 
+            window_size of them are in-flight at once, and they're all driven 
+            by our reactor.  Sharing one reactor between many sensors lets a 
+            single thread read from all of them at once, e.g.
+            
+                reactor = Reactor()
+                sensors = [MemorySensorPhysical(ip, window_size=16, 
+                                                reactor=reactor) 
+                           for ip in ips]
+                reads = [s.read_async(addr, length) for s in sensors]
+                reactor.run_until_complete(reads)
+            
+            NOTE: This reads the sensor directly, skipping our cache and bad 
+            memory regions.
             
             @param address: Physical memory address to read
-            @param length: Length of memory to read starting at @address 
+            @param length: Number of bytes to read
+            @return: Request whose result is the RAW data (raises 
+            socket.timeout if the sensor stops responding) 
+        """
+        # Our sensor only reads whole words
+        adjust_addr = address%4
+        adjust_len = (4-(length+adjust_addr)%4)%4
+        
+        aligned = bytearray(adjust_addr + length + adjust_len)
+        view = memoryview(aligned)
+        
+        requests = []
+        for offset in xrange(0, len(aligned), READ_CHUNK):
+            requests.append(self._request_read(
+                                    address - adjust_addr + offset,
+                                    view[offset:offset+READ_CHUNK]))
             
-            @TODO: Remove our horrible hack once the hardware is up-to-date
+        rtn = Request()
+        def reads_done(combined):
+            if combined.exception is not None:
+                rtn.set_exception(combined.exception)
+            else:
+                rtn.set_result(str(aligned[adjust_addr:adjust_addr+length]))
+        gather(requests).add_done_callback(reads_done)
+        
+        return rtn
+        
+        
+    def _read_windowed(self,address,view):
         """
-        with network_lock:
-            # This is a HACK to work around a bug in the PCI sensor that has trouble
-            # when not reading on word boundaries?
-            adjust_addr = 0
+            Read memory keeping up to window_size requests in-flight at once.
             
-            # Is our start address word aligned?
-            if address%4 != 0:
-                adjust_addr = address%4
-                address -= adjust_addr
-                length += adjust_addr
-                
-            # Only read in words.
-            adjust_len = 0
-            if length%4 != 0:
-                adjust_len = 4-length%4
-                length += adjust_len
-            
-            self.transaction_no = 0
-            rtn_data = ""
-            
-            remaining_length = length
-            offset = 0
-            
-            if not self.use_threading:
-                while remaining_length > 0:
-                    # Calculate how much to read?
-                    req_len = min(READ_CHUNK,remaining_length)
-                    # Send our read command
-                    
-                    # Try to read RETRIES times
-                    attempt = 0
-                    while attempt < self.RETRIES:
-                        try:
-                            # Send read command
-                            self._send_command(G.SENSOR_MEMORY.COMMAND.READ, 
-                                               address+offset, 
-                                               req_len)
-                            # get data off the wire
-                            tmp = self._get_read_response(req_len)
-                            
-                            # Something bad happen in the read, let's try to re-open the socket
-                            if tmp is None:
-                                logger.error("Didn't get a response from sensor. Trying again.")
-                                self._disconnect()
-                                self._connect()
-                                continue
-                            
-                            break
-                        
-                        except socket.timeout:
-                            logger.error("Memory sensor timeout (%d/%d)"%(attempt,
-                                         self.RETRIES))
-                            pass
-                        
-                        attempt += 1
-                        
-                    # if we hit our retries, the card has timed out.
-                    if attempt == self.RETRIES:
-                        logger.error("Memory sensor timed out! (0x%16X, %d)"%
-                                     (address+offset,
-                                     req_len))
-                        raise socket.timeout
-
-                    # If nothing came back, keep trying!
-                    if tmp is None:
-#                         continue
-                        rtn_data = None
-                        break
-                    
-                    rtn_data += tmp 
+            The region is split into READ_CHUNK requests, each tagged with its 
+            own transaction number.  Replies are matched on that number, 
+            address, and length (See rapid_reply_key) and copied straight into
+            their place in the output buffer, so they may arrive in any order.
+            Any request that goes unanswered for TIMEOUT seconds is re-sent on 
+            its own, rather than restarting the entire read.
+            
+            @param address: Word-aligned physical address to read
+            @param view: Word-aligned memoryview to fill with memory
+            @return: True on success 
+        """
+        length = len(view)
+        
+        requests = [self._request_read(address+offset, 
+                                       view[offset:offset+READ_CHUNK])
+                    for offset in xrange(0, length, READ_CHUNK)]
+        
+        self.reactor.run_until_complete(requests)
+        
+        for request in requests:
+            if request.exception is not None:
+                logger.error("Memory sensor timed out! (0x%16X, %d)"%
+                             (address, length))
+                raise request.exception
                     
-                    # Calculate how much more we have to read
-                    remaining_length -= req_len
-                    offset += req_len
+        return True
+        
+        
+    def _read_aligned_into(self,address,view):
+        """
+            Read word-aligned memory from the sensor into a buffer.
             
-            else:
+            @param address: Word-aligned physical address to read
+            @param view: Word-aligned memoryview to fill with memory
+            @return: True on success, None on error 
+        """
+        # Windowed reads may share transaction numbers with other reads
+        if self.window_size > 0:
+            return self._read_windowed(address, view)
+        
+        self.transaction_no = 0
+        
+        length = len(view)
+        remaining_length = length
+        offset = 0
+        
+        if not self.use_threading:
+            while remaining_length > 0:
+                # Calculate how much to read?
+                req_len = min(READ_CHUNK,remaining_length)
+                # Send our read command
+                
                 # Try to read RETRIES times
                 attempt = 0
                 while attempt < self.RETRIES:
                     try:
-                        
-                        # Send all of our read commands
-                        while remaining_length > 0:
-                            # Calculate how much to read?
-                            req_len = min(READ_CHUNK,remaining_length)
-                            # Send our read command
-                            self._send_command(G.SENSOR_MEMORY.COMMAND.READ, address+offset, req_len)
-                        
-                            # Calculate how much more we have to read
-                            remaining_length -= req_len
-                            offset += req_len
-                            
-                        # Read all of the data back at once.
-                        rtn_data = self._get_read_response(length, True)
+                        # Send read command
+                        self._send_command(G.SENSOR_MEMORY.COMMAND.READ, 
+                                           address+offset, 
+                                           req_len)
+                        # get data off the wire
+                        tmp = self._get_read_response_into(
+                                            view[offset:offset+req_len])
                         
                         # Something bad happen in the read, let's try to re-open the socket
-                        if rtn_data is None:
-                            logger.error("Didn't get a response from sensor. (%d/%d)"%(attempt,
-                                     self.RETRIES))
-                            time.sleep(1)
+                        if tmp is None:
+                            logger.error("Didn't get a response from sensor. Trying again.")
                             self._disconnect()
                             self._connect()
-                            remaining_length = length
-                        else:
-                            break
+                            continue
                         
+                        break
+                    
                     except socket.timeout:
                         logger.error("Memory sensor timeout (%d/%d)"%(attempt,
                                      self.RETRIES))
                         pass
                     
                     attempt += 1
-                        
+                    
+                # if we hit our retries, the card has timed out.
                 if attempt == self.RETRIES:
                     logger.error("Memory sensor timed out! (0x%16X, %d)"%
-                                 (address,
-                                 length))
+                                 (address+offset,
+                                 req_len))
                     raise socket.timeout
+
+                # If nothing came back, keep trying!
+                if tmp is None:
+                    return None
+                
+                # Calculate how much more we have to read
+                remaining_length -= req_len
+                offset += req_len
+        
+        else:
+            # Try to read RETRIES times
+            attempt = 0
+            while attempt < self.RETRIES:
+                try:
+                    
+                    # Send all of our read commands
+                    while remaining_length > 0:
+                        # Calculate how much to read?
+                        req_len = min(READ_CHUNK,remaining_length)
+                        # Send our read command
+                        self._send_command(G.SENSOR_MEMORY.COMMAND.READ, address+offset, req_len)
                     
+                        # Calculate how much more we have to read
+                        remaining_length -= req_len
+                        offset += req_len
+                        
+                    # Read all of the data back at once.
+                    rtn = self._get_read_response_into(view, True)
+                    
+                    # Something bad happen in the read, let's try to re-open the socket
+                    if rtn is None:
+                        logger.error("Didn't get a response from sensor. (%d/%d)"%(attempt,
+                                 self.RETRIES))
+                        time.sleep(1)
+                        self._disconnect()
+                        self._connect()
+                        remaining_length = length
+                        offset = 0
+                    else:
+                        break
+                    
+                except socket.timeout:
+                    logger.error("Memory sensor timeout (%d/%d)"%(attempt,
+                                 self.RETRIES))
+                    pass
                 
+                attempt += 1
+                    
+            if attempt == self.RETRIES:
+                logger.error("Memory sensor timed out! (0x%16X, %d)"%
+                             (address,
+                             length))
+                raise socket.timeout
+            
+        return True
         
-    
-            # return the read data
-            # HACK: start from our offset and truncate extra data appended to ensure
-            # that we were word-aligned
-            if rtn_data is None:
-                return rtn_data
+        
+    def _read_from_sensor_into(self,address,buf):
+        """
+            This is the lowest level read command and the only read command that
+             will acctually perform a memory read from the sensor.
+            
+            Replies are copied from the receive buffer straight into buf, 
+            without building any intermediate strings.
+            
+            @param address: Physical memory address to read
+            @param buf: Writable buffer (bytearray or memoryview) to fill with
+            len(buf) bytes of memory starting at @address
+            @return: Number of bytes read, or None on error
+            
+            @TODO: Remove our horrible hack once the hardware is up-to-date
+        """
+        view = memoryview(buf)
+        length = len(view)
+        
+        with network_lock:
+            # This is a HACK to work around a bug in the PCI sensor that has trouble
+            # when not reading on word boundaries?
+            adjust_addr = address%4
+            adjust_len = (4-(length+adjust_addr)%4)%4
+            
+            # Aligned reads go straight into the caller's buffer, otherwise we
+            # read the word-aligned region and copy out the bytes we wanted.
+            if adjust_addr == 0 and adjust_len == 0:
+                rtn = self._read_aligned_into(address, view)
             else:
-                return rtn_data[adjust_addr:length-adjust_len]
+                aligned = bytearray(adjust_addr + length + adjust_len)
+                rtn = self._read_aligned_into(address - adjust_addr, 
+                                              memoryview(aligned))
+                if rtn is not None:
+                    view[:] = aligned[adjust_addr:adjust_addr+length]
+                
+        if rtn is None:
+            return None
+        
+        return length
         
-    
-    
-    
         
     def get_rapid_packet(self):
         """
@@ -456,6 +750,9 @@ class MemorySensorPhysical(MemorySensor):
                       ('length','!I')
                       ]
         
+        # Anything we have cached for this region is now stale
+        self.cache.invalidate(address, len(data))
+        
         write_packet = MemoryWritePacket()
         write_packet.address = address
         write_packet.data = data
@@ -4,16 +4,29 @@
     (c) 2015 Massachusetts Institute of Technology
 """
 # Native
+import sys
 import socket
+import mmap
 import os
 import logging
 
 # LO-PHI
 from lophi.sensors.memory import MemorySensor
+from lophi.sensors.memory.cache import DEFAULT_MAX_BYTES
 from lophi.data import KvmMemRequest
 
 logger = logging.getLogger(__name__)
 
+# Where a QEMU memory-backend-file usually keeps guest RAM (%s is the VM name)
+RAM_BACKING_PATHS = ["/dev/shm/%s",
+                     "/dev/hugepages/%s",
+                     "/dev/hugepages/libvirt/qemu/%s"]
+
+# On a QEMU pc machine RAM is split around the PCI hole, the first 
+# lowmem_size bytes are at 0 and the rest starts at 4GB
+DEFAULT_LOWMEM_SIZE = 0xe0000000
+HIGHMEM_START = 0x100000000
+
 class MemorySensorVirtual(MemorySensor):
     """"
         Our virtual memory sensor is just an interface to virsh and a UNIX 
@@ -25,8 +38,25 @@ class MemorySensorVirtual(MemorySensor):
         READ = 1
         WRITE = 2
 
-    def __init__(self, vm_name, cache_timeout=0):
-        """ Initialize our class """
+    def __init__(self, vm_name, cache_timeout=0,
+                 cache_size=DEFAULT_MAX_BYTES,
+                 ram_path=None,
+                 lowmem_size=DEFAULT_LOWMEM_SIZE):
+        """
+            Initialize our class
+
+            If the guest's RAM is backed by a file (e.g. a memory-backend-file
+            in /dev/shm or on hugetlbfs) we map it read-only and serve reads
+            straight from it, otherwise everything goes through the 
+            pmemaccess socket.
+
+            @param vm_name: Name of the virtual machine
+            @param cache_timeout: How long to keep data in the cache (seconds)
+            @param cache_size: Maximum number of bytes to keep in the cache
+            @param ram_path: File backing the guest's RAM (Default: search 
+            RAM_BACKING_PATHS)
+            @param lowmem_size: Amount of RAM that the guest maps below 4GB
+        """
         self.vmi = None
 
         # Ensure that we are root
@@ -38,21 +68,142 @@ class MemorySensorVirtual(MemorySensor):
         self.name = vm_name + "-MemorySensor"
 
         # Caching
-        self.cache = {}
-        self.cache_timeouts = {}
         self.CACHE_TIMEOUT = cache_timeout  # seconds
+        self.CACHE_MAX_BYTES = cache_size
 
         # Bad Memory regions
         self.BAD_MEM_REGIONS = [(0x0, 4096)]
 
         self.SOCK = None
+        self.SOCK_NAME = "vmi-" + vm_name
         self.RETRIES = 3
+        self.connections = 0
+
+        # Maximum number of read requests in flight on our socket at once
+        self.PIPELINE_DEPTH = 256
+
+        # Guest RAM backing file
+        self.ram_path = ram_path
+        self.lowmem_size = lowmem_size
+        self.RAM = None
+        # List of (guest start, guest end, file offset)
+        self.RAM_REGIONS = []
 
         MemorySensor.__init__(self)
 
+        self._map_ram()
+
     def __del__(self):
         """ Try to cleanup nicely """
         self._disconnect()
+        self._unmap_ram()
+
+    def _map_ram(self):
+        """
+            Try to map the file backing our guest's RAM
+            
+            NOTE: Reads from the mapping are always current, so caching is 
+            disabled once we are mapped
+            
+            @return: True/False
+        """
+        if self.RAM is not None:
+            return True
+
+        if self.ram_path is not None:
+            paths = [self.ram_path]
+        else:
+            paths = [path % self.vm_name for path in RAM_BACKING_PATHS]
+
+        for path in paths:
+            if not os.path.isfile(path):
+                continue
+            try:
+                f = open(path, "rb")
+                size = os.fstat(f.fileno()).st_size
+                if size > 0:
+                    self.RAM = mmap.mmap(f.fileno(), size, 
+                                         access=mmap.ACCESS_READ)
+                f.close()
+            except EnvironmentError:
+                logger.warn("Could not map guest RAM. (%s)" % path)
+                continue
+
+            if self.RAM is None:
+                continue
+
+            # Lay the file out in guest physical memory
+            low = min(size, self.lowmem_size)
+            self.RAM_REGIONS = [(0, low, 0)]
+            if size > low:
+                self.RAM_REGIONS.append((HIGHMEM_START,
+                                         HIGHMEM_START + size - low,
+                                         low))
+
+            # Our cache was built before we were mapped, turn it off and 
+            # drop anything that it read through the socket
+            self.CACHE_TIMEOUT = 0
+            self.cache.timeout = 0
+            self.cache.clear()
+
+            logger.info("Mapped guest RAM. (%s, %d bytes)" % (path, size))
+            return True
+
+        return False
+
+    def _unmap_ram(self):
+        """ Unmap our guest's RAM """
+        if self.RAM is not None:
+            self.RAM.close()
+            self.RAM = None
+            self.RAM_REGIONS = []
+
+    def _ram_offset(self, address, length):
+        """
+            Find a region of guest physical memory in our RAM mapping
+            
+            @param address: Starting physical memory address
+            @param length: Length of the region
+            @return: Offset into our mapping, or None if the region isn't
+            entirely backed by it
+        """
+        for (start, end, offset) in self.RAM_REGIONS:
+            if start <= address and address + length <= end:
+                return offset + (address - start)
+        return None
+
+    def read_view(self, address, length):
+        """
+            Return guest memory from our RAM mapping without copying it
+            
+            @param address: Starting physical memory address
+            @param length: Length of memory to read
+            @return: Read-only buffer, or None if the region isn't mapped
+        """
+        if self.RAM is None or self._in_bad_region(address, length):
+            return None
+
+        offset = self._ram_offset(address, length)
+        if offset is None:
+            return None
+
+        return buffer(self.RAM, offset, length)
+
+    def read(self, address, length):
+        """
+            Read memory from our guest, straight from our RAM mapping if we can
+            
+            @param address: Starting physical memory address
+            @param length: Length of memory to read
+            @return: RAW data string from memory 
+        """
+        if self.RAM is not None and length > 0 and \
+                not self._in_bad_region(address, length):
+            offset = self._ram_offset(address, length)
+            if offset is not None:
+                return self.RAM[offset:offset + length]
+
+        return MemorySensor.read(self, address, length)
 
     def _exec_qmp(self, cmd):
         """
@@ -76,10 +227,12 @@ class MemorySensorVirtual(MemorySensor):
         if self.SOCK is not None:
             return True
 
+        # The guest may not have been running when we were created
+        self._map_ram()
+
         logger.info("Connecting to KVM instance. (%s)" % self.vm_name)
 
-        tmp_name = "vmi-" + self.vm_name
-        tmp_path = os.path.join("/tmp", tmp_name)
+        tmp_path = os.path.join("/tmp", self.SOCK_NAME)
 
         cmd = '{"execute": "pmemaccess", "arguments": {"path": "%s"}}' % tmp_path
 
@@ -110,17 +263,39 @@ class MemorySensorVirtual(MemorySensor):
             self.SOCK.close()
             self.SOCK = None
 
-    def _read_from_sensor(self, address, read_len):
+    def new_connection(self):
         """
-            Read physical memory
+            Open another pmemaccess socket to our guest
+            
+            @return: New MemorySensorVirtual with its own socket
+        """
+        self.connections += 1
+        
+        sensor = MemorySensorVirtual(self.vm_name,
+                                     ram_path=self.ram_path,
+                                     lowmem_size=self.lowmem_size)
+        sensor.SOCK_NAME = "%s-%d" % (self.SOCK_NAME, self.connections)
+        return sensor
+
+    def _read_from_sensor_into(self, address, buf):
+        """
+            Read physical memory directly into a writable buffer
             
             @param address: Address to start reading from
-            @param read_len: How much memory to read
+            @param buf: bytearray or memoryview to fill with len(buf) bytes
+            @return: Number of bytes read, or None on error
             
             @TODO: Fix KVM bug that doesn't allow reading the first page of memory!
         """
-        # BUGFIX: Some bizarre stuff was happenin the volatility NativeType
-        read_len = int(read_len)
+        view = memoryview(buf)
+        read_len = len(view)
+
+        # Can we copy it straight from our RAM mapping?
+        if self.RAM is not None:
+            offset = self._ram_offset(address, read_len)
+            if offset is not None:
+                view[:] = buffer(self.RAM, offset, read_len)
+                return read_len
 
         logger.debug(
             "Sending memory read request to hypervisor. (0x%016X, %d)" % (
@@ -137,31 +312,49 @@ class MemorySensorVirtual(MemorySensor):
         req.length = read_len
 
         # Try RETRIES time to read from the guest system
-        read = ""
+        received = 0
+        status = ""
         for retry in range(3):
             if not self._connect():
                 logger.error("No VM connected.")
                 return None
-            read = ""
+            received = 0
+            status = ""
             try:
                 self.SOCK.settimeout(1)
 
                 # Send our request
                 self.SOCK.send(repr(req))
 
-                # Get our response
-                while len(read) < read_len+1:
+                # Get our response, straight into the caller's buffer
+                while received < read_len:
                     logger.debug("Reading %d bytes... (%d read)" % (read_len,
-                                                                    len(read)))
+                                                                    received))
 
-                    read += self.SOCK.recv(read_len + 1 - len(read))
+                    nbytes = self.SOCK.recv_into(view[received:])
+                    if nbytes == 0:
+                        raise socket.error("Socket closed by hypervisor.")
 
                     # Optimization if all of the bits are 1
-                    if len(read) == 1 and read == "\xff":
-                        read = ("\xff" * read_len) + "\x01"
-
-                    self.SOCK.settimeout(None)
+                    if received == 0 and nbytes == 1 and view[0] == "\xff":
+                        view[:] = "\xff" * read_len
+                        received = read_len
+                        status = "\x01"
+                        break
+
+                    received += nbytes
+
+                # The final byte is our status
+                if status == "":
+                    status = self.SOCK.recv(1)
+                break
             except:
+                # pmemaccess answers a failed read with only a single byte, 
+                # which leaves our socket in step for the next request
+                if received == 1 and \
+                        isinstance(sys.exc_info()[1], socket.timeout):
+                    break
+
                 logger.error("Failed to read from sensor. [0x%016X, %d] "
                              "(Attempt %d/%d)" % (
                                  address,
@@ -172,24 +365,20 @@ class MemorySensorVirtual(MemorySensor):
                 traceback.print_exc()
                 self._disconnect()
 
-        logger.debug("Read %d bytes" % len(read))
+        logger.debug("Read %d bytes" % received)
 
         # Did we get all of our data?
-        if len(read) != read_len + 1:
+        if received != read_len or len(status) != 1:
             logger.error(
                 "Could not read memory from sensor. (Addr: %016X, Len: %d, %s)" % (
                     address,
                     read_len,
                     self.vm_name))
-            logger.error("Got %d bytes, expected %d" % (len(read), read_len))
+            logger.error("Got %d bytes, expected %d" % (received, read_len))
             return None
 
-        # extract portions of our resposne
-        status = read[-1]
-        data = read[:-1]
-
         # What is our status as reported by the hypervisor?
-        if status == 0:
+        if status == "\x00":
             logger.error(
                 "Error in memory read, reported by guest. (Addr: %016X, Len: %d, %s)" % (
                     address,
@@ -197,7 +386,159 @@ class MemorySensorVirtual(MemorySensor):
                     self.vm_name))
             return None
 
-        return data
+        return read_len
+
+    def _recv_into(self, view):
+        """
+            Fill a buffer from our socket
+            
+            @param view: memoryview to fill with len(view) bytes
+        """
+        received = 0
+        while received < len(view):
+            nbytes = self.SOCK.recv_into(view[received:])
+            if nbytes == 0:
+                raise socket.error("Socket closed by hypervisor.")
+            received += nbytes
+
+    def _read_many_from_sensor_into(self, requests):
+        """
+            Read many regions of physical memory, from our RAM mapping where
+            we can and otherwise by pipelining them over our socket
+            
+            @param requests: List of (address, buf) where buf is a bytearray or
+            memoryview to fill with len(buf) bytes
+            @return: List with the number of bytes read into each buffer, or 
+            None for any read that failed
+        """
+        rtn = [None] * len(requests)
+
+        # Copy anything that we can straight from our RAM mapping
+        if self.RAM is not None:
+            unmapped = []
+            for (idx, (address, buf)) in enumerate(requests):
+                nbytes = len(buf)
+                offset = self._ram_offset(address, nbytes)
+                if offset is None:
+                    unmapped.append(idx)
+                    continue
+                memoryview(buf)[:] = buffer(self.RAM, offset, nbytes)
+                rtn[idx] = nbytes
+
+            if len(unmapped) == 0:
+                return rtn
+
+            # Read the rest from the hypervisor
+            nbytes = self._read_many_from_socket_into([requests[idx] 
+                                                       for idx in unmapped])
+            for (idx, n) in zip(unmapped, nbytes):
+                rtn[idx] = n
+            return rtn
+
+        return self._read_many_from_socket_into(requests)
+
+    def _read_many_from_socket_into(self, requests):
+        """
+            Read many regions of physical memory over the pmemaccess socket,
+            pipelining the requests
+            
+            Up to PIPELINE_DEPTH requests are sent before we read any replies.
+            pmemaccess answers a successful read with the requested bytes 
+            followed by a status byte, but answers a failed read with only a
+            single byte, so one failed read leaves every reply after it out of
+            step.  That can't be told apart from data while the replies are
+            streaming in, it only shows up as the batch coming up short (or a
+            bad status byte).  When it does, the whole batch is thrown away 
+            and we fall back to one request per round trip for the rest of 
+            the reads.
+            
+            @param requests: List of (address, buf)
+            @return: List with the number of bytes read into each buffer, or 
+            None for any read that failed
+        """
+        rtn = [None] * len(requests)
+
+        pipeline = True
+        for start in xrange(0, len(requests), self.PIPELINE_DEPTH):
+            batch = requests[start:start + self.PIPELINE_DEPTH]
+
+            if pipeline:
+                nbytes = self._read_pipelined_into(batch)
+                if nbytes is not None:
+                    rtn[start:start + len(batch)] = nbytes
+                    continue
+
+                logger.debug("Pipelined memory read failed, reading one "
+                             "request at a time.")
+                pipeline = False
+
+            for (idx, (address, buf)) in enumerate(batch):
+                rtn[start + idx] = self._read_from_sensor_into(address, buf)
+
+        return rtn
+
+    def _read_pipelined_into(self, batch):
+        """
+            Send a batch of read requests at once, and receive every reply 
+            straight into its buffer
+            
+            @param batch: List of (address, buf)
+            @return: List with the number of bytes read into each buffer, 
+            [None, ...] if we couldn't talk to the hypervisor, or None if any 
+            of the reads failed (The replies can't be trusted)
+        """
+        views = [memoryview(buf) for (address, buf) in batch]
+
+        status = bytearray(1)
+        status_view = memoryview(status)
+
+        # Construct all of our requests
+        packed = []
+        for ((address, buf), view) in zip(batch, views):
+            req = KvmMemRequest()
+            req.type = self.CMD_TYPE.READ
+            req.address = address
+            req.length = len(view)
+            packed.append(repr(req))
+        packed = "".join(packed)
+
+        logger.debug("Sending %d memory read requests to hypervisor." % 
+                     len(batch))
+
+        # Try RETRIES time to read from the guest system
+        for retry in range(self.RETRIES):
+            if not self._connect():
+                logger.error("No VM connected.")
+                return [None] * len(batch)
+            try:
+                self.SOCK.settimeout(1)
+
+                # Send all of our requests
+                self.SOCK.sendall(packed)
+
+                # Get our responses, straight into the caller's buffers
+                for view in views:
+                    self._recv_into(view)
+                    self._recv_into(status_view)
+
+                    # Anything but success means that we are out of step
+                    if status[0] != 1:
+                        self._disconnect()
+                        return None
+
+                return [len(view) for view in views]
+            except socket.timeout:
+                # Failed reads made the replies come up short
+                self._disconnect()
+                return None
+            except:
+                logger.error("Failed to read from sensor. [%d requests] "
+                             "(Attempt %d/%d)" % (len(batch),
+                                                  retry,
+                                                  self.RETRIES))
+                self._disconnect()
+
+        return [None] * len(batch)
 
     def write(self, address, data):
         """
@@ -214,6 +555,9 @@ class MemorySensorVirtual(MemorySensor):
 
         logger.debug("Sending memory write request to hypervisor.")
 
+        # Anything we have cached for this region is now stale
+        self.cache.invalidate(address, len(data))
+
         # Construct our request
         req = KvmMemRequest()
         req.type = self.CMD_TYPE.WRITE